@@ -0,0 +1,135 @@
+import json
+import math
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+
+
+class Benchmark:
+    """A named timing case.  Runs warmup rounds that are discarded, then repeat timed rounds.
+
+    Each round calls func once and divides the elapsed time by ops, the number of operations one call performs, so
+    results are reported per operation.  func may instead return a list of its own per-operation samples (e.g.,
+    handoff latencies measured inside a round), which are then used in place of the round timing.
+    """
+
+    def __init__(self, name, func, ops=1, warmup=3, repeat=20, setup=None, teardown=None, params=None):
+        """Construct a benchmark.
+            Args:
+                name (str): Unique name of the case, used to compare results between runs
+                func (callable): Performs ops operations.  May return a list of per-operation times in seconds.
+                ops (int): Number of operations one call of func performs
+                warmup (int): Untimed calls made before measuring
+                repeat (int): Timed calls
+                setup (callable): Called before every round, untimed
+                teardown (callable): Called once after the last round
+                params (dict): Parameters of the case recorded with its results (e.g., number of cavities)
+        """
+        self.name = name  #: str: unique name of the case
+        self.func = func  #: callable: the code being timed
+        self.ops = ops  #: int: operations per call of func
+        self.warmup = warmup  #: int: untimed calls made first
+        self.repeat = repeat  #: int: timed calls
+        self.setup = setup  #: callable: called untimed before every round
+        self.teardown = teardown  #: callable: called once after the last round
+        self.params = params or {}  #: dict: parameters recorded with the results
+
+    def run(self):
+        """Returns (dict): The case's name, params and per-operation timing summary (see summarize)"""
+        try:
+            for _ in range(self.warmup):
+                if self.setup is not None:
+                    self.setup()
+                self.func()
+
+            samples = []
+            for _ in range(self.repeat):
+                if self.setup is not None:
+                    self.setup()
+                start = time.perf_counter()
+                out = self.func()
+                elapsed = time.perf_counter() - start
+                if isinstance(out, list):
+                    samples.extend(out)
+                else:
+                    samples.append(elapsed / self.ops)
+        finally:
+            if self.teardown is not None:
+                self.teardown()
+
+        result = {"name": self.name, "params": self.params, "ops": self.ops, "warmup": self.warmup,
+                  "repeat": self.repeat}
+        result.update(summarize(samples))
+        return result
+
+
+def summarize(samples):
+    """Summary statistics of timing samples.
+        Args:
+            samples (list(float)): Times in seconds
+        Returns (dict): n, min, median, mean, stdev, p95 and max in seconds, and ops_per_sec from the median
+    """
+    ordered = sorted(samples)
+    n = len(ordered)
+    median = statistics.median(ordered)
+    return {
+        "n": n,
+        "min": ordered[0],
+        "median": median,
+        "mean": statistics.mean(ordered),
+        "stdev": statistics.stdev(ordered) if n > 1 else 0.0,
+        "p95": ordered[min(n - 1, int(math.ceil(0.95 * n)) - 1)],
+        "max": ordered[-1],
+        "ops_per_sec": 1.0 / median if median > 0 else math.inf,
+    }
+
+
+def environment():
+    """Returns (dict): Details of the machine and commit the benchmarks ran on"""
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                         stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "commit": commit,
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "cpu_count": os.cpu_count(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+    }
+
+
+def write_results(path, results):
+    """Write benchmark results and the environment they were measured in as JSON.
+        Args:
+            path (str): The file to write
+            results (list(dict)): Results of Benchmark.run
+        Returns (None): Returns nothing
+    """
+    with open(path, "w") as f:
+        json.dump({"environment": environment(), "results": results}, f, indent=2)
+
+
+def compare(baseline_path, results, threshold=0.1):
+    """Compare results to an earlier run, matching cases by name.
+        Args:
+            baseline_path (str): JSON file written by write_results
+            results (list(dict)): Results of Benchmark.run
+            threshold (float): Relative slowdown of the median that counts as a regression
+        Returns (list(tuple)): (name, baseline median, current median, ratio, regressed) for each case in both runs
+    """
+    with open(baseline_path) as f:
+        baseline = {r["name"]: r for r in json.load(f)["results"]}
+    out = []
+    for r in results:
+        b = baseline.get(r["name"])
+        if b is None:
+            continue
+        ratio = r["median"] / b["median"] if b["median"] > 0 else math.inf
+        out.append((r["name"], b["median"], r["median"], ratio, ratio > 1 + threshold))
+    return out
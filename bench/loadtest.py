@@ -0,0 +1,112 @@
+"""End-to-end load test of the full qlCalc pipeline against a simulated FCC IOC.
+
+For each machine size, qlCalc.main.main runs with every thread it normally starts, but with its PVs served by a
+SimulatedIOC.  After a warmup, the IOC measures the achieved request (cycle) rate, the time between successive requests
+of a cavity, and the time from data being posted to its result being published.  A size is reported as saturated when
+the achieved rate falls below the offered rate (cavities / ideal cycle time) by more than the tolerance.
+
+    python -m bench.loadtest --cavities 100 1000 5000 --duration 30 --output loadtest.json
+"""
+import argparse
+import json
+import logging
+import sys
+import threading
+import time
+
+from bench.harness import environment
+
+logger = logging.getLogger(__name__)
+
+
+def run_load(n, duration=30.0, warmup=5.0, latency=0.1, jitter=0.02, drop_rate=0.0, seed=None):
+    """Run the pipeline against n simulated cavities and measure it.
+        Args:
+            n (int): Number of simulated cavities
+            duration (float): Seconds measured after the warmup
+            warmup (float): Seconds run before measuring, covering startup and the initial triggers
+            latency (float): Mean IOC response latency in seconds
+            jitter (float): Standard deviation of the IOC response latency in seconds
+            drop_rate (float): Fraction of data requests the IOC never answers
+            seed (int): Seed of the simulation's random generator
+        Returns (dict): The IOC's stats (see SimulatedIOC.get_stats) plus the run's parameters and offered rate
+    """
+    import qlCalc.main
+    from qlCalc.metadata import CavityMetadata
+    from qlCalc.simioc import SimulatedIOC
+
+    names = ["SIM-{}".format(i) for i in range(n)]
+    metadata = {name: CavityMetadata(name, "S{:05d}".format(i), "c100", 0.7, 868.9) for i, name in enumerate(names)}
+    ioc = SimulatedIOC(prefix="adamc:", result_prefix=qlCalc.main.results_prefix, latency=latency, jitter=jitter,
+                       drop_rate=drop_rate, seed=seed)
+    ioc.start()
+
+    event = qlCalc.main.shutdown_event
+    event.clear()
+    reset = threading.Timer(warmup, ioc.get_stats, kwargs={"reset": True})
+    stats = {}
+
+    def measure():
+        stats.update(ioc.get_stats())
+        event.set()
+
+    stop = threading.Timer(warmup + duration, measure)
+    reset.start()
+    stop.start()
+    # Every run starts fresh rather than from the schedule of the previous one
+    saved_checkpoint = qlCalc.main.checkpoint_file
+    qlCalc.main.checkpoint_file = None
+    try:
+        qlCalc.main.main(cav_names=tuple(names), pv_factory=ioc.pv_factory, metadata=metadata)
+    finally:
+        qlCalc.main.checkpoint_file = saved_checkpoint
+        reset.cancel()
+        stop.cancel()
+        event.clear()
+        ioc.stop()
+
+    # Each cavity asks for data again one request_interval after its last request, or when the answer arrives
+    ideal_cycle = max(1.0, latency)
+    stats.update({"cavities": n, "duration": duration, "warmup": warmup, "latency": latency, "jitter": jitter,
+                  "drop_rate": drop_rate, "offered_rate": n / ideal_cycle})
+    return stats
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load test qlCalc against a simulated FCC IOC")
+    parser.add_argument("--cavities", type=int, nargs="+", default=[100, 1000, 5000])
+    parser.add_argument("--duration", type=float, default=30.0)
+    parser.add_argument("--warmup", type=float, default=5.0)
+    parser.add_argument("--latency", type=float, default=0.1)
+    parser.add_argument("--jitter", type=float, default=0.02)
+    parser.add_argument("--drop-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--tolerance", type=float, default=0.1,
+                        help="Relative shortfall of the cycle rate that counts as saturated")
+    parser.add_argument("--output", default="loadtest_results.json")
+    parser.add_argument("--log-level", default="WARNING")
+    args = parser.parse_args(argv)
+
+    # Configured logging stops qlCalc.main from setting up its own file logging
+    logging.basicConfig(level=args.log_level)
+
+    results = []
+    for n in args.cavities:
+        stats = run_load(n, args.duration, args.warmup, args.latency, args.jitter, args.drop_rate, args.seed)
+        stats["saturated"] = stats["cycle_rate"] < (1 - args.tolerance) * stats["offered_rate"]
+        results.append(stats)
+        cycle = stats["cycle_time"]
+        proc = stats["processing_latency"]
+        print("{:>6} cavities: {:9.1f} req/s of {:9.1f} offered{}  cycle p50 {:.3f} p99 {:.3f} s  "
+              "processing p50 {:.4f} p90 {:.4f} p99 {:.4f} max {:.4f} s".format(
+                  n, stats["cycle_rate"], stats["offered_rate"], "  SATURATED" if stats["saturated"] else "",
+                  cycle["p50"], cycle["p99"], proc["p50"], proc["p90"], proc["p99"], proc["max"]))
+        time.sleep(1)
+
+    with open(args.output, "w") as f:
+        json.dump({"environment": environment(), "results": results}, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
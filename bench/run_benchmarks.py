@@ -0,0 +1,296 @@
+"""Benchmarks of the calculation, input, queue handoff and request scheduling hot paths.
+
+Every case runs warmup rounds first and reports per-operation statistics over repeat rounds.  Results are written as
+JSON so runs on different commits can be compared, e.g.,
+
+    python -m bench.run_benchmarks --output before.json
+    (change something)
+    python -m bench.run_benchmarks --output after.json --compare before.json
+
+EPICS is replaced by in-memory PVs, so the numbers measure this application's own overhead.  Logging is set to
+WARNING (see --log-level) so that debug logging does not dominate the timings.
+"""
+import argparse
+import logging
+import queue
+import sys
+import threading
+import time
+
+import numpy as np
+
+from bench.harness import Benchmark, compare, write_results
+
+logger = logging.getLogger(__name__)
+
+# Number of cavities used by the scheduler cases.  400 is roughly the whole machine.
+DEFAULT_SIZES = (10, 400, 5000)
+
+
+class FakePV:
+    """In-memory stand-in for an epics.PV.  Puts update the value and notify an optional counter."""
+
+    def __init__(self, pvname, value=0, counter=None):
+        self.pvname = pvname
+        self.value = value
+        self.connected = True
+        self.counter = counter
+        self.callbacks = {}
+
+    def get(self, **kw):
+        return self.value
+
+    def put(self, value, wait=False, **kw):
+        self.value = value
+        if self.counter is not None:
+            self.counter.increment()
+
+    def add_callback(self, callback, **kw):
+        index = len(self.callbacks) + 1
+        self.callbacks[index] = callback
+        return index
+
+    def remove_callback(self, index):
+        self.callbacks.pop(index, None)
+
+    def disconnect(self):
+        self.connected = False
+
+
+class PutCounter:
+    """Counts puts across many FakePVs and lets a thread wait for a total"""
+
+    def __init__(self):
+        self.count = 0
+        self._cond = threading.Condition()
+
+    def increment(self):
+        with self._cond:
+            self.count += 1
+            self._cond.notify_all()
+
+    def wait_for(self, total, timeout=60):
+        with self._cond:
+            if not self._cond.wait_for(lambda: self.count >= total, timeout):
+                raise RuntimeError("Only {} of {} puts arrived".format(self.count, total))
+
+
+# Input PV values of a typical C100 cavity, in PV units
+INPUT_VALUES = {"GMESLQ": 17.794, "CRFPLQ": 3.396, "CRRPLQ": 0.805, "DETALQ": 0.67, "ITOTLQ": 201.8}
+
+
+def make_cavity(name, input_mode=None, counter=None, update_queue=None):
+    """Build a Cryocavity wired to FakePVs holding INPUT_VALUES"""
+    from qlCalc.cryocavity import Cryocavity
+    from qlCalc.acquisition import INPUT_MODE_GET, INPUT_PVS
+
+    pvs = {suffix: FakePV(name + suffix, INPUT_VALUES.get(suffix, 0), counter if suffix == "GETDATA" else None)
+           for suffix in Cryocavity.PV_SUFFIXES}
+    cav = Cryocavity(cavity_name=name, cavity_type="c100", length=0.7, RQ=868.9, update_queue=update_queue,
+                     request_interval=1, shutdown_event=threading.Event(),
+                     input_mode=input_mode or INPUT_MODE_GET, **pvs)
+    cav.epics_name = name
+    if cav.snapshot is not None:
+        # One data collection window that brackets all of the inputs
+        now = time.time()
+        cav.snapshot.update("STARTLQ", now, now)
+        for suffix in INPUT_PVS:
+            cav.snapshot.update(suffix, INPUT_VALUES[suffix], now)
+        cav.snapshot.update("ENDLQ", now, now)
+    cav.update_formula_data()
+    return cav
+
+
+def calculation_benchmarks(warmup, repeat):
+    from qlCalc import batch
+    from qlCalc.uncertainty import monte_carlo
+
+    cav = make_cavity("bench")
+    n = 408
+
+    def scalar_chain():
+        for _ in range(n):
+            cav.run_calculations()
+
+    rng = np.random.RandomState(11)
+    inputs = (rng.uniform(15, 19, n) * 0.7e6, rng.uniform(3e3, 4e3, n), rng.uniform(500, 1000, n),
+              np.radians(rng.uniform(-5, 5, n)), rng.uniform(100e-6, 200e-6, n), 868.9)
+    sigma = tuple(0.02 * np.abs(x) for x in inputs[:5])
+    draws = 2000
+
+    return [
+        Benchmark("calc_chain_scalar", scalar_chain, ops=n, warmup=warmup, repeat=repeat, params={"cavities": n}),
+        Benchmark("calc_chain_batch_exact", lambda: batch.calculate(*inputs, exact=True), ops=n, warmup=warmup,
+                  repeat=repeat, params={"cavities": n}),
+        Benchmark("calc_chain_batch_fast", lambda: batch.calculate(*inputs, exact=False), ops=n, warmup=warmup,
+                  repeat=repeat, params={"cavities": n}),
+        Benchmark("uncertainty_monte_carlo", lambda: monte_carlo(*inputs, sigma=sigma, draws=draws, rng=rng),
+                  ops=n, warmup=warmup, repeat=repeat, params={"cavities": n, "draws": draws}),
+    ]
+
+
+def input_benchmarks(warmup, repeat):
+    from qlCalc.acquisition import INPUT_MODE_MONITOR
+
+    n = 1000
+    get_cav = make_cavity("get")
+    monitor_cav = make_cavity("monitor", input_mode=INPUT_MODE_MONITOR)
+
+    def update(cav):
+        def func():
+            for _ in range(n):
+                cav.update_formula_data()
+        return func
+
+    return [
+        Benchmark("update_formula_data_get", update(get_cav), ops=n, warmup=warmup, repeat=repeat),
+        Benchmark("update_formula_data_monitor", update(monitor_cav), ops=n, warmup=warmup, repeat=repeat),
+    ]
+
+
+def handoff_benchmarks(warmup, repeat):
+    """Latency from a GETDATA=2 callback, through update_queue and a ProcessingPool worker, to the task reaching
+    req_queue"""
+    from qlCalc.publisher import ResultPublisher
+    from qlCalc.workers import ProcessingPool
+
+    stop = threading.Event()
+    update_queue = queue.Queue()
+    req_queue = queue.Queue()
+    cav = make_cavity("handoff", update_queue=update_queue)
+    cav.last_request_timestamp = time.time()
+    cav.GETDATA.value = 2
+    cav.publisher = ResultPublisher(stop, pv_factory=FakePV)
+    cav.publisher.register(cav)
+    cav.results_out = "epics"
+    pool = ProcessingPool({cav.cavity_name: cav}, update_queue, req_queue, stop, poll_interval=0.05)
+    pool.start()
+    n = 200
+
+    def round_trip():
+        latencies = []
+        for _ in range(n):
+            start = time.perf_counter()
+            cav.on_GETDATA_change(pvname=cav.GETDATA.pvname, value=2)
+            req_queue.get()
+            latencies.append(time.perf_counter() - start)
+        return latencies
+
+    def teardown():
+        stop.set()
+        pool.join()
+
+    return [Benchmark("getdata_handoff_latency", round_trip, ops=n, warmup=warmup, repeat=repeat, teardown=teardown)]
+
+
+def scheduler_benchmarks(sizes, warmup, repeat):
+    import qlCalc.main
+    from qlCalc.cryocavity import CavityTask
+    from qlCalc.scheduler import RequestScheduler
+
+    benchmarks = []
+    for n in sizes:
+        counter = PutCounter()
+        cav_dict = {}
+        for i in range(n):
+            cav = make_cavity("C{}".format(i), counter=counter)
+            cav_dict[cav.cavity_name] = cav
+        names = list(cav_dict)
+        tasks = queue.Queue()
+
+        def fill(tasks=tasks, names=names):
+            # Already overdue, so no case waits for a time slot to end
+            due = time.time() - 1
+            for name in names:
+                tasks.put(CavityTask(name, due))
+
+        def drain(tasks=tasks, n=n):
+            # The scheduler's own work: read every notification into the schedule, then release them
+            scheduler = RequestScheduler(slot_width=qlCalc.main.request_slot_width)
+            for _ in range(n):
+                qlCalc.main.get_cavity_notification(tasks, scheduler, 0)
+            while len(scheduler) != 0:
+                scheduler.pop_due(scheduler.next_release_time())
+
+        benchmarks.append(Benchmark("scheduler_drain[{}]".format(n), drain, ops=n, warmup=warmup, repeat=repeat,
+                                    setup=fill, params={"cavities": n}))
+
+        # End to end through the request_new_data thread, from notifications queued to all GETDATA puts made
+        stop = threading.Event()
+        req_queue = queue.Queue()
+        scheduler = RequestScheduler(slot_width=qlCalc.main.request_slot_width)
+        thread = threading.Thread(target=qlCalc.main.request_new_data, args=(cav_dict, req_queue, stop, scheduler))
+        thread.start()
+
+        def request_all(req_queue=req_queue, names=names, counter=counter):
+            target = counter.count + len(names)
+            due = time.time() - 1
+            for name in names:
+                req_queue.put(CavityTask(name, due))
+            counter.wait_for(target)
+
+        def stop_thread(stop=stop, req_queue=req_queue, thread=thread, names=names):
+            stop.set()
+            req_queue.put(CavityTask(names[0], time.time()))
+            thread.join()
+
+        benchmarks.append(Benchmark("request_new_data[{}]".format(n), request_all, ops=n, warmup=warmup, repeat=repeat,
+                                    teardown=stop_thread, params={"cavities": n}))
+    return benchmarks
+
+
+def build_benchmarks(sizes=DEFAULT_SIZES, warmup=3, repeat=20):
+    """Returns (list(Benchmark)): Every benchmark case"""
+    return (calculation_benchmarks(warmup, repeat) + input_benchmarks(warmup, repeat) +
+            handoff_benchmarks(warmup, repeat) + scheduler_benchmarks(sizes, warmup, repeat))
+
+
+def run_benchmarks(benchmarks, name_filter=None):
+    """Run benchmarks whose name contains name_filter (all if None), always running teardowns.
+        Returns (list(dict)): Results of Benchmark.run
+    """
+    results = []
+    for b in benchmarks:
+        if name_filter is None or name_filter in b.name:
+            logger.info("Running %s %s", b.name, b.params)
+            results.append(b.run())
+        elif b.teardown is not None:
+            b.teardown()
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the qlCalc hot paths")
+    parser.add_argument("--output", default="benchmark_results.json", help="JSON file to write the results to")
+    parser.add_argument("--compare", help="JSON results of an earlier run to compare against")
+    parser.add_argument("--threshold", type=float, default=0.1, help="Relative slowdown reported as a regression")
+    parser.add_argument("--warmup", type=int, default=3)
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--sizes", type=int, nargs="+", default=list(DEFAULT_SIZES),
+                        help="Cavity counts for the scheduler cases")
+    parser.add_argument("--filter", help="Only run cases whose name contains this")
+    parser.add_argument("--log-level", default="WARNING")
+    args = parser.parse_args(argv)
+
+    # Configured logging stops qlCalc.main from setting up its own file logging
+    logging.basicConfig(level=args.log_level)
+
+    results = run_benchmarks(build_benchmarks(args.sizes, args.warmup, args.repeat), args.filter)
+    for r in results:
+        params = " ".join("{}={}".format(k, v) for k, v in sorted(r["params"].items()))
+        print("{:<32} {:<16} median {:10.3f} us  p95 {:10.3f} us  {:12.0f} ops/s".format(
+            r["name"], params, r["median"] * 1e6, r["p95"] * 1e6, r["ops_per_sec"]))
+    write_results(args.output, results)
+
+    regressed = False
+    if args.compare:
+        print("\nCompared to {}:".format(args.compare))
+        for name, before, after, ratio, slower in compare(args.compare, results, args.threshold):
+            regressed = regressed or slower
+            print("{:<32} {:10.3f} -> {:10.3f} us  x{:.2f}{}".format(name, before * 1e6, after * 1e6, ratio,
+                                                                   "  REGRESSION" if slower else ""))
+    return 1 if regressed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,122 @@
+import logging
+import threading
+import epics
+
+logger = logging.getLogger(__name__)
+
+# How a Cryocavity reads its synchronized *LQ inputs
+INPUT_MODE_GET = "get"  #: One blocking PV.get() per input, the original behavior
+INPUT_MODE_MONITOR = "monitor"  #: Read the latest monitor updates cached in an InputSnapshot, no network I/O
+INPUT_MODE_CAGET_MANY = "caget_many"  #: One batched caget_many round for all inputs
+INPUT_MODES = (INPUT_MODE_GET, INPUT_MODE_MONITOR, INPUT_MODE_CAGET_MANY)
+
+# The synchronized formula inputs followed by the PVs that bracket the synchronized data collection.  Order matters -
+# it is the slot order of InputSnapshot.
+INPUT_PVS = ("GMESLQ", "CRFPLQ", "CRRPLQ", "DETALQ", "ITOTLQ")
+SYNC_PVS = ("STARTLQ", "ENDLQ")
+SNAPSHOT_PVS = INPUT_PVS + SYNC_PVS
+
+
+class InputSnapshot:
+    """The latest value and CA timestamp of each synchronized PV of a single cavity, kept current by monitors.
+
+    Monitor callbacks write into fixed slots (see SNAPSHOT_PVS) from the CA callback thread, and processing threads
+    read a consistent copy of all slots under a lock.  Reading never touches the network.
+    """
+    __slots__ = ("values", "timestamps", "_lock", "_pvs")
+
+    def __init__(self):
+        self.values = [None] * len(SNAPSHOT_PVS)  #: list: latest value of each PV in SNAPSHOT_PVS order
+        self.timestamps = [None] * len(SNAPSHOT_PVS)  #: list(float): CA timestamp of each latest value
+        self._lock = threading.Lock()
+        self._pvs = []
+
+    def subscribe(self, pvs):
+        """Add monitor callbacks that keep this snapshot current.
+            Args:
+                pvs (list(PV)): The PVs to watch in SNAPSHOT_PVS order
+            Returns (None): Returns nothing
+        """
+        for slot, pv in enumerate(pvs):
+            index = pv.add_callback(self._make_callback(slot))
+            self._pvs.append((pv, index))
+
+    def unsubscribe(self):
+        """Remove the callbacks added by subscribe"""
+        for pv, index in self._pvs:
+            pv.remove_callback(index)
+        self._pvs = []
+
+    def _make_callback(self, slot):
+        def on_change(value=None, timestamp=None, **kw):
+            with self._lock:
+                self.values[slot] = value
+                self.timestamps[slot] = timestamp
+        return on_change
+
+    def update(self, name, value, timestamp):
+        """Set the slot of the named PV (one of SNAPSHOT_PVS) directly"""
+        slot = SNAPSHOT_PVS.index(name)
+        with self._lock:
+            self.values[slot] = value
+            self.timestamps[slot] = timestamp
+
+    def read(self):
+        """Copy the current contents of the snapshot.
+            Returns (tuple(list, list)): The values and timestamps in SNAPSHOT_PVS order
+        """
+        with self._lock:
+            return list(self.values), list(self.timestamps)
+
+    def is_bracketed(self, sample=None, tolerance=0.0):
+        """Check that the *LQ input updates all happened within the data collection window posted in STARTLQ and ENDLQ.
+
+        The window is the values of STARTLQ and ENDLQ, the start and end times of the synchronized data collection,
+        and each input's CA timestamp must fall inside it.  A sample that is not bracketed may mix values from two
+        different data collections, or may be missing an update that is still in flight.
+            Args:
+                sample (tuple(list, list)): Values and timestamps as returned by read().  None reads the current ones.
+                tolerance (float): Slack in seconds allowed on either side of the window
+            Returns (bool): True if STARTLQ <= every input timestamp <= ENDLQ (within tolerance)
+        """
+        values, timestamps = self.read() if sample is None else sample
+        start, end = self._window(values)
+        if start is None or end is None or start > end + tolerance:
+            return False
+        timestamps = timestamps[:len(INPUT_PVS)]
+        if any(ts is None for ts in timestamps):
+            return False
+        return all(start - tolerance <= ts <= end + tolerance for ts in timestamps)
+
+    def is_newer(self, requested, sample=None, tolerance=0.0):
+        """Check that the posted data collection started after a request, i.e., is not left over from an older one.
+            Args:
+                requested (float): Unix time stamp of the request
+                sample (tuple(list, list)): Values and timestamps as returned by read().  None reads the current ones.
+                tolerance (float): Slack in seconds allowed before the request
+            Returns (bool): True if the STARTLQ value is no earlier than requested (within tolerance)
+        """
+        values = self.read()[0] if sample is None else sample[0]
+        start = self._window(values)[0]
+        return start is not None and start >= requested - tolerance
+
+    @staticmethod
+    def _window(values):
+        """Returns (tuple): The STARTLQ and ENDLQ values as Unix time stamps.  None for any missing or not numeric."""
+        window = []
+        for name in ("STARTLQ", "ENDLQ"):
+            try:
+                window.append(float(values[SNAPSHOT_PVS.index(name)]))
+            except (TypeError, ValueError):
+                window.append(None)
+        return tuple(window)
+
+
+def caget_inputs(pvs, timeout=1.0):
+    """Read the synchronized *LQ inputs of one cavity with a single batched caget_many round.
+        Args:
+            pvs (list(PV)): The input PVs in INPUT_PVS order
+            timeout (float): Maximum time in seconds to wait for each get
+        Returns (list): Values in INPUT_PVS order.  None for any PV that is not connected or timed out.
+    """
+    return epics.caget_many([pv.pvname for pv in pvs], timeout=timeout)
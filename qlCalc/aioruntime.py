@@ -0,0 +1,425 @@
+import asyncio
+import concurrent.futures
+import functools
+import logging
+import math
+import signal
+import threading
+import time
+
+from qlCalc.cryocavity import Cryocavity
+
+logger = logging.getLogger(__name__)
+
+
+class _LoopQueue:
+    """Stands in for the update queue of cavities run by an AsyncRuntime.
+
+    GETDATA callbacks call put from the CA callback thread, as they would on a queue.Queue.  The task is handed to the
+    event loop with call_soon_threadsafe instead of being queued.
+    """
+
+    def __init__(self, runtime):
+        self.runtime = runtime
+
+    def put(self, task, block=True, timeout=None):
+        try:
+            self.runtime.loop.call_soon_threadsafe(self.runtime._on_data_ready, task)
+        except RuntimeError:
+            # The loop has closed during shutdown.  Nothing will process the data anyway.
+            logger.debug("Dropping data ready notification after shutdown - %s", task.cavity_name)
+
+    def qsize(self):
+        return len(self.runtime._pending)
+
+    def empty(self):
+        return self.qsize() == 0
+
+
+class AsyncRuntime:
+    """Runs the request/process cycle of every cavity on one asyncio event loop, as an alternative to the request
+    thread, processing pool and watchdog thread.
+
+    GETDATA=2 callbacks hand off to the loop with call_soon_threadsafe.  Each cavity's next request and the timeout of
+    its outstanding request are loop timers, so thousands of cavities cost timers rather than threads or queues.  Due
+    requests are coalesced into one batched put per time slot, as RequestScheduler does.  The blocking CA work
+    (reading inputs, exporting results, making requests) runs in a bounded thread pool with at most one task per
+    cavity in flight.
+
+    Cavities can be added and removed while the loop runs (see add_cavities and remove_cavity) without touching the
+    timers of the others.
+
+    Shutdown is structured: stop (callable from any thread or a signal handler) cancels every timer, lets in-flight
+    processing finish (up to shutdown_timeout) and shuts the executor down.  Work still running after
+    shutdown_timeout, e.g., stuck in a blocking CA call, cannot be interrupted.  run returns without waiting for it, so
+    that the caller can finish its own shutdown, but the executor threads are not daemons: concurrent.futures joins
+    them when the interpreter exits, so the process only exits once the call returns.  The runtime can only be run
+    once.
+    """
+
+    def __init__(self, event=None, num_workers=4, slot_width=0.05, request_timeout=5.0, backoff_factor=2.0,
+                 max_timeout=60.0, shutdown_timeout=10.0, rate_controller=None):
+        """Construct a runtime.  Nothing runs until run is called.
+            Args:
+                event (threading.Event): Set when the runtime stops, for the benefit of other threads.  Never polled.
+                num_workers (int): Threads in the executor doing blocking CA work
+                slot_width (float): Width in seconds of the time slots due requests are coalesced in
+                request_timeout (float): Seconds a request may stay outstanding before it is re-triggered
+                backoff_factor (float): Multiplier applied to the timeout for each consecutive timeout of a cavity
+                max_timeout (float): Upper bound in seconds on the backed off timeout
+                shutdown_timeout (float): Longest time in seconds to wait for in-flight work at shutdown
+                rate_controller (RateController): Limits the requests outstanding per IOC.  None for no limit.
+        """
+        if num_workers < 1:
+            raise ValueError("num_workers must be at least 1, got {}".format(num_workers))
+        self.event = event  #: threading.Event: set when the runtime stops
+        self.slot_width = slot_width  #: float: width in seconds of request time slots
+        self.request_timeout = request_timeout  #: float: base request timeout in seconds
+        self.backoff_factor = backoff_factor  #: float: timeout multiplier per consecutive timeout
+        self.max_timeout = max_timeout  #: float: upper bound on the backed off timeout in seconds
+        self.shutdown_timeout = shutdown_timeout  #: float: seconds to wait for in-flight work at shutdown
+        self.rate_controller = rate_controller  #: RateController: limits requests outstanding per IOC
+        self.cav_dict = {}  #: dict: cavity names to the Cryocavity objects being run
+        self.loop = asyncio.new_event_loop()  #: AbstractEventLoop: the loop everything is scheduled on
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=num_workers,
+                                                              thread_name_prefix="async-worker")  #: blocking CA work
+        self.update_queue = _LoopQueue(self)  #: Give to cavities (see add_cavity) in place of a queue.Queue
+
+        # Everything below is only touched from the loop thread
+        self._stopped = self.loop.create_future()
+        self._stopping = False
+        self._abandoned = False  # Work was still running when shutdown_timeout ran out
+        self._processing = {}  # Cavity name to future of its in-flight processing
+        self._pending = {}  # Cavity name to the latest task that arrived while it was being processed
+        self._request_timers = {}  # Cavity name to TimerHandle of its next request
+        self._timeout_timers = {}  # Cavity name to TimerHandle of its outstanding request's timeout
+        self._start_timers = []  # TimerHandles of initial triggers spread out by start_times
+        self._consecutive_timeouts = {}  # Cavity name to timeouts since its last completed request
+        self._background = set()  # Futures of requests and timeout handling still running
+        self._due = []  # Cavities whose request is due in the current slot
+        self._flush_scheduled = False
+
+        self._stats_start = time.time()
+        self._processed = 0
+        self._failed = 0
+        self._requests = 0
+        self._batches = 0
+        self._timeouts = 0
+
+    def add_cavity(self, cav):
+        """Run a cavity.  Redirects its update queue to the loop.  Must be called before run."""
+        self.cav_dict[cav.cavity_name] = cav
+        cav.update_queue = self.update_queue
+
+    def add_cavities(self, cavities, start_times=None):
+        """Start running more cavities, e.g., ones added while the runtime is running.  Safe to call from any thread.
+            Args:
+                cavities (list(Cryocavity)): The cavities.  Their update queues are redirected to the loop.
+                start_times (dict): Cavity name to the time.time() of its initial trigger.  None triggers them at once.
+            Returns (None): Returns nothing
+        """
+        for cav in cavities:
+            cav.update_queue = self.update_queue
+
+        def add():
+            if self._stopping:
+                return
+            for cav in cavities:
+                self.cav_dict[cav.cavity_name] = cav
+            if start_times is None:
+                self._trigger(list(cavities))
+            else:
+                self._stagger(start_times)
+        try:
+            self.loop.call_soon_threadsafe(add)
+        except RuntimeError:
+            logger.warning("Runtime has shut down - not adding %d cavities", len(cavities))
+
+    def remove_cavity(self, cavity_name, timeout=None):
+        """Stop running a cavity and wait for its in-flight processing, if any.  Its pending request and timeout are
+        cancelled, and data it posts later is ignored.  Call from any thread but the loop's.
+            Args:
+                cavity_name (str): The cavity
+                timeout (float): Longest time in seconds to wait.  None waits as long as it takes.
+            Returns (bool): True if the cavity is no longer run or processed
+        """
+        removed = concurrent.futures.Future()
+
+        def remove():
+            self.cav_dict.pop(cavity_name, None)
+            self._pending.pop(cavity_name, None)
+            self._consecutive_timeouts.pop(cavity_name, None)
+            for timers in (self._request_timers, self._timeout_timers):
+                handle = timers.pop(cavity_name, None)
+                if handle is not None:
+                    handle.cancel()
+            fut = self._processing.get(cavity_name)
+            if fut is None:
+                removed.set_result(None)
+            else:
+                fut.add_done_callback(lambda f: removed.set_result(None))
+        try:
+            self.loop.call_soon_threadsafe(remove)
+        except RuntimeError:
+            return True  # Already closed, so nothing runs any more
+        deadline = None if timeout is None else time.time() + timeout
+        while not removed.done() and not self.loop.is_closed():
+            # The loop may shut down without getting to remove, which is as good
+            wait = 0.1 if deadline is None else min(0.1, deadline - time.time())
+            if wait <= 0:
+                return False
+            concurrent.futures.wait([removed], timeout=wait)
+        return True
+
+    def stop(self):
+        """Ask the runtime to shut down.  Safe to call from any thread, a signal handler or the loop itself."""
+        if self.event is not None:
+            self.event.set()
+        try:
+            self.loop.call_soon_threadsafe(self._request_stop)
+        except RuntimeError:
+            pass  # Already closed
+
+    def _request_stop(self):
+        if not self._stopped.done():
+            self._stopped.set_result(None)
+
+    def run(self, trigger=True, stats_callback=None, stats_interval=60, install_signal_handlers=True,
+            start_times=None):
+        """Run the loop in the calling thread until stop is called.
+            Args:
+                trigger (bool): Force trigger data collection on every cavity first
+                stats_callback (callable): Called with the runtime every stats_interval seconds, e.g., to log stats
+                stats_interval (float): Seconds between stats_callback calls
+                install_signal_handlers (bool): Stop on SIGHUP, SIGINT, SIGQUIT and SIGTERM.  Only possible from the
+                  main thread.  This replaces any handlers already installed for them, so pass False to keep those,
+                  e.g., ones that set the runtime's event and are relayed to stop.
+                start_times (dict): Cavity name to the time.time() of its initial trigger, e.g., from
+                  scheduler.staggered_start_times.  None triggers every cavity at once.
+            Returns (None): Returns nothing
+        """
+        try:
+            if install_signal_handlers and threading.current_thread() is threading.main_thread():
+                for sig in (signal.SIGHUP, signal.SIGINT, signal.SIGQUIT, signal.SIGTERM):
+                    self.loop.add_signal_handler(sig, self.stop)
+            self.loop.run_until_complete(self._main(trigger, stats_callback, stats_interval, start_times))
+        finally:
+            self.executor.shutdown(wait=not self._abandoned)
+            self.loop.close()
+        logger.debug("async runtime has exited")
+
+    async def _main(self, trigger, stats_callback, stats_interval, start_times):
+        if trigger and start_times is None:
+            self._trigger(list(self.cav_dict.values()))
+        elif trigger:
+            self._stagger(start_times)
+        stats_timer = None
+        if stats_callback is not None:
+            def report():
+                nonlocal stats_timer
+                try:
+                    stats_callback(self)
+                except Exception:
+                    logger.exception("Error reporting runtime stats")
+                stats_timer = self.loop.call_later(stats_interval, report)
+            stats_timer = self.loop.call_later(stats_interval, report)
+
+        await self._stopped
+        if stats_timer is not None:
+            stats_timer.cancel()
+        await self._shutdown()
+
+    async def _shutdown(self):
+        self._stopping = True
+        for handle in self._start_timers:
+            handle.cancel()
+        for timers in (self._request_timers, self._timeout_timers):
+            for handle in timers.values():
+                handle.cancel()
+            timers.clear()
+        self._pending.clear()
+
+        in_flight = list(self._processing.values()) + list(self._background)
+        if in_flight:
+            done, not_done = await asyncio.wait(in_flight, timeout=self.shutdown_timeout)
+            if not_done:
+                logger.warning("%d tasks still running after %.1f s at shutdown, not waiting for them", len(not_done),
+                               self.shutdown_timeout)
+                self._abandoned = True
+
+    def _slot_end(self, timestamp):
+        if self.slot_width <= 0:
+            return timestamp
+        return math.ceil(timestamp / self.slot_width) * self.slot_width
+
+    def _submit(self, func, *args):
+        """Run blocking work in the executor, logging any exception and tracking it for shutdown"""
+        fut = self.loop.run_in_executor(self.executor, func, *args)
+        self._background.add(fut)
+        fut.add_done_callback(self._background_done)
+        return fut
+
+    def _background_done(self, fut):
+        self._background.discard(fut)
+        if not fut.cancelled() and fut.exception() is not None:
+            logger.error("Error in background CA work", exc_info=fut.exception())
+
+    def _trigger(self, cavities):
+        cavities = [cav for cav in cavities if cav.cavity_name in self.cav_dict]
+        if not cavities:
+            return
+        self._submit(Cryocavity.trigger_data_collection_batch, cavities)
+        for cav in cavities:
+            self._arm_timeout(cav.cavity_name)
+
+    def _stagger(self, start_times):
+        """Schedule the initial triggers, coalescing those of the same time slot into one batch"""
+        slots = {}
+        for name, timestamp in start_times.items():
+            cav = self.cav_dict.get(name)
+            if cav is not None:
+                slots.setdefault(self._slot_end(timestamp), []).append(cav)
+        now = time.time()
+        for slot, cavities in sorted(slots.items()):
+            self._start_timers.append(self.loop.call_later(max(0.0, slot - now), self._trigger, cavities))
+
+    def _on_data_ready(self, task):
+        """A cavity's data was posted.  Runs on the loop."""
+        name = task.cavity_name
+        if self._stopping or name not in self.cav_dict:
+            return
+        handle = self._timeout_timers.pop(name, None)
+        if handle is not None:
+            handle.cancel()
+        self._consecutive_timeouts[name] = 0
+        if name in self._processing:
+            self._pending[name] = task
+            return
+        self._start_processing(task)
+
+    def _start_processing(self, task):
+        cav = self.cav_dict[task.cavity_name]
+        if cav.metrics is not None:
+            cav.metrics.mark(cav.cavity_name, "dequeued")
+        fut = self.loop.run_in_executor(self.executor, cav.process_new_data)
+        self._processing[cav.cavity_name] = fut
+        fut.add_done_callback(functools.partial(self._processed_done, task))
+
+    def _processed_done(self, task, fut):
+        name = task.cavity_name
+        self._processing.pop(name, None)
+        if fut.cancelled():
+            return
+        self._processed += 1
+        if fut.exception() is not None:
+            # Keep the cavity's request cycle alive.  A bad sample should only cost one result.
+            self._failed += 1
+            logger.error("Error processing new data - %s", name, exc_info=fut.exception())
+        if self._stopping or name not in self.cav_dict:
+            return
+
+        delay = max(0.0, self._slot_end(task.request_timestamp) - time.time())
+        self._request_timers[name] = self.loop.call_later(delay, self._request_due, name)
+        cav = self.cav_dict[name]
+        if cav.metrics is not None:
+            cav.metrics.mark(name, "rescheduled")
+
+        task = self._pending.pop(name, None)
+        if task is not None:
+            self._start_processing(task)
+
+    def _request_due(self, name):
+        self._request_timers.pop(name, None)
+        cav = self.cav_dict.get(name)
+        if cav is None:
+            return
+        self._due.append(cav)
+        if not self._flush_scheduled:
+            # Timers of the same slot fire in the same loop iteration, before this runs
+            self._flush_scheduled = True
+            self.loop.call_soon(self._flush_requests)
+
+    def _flush_requests(self):
+        due = self._due
+        self._due = []
+        self._flush_scheduled = False
+        due = [cav for cav in due if cav.cavity_name in self.cav_dict]
+        if self._stopping or not due:
+            return
+        if self.rate_controller is not None:
+            due, deferred = self.rate_controller.admit(due)
+            for cav in deferred:
+                name = cav.cavity_name
+                self._request_timers[name] = self.loop.call_later(self.rate_controller.retry_delay,
+                                                                  self._request_due, name)
+            if not due:
+                return
+        self._requests += len(due)
+        self._batches += 1
+        self._submit(Cryocavity.request_new_data_batch, due)
+        for cav in due:
+            self._arm_timeout(cav.cavity_name)
+
+    def timeout_for(self, cavity_name):
+        """Returns (float): The time in seconds the cavity's next request may take, including any backoff"""
+        n = self._consecutive_timeouts.get(cavity_name, 0)
+        return min(self.request_timeout * self.backoff_factor ** n, self.max_timeout)
+
+    def _arm_timeout(self, name):
+        handle = self._timeout_timers.pop(name, None)
+        if handle is not None:
+            handle.cancel()
+        self._timeout_timers[name] = self.loop.call_later(self.timeout_for(name), self._timed_out, name)
+
+    def _timed_out(self, name):
+        self._timeout_timers.pop(name, None)
+        cav = self.cav_dict.get(name)
+        if cav is None or self._stopping:
+            return
+        self._timeouts += 1
+        self._consecutive_timeouts[name] = self._consecutive_timeouts.get(name, 0) + 1
+        logger.warning("Data request timed out (%d consecutive), re-triggering - %s",
+                       self._consecutive_timeouts[name], name)
+        self._submit(self._handle_timeout, cav)
+        self._arm_timeout(name)
+
+    @staticmethod
+    def _handle_timeout(cav):
+        # Runs in the executor
+        if cav.rate_controller is not None:
+            cav.request_interval = cav.rate_controller.timed_out(cav.cavity_name, cav.request_interval)
+        try:
+            cav.publish_invalid_results("Data request timed out")
+        except Exception:
+            logger.exception("Error publishing invalid results - %s", cav.cavity_name)
+        cav.trigger_data_collection()
+
+    def get_stats(self, reset=False):
+        """Report throughput since the runtime was created or the stats were last reset.
+            Args:
+                reset (bool): Start a new measurement interval after reading the stats
+            Returns (dict): Keys are processed, failed, requests, batches, timeouts, elapsed (s), throughput
+              (processed/s), in_flight, pending and timers (scheduled requests and timeouts)
+        """
+        now = time.time()
+        elapsed = now - self._stats_start
+        stats = {
+            "processed": self._processed,
+            "failed": self._failed,
+            "requests": self._requests,
+            "batches": self._batches,
+            "timeouts": self._timeouts,
+            "elapsed": elapsed,
+            "throughput": self._processed / elapsed if elapsed > 0 else 0.0,
+            "in_flight": len(self._processing),
+            "pending": len(self._pending),
+            "timers": len(self._request_timers) + len(self._timeout_timers),
+        }
+        if reset:
+            self._stats_start = now
+            self._processed = 0
+            self._failed = 0
+            self._requests = 0
+            self._batches = 0
+            self._timeouts = 0
+        return stats
@@ -0,0 +1,227 @@
+import math
+import time
+import logging
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Values of CavityBatch.attenuation_factor_flag.  Mirror the clamping done in Cryocavity.calculate_attenuation_factor.
+AF_OK = 0  #: int: attenuation factor was inside [0,1]
+AF_LOWERED = 1  #: int: attenuation factor was above 1 and lowered to 1
+AF_RAISED = -1  #: int: attenuation factor was below 0 and raised to 0
+
+# Names of the per-cavity result arrays produced by calculate(), in the order the scalar chain produces them
+RESULT_FIELDS = ("unclamped_attenuation_factor", "attenuation_factor", "attenuation_factor_flag", "attenuation", "P_fc",
+                 "P_rc", "Q_lf", "Q_lr")
+
+
+def _libm(func, nin):
+    """Wrap a scalar math function as a float64 ufunc that returns NaN where math would raise.
+
+    In exact mode the transcendental steps of the chain go through the same libm routines as the scalar Cryocavity
+    methods so that batch results are bit-for-bit identical to them.  NumPy's own log10/power/tan implementations can
+    differ by an ULP.  The price is a Python call per element, about 15x the cost of the native ufuncs.
+    """
+
+    def safe(*args):
+        try:
+            return func(*args)
+        except (ValueError, OverflowError):
+            return math.nan
+
+    ufunc = np.frompyfunc(safe, nin, 1)
+
+    def apply(*args):
+        return np.asarray(ufunc(*args), dtype=np.float64)
+
+    return apply
+
+
+_pow = _libm(math.pow, 2)
+_log10 = _libm(math.log10, 1)
+_tan = _libm(math.tan, 1)
+
+
+def calculate(V_c, P_f, P_r, detune_angle, I_tot, RQ, exact=True):
+    """Run the full loaded Q calculation chain over arrays of cavity inputs in a single vectorized pass.
+
+    Inputs are in base SI units, exactly as Cryocavity holds them after update_formula_data.  Any of them may be a
+    scalar, which is broadcast across the other inputs.  Where the scalar path would raise (e.g., zero beam current or
+    a negative square root argument) the corresponding result is NaN or inf instead so that one bad cavity does not
+    spoil the whole pass.
+
+        Args:
+            V_c (array_like): cavity voltage in V
+            P_f (array_like): synchronized RF forward power in W
+            P_r (array_like): synchronized RF reflected power in W
+            detune_angle (array_like): synchronized detune angle in radians
+            I_tot (array_like): total beam current in A
+            RQ (array_like): characteristic shunt impedance in Ohms
+            exact (bool): Use the libm routines of the scalar path so results match it exactly.  This is the
+              default because batch and scalar results are published side by side, but it runs an np.frompyfunc loop
+              at about 15x the cost.  False uses NumPy's native ufuncs, which may differ from the scalar path in the
+              last bit, and suits bulk work such as replays and uncertainty draws.
+
+        Returns (dict): Maps each name in RESULT_FIELDS to a float64 array (int8 for attenuation_factor_flag)
+    """
+    if exact:
+        pow_, log10, tan = _pow, _log10, _tan
+    else:
+        pow_, log10, tan = np.power, np.log10, np.tan
+
+    V_c, P_f, P_r, detune_angle, I_tot, RQ = np.broadcast_arrays(
+        *(np.asarray(x, dtype=np.float64) for x in (V_c, P_f, P_r, detune_angle, I_tot, RQ)))
+
+    with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+        # Operations below are written in the same order as the scalar Cryocavity.calculate_* methods.  IEEE
+        # arithmetic and sqrt are correctly rounded in both, so the same order gives the same bits.
+        IV = I_tot * V_c
+        attenuation_factor = (IV + np.sqrt(pow_(IV, 2) + 4 * P_f * P_r)) / (2 * P_f)
+
+        # According to F. Marhauser, this can only be in [0,1].  Truncate if bounds are exceeded.
+        flag = np.zeros(attenuation_factor.shape, dtype=np.int8)
+        lowered = attenuation_factor > 1
+        raised = attenuation_factor < 0
+        flag[lowered] = AF_LOWERED
+        flag[raised] = AF_RAISED
+        clamped = np.where(lowered, 1.0, np.where(raised, 0.0, attenuation_factor))
+
+        attenuation = -10 * log10(clamped)
+        P_fc = P_f * pow_(10, -attenuation / 10)
+        P_rc = P_r * pow_(10, attenuation / 10)
+
+        tan2 = pow_(tan(detune_angle), 2)
+        IV2 = pow_(I_tot, 2) * pow_(V_c, 2)
+        denom = RQ * pow_(I_tot, 2)
+        Q_lf = (2 * P_fc - IV - 2 * P_fc * np.sqrt(1 - IV / P_fc - IV2 / (4 * pow_(P_fc, 2)) * tan2)) / denom
+        Q_lr = (2 * P_rc + IV - 2 * P_rc * np.sqrt(1 + IV / P_rc - IV2 / (4 * pow_(P_rc, 2)) * tan2)) / denom
+
+    return {
+        "unclamped_attenuation_factor": attenuation_factor,
+        "attenuation_factor": clamped,
+        "attenuation_factor_flag": flag,
+        "attenuation": attenuation,
+        "P_fc": P_fc,
+        "P_rc": P_rc,
+        "Q_lf": Q_lf,
+        "Q_lr": Q_lr,
+    }
+
+
+# noinspection PyPep8Naming
+class CavityBatch:
+    """Array-backed inputs and results for a fixed set of cavities, calculated all at once.
+
+    Each cavity owns one row.  Inputs are held in base SI units like the matching Cryocavity attributes.  Results are
+    the same quantities the scalar Cryocavity.run_calculations produces, with the attenuation factor already clamped
+    to [0,1] and attenuation_factor_flag recording which cavities were clamped (see AF_OK, AF_LOWERED, AF_RAISED).
+    """
+
+    def __init__(self, cavity_names, length, RQ):
+        """Construct a batch with room for the named cavities.  Inputs start out as NaN.
+            Args:
+                cavity_names (iterable(str)): CED names of the cavities, one row each in the given order
+                length (array_like): active length of each cryocavity in meters (scalar applies to all)
+                RQ (array_like): characteristic shunt impedance of each cryocavity in Ohms (scalar applies to all)
+        """
+        self.cavity_names = tuple(cavity_names)  #: tuple(str): CED names of the cavities in row order
+        self.index = {name: i for i, name in enumerate(self.cavity_names)}  #: dict: cavity name to row number
+        n = len(self.cavity_names)
+        self.length = np.broadcast_to(np.asarray(length, dtype=np.float64), (n,)).copy()  #: ndarray: lengths in m
+        self.RQ = np.broadcast_to(np.asarray(RQ, dtype=np.float64), (n,)).copy()  #: ndarray: R/Q in Ohms
+
+        self.V_c = np.full(n, np.nan)  #: ndarray: cavity voltage in V
+        self.P_f = np.full(n, np.nan)  #: ndarray: synchronized RF forward power in W
+        self.P_r = np.full(n, np.nan)  #: ndarray: synchronized RF reflected power in W
+        self.detune_angle = np.full(n, np.nan)  #: ndarray: synchronized detune angle in radians
+        self.I_tot = np.full(n, np.nan)  #: ndarray: total beam current in A
+
+        self.attenuation_factor = np.full(n, np.nan)  #: ndarray: clamped attenuation factor
+        self.attenuation_factor_flag = np.zeros(n, dtype=np.int8)  #: ndarray: AF_OK, AF_LOWERED or AF_RAISED
+        self.unclamped_attenuation_factor = np.full(n, np.nan)  #: ndarray: attenuation factor before clamping
+        self.attenuation = np.full(n, np.nan)  #: ndarray: attenuation
+        self.P_fc = np.full(n, np.nan)  #: ndarray: corrected forward power in W
+        self.P_rc = np.full(n, np.nan)  #: ndarray: corrected reflected power in W
+        self.Q_lf = np.full(n, np.nan)  #: ndarray: loaded Q based on forward power
+        self.Q_lr = np.full(n, np.nan)  #: ndarray: loaded Q based on reflected power
+        self.calc_timestamp = None  #: float: The Unix timestamp when the calculations were last run
+
+    @staticmethod
+    def from_cavities(cavities):
+        """Build a batch for a collection of Cryocavity objects, taking length and R/Q from each.
+            Args:
+                cavities (iterable(Cryocavity)): The cavities to include, one row each in iteration order
+            Returns (CavityBatch): The new batch.  Inputs are not loaded - see load_inputs.
+        """
+        cavities = list(cavities)
+        return CavityBatch([c.cavity_name for c in cavities], [c.length for c in cavities],
+                           [c.RQ for c in cavities])
+
+    def __len__(self):
+        return len(self.cavity_names)
+
+    def set_inputs(self, cavity_name, V_c, P_f, P_r, detune_angle, I_tot):
+        """Set one cavity's inputs.  Values are in base SI units, detune_angle in radians.
+            Returns (None): Returns nothing
+        """
+        i = self.index[cavity_name]
+        self.V_c[i] = V_c
+        self.P_f[i] = P_f
+        self.P_r[i] = P_r
+        self.detune_angle[i] = detune_angle
+        self.I_tot[i] = I_tot
+
+    def load_inputs(self, cavities):
+        """Copy the formula inputs of Cryocavity objects (as set by update_formula_data) into the batch.
+            Args:
+                cavities (iterable(Cryocavity)): Cavities belonging to this batch.  Others are ignored.
+            Returns (None): Returns nothing
+        """
+        for cav in cavities:
+            if cav.cavity_name in self.index:
+                self.set_inputs(cav.cavity_name, cav.V_c, cav.P_f, cav.P_r, cav.detune_angle, cav.I_tot)
+
+    def run_calculations(self, exact=True):
+        """Calculate attenuation factor through Q_lr for every cavity in one vectorized pass.
+            Args:
+                exact (bool): See calculate()
+            Returns (None): Updates the batch's result arrays
+        """
+        self.calc_timestamp = time.time()
+        results = calculate(self.V_c, self.P_f, self.P_r, self.detune_angle, self.I_tot, self.RQ, exact=exact)
+        for field in RESULT_FIELDS:
+            getattr(self, field)[:] = results[field]
+
+    def apply_results(self, cavities):
+        """Write the batch results back onto Cryocavity objects, as if each had run its own calculations.
+
+        Clamped attenuation factors are logged and recorded in the cavity's err_msg with the same text the scalar
+        path uses.
+            Args:
+                cavities (iterable(Cryocavity)): Cavities belonging to this batch.  Others are ignored.
+            Returns (None): Returns nothing
+        """
+        for cav in cavities:
+            i = self.index.get(cav.cavity_name)
+            if i is None:
+                continue
+            flag = self.attenuation_factor_flag[i]
+            raw = float(self.unclamped_attenuation_factor[i])
+            if flag == AF_LOWERED:
+                logger.warning("Attenuation factor lowered from %s to 1 - %s", raw, cav.cavity_name)
+                cav.err_msg.append("Attenuation factor lowered from {} to 1".format(raw))
+                cav.attenuation_factor = 1
+            elif flag == AF_RAISED:
+                logger.warning("Attenuation factor raised from %s to 0 - %s", raw, cav.cavity_name)
+                cav.err_msg.append("Attenuation factor raised from {} to 0".format(raw))
+                cav.attenuation_factor = 0
+            else:
+                cav.attenuation_factor = raw
+            cav.calc_timestamp = self.calc_timestamp
+            cav.attenuation = float(self.attenuation[i])
+            cav.P_fc = float(self.P_fc[i])
+            cav.P_rc = float(self.P_rc[i])
+            cav.Q_lf = float(self.Q_lf[i])
+            cav.Q_lr = float(self.Q_lr[i])
+            cav.data_sync_start = "now"
+            cav.data_sync_end = "a little later"
@@ -0,0 +1,124 @@
+import json
+import logging
+import os
+import tempfile
+import time
+
+logger = logging.getLogger(__name__)
+
+# Format of the checkpoint file.  Files of any other version are ignored.
+CHECKPOINT_VERSION = 1
+
+# Cryocavity result attributes kept in the checkpoint
+CHECKPOINT_RESULTS = ("attenuation_factor", "attenuation", "P_fc", "P_rc", "Q_lf", "Q_lr", "Q_fit", "attenuation_fit",
+                      "calc_timestamp")
+
+
+class Checkpoint:
+    """Saves each cavity's request schedule, timing and latest results to a local file, and restores them on restart.
+
+    The file is compact JSON, replaced atomically so that a crash while writing never leaves a partial checkpoint.  Per
+    cavity it holds the request interval and the time of the last request (which together give the phase of its
+    request schedule), the rate controller's moving average turnaround and the CHECKPOINT_RESULTS attributes.
+    """
+
+    def __init__(self, path, cav_dict, rate_controller=None):
+        """Construct a checkpoint.  Nothing is read or written until asked.
+            Args:
+                path (str): The checkpoint file
+                cav_dict (dict): Cavity name to Cryocavity whose state is saved and restored
+                rate_controller (RateController): Its per-cavity state is saved and restored too.  None if unused.
+        """
+        self.path = path  #: str: the checkpoint file
+        self.cav_dict = cav_dict  #: dict: cavity name to Cryocavity
+        self.rate_controller = rate_controller  #: RateController: adapts request intervals.  None if unused.
+
+    def snapshot(self):
+        """Returns (dict): The current state of every cavity, as written to the file"""
+        cavities = {}
+        for name, cav in list(self.cav_dict.items()):  # Cavities may be added or removed meanwhile
+            entry = {
+                "request_interval": cav.request_interval,
+                "last_request": cav.last_request_timestamp,
+                "results": {attr: getattr(cav, attr) for attr in CHECKPOINT_RESULTS},
+            }
+            if self.rate_controller is not None:
+                entry["turnaround"] = self.rate_controller.turnaround(name)
+            cavities[name] = entry
+        return {"version": CHECKPOINT_VERSION, "time": time.time(), "cavities": cavities}
+
+    def write(self):
+        """Write a snapshot, replacing the file atomically.
+            Returns (None): Returns nothing
+        """
+        directory = os.path.dirname(self.path) or "."
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=directory, prefix=".checkpoint")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(self.snapshot(), f, separators=(",", ":"))
+            os.replace(tmp, self.path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+    def read(self, max_age=None):
+        """Read the checkpoint file.  A missing, unreadable, stale or foreign file is logged and treated as empty.
+            Args:
+                max_age (float): Seconds after which a checkpoint is too old to use.  None for no limit.
+            Returns (dict): Cavity name to its saved state, for the cavities in cav_dict
+        """
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            logger.info("No checkpoint at %s - starting fresh", self.path)
+            return {}
+        except (OSError, ValueError) as exc:
+            logger.warning("Ignoring unreadable checkpoint %s: %s", self.path, exc)
+            return {}
+        if not isinstance(data, dict) or data.get("version") != CHECKPOINT_VERSION:
+            logger.warning("Ignoring checkpoint %s of unsupported version", self.path)
+            return {}
+        age = time.time() - data.get("time", 0)
+        if max_age is not None and age > max_age:
+            logger.info("Ignoring checkpoint %s written %.0f s ago (max age %.0f s)", self.path, age, max_age)
+            return {}
+        return {name: entry for name, entry in data.get("cavities", {}).items() if name in self.cav_dict}
+
+    def restore(self, max_age=None):
+        """Apply the saved state to the cavities (and rate controller) it belongs to.
+            Args:
+                max_age (float): See read
+            Returns (dict): Cavity name to saved state of the cavities restored.  Pass it to
+              scheduler.staggered_start_times to resume their request schedules.
+        """
+        saved = self.read(max_age)
+        for name, entry in saved.items():
+            cav = self.cav_dict[name]
+            interval = entry.get("request_interval")
+            if interval is not None and interval > 0:
+                cav.request_interval = interval
+            for attr, value in entry.get("results", {}).items():
+                if attr in CHECKPOINT_RESULTS:
+                    setattr(cav, attr, value)
+            if self.rate_controller is not None:
+                self.rate_controller.restore(name, cav.request_interval, entry.get("turnaround"))
+                cav.request_interval = self.rate_controller.interval(name, cav.request_interval)
+        if saved:
+            logger.info("Restored %d of %d cavities from checkpoint %s", len(saved), len(self.cav_dict), self.path)
+        return saved
+
+    def run(self, interval, event):
+        """Callable meant to be run in own thread.  Writes a checkpoint every interval seconds until the event is set,
+        and once more after."""
+        while not event.wait(interval):
+            try:
+                self.write()
+            except OSError:
+                logger.exception("Error writing checkpoint to %s", self.path)
+        try:
+            self.write()
+        except OSError:
+            logger.exception("Error writing checkpoint to %s", self.path)
+
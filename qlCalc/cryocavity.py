@@ -6,9 +6,15 @@ import atexit
 from epics import PV
 
 import qlCalc.utils
+from qlCalc.metadata import static_metadata
+from qlCalc.acquisition import InputSnapshot, caget_inputs, INPUT_MODES, INPUT_MODE_GET, INPUT_MODE_MONITOR, \
+    INPUT_MODE_CAGET_MANY, INPUT_PVS, SNAPSHOT_PVS
 
 logger = logging.getLogger(__name__)
 
+# Result attributes exported for a cycle whose inputs did not change.  The window statistics move on regardless.
+HEARTBEAT_ATTRS = ("heartbeat", "Q_lf_mean", "Q_lf_std", "Q_lr_mean", "Q_lr_std", "Q_fit", "attenuation_fit")
+
 
 class CavityTask:
     """A class representing a notification that a cavity needs it's data processed and a new data request sent."""
@@ -16,6 +22,61 @@ class CavityTask:
     def __init__(self, cavity_name, request_timestamp):
         self.request_timestamp = request_timestamp  #: time.time  The time at which the next request should be made
         self.cavity_name = cavity_name  #: str: The CED element name of the cavity
+        self.enqueue_timestamp = time.time()  #: time.time: The time at which the task was created and queued
+
+
+class ErrorRecord(list):
+    """The error messages of one calculation cycle, bounded so that a cavity that errs every cycle cannot grow it.
+
+    A message already recorded is not added again.  Once maxlen messages are held, further ones are only counted in a
+    trailing "N more errors" entry.  It is still a list, so it can be joined and compared like one.  Copy it with
+    copy(), which keeps the count, rather than list().
+    """
+
+    def __init__(self, maxlen=8):
+        super().__init__()
+        self.maxlen = maxlen  #: int: most messages kept
+        self.dropped = 0  #: int: messages counted but not kept
+
+    def messages(self):
+        """Returns (list(str)): The messages kept, without the trailing summary"""
+        return self[:-1] if self.dropped else self[:]
+
+    def append(self, message):
+        kept = len(self) - 1 if self.dropped else len(self)
+        if message in self[:kept]:
+            return
+        if kept < self.maxlen:
+            super().append(message)
+            return
+        self._count_dropped(1)
+
+    def extend(self, messages):
+        """Append each message.  Another ErrorRecord adds its own messages and its count of dropped ones."""
+        dropped = 0
+        if isinstance(messages, ErrorRecord):
+            dropped = messages.dropped
+            messages = messages.messages()
+        for message in messages:
+            self.append(message)
+        if dropped:
+            self._count_dropped(dropped)
+
+    def copy(self):
+        """Returns (ErrorRecord): A copy holding the same messages and count of dropped ones"""
+        other = ErrorRecord(self.maxlen)
+        other.extend(self)
+        return other
+
+    def clear(self):
+        super().clear()
+        self.dropped = 0
+
+    def _count_dropped(self, n):
+        if self.dropped:
+            super().pop()
+        self.dropped += n
+        super().append("{} more errors".format(self.dropped))
 
 
 # TODO: Add logging of error messages
@@ -31,46 +92,137 @@ class Cryocavity:
     should be used in general, but the regular constructor is convenient for test cases.
     """
 
+    # Suffixes of the PVs every cryocavity is constructed with, in constructor argument order
+    PV_SUFFIXES = ("GETDATA", "GMESLQ", "CRFPLQ", "CRRPLQ", "DETALQ", "ITOTLQ", "STARTLQ", "ENDLQ")
+
+    @staticmethod
+    def create_pvs(epics_name, pv_factory=epics.PV):
+        """Create the PV objects of a cryocavity.  Connection happens in the background - nothing waits for it.
+            Args:
+                epics_name (str): The cavity's EPICS name including any prefix, e.g., adamc:R1Q1
+                pv_factory (callable): Creates a PV object from a PV name
+            Returns (dict): PV suffix (see PV_SUFFIXES) to PV object
+        """
+        return {suffix: pv_factory(epics_name + suffix) for suffix in Cryocavity.PV_SUFFIXES}
+
     @staticmethod
-    def create_cryocavity(cavity_name, update_queue, shutdown_event, epics_prefix=None):
-        # TODO: Update factory to handle more than just C100s
-        length = 0.7
-        epics_name = qlCalc.utils.get_epics_cavity_name(cavity_name)
+    def create_cryocavity(cavity_name, update_queue, shutdown_event, epics_prefix=None, input_mode=INPUT_MODE_GET,
+                          metadata=None):
+        if metadata is None:
+            metadata = static_metadata(cavity_name)
+        epics_name = metadata.epics_name
         if epics_prefix is not None:
             epics_name = epics_prefix + epics_name
-        cavity_type = "c100"
-        RQ = 868.9
-        GETDATA = epics.PV(epics_name + "GETDATA")
-        GMESLQ = epics.PV(epics_name + "GMESLQ")
-        CRFPLQ = epics.PV(epics_name + "CRFPLQ")
-        CRRPLQ = epics.PV(epics_name + "CRRPLQ")
-        DETALQ = epics.PV(epics_name + "DETALQ")
-        ITOTLQ = epics.PV(epics_name + "ITOTLQ")
-        STARTLQ = epics.PV(epics_name + "STARTLQ")
-        ENDLQ = epics.PV(epics_name + "ENDLQ")
+        pvs = Cryocavity.create_pvs(epics_name)
 
         # Set the GETDATA PV to 0 ("disabled") so that we have a known starting point for monitoring, etc.
-        GETDATA.put(0)
+        pvs["GETDATA"].put(0)
 
-        logger.debug("About to construct Cryocavity %s.  GETDATA.value = %d", cavity_name, GETDATA.get())
+        logger.debug("About to construct Cryocavity %s.  GETDATA.value = %d", cavity_name, pvs["GETDATA"].get())
 
         # Create the cavity object
-        cav = Cryocavity(GETDATA=GETDATA, GMESLQ=GMESLQ, CRFPLQ=CRFPLQ, CRRPLQ=CRRPLQ, DETALQ=DETALQ, ITOTLQ=ITOTLQ,
-                         STARTLQ=STARTLQ, ENDLQ=ENDLQ, cavity_name=cavity_name, cavity_type=cavity_type,
-                         request_interval=1, length=length, RQ=RQ, update_queue=update_queue,
-                         shutdown_event=shutdown_event)
+        cav = Cryocavity(cavity_name=cavity_name, cavity_type=metadata.cavity_type, request_interval=1,
+                         length=metadata.length, RQ=metadata.RQ, update_queue=update_queue,
+                         shutdown_event=shutdown_event, input_mode=input_mode, **pvs)
+        cav.epics_name = metadata.epics_name
 
         # Register the objects cleanup method to be run on nomral program exit
         atexit.register(cav.cleanup)
 
         return cav
 
-    def get_ced_data(self):
-        # TODO: Implement method that get CED data related to the cryocavity and it's parent cryomodule
-        pass
+    @staticmethod
+    def create_cryocavities(cavity_names, update_queue, shutdown_event, epics_prefix=None, input_mode=INPUT_MODE_GET,
+                            connection_timeout=10.0, pv_factory=epics.PV, metadata=None):
+        """Factory for many cryocavities at once that connects all of their PVs concurrently.
+
+        Every PV is created up front and all connections are awaited together against one overall deadline, so startup
+        time no longer grows with the number of cavities times the CA round trip time.  Cavities with any PV that did
+        not connect in time are reported and left out, without holding up the rest.  GETDATA is set to 0 ("disabled")
+        for all connected cavities with one batched put.  A breakdown of startup time is logged.
+            Args:
+                cavity_names (iterable(str)): CED names of the cavities to create
+                update_queue (queue.Queue): Queue to which on_GETDATA_change writes to trigger processing data
+                shutdown_event (threading.Event): Event used to signal graceful shutdown
+                epics_prefix (str): Prefix prepended to every PV name
+                input_mode (str): How the cavities read their synchronized *LQ inputs.  See acquisition.INPUT_MODES
+                connection_timeout (float): Overall time in seconds allowed for all PVs to connect
+                pv_factory (callable): Creates a PV object from a PV name
+                metadata (dict): Cavity name to CavityMetadata.  Cavities not in it (or all if None) use the static
+                  name mapper and C100 defaults, and are left out if the mapper does not know them.
+            Returns (tuple(dict, dict)): Cavity name to Cryocavity for the cavities that connected, and cavity name to
+              list of unconnected PV names for those that did not (an empty list for those without metadata)
+        """
+        t_start = time.time()
+        prefix = epics_prefix if epics_prefix is not None else ""
+        if metadata is None:
+            metadata = {}
+        cav_pvs = {}
+        cav_md = {}
+        failed = {}
+        for cavity_name in cavity_names:
+            md = metadata.get(cavity_name)
+            if md is None:
+                try:
+                    md = static_metadata(cavity_name)
+                except KeyError:
+                    logger.error("No metadata for cavity, leaving it out - %s", cavity_name)
+                    failed[cavity_name] = []
+                    continue
+            cav_md[cavity_name] = md
+            cav_pvs[cavity_name] = Cryocavity.create_pvs(prefix + cav_md[cavity_name].epics_name,
+                                                         pv_factory=pv_factory)
+        t_created = time.time()
+
+        all_pvs = [pv for pvs in cav_pvs.values() for pv in pvs.values()]
+        qlCalc.utils.wait_for_connections(all_pvs, timeout=connection_timeout)
+        t_connected = time.time()
+
+        cav_dict = {}
+        for cavity_name, pvs in cav_pvs.items():
+            missing = [pv.pvname for pv in pvs.values() if not pv.connected]
+            if missing:
+                logger.error("Cavity PVs did not connect within %.1f s, leaving it out: %s - %s", connection_timeout,
+                             ", ".join(missing), cavity_name)
+                failed[cavity_name] = missing
+                for pv in pvs.values():
+                    pv.disconnect()
+                continue
+            md = cav_md[cavity_name]
+            cav = Cryocavity(cavity_name=cavity_name, cavity_type=md.cavity_type, request_interval=1,
+                             length=md.length, RQ=md.RQ, update_queue=update_queue, shutdown_event=shutdown_event,
+                             input_mode=input_mode, **pvs)
+            cav.epics_name = md.epics_name
+            atexit.register(cav.cleanup)
+            cav_dict[cavity_name] = cav
+
+        # Set the GETDATA PVs to 0 ("disabled") so that we have a known starting point for monitoring, etc.
+        cavities = list(cav_dict.values())
+        qlCalc.utils.put_many([cav.GETDATA for cav in cavities], [0] * len(cavities))
+        t_done = time.time()
+
+        logger.info("Created %d cavities (%d failed) in %.3f s: create PVs %.3f s, connect %.3f s, initialize %.3f s",
+                    len(cav_dict), len(failed), t_done - t_start, t_created - t_start, t_connected - t_created,
+                    t_done - t_connected)
+        return cav_dict, failed
+
+    def apply_metadata(self, metadata):
+        """Update the cavity's static description, e.g., from the CED or a metadata cache.
+            Args:
+                metadata (CavityMetadata): The new metadata.  Its cavity_name must match this cavity's.
+            Returns (None): No return
+        """
+        if metadata.cavity_name != self.cavity_name:
+            raise ValueError("Metadata for '{}' applied to {}".format(metadata.cavity_name, self.cavity_name))
+        self.epics_name = metadata.epics_name
+        self.cavity_type = metadata.cavity_type
+        self.length = metadata.length
+        self.RQ = metadata.RQ
+        if self.memo is not None:
+            self.memo.invalidate(self.cavity_name)
 
     def __init__(self, GETDATA, GMESLQ, CRFPLQ, CRRPLQ, DETALQ, ITOTLQ, STARTLQ, ENDLQ, cavity_name, cavity_type,
-                 request_interval, length, RQ, update_queue, shutdown_event):
+                 request_interval, length, RQ, update_queue, shutdown_event, input_mode=INPUT_MODE_GET):
         """Construct a cryocavity object with references to the appropriate PVs and parameters for the cryocavity
             Args:
                 GETDATA (PV): value is the state of the data request process.  (0 = idle, 1 = data requested, 2 = data
@@ -89,7 +241,12 @@ class Cryocavity:
                 RQ (float): characteristic shunt impedance in Ohms
                 update_queue (queue.Queue): Queue to which on_GETDATA_change writes to trigger processing data
                 shutdown_event (threading.Event): Event used to signal graceful shutdown
+                input_mode (str): How the synchronized *LQ inputs are read.  One of INPUT_MODE_GET (blocking get per
+                  PV), INPUT_MODE_MONITOR (cached monitor updates, no network I/O) or INPUT_MODE_CAGET_MANY (one
+                  batched caget_many)
         """
+        if input_mode not in INPUT_MODES:
+            raise ValueError("Received unsupported input_mode '{}'".format(input_mode))
         self.request_interval = request_interval  #: float: The target time interval in seconds between data requests.
         self.GETDATA = GETDATA  #: PV: The cavity's R???GETDATA pv object
         self.ITOTLQ = ITOTLQ  #: PV: The cavity's R???ITOTLQ pv object
@@ -105,14 +262,23 @@ class Cryocavity:
         self.RQ = RQ  #: string: The cavity's resistance (related to shunt impedance)
         self.update_queue = update_queue  #: queue to which GETDATA monitor callbacks should write if new data is ready
         self.shutdown_event = shutdown_event  #: event used to signal a graceful shutdown (no new requests, process old)
+        self.input_mode = input_mode  #: str: How the synchronized *LQ inputs are read.  See acquisition.INPUT_MODES
+        self.snapshot = None  #: InputSnapshot: Latest monitored *LQ values.  Only used in INPUT_MODE_MONITOR
+        #: float: Slack in seconds allowed when checking the STARTLQ/ENDLQ window.  None allows a tenth of the request
+        #: interval, enough for the usual skew between the IOC's clock and ours.
+        self.bracket_tolerance = None
 
         # Hang a callback on the GETDATA monitor so we can have the callback thread notify the main thread of the new
         # data.  None may be used in unit tests - can't add a callback to that.
         if GETDATA is not None:
             self.GETDATA.add_callback(self.on_GETDATA_change)
+        if input_mode == INPUT_MODE_MONITOR:
+            self.snapshot = InputSnapshot()
+            if GMESLQ is not None:
+                self.snapshot.subscribe([GMESLQ, CRFPLQ, CRRPLQ, DETALQ, ITOTLQ, STARTLQ, ENDLQ])
 
         # These attributes may/should be calculated at some point later
-        self.calc_timestamp = None  #: string: The timestamp when the calculations are run
+        self.calc_timestamp = None  #: float: The Unix timestamp when the calculations are run
         self.attenuation_factor = None  #: float: The calculated attenuation factor.  None until calculated
         self.attenuation = None  #: float: The calculated attenuation.  None until calculated
         self.detune_angle = None  #: float: synchronized detune angle (called psi by F. Marhauser) in radians
@@ -120,7 +286,19 @@ class Cryocavity:
         self.P_rc = None  #: float: The calculated corrected reflected power.  None until calculated
         self.Q_lf = None  #: float: The calculated loaded Q based on forward power.  None until calculated
         self.Q_lr = None  #: float: The calculated loaded Q based on reflected power.  None until calculated
-        self.err_msg = []  #: list(string): A list of error messages that may be found during calculations
+        self.Q_lf_mean = None  #: float: Rolling mean of Q_lf from the history.  None without a history
+        self.Q_lf_std = None  #: float: Rolling standard deviation of Q_lf from the history.  None without a history
+        self.Q_lr_mean = None  #: float: Rolling mean of Q_lr from the history.  None without a history
+        self.Q_lr_std = None  #: float: Rolling standard deviation of Q_lr from the history.  None without a history
+        self.Q_lf_unc = None  #: float: Monte Carlo standard deviation of Q_lf.  None until estimated
+        self.Q_lf_lo = None  #: float: Lower bound of the Monte Carlo confidence interval of Q_lf
+        self.Q_lf_hi = None  #: float: Upper bound of the Monte Carlo confidence interval of Q_lf
+        self.Q_lr_unc = None  #: float: Monte Carlo standard deviation of Q_lr.  None until estimated
+        self.Q_lr_lo = None  #: float: Lower bound of the Monte Carlo confidence interval of Q_lr
+        self.Q_lr_hi = None  #: float: Upper bound of the Monte Carlo confidence interval of Q_lr
+        self.Q_fit = None  #: float: Loaded Q fitted over recent samples.  None without a fit
+        self.attenuation_fit = None  #: float: Attenuation fitted over recent samples.  None without a fit
+        self.err_msg = ErrorRecord()  #: ErrorRecord: Error messages of the current cycle, cleared as it starts
         self.V_c = None  #: float: cavity voltage in V
         self.P_f = None  #: float: synchronized RF forward power in W
         self.P_r = None  #: float: synchronized RF reflected power in W
@@ -128,6 +306,19 @@ class Cryocavity:
         self.data_sync_start = None  #: str: time stamp of beginning of the data synchronization process
         self.data_sync_end = None  #: str: time stamp of end of the data synchronization process
         self.last_request_timestamp = None  #: float: Unix time stamp of last request.
+        self.awaiting_data = False  #: bool: A data request was made and its data has not been posted yet
+        self.watchdog = None  #: RequestWatchdog: Watches this cavity's requests for timeouts.  None if unwatched.
+        self.epics_name = None  #: str: The cavity's EPICS name without any prefix, e.g., R1Q1.  Set by the factory.
+        self.results_out = "stdout"  #: str: Default destination of export_results - "stdout" or "epics"
+        self.publisher = None  #: ResultPublisher: Buffers results for writing to EPICS when results_out is "epics"
+        self.history = None  #: ResultHistory: Keeps recent results and their rolling statistics.  None if unused.
+        self.metrics = None  #: PipelineMetrics: Records when this cavity reaches each stage of its cycle, if used
+        self.memo = None  #: InputMemo: Lets cycles with unchanged inputs skip recalculating.  None if unused.
+        self.heartbeat = None  #: float: Unix time stamp of the last completed cycle, whether or not it recalculated
+        self.rate_controller = None  #: RateController: Adapts request_interval to the IOC's turnaround.  None if fixed.
+        self.uncertainty = None  #: UncertaintyEstimator: Estimates the Q values' uncertainty.  None if not estimated.
+        self.fit = None  #: WindowedFit: Fits Q_L and attenuation over recent samples.  None if not fitted.
+        self.results_table = None  #: ResultTable: Shares the latest results with local processes.  None if unused.
 
     def cleanup(self):
         """Method the cleans up any attached resources, e.g., connected PVs"""
@@ -141,12 +332,41 @@ class Cryocavity:
         self.STARTLQ.disconnect()
         self.ENDLQ.disconnect()
 
-    def export_results(self, out="stdout"):
+    def retire(self):
+        """Take the cavity out of a running application, e.g., because it was removed from the set of cavities.
+
+        The cavity is dropped from every machine-wide object it is attached to, so its rows, PVs and counters can be
+        reused or freed, and its PVs are disconnected.  It should no longer be requested or processed by then.
+            Returns (None): No return
+        """
+        name = self.cavity_name
+        if self.watchdog is not None:
+            self.watchdog.discard(name)
+        if self.rate_controller is not None:
+            self.rate_controller.discard(name)
+        if self.uncertainty is not None:
+            self.uncertainty.discard(name)
+        if self.memo is not None:
+            self.memo.invalidate(name)
+        for shared in (self.metrics, self.history, self.fit, self.results_table):
+            if shared is not None:
+                shared.remove_cavity(name)
+        if self.publisher is not None:
+            self.publisher.unregister(name)
+        self.cleanup()
+        atexit.unregister(self.cleanup)
+
+    def export_results(self, out=None):
         """Routine for exporting results to either EPICS control system or printing them to STDOUT.
             Args:
-                out (str): Specify output destination - valid options include "epics", "stdout"
+                out (str): Specify output destination - valid options include "epics", "stdout".  None uses
+                  self.results_out.
             Returns (None):  No return
         """
+        if out is None:
+            out = self.results_out
+        if self.results_table is not None:
+            self.results_table.write_cavity(self)
         if out == "stdout":
             self.print_results()
         elif out == "epics":
@@ -161,29 +381,114 @@ class Cryocavity:
         #     logger.info("request_new_data method skipping request since shutdown is active - %s", self.cavity_name)
         # else:
         logger.debug("Triggering next data collection - %s", self.cavity_name)
-        self.last_request_timestamp = time.time()
+        self.mark_requested(time.time())
         self.GETDATA.put(1)
 
+    @staticmethod
+    def request_new_data_batch(cavities):
+        """Make a normal data request for several cavities at once with a single batched put to their GETDATA PVs.
+            Args:
+                cavities (list(Cryocavity)): The cavities whose next data collection should be requested
+            Returns (None): No return
+        """
+        if not cavities:
+            return
+        logger.debug("Triggering next data collection for %d cavities", len(cavities))
+        now = time.time()
+        for cav in cavities:
+            cav.mark_requested(now)
+        qlCalc.utils.put_many([cav.GETDATA for cav in cavities], [1] * len(cavities))
+
     def trigger_data_collection(self):
         """Method to 'force' trigger data collection.  Typically, processes should toggle between states 1 and 2
             Returns (None): No return
         """
         self.GETDATA.put(0)
-        self.last_request_timestamp = time.time()
+        self.mark_requested(time.time())
         self.GETDATA.put(1)
 
+    @staticmethod
+    def trigger_data_collection_batch(cavities):
+        """Force trigger data collection for several cavities at once with batched puts to their GETDATA PVs.
+            Args:
+                cavities (list(Cryocavity)): The cavities to trigger
+            Returns (None): No return
+        """
+        if not cavities:
+            return
+        getdata = [cav.GETDATA for cav in cavities]
+        qlCalc.utils.put_many(getdata, [0] * len(cavities))
+        now = time.time()
+        for cav in cavities:
+            cav.mark_requested(now)
+        qlCalc.utils.put_many(getdata, [1] * len(cavities))
+
+    def mark_requested(self, timestamp):
+        """Record that a data request is being made and have the watchdog, if any, start watching it.
+            Args:
+                timestamp (float): The time.time() of the request
+            Returns (None): No return
+        """
+        self.last_request_timestamp = timestamp
+        self.awaiting_data = True
+        if self.rate_controller is not None:
+            self.rate_controller.requested(self.cavity_name)
+        if self.watchdog is not None:
+            self.watchdog.arm(self.cavity_name, timestamp)
+        if self.metrics is not None:
+            self.metrics.mark(self.cavity_name, "requested", timestamp)
+
+    def publish_invalid_results(self, reason):
+        """Replace the cavity's results with NaN and export them, e.g., because its data request never completed.
+            Args:
+                reason (str): Why the results are invalid.  Recorded in err_msg.
+            Returns (None): No return
+        """
+        self.err_msg.clear()
+        self.err_msg.append(reason)
+        if self.memo is not None:
+            self.memo.invalidate(self.cavity_name)
+        if self.uncertainty is not None:
+            self.uncertainty.discard(self.cavity_name)
+        self.attenuation_factor = math.nan
+        self.attenuation = math.nan
+        self.P_fc = math.nan
+        self.P_rc = math.nan
+        self.Q_lf = math.nan
+        self.Q_lr = math.nan
+        if self.uncertainty is not None:
+            self.Q_lf_unc = self.Q_lf_lo = self.Q_lf_hi = math.nan
+            self.Q_lr_unc = self.Q_lr_lo = self.Q_lr_hi = math.nan
+        self.calc_timestamp = time.time()
+        self.heartbeat = self.calc_timestamp
+        if self.history is not None:
+            self.history.record_cavity(self)
+        self.export_results()
+
     # TODO: finish implementing this method
     def print_results(self):
         """Routine for print results to STDOUT.  Used mostly for debug/testing"""
         fmt = "Cavity Name: {}\nCavity Type: {}\nLength: {}\nR/Q: {}\n"
         print(fmt.format(self.cavity_name, self.cavity_type, self.length, self.RQ))
 
-    # TODO: Implement this method
+    def export_heartbeat(self):
+        """Export only the heartbeat and window statistics, for a cycle whose results are unchanged.  Nothing is
+        printed to STDOUT."""
+        if self.results_table is not None:
+            self.results_table.write_cavity(self)
+        if self.results_out == "epics":
+            if self.publisher is None:
+                raise ValueError("No result publisher configured - {}".format(self.cavity_name))
+            self.publisher.submit(self, attrs=HEARTBEAT_ATTRS)
+
     def write_results_to_epics(self):
-        """Routine for writing data, metadata, and results to control system"""
-        pass
+        """Routine for writing data, metadata, and results to control system.  Results are handed to the cavity's
+        ResultPublisher, which writes them in batches from its own thread."""
+        if self.publisher is None:
+            raise ValueError("No result publisher configured - {}".format(self.cavity_name))
+        self.publisher.submit(self)
 
-    def update_formula_data(self, V_c=None, P_f=None, P_r=None, detune_angle=None, I_tot=None):
+    def update_formula_data(self, V_c=None, P_f=None, P_r=None, detune_angle=None, I_tot=None, raw=None):
         """Updates internal formula variables, based on current PV values or optional manually supplied values
 
         Note: this converts PV data to base SI units, but specified values are assumed to be in SI units
@@ -194,63 +499,161 @@ class Cryocavity:
             P_r (float): Value to apply to self.P_r
             detune_angle (float): Value to apply to self.detune_angle (degrees)
             I_tot (float): Value to apply to self.I_tot
+            raw (list): Raw input values already read with read_inputs.  None reads them if needed.
         Returns None:  Returns nothing
         """
-        # TODO: figure out the channel access stuff
         logger.debug("Reading PV data and updating formula variables - %s", self.cavity_name)
+        GMES = CRFP = CRRP = DETA = ITOT = None
+        if raw is not None:
+            GMES, CRFP, CRRP, DETA, ITOT = raw
+        elif V_c is None or P_f is None or P_r is None or detune_angle is None or I_tot is None:
+            GMES, CRFP, CRRP, DETA, ITOT = self.read_inputs()
+
         # Update internal formula variables to base SI units (PVs are not necessarily in those)
         if V_c is None:
-            self.V_c = self.GMESLQ.get() * self.length * 1000000
+            self.V_c = GMES * self.length * 1000000
         else:
             self.V_c = V_c
         if P_f is None:
-            self.P_f = self.CRFPLQ.get() * 1000
+            self.P_f = CRFP * 1000
         else:
             self.P_f = P_f
         if P_r is None:
-            self.P_r = self.CRRPLQ.get() * 1000
+            self.P_r = CRRP * 1000
         else:
             self.P_r = P_r
         if detune_angle is None:
-            self.detune_angle = math.radians(self.DETALQ.get())
+            self.detune_angle = math.radians(DETA)
         else:
             self.detune_angle = detune_angle
         if I_tot is None:
-            self.I_tot = self.ITOTLQ.get() / 1000000
+            self.I_tot = ITOT / 1000000
         else:
             self.I_tot = I_tot
 
+    def read_inputs(self):
+        """Read the raw values of the synchronized *LQ input PVs according to the cavity's input_mode.
+
+        In INPUT_MODE_MONITOR the values come from the monitor snapshot without any network I/O.  A snapshot whose
+        data collection window (the STARTLQ and ENDLQ values) started before the last request may be left over from an
+        earlier cycle, and one whose inputs were not updated within that window may mix two collections.  Either is
+        still used, but is logged and noted in err_msg.
+
+            Returns (list): The GMESLQ, CRFPLQ, CRRPLQ, DETALQ and ITOTLQ values, in their PVs' units
+        """
+        if self.input_mode == INPUT_MODE_MONITOR:
+            sample = self.snapshot.read()
+            values, timestamps = sample
+            tolerance = self.bracket_tolerance
+            if tolerance is None:
+                tolerance = 0.1 * self.request_interval
+            if self.last_request_timestamp is not None and \
+                    not self.snapshot.is_newer(self.last_request_timestamp, sample, tolerance):
+                logger.warning("Synchronized inputs predate the last request at %s (STARTLQ = %s) - %s",
+                               self.last_request_timestamp, values[SNAPSHOT_PVS.index("STARTLQ")], self.cavity_name)
+                self.err_msg.append("Synchronized inputs predate the last request")
+            elif not self.snapshot.is_bracketed(sample, tolerance):
+                logger.warning("Synchronized inputs not bracketed by STARTLQ/ENDLQ (%s, %s) - %s", values, timestamps,
+                               self.cavity_name)
+                self.err_msg.append("Synchronized inputs not bracketed by STARTLQ/ENDLQ")
+            values = values[:len(INPUT_PVS)]
+        elif self.input_mode == INPUT_MODE_CAGET_MANY:
+            values = caget_inputs([self.GMESLQ, self.CRFPLQ, self.CRRPLQ, self.DETALQ, self.ITOTLQ])
+        else:
+            values = [self.GMESLQ.get(), self.CRFPLQ.get(), self.CRRPLQ.get(), self.DETALQ.get(), self.ITOTLQ.get()]
+
+        for name, value in zip(INPUT_PVS, values):
+            if value is None:
+                raise ValueError("No value available for {} - {}".format(name, self.cavity_name))
+        return values
+
     def on_GETDATA_change(self, pvname=None, value=None, char_value=None, **kw):
         """Callback function for handling changes in GETDATA PV.  Simple writes the cavity name to the 'event' queue."""
-        logger.debug("on_GETDATA_change callback received %s = %s (qsize=%d) - %s", pvname, value,
-                     self.update_queue.qsize(), self.cavity_name)
+        logger.debug("on_GETDATA_change callback received %s = %s - %s", pvname, value, self.cavity_name)
         if value == 0:
             return
         if value == 1:
             return
         elif value == 2:
+            self.awaiting_data = False
+            if self.watchdog is not None:
+                self.watchdog.complete(self.cavity_name)
+            if self.metrics is not None:
+                self.metrics.mark(self.cavity_name, "posted")
+            if self.rate_controller is not None:
+                self.request_interval = self.rate_controller.completed(
+                    self.cavity_name, time.time() - self.last_request_timestamp, self.request_interval)
             next_req = self.last_request_timestamp + self.request_interval
             logger.debug("on_GETDATA_change writing to queue - (%s, %f)", self.cavity_name, next_req)
             self.update_queue.put(CavityTask(self.cavity_name, next_req))
 
     def process_new_data(self):
         """Method for processing new data.  Read from EPICS, run calculations, write results, and request more data.
+
+        If the cavity has a memo and the inputs have not changed beyond its deadbands, the current results are kept
+        and only the heartbeat is refreshed.  The sample still goes into the history and fit windows, so that they
+        cover the same span of time either way, with the results repeated but the newly read inputs, and the heartbeat
+        and window statistics are exported.
             Returns (None): Returns nothing
         """
         logger.debug("Processing new data - %s", self.cavity_name)
+        previous_errors = self.err_msg.copy()
+        self.err_msg.clear()
         value = self.GETDATA.get()
         if value != 2:
             logger.warning("process_new_data found %s = %d (!= 2, i.e., Data Posted) - %s", self.GETDATA.pvname,
                            self.GETDATA.value, self.cavity_name)
-        self.update_formula_data()
-        self.run_calculations()
+        raw = self.read_inputs()
+        if self.metrics is not None:
+            self.metrics.mark(self.cavity_name, "inputs_read")
+        # A read that raised new errors always gets a full cycle, so they are published
+        if self.memo is not None and not self.err_msg and self.memo.check(self.cavity_name, raw):
+            self.err_msg.extend(previous_errors)
+            self.heartbeat = time.time()
+            self.update_formula_data(raw=raw)
+            self.record_windows(self.heartbeat)
+            if self.metrics is not None:
+                self.metrics.mark(self.cavity_name, "calculated")
+            self.export_heartbeat()
+            if self.metrics is not None:
+                self.metrics.mark(self.cavity_name, "exported")
+            return
+
+        try:
+            self.update_formula_data(raw=raw)
+            self.run_calculations()
+        except Exception:
+            # The memo now holds these inputs, but the results were never calculated from them
+            if self.memo is not None:
+                self.memo.invalidate(self.cavity_name)
+            raise
+        self.heartbeat = self.calc_timestamp
+        self.record_windows(self.calc_timestamp)
+        if self.uncertainty is not None:
+            self.uncertainty.submit(self)
+        if self.metrics is not None:
+            self.metrics.mark(self.cavity_name, "calculated")
         self.export_results()
+        if self.metrics is not None:
+            self.metrics.mark(self.cavity_name, "exported")
+
+    def record_windows(self, timestamp):
+        """Add the current results and inputs to the cavity's history and fit windows, if it has them.
+            Args:
+                timestamp (float): When the sample was taken
+            Returns (None): Returns nothing
+        """
+        if self.history is not None:
+            self.history.record_cavity(self, timestamp)
+        if self.fit is not None:
+            self.fit.record_cavity(self)
 
     def run_calculations(self):
         """Reads current values of the synchronized *LQ PVs from the control system and performs all calculations.
             Returns (None): Returns nothing
         """
         logger.debug("Beginning calculation run - %s", self.cavity_name)
+        self.calc_timestamp = time.time()
         self.calculate_attenuation_factor()
         self.calculate_attenuation()
         self.calculate_P_fc()
@@ -277,11 +680,11 @@ class Cryocavity:
 
         # According to F. Marhauser, this can only be in [0,1].  Truncate if bounds are exceeded.
         if attenuation_factor > 1:
-            logger.warning("Attenuation factor lowered from %d to 1 - %s", attenuation_factor, self.cavity_name)
+            logger.warning("Attenuation factor lowered from %s to 1 - %s", attenuation_factor, self.cavity_name)
             self.err_msg.append("Attenuation factor lowered from {} to 1".format(attenuation_factor))
             self.attenuation_factor = 1
         elif attenuation_factor < 0:
-            logger.warning("Attenuation factor raised from %d to 0 - %s", attenuation_factor, self.cavity_name)
+            logger.warning("Attenuation factor raised from %s to 0 - %s", attenuation_factor, self.cavity_name)
             self.err_msg.append("Attenuation factor raised from {} to 0".format(attenuation_factor))
             self.attenuation_factor = 0
         else:
@@ -0,0 +1,203 @@
+import logging
+import threading
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Per-sample terms whose window sums are the sufficient statistics of the fit, in column order of WindowedFit.sums.
+# With c = V_c**2 * (1 + tan(detune_angle)**2) / 4, d = I_tot**2 / 4, y = sqrt(P_f * P_r + (I_tot * V_c / 2)**2) and
+# h = I_tot * V_c / 2 they are c*c, c*y, c*d (Q_L) and P_f*P_f, P_f*c, P_f*d, P_f*h (attenuation).
+FIT_TERMS = ("cc", "cy", "cd", "ff", "fc", "fd", "fh")
+_CC, _CY, _CD, _FF, _FC, _FD, _FH = range(len(FIT_TERMS))
+
+# Per-row arrays of a WindowedFit and the value an empty row holds in each
+_ROW_ARRAYS = (("terms", 0.0), ("valid", False), ("sums", 0.0), ("count", 0), ("seq", 0), ("RQ", np.nan))
+
+
+def sample_terms(V_c, P_f, P_r, detune_angle, I_tot):
+    """Compute the fit terms of synchronized samples.  Samples with non-finite inputs or no forward power contribute
+    nothing.
+        Args:
+            V_c, P_f, P_r, detune_angle, I_tot (array_like): Sample inputs in base SI units, as for batch.calculate
+        Returns (tuple(ndarray, ndarray)): Terms (..., len(FIT_TERMS)) and whether each sample is valid
+    """
+    V_c, P_f, P_r, detune_angle, I_tot = np.broadcast_arrays(
+        *(np.asarray(x, dtype=np.float64) for x in (V_c, P_f, P_r, detune_angle, I_tot)))
+    with np.errstate(invalid="ignore", over="ignore"):
+        h = I_tot * V_c / 2
+        c = V_c * V_c * (1 + np.tan(detune_angle) ** 2) / 4
+        d = I_tot * I_tot / 4
+        y = np.sqrt(P_f * P_r + h * h)
+        terms = np.stack((c * c, c * y, c * d, P_f * P_f, P_f * c, P_f * d, P_f * h), axis=-1)
+        valid = np.all(np.isfinite(terms), axis=-1) & (P_f > 0) & (c > 0)
+    terms[~valid] = 0.0
+    return terms, valid
+
+
+def solve_terms(sums, count, RQ, min_samples=1):
+    """Solve for loaded Q and attenuation factor from window sums of the fit terms, for many cavities at once.
+
+    The model is the one the scalar calculation chain inverts, written in terms of x = RQ * Q_L.  Multiplying the
+    forward and reflected power equations eliminates the attenuation factor a and leaves y = c / x + d * x for every
+    sample, which has no 1 / I_tot**2 term and so stays well conditioned as the beam current goes to zero.  Setting the
+    derivative of the squared residuals with respect to u = 1 / x to zero, with the small beam loading term d * x
+    evaluated at the fitted x, gives sum(cc) * u**2 - sum(cy) * u + sum(cd) = 0.  Its larger root is the one the scalar
+    chain picks and the only one while the field term c / x dominates d * x, as it does below the beam matched Q_L.
+    The attenuation factor is then the least squares fit of a * P_f = c / x + d * x + h, clamped to [0,1] like the
+    scalar chain.  A single noise free sample gives back the scalar chain's Q_lf and Q_lr.
+
+        Args:
+            sums (ndarray): Window sums of the fit terms, (cavities, len(FIT_TERMS))
+            count (array_like): Number of valid samples in each cavity's window
+            RQ (array_like): Characteristic shunt impedance of each cavity in Ohms
+            min_samples (int): Cavities with fewer valid samples get NaN
+        Returns (dict): Arrays with one value per cavity - Q_L, attenuation_factor and attenuation
+    """
+    sums = np.asarray(sums, dtype=np.float64)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        cc, cy, cd = sums[..., _CC], sums[..., _CY], sums[..., _CD]
+        u = (cy + np.sqrt(cy * cy - 4 * cc * cd)) / (2 * cc)
+        x = 1 / u
+        Q_L = x / np.asarray(RQ, dtype=np.float64)
+        a = (sums[..., _FC] * u + sums[..., _FD] * x + sums[..., _FH]) / sums[..., _FF]
+        a = np.clip(a, 0.0, 1.0)
+        attenuation = -10 * np.log10(a)
+    undefined = (np.asarray(count) < max(min_samples, 1)) | ~np.isfinite(Q_L)
+    for values in (Q_L, a, attenuation):
+        values[undefined] = np.nan
+    return {"Q_L": Q_L, "attenuation_factor": a, "attenuation": attenuation}
+
+
+class WindowedFit:
+    """A least squares fit of each cavity's loaded Q and attenuation over its last window synchronized samples.
+
+    Single-shot Q_lf and Q_lr divide by RQ * I_tot**2, so they blow up as the beam current goes to zero.  The fit
+    instead solves the power balance for Q_L directly (see solve_terms) and averages the noise of many samples.
+
+    Like ResultHistory, the whole machine shares preallocated arrays with a row per cavity.  Each sample's fit terms
+    are kept in a ring, and their window sums are updated incrementally as a sample is added and the oldest dropped, so
+    recording is O(1) and solving needs only the sums, however long the window.  The sums of a cavity are recomputed
+    from its ring each time the ring wraps, so rounding drift cannot build up.  Solving is vectorized across cavities.
+    Like ResultHistory, a removed cavity's row is cleared and reused by the next cavity added.
+    """
+
+    def __init__(self, cavity_names, window=30, min_samples=3):
+        """Construct an empty fit.
+            Args:
+                cavity_names (iterable(str)): CED names of the cavities, one row each
+                window (int): Number of samples fitted per cavity
+                min_samples (int): Fewest valid samples a cavity needs for a result.  NaN until then.
+        """
+        if window < 1:
+            raise ValueError("window must be at least 1, got {}".format(window))
+        self.cavity_names = list(cavity_names)  #: list(str): cavity names in row order.  None for a free row.
+        self.index = {name: i for i, name in enumerate(self.cavity_names)}  #: dict: cavity name to row number
+        self.window = window  #: int: number of samples fitted per cavity
+        self.min_samples = min_samples  #: int: fewest valid samples a cavity needs for a result
+        n = len(self.cavity_names)
+
+        self.terms = np.zeros((n, window, len(FIT_TERMS)))  #: ndarray: fit terms, slot = sequence number % window
+        self.valid = np.zeros((n, window), dtype=bool)  #: ndarray: whether each slot holds a valid sample
+        self.sums = np.zeros((n, len(FIT_TERMS)))  #: ndarray: window sums of the fit terms
+        self.count = np.zeros(n, dtype=np.int64)  #: ndarray: valid samples in each cavity's window
+        self.seq = np.zeros(n, dtype=np.int64)  #: ndarray: number of samples recorded per cavity
+        self.RQ = np.full(n, np.nan)  #: ndarray: R/Q of each cavity in Ohms, as of its latest sample
+        self._free = []  # Rows of removed cavities, reused before growing
+        self._lock = threading.Lock()
+
+    def add_cavity(self, cavity_name):
+        """Give a cavity an empty row.  Does nothing if it already has one.
+            Args:
+                cavity_name (str): CED name of the cavity
+            Returns (None): Returns nothing
+        """
+        with self._lock:
+            if cavity_name in self.index:
+                return
+            if not self._free:
+                self._grow(max(1, len(self.cavity_names)))
+            row = self._free.pop()
+            self.cavity_names[row] = cavity_name
+            self.index[cavity_name] = row
+
+    def remove_cavity(self, cavity_name):
+        """Drop a cavity's samples and free its row.  Does nothing for a cavity without a row."""
+        with self._lock:
+            row = self.index.pop(cavity_name, None)
+            if row is None:
+                return
+            for name, empty in _ROW_ARRAYS:
+                getattr(self, name)[row] = empty
+            self.cavity_names[row] = None
+            self._free.append(row)
+
+    def _grow(self, extra):
+        n = len(self.cavity_names)
+        for name, empty in _ROW_ARRAYS:
+            array = getattr(self, name)
+            rows = np.full((extra,) + array.shape[1:], empty, dtype=array.dtype)
+            setattr(self, name, np.concatenate((array, rows)))
+        self.cavity_names.extend([None] * extra)
+        self._free.extend(range(n + extra - 1, n - 1, -1))  # Lowest row is popped first
+
+    def record_many(self, cavity_names, V_c, P_f, P_r, detune_angle, I_tot, RQ):
+        """Add one sample for each of several cavities, replacing each one's oldest.
+            Args:
+                cavity_names (sequence(str)): The cavities the samples belong to, each at most once
+                V_c, P_f, P_r, detune_angle, I_tot, RQ (array_like): Sample inputs in base SI units, one per cavity
+            Returns (None): Returns nothing
+        """
+        terms, valid = sample_terms(V_c, P_f, P_r, detune_angle, I_tot)
+        terms = np.broadcast_to(terms, (len(cavity_names), len(FIT_TERMS)))
+        valid = np.broadcast_to(valid, (len(cavity_names),))
+        with self._lock:
+            rows = np.array([self.index[name] for name in cavity_names], dtype=np.int64)
+            slots = self.seq[rows] % self.window
+            self.sums[rows] += terms - self.terms[rows, slots]
+            self.count[rows] += valid.astype(np.int64) - self.valid[rows, slots]
+            self.terms[rows, slots] = terms
+            self.valid[rows, slots] = valid
+            self.RQ[rows] = RQ
+            self.seq[rows] += 1
+            wrapped = rows[slots == self.window - 1]
+            if len(wrapped):
+                self.sums[wrapped] = self.terms[wrapped].sum(axis=1)
+
+    def record(self, cavity_name, V_c, P_f, P_r, detune_angle, I_tot, RQ):
+        """Add one sample for a cavity, replacing its oldest.  Inputs are in base SI units.
+            Returns (None): Returns nothing
+        """
+        self.record_many([cavity_name], V_c, P_f, P_r, detune_angle, I_tot, RQ)
+
+    def solve(self, cavity_names=None):
+        """Fit the current windows.
+            Args:
+                cavity_names (sequence(str)): Cavities to fit.  None fits every row, free ones included, in row order.
+            Returns (dict): Arrays with one value per cavity - Q_L, attenuation_factor, attenuation and count (valid
+              samples fitted)
+        """
+        with self._lock:
+            rows = slice(None) if cavity_names is None else [self.index[name] for name in cavity_names]
+            sums = self.sums[rows]
+            count = self.count[rows]
+            RQ = self.RQ[rows]
+        results = solve_terms(sums, count, RQ, self.min_samples)
+        results["count"] = count
+        return results
+
+    def record_cavity(self, cav):
+        """Record a cavity's current formula inputs (as set by update_formula_data) and copy its updated fit back onto
+        it as the Q_fit and attenuation_fit attributes.
+            Args:
+                cav (Cryocavity): The cavity
+            Returns (None): Returns nothing
+        """
+        self.record(cav.cavity_name, cav.V_c, cav.P_f, cav.P_r, cav.detune_angle, cav.I_tot, cav.RQ)
+        results = self.solve([cav.cavity_name])
+        cav.Q_fit = float(results["Q_L"][0])
+        cav.attenuation_fit = float(results["attenuation"][0])
+
+    def get_stats(self, cavity_name):
+        """Returns (dict): The cavity's current fit - Q_L, attenuation_factor, attenuation and count"""
+        results = self.solve([cavity_name])
+        return {key: value[0].item() for key, value in results.items()}
@@ -0,0 +1,219 @@
+import logging
+import math
+import threading
+import time
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Cryocavity result attributes kept in the history by default
+HISTORY_FIELDS = ("Q_lf", "Q_lr")
+
+# Per-row arrays of a ResultHistory and the value an empty row holds in each
+_ROW_ARRAYS = (("values", math.nan), ("timestamps", math.nan), ("seq", 0), ("count", 0), ("mean", math.nan),
+               ("std", math.nan), ("min", math.nan), ("max", math.nan), ("_m2", 0.0), ("_minq", 0), ("_maxq", 0),
+               ("_minq_ends", 0), ("_maxq_ends", 0))
+
+
+class ResultHistory:
+    """A preallocated ring buffer of the last window results of every cavity, with incremental rolling statistics.
+
+    The whole machine shares one set of NumPy arrays with a row per cavity.  Recording a result overwrites the oldest
+    slot of that cavity's row and updates the rolling mean and standard deviation (sliding Welford update) and the
+    rolling min and max (monotonic queues over sample sequence numbers) in O(1) amortized time, without allocating or
+    rescanning the window.  The statistics live in arrays (mean, std, min, max, count) that are always current, so
+    smoothed values can be exported by simply reading them.
+
+    Non-finite results (e.g., the NaN published for a timed out request) take up a slot, so they age out of the
+    window like any other result, but are left out of the statistics.
+
+    Cavities can be added and removed while results are being recorded.  A removed cavity's row is cleared and reused
+    by the next cavity added, and the arrays only grow (doubling) when no row is free.
+    """
+
+    def __init__(self, cavity_names, window=60, fields=HISTORY_FIELDS):
+        """Construct an empty history.
+            Args:
+                cavity_names (iterable(str)): CED names of the cavities, one row each
+                window (int): Number of results kept per cavity
+                fields (tuple(str)): Names of the Cryocavity result attributes to keep
+        """
+        if window < 1:
+            raise ValueError("window must be at least 1, got {}".format(window))
+        self.cavity_names = list(cavity_names)  #: list(str): cavity names in row order.  None for a free row.
+        self.index = {name: i for i, name in enumerate(self.cavity_names)}  #: dict: cavity name to row number
+        self.window = window  #: int: number of results kept per cavity
+        self.fields = tuple(fields)  #: tuple(str): names of the result attributes kept
+        n = len(self.cavity_names)
+        f = len(self.fields)
+
+        self.values = np.full((n, f, window), np.nan)  #: ndarray: results, slot = sequence number % window
+        self.timestamps = np.full((n, window), np.nan)  #: ndarray: calculation time of each slot
+        self.seq = np.zeros(n, dtype=np.int64)  #: ndarray: number of results recorded per cavity
+
+        self.count = np.zeros((n, f), dtype=np.int64)  #: ndarray: finite results in each cavity's window
+        self.mean = np.full((n, f), np.nan)  #: ndarray: rolling mean
+        self.std = np.full((n, f), np.nan)  #: ndarray: rolling sample standard deviation
+        self.min = np.full((n, f), np.nan)  #: ndarray: rolling minimum
+        self.max = np.full((n, f), np.nan)  #: ndarray: rolling maximum
+        self._m2 = np.zeros((n, f))  # Sum of squared deviations from the mean
+
+        # Monotonic queues of sequence numbers whose values are candidates for the window min (or max).  Each is a
+        # ring of window entries addressed by the head and tail counters.
+        self._minq = np.zeros((n, f, window), dtype=np.int64)
+        self._maxq = np.zeros((n, f, window), dtype=np.int64)
+        self._minq_ends = np.zeros((n, f, 2), dtype=np.int64)
+        self._maxq_ends = np.zeros((n, f, 2), dtype=np.int64)
+        self._free = []  # Rows of removed cavities, reused before growing
+        self._lock = threading.Lock()  # Held while recording or reading, so rows can be added and removed meanwhile
+
+    def add_cavity(self, cavity_name):
+        """Give a cavity an empty row.  Does nothing if it already has one.
+            Args:
+                cavity_name (str): CED name of the cavity
+            Returns (None): Returns nothing
+        """
+        with self._lock:
+            if cavity_name in self.index:
+                return
+            if not self._free:
+                self._grow(max(1, len(self.cavity_names)))
+            row = self._free.pop()
+            self.cavity_names[row] = cavity_name
+            self.index[cavity_name] = row
+
+    def remove_cavity(self, cavity_name):
+        """Drop a cavity's results and free its row.  Does nothing for a cavity without a row."""
+        with self._lock:
+            row = self.index.pop(cavity_name, None)
+            if row is None:
+                return
+            for name, empty in _ROW_ARRAYS:
+                getattr(self, name)[row] = empty
+            self.cavity_names[row] = None
+            self._free.append(row)
+
+    def _grow(self, extra):
+        n = len(self.cavity_names)
+        for name, empty in _ROW_ARRAYS:
+            array = getattr(self, name)
+            rows = np.full((extra,) + array.shape[1:], empty, dtype=array.dtype)
+            setattr(self, name, np.concatenate((array, rows)))
+        self.cavity_names.extend([None] * extra)
+        self._free.extend(range(n + extra - 1, n - 1, -1))  # Lowest row is popped first
+
+    def record(self, cavity_name, values, timestamp):
+        """Add one set of results for a cavity, replacing its oldest.
+            Args:
+                cavity_name (str): The cavity the results belong to
+                values (sequence(float)): One result per field, in fields order
+                timestamp (float): When the results were calculated
+            Returns (None): Returns nothing
+        """
+        with self._lock:
+            self._record(self.index[cavity_name], values, timestamp)
+
+    def _record(self, row, values, timestamp):
+        s = int(self.seq[row])
+        slot = s % self.window
+        for f, x in enumerate(values):
+            x = math.nan if x is None else float(x)
+            if s >= self.window:
+                old = self.values[row, f, slot]
+                if math.isfinite(old):
+                    self._remove(row, f, old)
+            if math.isfinite(x):
+                self._add(row, f, x)
+            self.values[row, f, slot] = x
+            self._update_extremes(row, f, s, x)
+        self.timestamps[row, slot] = timestamp
+        self.seq[row] = s + 1
+
+    def record_cavity(self, cav, timestamp=None):
+        """Record a cavity's current results and copy the updated rolling statistics back onto it as
+        <field>_mean and <field>_std attributes (e.g., Q_lf_mean).
+            Args:
+                cav (Cryocavity): The cavity
+                timestamp (float): When the results are from.  None uses the cavity's calc_timestamp, or now.
+            Returns (None): Returns nothing
+        """
+        ts = timestamp
+        if ts is None:
+            ts = cav.calc_timestamp if cav.calc_timestamp is not None else time.time()
+        with self._lock:
+            row = self.index[cav.cavity_name]
+            self._record(row, [getattr(cav, field) for field in self.fields], ts)
+            mean = self.mean[row].tolist()
+            std = self.std[row].tolist()
+        for f, field in enumerate(self.fields):
+            setattr(cav, field + "_mean", mean[f])
+            setattr(cav, field + "_std", std[f])
+
+    def _add(self, row, f, x):
+        n = int(self.count[row, f]) + 1
+        mean = 0.0 if n == 1 else float(self.mean[row, f])
+        delta = x - mean
+        mean += delta / n
+        m2 = (0.0 if n == 1 else float(self._m2[row, f])) + delta * (x - mean)
+        self._set_moments(row, f, n, mean, m2)
+
+    def _remove(self, row, f, y):
+        n = int(self.count[row, f]) - 1
+        if n == 0:
+            self._set_moments(row, f, 0, math.nan, 0.0)
+            return
+        mean = float(self.mean[row, f])
+        delta = y - mean
+        mean -= delta / n
+        m2 = float(self._m2[row, f]) - delta * (y - mean)
+        self._set_moments(row, f, n, mean, m2)
+
+    def _set_moments(self, row, f, n, mean, m2):
+        m2 = max(m2, 0.0)  # Guard against rounding drift
+        self.count[row, f] = n
+        self.mean[row, f] = mean
+        self._m2[row, f] = m2
+        self.std[row, f] = math.sqrt(m2 / (n - 1)) if n > 1 else math.nan
+
+    def _update_extremes(self, row, f, s, x):
+        values = self.values[row, f]
+        w = self.window
+        oldest = s - w + 1
+        # sign turns the max queue into a min queue over negated values
+        for q, ends, out, sign in ((self._minq[row, f], self._minq_ends[row, f], self.min, 1.0),
+                                   (self._maxq[row, f], self._maxq_ends[row, f], self.max, -1.0)):
+            head, tail = int(ends[0]), int(ends[1])
+            # Expire candidates that left the window first, so the queue never holds more than window entries
+            while tail > head and q[head % w] < oldest:
+                head += 1
+            if math.isfinite(x):
+                # Drop candidates that can never be the extreme again because x is newer and at least as extreme
+                while tail > head and sign * values[q[(tail - 1) % w] % w] >= sign * x:
+                    tail -= 1
+                q[tail % w] = s
+                tail += 1
+            ends[0] = head
+            ends[1] = tail
+            out[row, f] = values[q[head % w] % w] if tail > head else math.nan
+
+    def get_stats(self, cavity_name):
+        """Returns (dict): Field name to dict of count, mean, std, min and max for the cavity's current window"""
+        with self._lock:
+            row = self.index[cavity_name]
+            return {field: {"count": int(self.count[row, f]), "mean": float(self.mean[row, f]),
+                            "std": float(self.std[row, f]), "min": float(self.min[row, f]),
+                            "max": float(self.max[row, f])}
+                    for f, field in enumerate(self.fields)}
+
+    def get_window(self, cavity_name):
+        """Copy a cavity's results in chronological order.
+            Args:
+                cavity_name (str): The cavity
+            Returns (tuple(ndarray, ndarray)): Timestamps (n,) and values (len(fields), n) for the n results held
+        """
+        with self._lock:
+            row = self.index[cavity_name]
+            s = int(self.seq[row])
+            n = min(s, self.window)
+            slots = np.arange(s - n, s) % self.window
+            return self.timestamps[row, slots], self.values[row][:, slots]
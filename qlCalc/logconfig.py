@@ -0,0 +1,188 @@
+import logging
+import logging.handlers
+import queue
+import threading
+import time
+
+# Format used for the application's log file
+LOG_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+LOG_DATEFMT = "%Y-%m-%d %H:%M:%S.%1s %Z"
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """A QueueHandler that never blocks the logging thread.  Records that do not fit in the bounded queue are counted
+    and dropped, and the count is reported with the next record that does fit."""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0  #: int: records dropped since the last one enqueued
+        self._lock = threading.Lock()
+
+    def enqueue(self, record):
+        with self._lock:
+            dropped = self.dropped
+        if dropped:
+            record.msg = "{} [{} log records dropped]".format(record.msg, dropped)
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+            return
+        if dropped:
+            with self._lock:
+                self.dropped -= dropped
+
+
+class RateLimitFilter(logging.Filter):
+    """Limits how often any one message template is logged, using a token bucket per (logger, level, template).
+
+    Records over the limit are suppressed and counted, and the count is appended to the next record of that template
+    that gets through.  Keying on the unformatted template means a message logged for every cavity shares one
+    budget, which is the point.
+    """
+
+    def __init__(self, rate=10.0, burst=50, max_keys=10000):
+        """Construct a filter.
+            Args:
+                rate (float): Records per second allowed for each template once the burst is used up
+                burst (int): Records of a template allowed back to back
+                max_keys (int): Templates tracked before idle ones are forgotten
+        """
+        super().__init__()
+        self.rate = rate  #: float: sustained records per second per template
+        self.burst = burst  #: int: records per template allowed back to back
+        self.max_keys = max_keys  #: int: templates tracked before idle ones are forgotten
+        self._lock = threading.Lock()
+        self._buckets = {}  # key to [tokens, last refill time, suppressed count]
+
+    def filter(self, record):
+        key = (record.name, record.levelno, record.msg)
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                if len(self._buckets) >= self.max_keys:
+                    self._forget_idle(now)
+                bucket = [float(self.burst), now, 0]
+                self._buckets[key] = bucket
+            else:
+                bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+                bucket[1] = now
+            if bucket[0] < 1:
+                bucket[2] += 1
+                return False
+            bucket[0] -= 1
+            suppressed = bucket[2]
+            bucket[2] = 0
+        if suppressed:
+            record.msg = record.getMessage() + " [{} similar messages suppressed]".format(suppressed)
+            record.args = None
+        return True
+
+    def _forget_idle(self, now):
+        # Buckets that have refilled completely carry no state worth keeping
+        full = [k for k, b in self._buckets.items() if b[2] == 0 and b[0] + (now - b[1]) * self.rate >= self.burst]
+        for k in full:
+            del self._buckets[k]
+        if len(self._buckets) >= self.max_keys:
+            self._buckets.clear()
+
+
+class DuplicateFilter(logging.Filter):
+    """Suppresses a message identical to one logged less than window seconds ago.  The number of repeats is appended
+    to the message the next time it is logged."""
+
+    def __init__(self, window=60.0, max_messages=10000):
+        """Construct a filter.
+            Args:
+                window (float): Seconds during which identical messages are suppressed
+                max_messages (int): Messages remembered before old ones are forgotten
+        """
+        super().__init__()
+        self.window = window  #: float: seconds during which identical messages are suppressed
+        self.max_messages = max_messages  #: int: messages remembered before old ones are forgotten
+        self._lock = threading.Lock()
+        self._seen = {}  # (logger, level, message) to [time first logged, repeats suppressed]
+
+    def filter(self, record):
+        message = record.getMessage()
+        key = (record.name, record.levelno, message)
+        now = time.monotonic()
+        with self._lock:
+            seen = self._seen.get(key)
+            if seen is not None and now - seen[0] < self.window:
+                seen[1] += 1
+                return False
+            repeats = seen[1] if seen is not None else 0
+            if len(self._seen) >= self.max_messages:
+                self._seen = {k: v for k, v in self._seen.items() if now - v[0] < self.window}
+                if len(self._seen) >= self.max_messages:
+                    self._seen.clear()
+            self._seen[key] = [now, 0]
+        if repeats:
+            record.msg = message + " [repeated {} times]".format(repeats)
+            record.args = None
+        return True
+
+
+class AsyncLogging:
+    """Logging through a bounded queue to a background writer thread.
+
+    Application threads only filter the record and put it on the queue, so they never wait on file I/O.  The writer
+    thread (a QueueListener) formats the records and writes them to the handlers.
+    """
+
+    def __init__(self, handlers, level=logging.INFO, queue_size=10000, rate=10.0, burst=50, dedup_window=60.0):
+        """Construct the pipeline.  Nothing is installed until start is called.
+            Args:
+                handlers (list(logging.Handler)): Handlers the writer thread passes records to
+                level (int): Level of the root logger
+                queue_size (int): Records buffered before new ones are dropped
+                rate (float): See RateLimitFilter.  None disables rate limiting.
+                burst (int): See RateLimitFilter
+                dedup_window (float): See DuplicateFilter.  None disables deduplication.
+        """
+        self.level = level  #: int: level of the root logger
+        self.queue = queue.Queue(maxsize=queue_size)  #: queue.Queue: records waiting for the writer thread
+        self.handler = DroppingQueueHandler(self.queue)  #: DroppingQueueHandler: installed on the root logger
+        if rate is not None:
+            self.handler.addFilter(RateLimitFilter(rate=rate, burst=burst))
+        if dedup_window is not None:
+            self.handler.addFilter(DuplicateFilter(window=dedup_window))
+        self.listener = logging.handlers.QueueListener(self.queue, *handlers, respect_handler_level=True)
+
+    def start(self):
+        """Install the queue handler on the root logger and start the writer thread"""
+        root = logging.getLogger()
+        root.setLevel(self.level)
+        root.addHandler(self.handler)
+        self.listener.start()
+
+    def stop(self):
+        """Remove the queue handler and stop the writer thread once it has written every queued record"""
+        logging.getLogger().removeHandler(self.handler)
+        self.listener.stop()
+        for handler in self.listener.handlers:
+            handler.close()
+
+
+def setup_logging(filename, level=logging.INFO, queue_size=10000, rate=10.0, burst=50, dedup_window=60.0):
+    """Send all logging to a file through an AsyncLogging pipeline, unless logging is already configured.
+
+    Like logging.basicConfig, this does nothing if the root logger already has handlers, e.g., when a test harness or
+    a benchmark configured logging first.
+        Args:
+            filename (str): The log file, appended to
+            level (int): Level of the root logger
+            queue_size, rate, burst, dedup_window: See AsyncLogging
+        Returns (AsyncLogging): The started pipeline, or None if logging was already configured
+    """
+    if logging.getLogger().handlers:
+        return None
+    file_handler = logging.FileHandler(filename, mode="a")
+    file_handler.setFormatter(logging.Formatter(LOG_FORMAT, datefmt=LOG_DATEFMT))
+    pipeline = AsyncLogging([file_handler], level=level, queue_size=queue_size, rate=rate, burst=burst,
+                            dedup_window=dedup_window)
+    pipeline.start()
+    return pipeline
@@ -1,162 +1,665 @@
 import logging
-from qlCalc.cryocavity import Cryocavity
+import epics
+from qlCalc.cryocavity import Cryocavity, CavityTask
+from qlCalc.workers import ProcessingPool
+from qlCalc.scheduler import RequestScheduler, staggered_start_times
+from qlCalc.watchdog import RequestWatchdog
+from qlCalc.publisher import ResultPublisher
+from qlCalc.history import ResultHistory
+from qlCalc.fit import WindowedFit
+from qlCalc.checkpoint import Checkpoint
+from qlCalc.resulttable import ResultTable
+from qlCalc.memo import InputMemo
+from qlCalc.ratecontrol import RateController
+from qlCalc.uncertainty import UncertaintyEstimator
+from qlCalc.metrics import PipelineMetrics, MetricsServer
+from qlCalc.metadata import MetadataCache, FileMetadataSource, CEDMetadataSource
+from qlCalc.logconfig import setup_logging
+from qlCalc.aioruntime import AsyncRuntime
+from qlCalc.reload import CavityReloader, file_stamp, read_cavity_list
+import functools
 import time
 import os
 import threading
 import queue
 import signal
-from sortedcontainers import SortedList
 
 # Setup basic app information and environment
 app_name = 'qlCalc'
 app_version = 'v0.1'
 app_dir = os.path.realpath(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
 
-# Set up global logging defaults
-log_level = logging.DEBUG
+# Global logging defaults.  main() writes the log file from a background thread through a bounded queue.  Each
+# message template may be logged log_rate_limit times per second (after a burst of log_rate_burst), and identical
+# messages are suppressed for log_dedup_window seconds.  DEBUG logs every step of every cycle - use it sparingly.
+log_level = logging.INFO
 log_file = os.path.join(app_dir, "log", "qlCalc.log")
-logging.basicConfig(level=log_level, filename=log_file, filemode='a', datefmt="%Y-%m-%d %H:%M:%S.%1s %Z",
-                    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+log_queue_size = 10000
+log_rate_limit = 10
+log_rate_burst = 50
+log_dedup_window = 60
 
 # Get a logger for this module
 logger = logging.getLogger(app_name)
 
+# Where cavity metadata (EPICS name, type, length, R/Q) comes from - "ced" or "file" (metadata_file stands in for the
+# CED) - and the on-disk cache that keeps startup independent of the source.  Cached entries are refreshed after
+# metadata_ttl seconds.
+metadata_source = "file"
+metadata_file = os.path.join(app_dir, "config", "cavities.csv")
+metadata_cache_file = os.path.join(app_dir, "cache", "metadata.sqlite")
+metadata_ttl = 86400
+
+# The cavities to run, if not given to main - one CED name per line, or a CSV file with a cavity_name column such as
+# metadata_file.  None runs the default set.  The file is checked every reload_interval seconds.  When it changes, or on
+# SIGUSR1, cavities added to it are connected and started, removed ones are drained (for up to reload_drain_timeout
+# seconds) and disconnected, and changed metadata is applied in place, without a restart.  The other cavities carry on
+# undisturbed.  Without a file SIGUSR1 still reloads the metadata.
+cavities_file = None
+reload_interval = 5
+reload_drain_timeout = 10
+
+# Overall time in seconds allowed at startup for every cavity's PVs to connect
+connection_timeout = 10
+
+# How cavities read their synchronized *LQ inputs.  See qlCalc.acquisition.INPUT_MODES.  "monitor" relies on STARTLQ
+# and ENDLQ holding Unix time stamps, which is not yet confirmed for the FCC IOCs, so stay with "get" until it is.
+input_mode = "get"
+
+# Width in seconds of the time slots in which due data requests are coalesced into one batched put
+request_slot_width = 0.05
+
+# Each cavity's request interval adapts to its FCC IOC's GETDATA turnaround - backing off (up to request_interval_max)
+# when requests take longer than request_slow_turnaround or time out, and shrinking towards request_interval_min when
+# they are quick.  At most ioc_max_outstanding requests are in flight at any one IOC.  The eight cavities of a zone
+# share one, so a limit of 8 or more never holds anything back.  Set request_rate_control to False for a fixed 1 s
+# interval and no limit.
+request_rate_control = True
+request_interval_min = 0.5
+request_interval_max = 10
+request_slow_turnaround = 2
+ioc_max_outstanding = 4
+
+# Seconds a data request may stay outstanding before it is re-triggered, and the cap on its backed off value
+request_timeout = 5
+request_timeout_max = 60
+
+# Where results go ("epics" or "stdout"), the prefix of the result PVs, and when buffered results are flushed (number
+# of values or seconds, whichever comes first).  Stays "stdout" until the result IOC exists.
+results_out = "stdout"
+results_prefix = "adamc:"
+results_flush_size = 500
+results_flush_interval = 0.1
+
+# Number of recent results per cavity from which the rolling (smoothed) Q values are computed
+history_window = 60
+
+# Number of recent synchronized samples per cavity over which Q_L and attenuation are fitted, and the fewest valid ones
+# a fit needs.  Unlike the single-shot Q values, the fit stays usable at low beam current.  None disables the fit.
+fit_window = 30
+fit_min_samples = 3
+
+# Cycles whose raw inputs changed by no more than their deadbands (input PV suffix to deadband in the PV's units; inputs
+# left out must match exactly) since the results were last calculated skip the calculation and writeback, and only
+# refresh the cavity's heartbeat and window statistic PVs.  Results are recalculated at least every results_max_age
+# seconds anyway.  None disables the check.
+input_deadbands = {}
+results_max_age = 300
+
+# Set estimate_uncertainty to publish the Monte Carlo standard deviation and confidence interval of Q_lf and Q_lr.
+# input_uncertainties maps input PV suffixes to (absolute in the PV's units, relative) standard deviations - see
+# qlCalc.uncertainty.DEFAULT_UNCERTAINTIES for the inputs left out.  All cavities updated in the last
+# uncertainty_interval seconds are estimated together, with uncertainty_draws draws each.
+estimate_uncertainty = False
+input_uncertainties = {}
+uncertainty_draws = 2000
+uncertainty_confidence = 0.9
+uncertainty_interval = 1.0
+
+# Per-stage latency, queue depth and update rate metrics are written to metrics_snapshot_file every
+# metrics_snapshot_interval seconds (None writes none), and served at http://127.0.0.1:<metrics_http_port>/metrics if a
+# port is set
+metrics_snapshot_file = os.path.join(app_dir, "log", "metrics.json")
+metrics_snapshot_interval = 10
+metrics_http_port = None
+
+# Local processes can read every cavity's latest results from a memory-mapped table in results_table_file, e.g.,
+# /dev/shm/qlCalc-results (see qlCalc.resulttable).  None disables the table.
+results_table_file = None
+
+# Every cavity's request interval, schedule phase, turnaround and latest results are saved to checkpoint_file every
+# checkpoint_interval seconds and at exit, and restored at startup unless older than checkpoint_max_age seconds, a few
+# of the longest request intervals, beyond which the saved schedule and turnarounds no longer say much.  Restored
+# results are never published as current, only fresh ones are.  None disables the checkpoint.  Either way the
+# initial requests are spread over the request interval.
+checkpoint_file = os.path.join(app_dir, "cache", "checkpoint.json")
+checkpoint_interval = 30
+checkpoint_max_age = 3 * request_interval_max
+
+# Number of threads processing new cavity data and how often (seconds) to log their throughput
+num_process_workers = 4
+stats_interval = 60
+
+# How the request/process cycle runs - "threads" (a request thread, a pool of processing threads and a watchdog
+# thread, joined by queues) or "asyncio" (one event loop with a timer per cavity, doing blocking CA work in a pool of
+# num_process_workers threads)
+runtime = "threads"
+
 # Create a signaling event that we are exiting.  This will be used to coordinate shutdown of threads, CA monitors, etc.
 shutdown_event = threading.Event()
+# The signal that requested the shutdown, set by sig_handler.  None if there was none.
+shutdown_signal = None
 
 
 def sig_handler(signum, frame):
-    """Method to handle a number of signals that indicate shutdown request"""
-    logger.info("received signal '%s' - gracefully terminating.", signum)
-    shutdown_event.set()
-
+    """Method to handle a number of signals that indicate shutdown request.
 
-def process_new_data(cav_dict, update_queue, req_queue, event):
-    """Callable meant to be run in own thread to handle the processing of new data
-        Args:
-            cav_dict (dict): A dictionary of cavity names to Cryocavity objects
-            update_queue (queue.Queue): The queue from which CavityTasks will be read
-            req_queue (queue.Queue): The queue to which CavityTasks will be written to after processing associated data.
-            event (threading.Event): Event used to signal application shutdown
+    Logging from a signal handler can deadlock on a lock held by the interrupted main thread, e.g., the log queue's,
+    so the signal is only recorded here and log_shutdown_signal logs it from the main thread.
     """
-    while not event.is_set() or not update_queue.empty():
-        logger.debug("Top of process_new_data loop.  event.is_set = %s", str(event.is_set()))
-        cavity_task = update_queue.get()
-        cavity_name = cavity_task.cavity_name
-        logger.debug("process_new_data thread received cavity '%s'", cavity_name)
-        cav_dict[cavity_name].process_new_data()
-        logger.debug("process_new_data thread finished new cavity data %s", cavity_name)
-        logger.debug("process_new_data thread writing '%s' to request_queue", cavity_name)
-        req_queue.put(cavity_task)
+    global shutdown_signal
+    shutdown_signal = signum
+    shutdown_event.set()
 
-    logger.debug("process_new_data method has exited")
 
+def log_shutdown_signal():
+    """Log the signal that requested the shutdown, if any.  Called by the main thread once shutdown_event is set."""
+    if shutdown_signal is not None:
+        logger.info("received signal '%s' - gracefully terminating.", shutdown_signal)
 
-def request_new_data(cav_dict, req_queue, event):
+
+def request_new_data(cav_dict, req_queue, event, scheduler=None, rate_controller=None):
     """Callable meant to be run in own thread to handle the scheduling of making the next data request for a cavity
         Args:
             cav_dict (dict): A dictionary of cavity names to Cryocavity objects
             req_queue (queue.Queue): The queue from which cavity tasks are read
             event (threading.Event): An event used to signal application shutdown
+            scheduler (RequestScheduler): The schedule of pending requests.  None creates one using request_slot_width.
+            rate_controller (RateController): Holds back requests to IOCs at their limit.  None for no limit.
             """
 
-    # Sort the requests according to the time at which the request should occur.  Earlier times first.
-    # TODO: The order on this sorting may need to be reversed.  Check it out
-    schedule = SortedList(key=lambda x: x.request_timestamp)
-    while not event.is_set() or not req_queue.empty() or len(schedule) != 0:
+    # Requests are released in time slots, earliest first, and each slot's requests are made with one batched put
+    if scheduler is None:
+        scheduler = RequestScheduler(slot_width=request_slot_width)
+    while not event.is_set() or not req_queue.empty() or len(scheduler) != 0:
         logger.debug("Top of request_new_data loop.  event.is_set = %s", str(event.is_set()))
-        # We don't have anything in the schedule, so just wait on the next item to arrive in the queue
-        if len(schedule) == 0:
-            # TODO: is this timeout actually needed here?
-            get_cavity_notification(req_queue, schedule, 15)
-
-        # We have something in the queue.  It may be time to make the request.  If so do it, if not try to get something
-        # from the queue until it is time to make that request.
-        if len(schedule) != 0:
-            # Should always assign to next_req since len(schedule) > 0.  Assignment here to quiet IDE warnings
-            next_req = None
-            for req in schedule:
-                next_req = req
-                break
-            next_req_ts = next_req.request_timestamp
-            if next_req_ts <= time.time():
-                # Remove the notice from the schedule and make the request
-                schedule.pop(0)
-                cav_dict[next_req.cavity_name].request_new_data()
+        # We don't have anything in the schedule, so just wait on the next item to arrive in the queue.  The timeout
+        # lets shutdown be noticed while nothing is scheduled, e.g., before the first staggered trigger is answered.
+        if len(scheduler) == 0:
+            get_cavity_notification(req_queue, scheduler, 1)
+
+        # We have something in the queue.  It may be time to make the requests.  If so do it, if not try to get
+        # something from the queue until it is time to make them.
+        if len(scheduler) != 0:
+            now = time.time()
+            release_ts = scheduler.next_release_time()
+            if release_ts <= now:
+                due = scheduler.pop_due(now)
+                if rate_controller is not None:
+                    due, deferred = rate_controller.admit(due)
+                    # Once shutting down no more data is expected, so an IOC at its limit may never free a slot
+                    if not event.is_set():
+                        for task in deferred:
+                            task.request_timestamp = now + rate_controller.retry_delay
+                            scheduler.add(task)
+                # Cavities removed since they were scheduled are dropped here
+                Cryocavity.request_new_data_batch([cav_dict[task.cavity_name] for task in due
+                                                   if task.cavity_name in cav_dict])
             else:
-                to = next_req_ts - time.time()
-                get_cavity_notification(req_queue, schedule, to)
+                get_cavity_notification(req_queue, scheduler, release_ts - now)
 
     logger.debug("at end of request_new_data method/thread")
 
 
+def trigger_staggered(cav_dict, start_times, event):
+    """Callable meant to be run in own thread.  Force triggers each cavity's initial data collection at its start
+    time, with one batched put per time slot, until all are triggered or shutdown.
+        Args:
+            cav_dict (dict): A dictionary of cavity names to Cryocavity objects
+            start_times (dict): Cavity name to the time.time() of its initial trigger
+            event (threading.Event): An event used to signal application shutdown
+    """
+    schedule = RequestScheduler(slot_width=request_slot_width)
+    for name, timestamp in start_times.items():
+        schedule.add(CavityTask(name, timestamp))
+    start = time.time()
+    while len(schedule) != 0 and not event.is_set():
+        now = time.time()
+        release_ts = schedule.next_release_time()
+        if release_ts > now:
+            event.wait(release_ts - now)
+            continue
+        Cryocavity.trigger_data_collection_batch([cav_dict[task.cavity_name] for task in schedule.pop_due(now)
+                                                  if task.cavity_name in cav_dict])
+    logger.info("Triggered initial data collection on %d cavities over %.3f s", len(start_times) - len(schedule),
+                time.time() - start)
+
+
 def get_cavity_notification(req_queue, schedule, timeout=None):
     """Attempts to read from request queue (with timeout) and adds the request to the 'schedule' data structure.
 
         Args:
             req_queue (queue.Queue):  The queue from which to read the next CavityNotification
-            schedule (sortedcontainers.SortedList): The sorted list representing the request schedule
+            schedule (RequestScheduler): The request schedule
             timeout (float): How long to attempt to read from the queue.  None for infinite wait
 
         Returns (None):  Returns nothing
     """
     try:
         cav = req_queue.get(timeout=timeout)
-        logger.debug("Read (%s, %f) from request_queue.", cav.cavity_name, cav.request_timestamp)
         schedule.add(cav)
-        logger.debug("Added (%s, %f) to schedule.", cav.cavity_name, cav.request_timestamp)
+        logger.debug("Added (%s, %f) from request_queue to schedule.", cav.cavity_name, cav.request_timestamp)
     except queue.Empty:
         # Timeout causes an exception to be thrown.  Just continue on.
         logger.debug("req_queue.get timed out after %d seconds.", timeout)
 
 
-# TODO: Need to add thread that sleeps for a while (maybe 10 seconds?) and then iterates over Cryocavity objects to see
-# when the last request was made and if we're still waiting on it.  If we'e been waiting longer than a timeout,
-# re-trigger the request and write out NaN's as results.
-def main():
-    logger.info("{} {} beginning execution".format(app_name, app_version))
+def log_pool_stats(pool):
+    """Log and reset the throughput and queue wait statistics of a ProcessingPool"""
+    stats = pool.get_stats(reset=True)
+    logger.info("Processed %d cavities (%d failed) in %.1f s: %.1f/s, queue wait mean %.4f s max %.4f s",
+                stats["processed"], stats["failed"], stats["elapsed"], stats["throughput"], stats["mean_queue_wait"],
+                stats["max_queue_wait"])
 
-    # Attach the "shutdown" signal handler to appropriate signals
-    signal.signal(signal.SIGHUP, sig_handler)
-    signal.signal(signal.SIGINT, sig_handler)
-    signal.signal(signal.SIGQUIT, sig_handler)
-    signal.signal(signal.SIGTERM, sig_handler)
 
-    # Queue for tracking which cavities have new data available and for tracking future requests.  maxsize=1000 since
-    # that is roughly twice the max number of cavities.  Should only ever have one active entry for each cavity, and
-    # this provides a nice safety margin.
-    update_queue = queue.Queue(maxsize=1000)
-    request_queue = queue.Queue(maxsize=1000)
+def log_scheduler_stats(scheduler):
+    """Log and reset the lateness and jitter statistics of a RequestScheduler"""
+    stats = scheduler.get_stats(reset=True)
+    logger.info("Made %d requests in %d batches (mean %.1f/batch), lateness mean %.4f s max %.4f s, jitter %.4f s",
+                stats["requests"], stats["batches"], stats["mean_batch_size"], stats["mean_lateness"],
+                stats["max_lateness"], stats["jitter"])
+
+
+def log_watchdog_stats(watchdog):
+    """Log the timeout counters of a RequestWatchdog"""
+    stats = watchdog.get_stats()
+    logger.info("%d requests outstanding, %d timed out in total.  Timeouts by cavity: %s", stats["outstanding"],
+                stats["timeouts"], stats["timed_out_cavities"])
+
+
+def log_runtime_stats(async_runtime):
+    """Log and reset the throughput and timeout statistics of an AsyncRuntime"""
+    stats = async_runtime.get_stats(reset=True)
+    logger.info("Processed %d cavities (%d failed) in %.1f s: %.1f/s, made %d requests in %d batches, %d timed out",
+                stats["processed"], stats["failed"], stats["elapsed"], stats["throughput"], stats["requests"],
+                stats["batches"], stats["timeouts"])
+
+
+def log_rate_stats(rate_controller):
+    """Log the request intervals and IOC load tracked by a RateController, resetting its counters"""
+    stats = rate_controller.get_stats(reset=True)
+    logger.info("Request interval mean %.3f s (%.3f - %.3f s), turnaround mean %.3f s, %d requests outstanding (max %d "
+                "at one IOC), %d backoffs, %d deferred", stats["mean_interval"], stats["min_interval"],
+                stats["max_interval"], stats["mean_turnaround"], stats["outstanding"], stats["max_ioc_outstanding"],
+                stats["backoffs"], stats["deferred"])
+
+
+def log_uncertainty_stats(estimator):
+    """Log and reset the pass statistics of an UncertaintyEstimator"""
+    stats = estimator.get_stats(reset=True)
+    logger.info("Estimated uncertainties of %d cavities in %d passes, pass time mean %.3f s max %.3f s",
+                stats["estimated"], stats["passes"], stats["mean_pass_time"], stats["max_pass_time"])
+
+
+def log_memo_stats(memo):
+    """Log and reset the hit and miss counts of an InputMemo"""
+    stats = memo.get_stats(reset=True)
+    logger.info("Reused unchanged results %d times, recalculated %d times (hit rate %.2f)", stats["hits"],
+                stats["misses"], stats["hit_rate"])
+
+
+def log_publisher_stats(publisher):
+    """Log and reset the latency and backlog statistics of a ResultPublisher"""
+    stats = publisher.get_stats(reset=True)
+    logger.info("Published %d results (%d unchanged skipped) in %d flushes, latency mean %.4f s max %.4f s, "
+                "backlog %d", stats["published"], stats["unchanged"], stats["flushes"], stats["mean_latency"],
+                stats["max_latency"], stats["backlog"])
+
+
+def load_metadata(cav_names, refresh=False):
+    """Look up cavity metadata through the metadata cache.
+        Args:
+            cav_names (iterable(str)): CED names of the cavities
+            refresh (bool): Go to metadata_source for every cavity, not just those missing or past metadata_ttl
+        Returns (dict): Cavity name to CavityMetadata for the cavities found
+    """
+    source = CEDMetadataSource() if metadata_source == "ced" else FileMetadataSource(metadata_file)
+    return MetadataCache(metadata_cache_file, ttl=metadata_ttl).load(cav_names, source=source, refresh=refresh)
+
+
+def main(cav_names=None, pv_factory=epics.PV, metadata=None):
+    """Run the application until shutdown_event is set.
+        Args:
+            cav_names (tuple(str)): CED names of the cavities to run.  None reads cavities_file, or uses the default set
+              without one.
+            pv_factory (callable): Creates PV objects from PV names, e.g., SimulatedIOC.pv_factory for load testing
+            metadata (dict): Cavity name to CavityMetadata.  None loads it through the metadata cache.
+    """
+    # Does nothing if logging was configured by whoever called main, e.g., a test or benchmark
+    log_pipeline = setup_logging(log_file, level=log_level, queue_size=log_queue_size, rate=log_rate_limit,
+                                 burst=log_rate_burst, dedup_window=log_dedup_window)
+    logger.info("{} {} beginning execution".format(app_name, app_version))
+
+    # Attach the "shutdown" signal handler to appropriate signals.  Only possible from the main thread.
+    if threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGHUP, sig_handler)
+        signal.signal(signal.SIGINT, sig_handler)
+        signal.signal(signal.SIGQUIT, sig_handler)
+        signal.signal(signal.SIGTERM, sig_handler)
 
     # TODO: Setup dev soft IOC for writing out results
     # Various "pre-built" lists for testing - my dev soft FCC IOC has zones TL02 - TL26 and VL02 - VL26
     # cav_names = ("VL26-7", "VL26-8")
     # cav_names = ("VL26-7",)
-    cav_names = ("VL26-1", "VL26-2", "VL26-3", "VL26-4", "VL26-5", "VL26-6", "VL26-7", "VL26-8")
+    watched_file = None
+    watched_stamp = None
+    if cav_names is None and cavities_file is not None:
+        watched_stamp = file_stamp(cavities_file)
+        cav_names = tuple(read_cavity_list(cavities_file))
+        watched_file = cavities_file
+    if cav_names is None:
+        cav_names = ("VL26-1", "VL26-2", "VL26-3", "VL26-4", "VL26-5", "VL26-6", "VL26-7", "VL26-8")
+
+    # Queue for tracking which cavities have new data available and for tracking future requests.  maxsize=1000 since
+    # that is roughly twice the max number of cavities.  Should only ever have one active entry for each cavity, and
+    # this provides a nice safety margin.  Larger (e.g., simulated) machines get the same margin.
+    # The asyncio runtime hands new data straight to its event loop instead.
+    async_runtime = None
+    rate_controller = None
+    if request_rate_control:
+        rate_controller = RateController(min_interval=request_interval_min, max_interval=request_interval_max,
+                                         slow_turnaround=request_slow_turnaround, max_outstanding=ioc_max_outstanding)
+    if runtime == "asyncio":
+        async_runtime = AsyncRuntime(shutdown_event, num_workers=num_process_workers, slot_width=request_slot_width,
+                                     request_timeout=request_timeout, max_timeout=request_timeout_max,
+                                     rate_controller=rate_controller)
+        update_queue = async_runtime.update_queue
+    else:
+        update_queue = queue.Queue(maxsize=max(1000, 2 * len(cav_names)))
+    request_queue = queue.Queue(maxsize=max(1000, 2 * len(cav_names)))
+
+    # Look up each cavity's metadata, going to the source only for cavities not cached or past their TTL
+    if metadata is None:
+        metadata = load_metadata(cav_names)
+
+    # Create every cavity's PVs and connect them concurrently.  Cavities that fail to connect are logged and left out.
+    # Cavities added by a reload are created the same way.
+    def create_cavities(names, md):
+        return Cryocavity.create_cryocavities(names, update_queue=update_queue, shutdown_event=shutdown_event,
+                                              epics_prefix="adamc:", input_mode=input_mode,
+                                              connection_timeout=connection_timeout, pv_factory=pv_factory, metadata=md)
+    cav_dict, failed = create_cavities(cav_names, metadata)
+
+    # Resume the request intervals and latest results saved before the last exit
+    checkpoint = None
+    saved = {}
+    if checkpoint_file is not None:
+        checkpoint = Checkpoint(checkpoint_file, cav_dict, rate_controller=rate_controller)
+        saved = checkpoint.restore(max_age=checkpoint_max_age)
+
+    # Time every stage of every cavity's cycle and watch the depth of the queues between them
+    metrics = PipelineMetrics()
+    for cc in cav_dict:
+        metrics.add_cavity(cc, cav_dict[cc].request_interval)
+        cav_dict[cc].metrics = metrics
+    metrics.add_gauge("update_queue", update_queue.qsize)
+    metrics.add_gauge("request_queue", request_queue.qsize)
+    metrics_thread = None
+    if metrics_snapshot_file is not None:
+        metrics_thread = threading.Thread(target=metrics.run_snapshots,
+                                          args=(metrics_snapshot_file, metrics_snapshot_interval, shutdown_event))
+        metrics_thread.start()
+    metrics_server = None
+    if metrics_http_port is not None:
+        metrics_server = MetricsServer(metrics, port=metrics_http_port)
+        metrics_server.start()
+        logger.info("Serving metrics on port %d", metrics_server.port)
+
+    # Keep recent results so that smoothed Q values can be published alongside each new result
+    history = ResultHistory(cav_dict.keys(), window=history_window)
+    for cc in cav_dict:
+        cav_dict[cc].history = history
+
+    # Fit Q_L and attenuation over recent samples, updating each cavity's fit as its samples arrive
+    fit = None
+    if fit_window is not None:
+        fit = WindowedFit(cav_dict.keys(), window=fit_window, min_samples=fit_min_samples)
+        for cc in cav_dict:
+            cav_dict[cc].fit = fit
+
+    for cc in cav_dict:
+        cav_dict[cc].rate_controller = rate_controller
+
+    # Skip recalculating and republishing results whose inputs have not changed
+    memo = None
+    if input_deadbands is not None:
+        memo = InputMemo(deadbands=input_deadbands, max_age=results_max_age)
+        for cc in cav_dict:
+            cav_dict[cc].memo = memo
+
+    # Buffer results and write them to EPICS in batches.  The publisher has its own stop event so that it outlives the
+    # processing workers and publishes their final results.
+    for cc in cav_dict:
+        cav_dict[cc].results_out = results_out
+    publisher_stop = threading.Event()
+    publisher = None
+    publisher_thread = None
+    if results_out == "epics":
+        publisher = ResultPublisher(publisher_stop, pv_prefix=results_prefix, flush_size=results_flush_size,
+                                    flush_interval=results_flush_interval, pv_factory=pv_factory)
+        for cc in cav_dict:
+            cav_dict[cc].publisher = publisher
+            publisher.register(cav_dict[cc])
+        publisher_thread = threading.Thread(target=publisher.run)
+        publisher_thread.start()
+
+    # Share every result with local processes through a memory-mapped table
+    results_table = None
+    if results_table_file is not None:
+        results_table = ResultTable(results_table_file, cav_dict.keys())
+        for cc in cav_dict:
+            cav_dict[cc].results_table = results_table
+        logger.info("Writing results to the table %s", results_table_file)
+
+    checkpoint_stop = threading.Event()
+    checkpoint_thread = None
+    if checkpoint is not None:
+        checkpoint_thread = threading.Thread(target=checkpoint.run, args=(checkpoint_interval, checkpoint_stop))
+        checkpoint_thread.start()
+
+    # Estimate the uncertainty of the Q values of every recently updated cavity in one pass per interval
+    uncertainty_thread = None
+    estimator = None
+    if estimate_uncertainty:
+        estimator = UncertaintyEstimator(shutdown_event, uncertainties=input_uncertainties, draws=uncertainty_draws,
+                                         confidence=uncertainty_confidence, interval=uncertainty_interval)
+        for cc in cav_dict:
+            cav_dict[cc].uncertainty = estimator
+        uncertainty_thread = threading.Thread(target=estimator.run)
+        uncertainty_thread.start()
+
+    # Add, remove and update cavities when the cavity list changes or on SIGUSR1, attaching the same shared objects.
+    # The runtime completes the reloader with its own hooks.
+    make_reloader = functools.partial(CavityReloader, cav_dict, create_cavities,
+                                      functools.partial(load_metadata, refresh=True), path=watched_file,
+                                      cavity_names=cav_names, drain_timeout=reload_drain_timeout, stamp=watched_stamp,
+                                      results_out=results_out, metrics=metrics, history=history, fit=fit,
+                                      rate_controller=rate_controller, memo=memo, publisher=publisher,
+                                      results_table=results_table, uncertainty=estimator)
 
-    cav_dict = {}
-    for cav in cav_names:
-        logger.debug("About to create_cryocavity %s", cav)
-        cc = Cryocavity.create_cryocavity(cav, update_queue=update_queue, shutdown_event=shutdown_event,
-                                          epics_prefix="adamc:")
-        cav_dict[cav] = cc
-        logger.debug("About to trigger data collection on %s", cc.cavity_name)
+    def log_output_stats():
+        if estimator is not None:
+            log_uncertainty_stats(estimator)
+        if rate_controller is not None:
+            log_rate_stats(rate_controller)
+        if publisher is not None:
+            log_publisher_stats(publisher)
+        if memo is not None:
+            log_memo_stats(memo)
 
+    # Spread the initial requests over the request interval instead of sending them all at once
+    start_times = staggered_start_times(cav_dict, time.time(), saved)
+    if async_runtime is not None:
+        run_async_runtime(async_runtime, cav_dict, log_output_stats, start_times, make_reloader)
+    else:
+        run_threads(cav_dict, update_queue, request_queue, metrics, log_output_stats, rate_controller, start_times,
+                    make_reloader)
+    if uncertainty_thread is not None:
+        uncertainty_thread.join()
+    if checkpoint_thread is not None:
+        checkpoint_stop.set()
+        checkpoint_thread.join()
+    if publisher_thread is not None:
+        publisher_stop.set()
+        publisher_thread.join()
+    if results_table is not None:
+        results_table.close()
+    if metrics_thread is not None:
+        metrics_thread.join()
+    if metrics_server is not None:
+        metrics_server.stop()
+    log_output_stats()
+
+    logger.debug("main routine exiting.")
+    if log_pipeline is not None:
+        log_pipeline.stop()
+
+
+def start_reloader(reloader):
+    """Run a CavityReloader on its own thread and have SIGUSR1 request a reload, if possible from this thread.
+        Args:
+            reloader (CavityReloader): The reloader
+        Returns (threading.Thread): The started reload thread
+    """
+    if threading.current_thread() is threading.main_thread():
+        def reload_handler(signum, frame):
+            # No logging here, see sig_handler.  The reloader logs the request.
+            reloader.request()
+        signal.signal(signal.SIGUSR1, reload_handler)
+    reload_thread = threading.Thread(target=reloader.run, args=(reload_interval, shutdown_event))
+    reload_thread.start()
+    return reload_thread
+
+
+def run_threads(cav_dict, update_queue, request_queue, metrics, log_output_stats, rate_controller=None,
+                start_times=None, make_reloader=None):
+    """Run the request/process cycle on a request thread, a processing pool and a watchdog thread until
+    shutdown_event is set.
+        Args:
+            cav_dict (dict): A dictionary of cavity names to Cryocavity objects
+            update_queue (queue.Queue): The queue the cavities put CavityTasks on when new data is available
+            request_queue (queue.Queue): The queue processed CavityTasks are scheduled from
+            metrics (PipelineMetrics): Gets a gauge of the request schedule
+            log_output_stats (callable): Logs the publisher's (and memo's) stats along with the others
+            rate_controller (RateController): Holds back requests to IOCs at their limit.  None for no limit.
+            start_times (dict): Cavity name to the time.time() of its initial trigger.  None triggers all at once.
+            make_reloader (callable): Creates the CavityReloader that reloads the cavities from its own thread while
+              running, given the watchdog, start and drain hooks.  None for a fixed set.
+        Returns (None): Returns nothing
+    """
+    # Watch every request for timeouts, starting with the initial triggers
+    watchdog = RequestWatchdog(cav_dict, shutdown_event, timeout=request_timeout, max_timeout=request_timeout_max)
     for cc in cav_dict:
-        cav_dict[cc].trigger_data_collection()
+        cav_dict[cc].watchdog = watchdog
+    watchdog_thread = threading.Thread(target=watchdog.run)
+    watchdog_thread.start()
+
+    if start_times is None:
+        start = time.time()
+        Cryocavity.trigger_data_collection_batch(list(cav_dict.values()))
+        logger.info("Triggered initial data collection on %d cavities in %.3f s", len(cav_dict), time.time() - start)
+        trigger_thread = None
+    else:
+        trigger_thread = threading.Thread(target=trigger_staggered, args=(cav_dict, start_times, shutdown_event))
+        trigger_thread.start()
 
-    # Start a thread that will process the data associated with a new set of data for an individual cavity
-    request_thread = threading.Thread(target=request_new_data, args=(cav_dict, request_queue, shutdown_event))
+    # Start a thread that schedules requests and a pool of workers that process the new data for individual cavities
+    scheduler = RequestScheduler(slot_width=request_slot_width)
+    metrics.add_gauge("schedule", scheduler.__len__)
+    request_thread = threading.Thread(target=request_new_data,
+                                      args=(cav_dict, request_queue, shutdown_event, scheduler, rate_controller))
     request_thread.start()
-    update_thread = threading.Thread(target=process_new_data,
-                                     args=(cav_dict, update_queue, request_queue, shutdown_event))
-    update_thread.start()
+    pool = ProcessingPool(cav_dict, update_queue, request_queue, shutdown_event, num_workers=num_process_workers)
+    pool.start()
+
+    # Added cavities get the same staggered start, from the reload thread.  Removed ones are drained by the pool and
+    # their scheduled requests dropped, so that a cavity added again under the same name starts a single cycle.
+    reloader = None
+    reload_thread = None
+    if make_reloader is not None:
+        def start_added(cavities, added_start_times):
+            trigger_staggered(cav_dict, added_start_times, shutdown_event)
 
-    # Now hangout, waiting to receive a signal that will trigger a shutdown
-    update_thread.join()
+        def drain_removed(cavity_name, timeout):
+            drained = pool.drain(cavity_name, timeout)
+            scheduler.discard(cavity_name)
+            return drained
+        reloader = make_reloader(watchdog=watchdog, start=start_added, drain=drain_removed)
+        reload_thread = start_reloader(reloader)
+
+    # Now hangout, waiting to receive a signal that will trigger a shutdown.  Report processing throughput meanwhile.
+    while not shutdown_event.wait(stats_interval):
+        log_pool_stats(pool)
+        log_scheduler_stats(scheduler)
+        log_watchdog_stats(watchdog)
+        log_output_stats()
+    log_shutdown_signal()
+    if reload_thread is not None:
+        reloader.request()
+        reload_thread.join()
+    pool.join()
     request_thread.join()
+    watchdog_thread.join()
+    if trigger_thread is not None:
+        trigger_thread.join()
+    log_pool_stats(pool)
+    log_scheduler_stats(scheduler)
+    log_watchdog_stats(watchdog)
 
-    logger.debug("main routine exiting.")
+
+def run_async_runtime(async_runtime, cav_dict, log_output_stats, start_times=None, make_reloader=None):
+    """Run the request/process cycle on an AsyncRuntime until shutdown_event is set.
+        Args:
+            async_runtime (AsyncRuntime): The runtime, whose update queue the cavities were created with
+            cav_dict (dict): A dictionary of cavity names to Cryocavity objects
+            log_output_stats (callable): Logs the publisher's (and memo's) stats along with the runtime's
+            start_times (dict): Cavity name to the time.time() of its initial trigger.  None triggers all at once.
+            make_reloader (callable): Creates the CavityReloader that reloads the cavities from its own thread while
+              running, given the start and drain hooks.  None for a fixed set.
+        Returns (None): Returns nothing
+    """
+    for cc in cav_dict:
+        async_runtime.add_cavity(cav_dict[cc])
+
+    # Removing a cavity from the runtime also cancels its request and timeout timers
+    reloader = None
+    reload_thread = None
+    if make_reloader is not None:
+        reloader = make_reloader(start=async_runtime.add_cavities, drain=async_runtime.remove_cavity)
+        reload_thread = start_reloader(reloader)
+
+    # sig_handler and callers like the load test only set shutdown_event, so stop the loop when it is set.  The
+    # runtime's own signal handlers would replace sig_handler, and with it the logging of the signal, so are not used.
+    def stop_on_shutdown():
+        shutdown_event.wait()
+        async_runtime.stop()
+    stop_thread = threading.Thread(target=stop_on_shutdown, daemon=True)
+    stop_thread.start()
+
+    def log_stats(rt):
+        log_runtime_stats(rt)
+        log_output_stats()
+
+    logger.info("Running %d cavities on the asyncio runtime", len(cav_dict))
+    async_runtime.run(stats_callback=log_stats, stats_interval=stats_interval, install_signal_handlers=False,
+                      start_times=start_times)
+    shutdown_event.set()
+    log_shutdown_signal()
+    stop_thread.join()
+    if reload_thread is not None:
+        reloader.request()
+        reload_thread.join()
+    log_runtime_stats(async_runtime)
 
 
 if __name__ == '__main__':
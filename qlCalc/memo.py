@@ -0,0 +1,112 @@
+import logging
+import threading
+import time
+
+from qlCalc.acquisition import INPUT_PVS
+
+logger = logging.getLogger(__name__)
+
+# Default deadband of each raw input, in the units of its PV.  A change no larger than the deadband does not count as a
+# change.  0 means any change does.
+DEFAULT_DEADBANDS = {
+    "GMESLQ": 0.0,  # MV/m
+    "CRFPLQ": 0.0,  # kW
+    "CRRPLQ": 0.0,  # kW
+    "DETALQ": 0.0,  # degrees
+    "ITOTLQ": 0.0,  # uA
+}
+
+
+class InputMemo:
+    """Remembers the raw inputs each cavity's current results were calculated from, so that a cycle whose inputs have
+    not changed meaningfully can skip the calculation and the writeback of identical results.
+
+    Each input is compared with the value the results were calculated from (not the previous sample), so a slow drift
+    is caught once it adds up to more than the deadband.  Results are still recalculated at least every max_age
+    seconds, and whenever invalidate is called, e.g., after NaN results were published.  Inputs that are not finite
+    never match.
+    """
+
+    def __init__(self, deadbands=None, max_age=300.0):
+        """Construct an empty memo.
+            Args:
+                deadbands (dict): Input PV suffix (see acquisition.INPUT_PVS) to deadband in the PV's units.  Inputs
+                  left out use DEFAULT_DEADBANDS.
+                max_age (float): Longest time in seconds results are reused before being recalculated anyway.  None
+                  reuses them indefinitely.
+        """
+        merged = dict(DEFAULT_DEADBANDS)
+        if deadbands is not None:
+            unknown = set(deadbands) - set(INPUT_PVS)
+            if unknown:
+                raise ValueError("Deadbands given for unknown inputs {}".format(sorted(unknown)))
+            merged.update(deadbands)
+        for name, band in merged.items():
+            if band < 0:
+                raise ValueError("Deadband of {} must not be negative, got {}".format(name, band))
+        self.deadbands = tuple(merged[name] for name in INPUT_PVS)  #: tuple(float): deadbands in INPUT_PVS order
+        self.max_age = max_age  #: float: longest time in seconds results are reused
+
+        self._lock = threading.Lock()
+        self._entries = {}  # Cavity name to (tuple of inputs the results came from, time they were calculated)
+        self._hits = 0
+        self._misses = 0
+        self._stats_start = time.time()
+
+    def check(self, cavity_name, values, now=None):
+        """Decide whether a cavity's current results still hold for a new set of inputs.  On a miss the new inputs
+        become the reference the next ones are compared with.
+            Args:
+                cavity_name (str): The cavity
+                values (sequence(float)): Raw input values in INPUT_PVS order, as returned by Cryocavity.read_inputs
+                now (float): time.time() of the check.  None means now.
+            Returns (bool): True (a hit) if the results can be reused, False if they must be recalculated
+        """
+        if now is None:
+            now = time.time()
+        values = tuple(values)
+        with self._lock:
+            entry = self._entries.get(cavity_name)
+            if entry is not None and self._matches(entry[0], values) and (
+                    self.max_age is None or now - entry[1] < self.max_age):
+                self._hits += 1
+                return True
+            self._entries[cavity_name] = (values, now)
+            self._misses += 1
+            return False
+
+    def _matches(self, reference, values):
+        for ref, value, band in zip(reference, values, self.deadbands):
+            try:
+                if not abs(value - ref) <= band:
+                    return False
+            except TypeError:
+                return False
+        return True
+
+    def invalidate(self, cavity_name):
+        """Make the next check of a cavity a miss, e.g., because its results or parameters were replaced"""
+        with self._lock:
+            self._entries.pop(cavity_name, None)
+
+    def get_stats(self, reset=False):
+        """Report how often results were reused since the memo was created or the stats were last reset.
+            Args:
+                reset (bool): Start a new measurement interval after reading the stats
+            Returns (dict): Keys are hits, misses, hit_rate (hits over checks, 0 without checks), elapsed (s) and
+              cavities (number of cavities with remembered inputs)
+        """
+        with self._lock:
+            checks = self._hits + self._misses
+            stats = {
+                "hits": self._hits,
+                "misses": self._misses,
+                "hit_rate": self._hits / checks if checks else 0.0,
+                "elapsed": time.time() - self._stats_start,
+                "cavities": len(self._entries),
+            }
+            if reset:
+                self._hits = 0
+                self._misses = 0
+                self._stats_start = time.time()
+        return stats
@@ -0,0 +1,217 @@
+import collections
+import csv
+import json
+import logging
+import os
+import sqlite3
+import time
+import urllib.parse
+import urllib.request
+
+import qlCalc.utils
+
+logger = logging.getLogger(__name__)
+
+#: The static description of a cryocavity needed to construct it
+CavityMetadata = collections.namedtuple("CavityMetadata", ("cavity_name", "epics_name", "cavity_type", "length", "RQ"))
+
+# Used for any field a source does not provide.  These are the C100 values the factory has always assumed.
+DEFAULT_CAVITY_TYPE = "c100"
+DEFAULT_LENGTH = 0.7
+DEFAULT_RQ = 868.9
+
+
+def static_metadata(cavity_name):
+    """Metadata for a cavity from the built in name mapper and the C100 defaults, for use without any source.
+        Args:
+            cavity_name (str): The CED name of the cavity
+        Returns (CavityMetadata): The cavity's metadata
+    """
+    return CavityMetadata(cavity_name, qlCalc.utils.get_epics_cavity_name(cavity_name), DEFAULT_CAVITY_TYPE,
+                          DEFAULT_LENGTH, DEFAULT_RQ)
+
+
+class MetadataSourceError(Exception):
+    """Raised when a metadata source cannot be read"""
+    pass
+
+
+class FileMetadataSource:
+    """Reads cavity metadata from a local CSV file that stands in for the CED.
+
+    The file needs a header row with the columns cavity_name and epics_name.  cavity_type, length and RQ columns are
+    optional and default to the C100 values.  Rows with a length or RQ that is not a number are logged and skipped.
+    """
+
+    def __init__(self, path):
+        self.path = path  #: str: path of the CSV file
+
+    def fetch(self, cavity_names=None):
+        """Read metadata for the requested cavities.
+            Args:
+                cavity_names (iterable(str)): The cavities wanted.  None returns every cavity in the file.
+            Returns (dict): Cavity name to CavityMetadata for the requested cavities found in the file
+        """
+        wanted = None if cavity_names is None else set(cavity_names)
+        out = {}
+        try:
+            with open(self.path, newline="") as f:
+                for row in csv.DictReader(f):
+                    name = row["cavity_name"].strip()
+                    if wanted is not None and name not in wanted:
+                        continue
+                    try:
+                        length = float(row.get("length") or DEFAULT_LENGTH)
+                        RQ = float(row.get("RQ") or DEFAULT_RQ)
+                    except ValueError:
+                        logger.warning("Skipping malformed metadata in %s: length %r, R/Q %r - %s", self.path,
+                                       row.get("length"), row.get("RQ"), name)
+                        continue
+                    out[name] = CavityMetadata(name, row["epics_name"].strip(),
+                                               (row.get("cavity_type") or DEFAULT_CAVITY_TYPE).strip(), length, RQ)
+        except (OSError, KeyError, ValueError) as e:
+            raise MetadataSourceError("Could not read cavity metadata from {}: {}".format(self.path, e))
+        return out
+
+
+class CEDMetadataSource:
+    """Reads cavity metadata from the CED web inventory with a single query for all CryoCavity elements.
+
+    The CED holds the EPICS name of each cavity, but not necessarily its cavity type, length or R/Q.  Properties
+    holding those may be named with type_property, length_property and RQ_property.  Anything the CED does not
+    provide falls back to the C100 values.
+    """
+
+    def __init__(self, url="https://ced.acc.jlab.org/inventory", workspace="OPS", timeout=10,
+                 type_property=None, length_property=None, RQ_property=None):
+        self.url = url  #: str: URL of the CED inventory web service
+        self.workspace = workspace  #: str: CED workspace to query
+        self.timeout = timeout  #: float: HTTP timeout in seconds
+        self.type_property = type_property  #: str: CED property holding the cavity type, if any
+        self.length_property = length_property  #: str: CED property holding the active length in m, if any
+        self.RQ_property = RQ_property  #: str: CED property holding R/Q in Ohms, if any
+
+    def fetch(self, cavity_names=None):
+        """Query the CED for the requested cavities.
+            Args:
+                cavity_names (iterable(str)): The cavities wanted.  None returns every CryoCavity in the CED.
+            Returns (dict): Cavity name to CavityMetadata for the requested cavities found in the CED
+        """
+        props = ["EPICSName"] + [p for p in (self.type_property, self.length_property, self.RQ_property) if p]
+        query = [("t", "CryoCavity"), ("out", "json"), ("ced", "ced"), ("wrkspc", self.workspace)]
+        query += [("p", p) for p in props]
+        url = self.url + "?" + urllib.parse.urlencode(query)
+        try:
+            with urllib.request.urlopen(url, timeout=self.timeout) as response:
+                doc = json.loads(response.read().decode("utf-8"))
+            elements = doc["Inventory"]["elements"]
+        except (OSError, ValueError, KeyError) as e:
+            raise MetadataSourceError("Could not query the CED at {}: {}".format(self.url, e))
+
+        wanted = None if cavity_names is None else set(cavity_names)
+        out = {}
+        for element in elements:
+            name = element.get("name")
+            properties = element.get("properties", {})
+            if name is None or "EPICSName" not in properties or (wanted is not None and name not in wanted):
+                continue
+            try:
+                length = float(properties.get(self.length_property, DEFAULT_LENGTH))
+                RQ = float(properties.get(self.RQ_property, DEFAULT_RQ))
+            except (TypeError, ValueError):
+                logger.warning("Skipping malformed CED metadata: length %r, R/Q %r - %s",
+                               properties.get(self.length_property), properties.get(self.RQ_property), name)
+                continue
+            out[name] = CavityMetadata(name, properties["EPICSName"],
+                                       properties.get(self.type_property, DEFAULT_CAVITY_TYPE), length, RQ)
+        return out
+
+
+class MetadataCache:
+    """An on-disk SQLite cache of cavity metadata with a time to live.
+
+    Entries are indexed by cavity name, and the whole cache is read with one query, so a restart never waits on the
+    source for cavities it already knows about.  Entries older than ttl are refreshed from the source when loaded.  If
+    the source cannot be reached, stale entries are used rather than nothing.
+    """
+
+    def __init__(self, path, ttl=86400.0):
+        """Open (creating if needed) the cache file.
+            Args:
+                path (str): Path of the SQLite cache file
+                ttl (float): Seconds after which a cached entry is refreshed from the source
+        """
+        self.path = path  #: str: path of the SQLite cache file
+        self.ttl = ttl  #: float: seconds after which a cached entry is refreshed
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        conn = self._connect()
+        with conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS cavities (cavity_name TEXT PRIMARY KEY, epics_name TEXT NOT NULL, "
+                         "cavity_type TEXT NOT NULL, length REAL NOT NULL, RQ REAL NOT NULL, "
+                         "fetched_at REAL NOT NULL)")
+        conn.close()
+
+    def _connect(self):
+        return sqlite3.connect(self.path)
+
+    def read(self):
+        """Returns (dict): Cavity name to (CavityMetadata, time it was fetched) for every cached cavity"""
+        conn = self._connect()
+        try:
+            rows = conn.execute("SELECT cavity_name, epics_name, cavity_type, length, RQ, fetched_at FROM cavities")
+            return {row[0]: (CavityMetadata(*row[:5]), row[5]) for row in rows}
+        finally:
+            conn.close()
+
+    def store(self, metadata, fetched_at=None):
+        """Add or replace cache entries.
+            Args:
+                metadata (iterable(CavityMetadata)): The entries to store
+                fetched_at (float): When they were fetched.  None means now.
+            Returns (None): Returns nothing
+        """
+        if fetched_at is None:
+            fetched_at = time.time()
+        conn = self._connect()
+        try:
+            with conn:
+                conn.executemany("INSERT OR REPLACE INTO cavities VALUES (?, ?, ?, ?, ?, ?)",
+                                 [tuple(md) + (fetched_at,) for md in metadata])
+        finally:
+            conn.close()
+
+    def load(self, cavity_names, source=None, refresh=False):
+        """Get metadata for cavities, going to the source only for those missing from the cache or past their TTL.
+            Args:
+                cavity_names (iterable(str)): The cavities wanted
+                source: A metadata source (anything with a fetch(cavity_names) method).  None only uses the cache.
+                refresh (bool): Refresh every requested cavity from the source, regardless of TTL
+            Returns (dict): Cavity name to CavityMetadata for every requested cavity that could be found
+        """
+        cavity_names = list(cavity_names)
+        cached = self.read()
+        now = time.time()
+        out = {}
+        needed = []
+        for name in cavity_names:
+            entry = cached.get(name)
+            if entry is not None:
+                out[name] = entry[0]
+            if entry is None or refresh or now - entry[1] > self.ttl:
+                needed.append(name)
+
+        if needed and source is not None:
+            try:
+                fetched = source.fetch(needed)
+            except MetadataSourceError as e:
+                logger.warning("Using cached cavity metadata for %d cavities: %s", len(needed), e)
+            else:
+                self.store(fetched.values(), fetched_at=now)
+                out.update(fetched)
+
+        missing = [name for name in cavity_names if name not in out]
+        if missing:
+            logger.error("No metadata available for cavities: %s", ", ".join(missing))
+        return out
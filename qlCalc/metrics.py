@@ -0,0 +1,371 @@
+import http.server
+import json
+import logging
+import math
+import os
+import tempfile
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Stages of a cavity's request cycle, in order.  The latency of a stage is the time from the previous stage of the same
+# cycle, and "requested" starts a new cycle.
+STAGES = ("requested", "posted", "dequeued", "inputs_read", "calculated", "exported", "rescheduled")
+
+# Name of the histogram of whole cycles, from one request to the next
+CYCLE = "cycle"
+
+# Quantiles reported for every histogram
+QUANTILES = (0.5, 0.9, 0.99)
+
+
+class LatencyHistogram:
+    """A fixed-size histogram of durations with logarithmically spaced buckets.
+
+    Bucket i counts values in [min_value * base**i, min_value * base**(i+1)).  With the default base of 2**0.25,
+    quantiles are accurate to within about 19%, whatever the scale, at the cost of one log and one increment per value.
+    """
+    __slots__ = ("min_value", "base", "counts", "count", "total", "min", "max", "_log_base")
+
+    def __init__(self, min_value=1e-6, max_value=1e3, base=2 ** 0.25):
+        self.min_value = min_value  #: float: lower bound of the first bucket in seconds
+        self.base = base  #: float: ratio between successive bucket bounds
+        self._log_base = math.log(base)
+        self.counts = [0] * (int(math.ceil(math.log(max_value / min_value) / self._log_base)) + 1)  #: list(int)
+        self.count = 0  #: int: number of values recorded
+        self.total = 0.0  #: float: sum of values recorded
+        self.min = math.inf  #: float: smallest value recorded
+        self.max = -math.inf  #: float: largest value recorded
+
+    def record(self, value):
+        """Add a duration in seconds.  Values outside the bucket range go to the first or last bucket."""
+        if value <= self.min_value:
+            i = 0
+        else:
+            i = min(int(math.log(value / self.min_value) / self._log_base), len(self.counts) - 1)
+        self.counts[i] += 1
+        self.count += 1
+        self.total += value
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    def copy(self):
+        """Returns (LatencyHistogram): An independent copy of this histogram"""
+        other = LatencyHistogram.__new__(LatencyHistogram)
+        other.min_value = self.min_value
+        other.base = self.base
+        other._log_base = self._log_base
+        other.counts = self.counts[:]
+        other.count = self.count
+        other.total = self.total
+        other.min = self.min
+        other.max = self.max
+        return other
+
+    def merge(self, other):
+        """Add the contents of another histogram with the same buckets to this one"""
+        for i, c in enumerate(other.counts):
+            self.counts[i] += c
+        self.count += other.count
+        self.total += other.total
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    def quantile(self, q):
+        """Estimate a quantile as the geometric midpoint of the bucket holding it, clamped to the recorded range.
+            Args:
+                q (float): The quantile, in [0, 1]
+            Returns (float): The estimate in seconds, NaN if nothing was recorded
+        """
+        if self.count == 0:
+            return math.nan
+        if q <= 0:
+            return self.min
+        if q >= 1:
+            return self.max
+        rank = q * self.count
+        seen = 0
+        for i, c in enumerate(self.counts):
+            seen += c
+            if c and seen >= rank:
+                if i == len(self.counts) - 1:
+                    return self.max  # The last bucket is unbounded above
+                estimate = self.min_value * self.base ** (i + 0.5)
+                return min(max(estimate, self.min), self.max)
+        return self.max
+
+    def summary(self):
+        """Returns (dict): count, mean, min, max and p50/p90/p99 in seconds (NaN where nothing was recorded)"""
+        out = {"count": self.count, "mean": self.total / self.count if self.count else math.nan,
+               "min": self.min if self.count else math.nan, "max": self.max if self.count else math.nan}
+        for q in QUANTILES:
+            out["p{:g}".format(q * 100)] = self.quantile(q)
+        return out
+
+
+class _CavityMetrics:
+    __slots__ = ("request_interval", "times", "histograms", "updates")
+
+    def __init__(self, request_interval):
+        self.request_interval = request_interval
+        self.times = [None] * len(STAGES)  # Time each stage of the current cycle was reached
+        self.histograms = {stage: LatencyHistogram() for stage in STAGES[1:] + (CYCLE,)}
+        self.updates = 0  # Results exported
+
+
+class PipelineMetrics:
+    """Per-stage, per-cavity latency histograms, queue depth gauges and achieved update rates.
+
+    Cryocavity and ProcessingPool call mark as a cavity passes each of STAGES.  Marking costs a couple of dict lookups
+    and a histogram increment under one lock, so it can stay on in production.  Gauges are callables (e.g., a queue's
+    qsize) sampled only when a snapshot is taken.  Machine-wide histograms are merged from the per-cavity ones at
+    snapshot time rather than kept separately.
+    """
+
+    def __init__(self, request_interval=1.0):
+        """Construct an empty set of metrics.
+            Args:
+                request_interval (float): Default seconds between requests of a cavity, for the expected update rate
+        """
+        self.request_interval = request_interval  #: float: default seconds between requests of a cavity
+        self._lock = threading.Lock()
+        self._cavities = {}  # Cavity name to _CavityMetrics
+        self._gauges = {}  # Gauge name to callable
+        self._start = time.time()
+        self._progress = 0  # Requests made and results exported.  Never reset.
+
+    def add_cavity(self, cavity_name, request_interval=None):
+        """Start tracking a cavity.  Cavities are also added on their first mark, with the default request_interval."""
+        with self._lock:
+            self._cavities[cavity_name] = _CavityMetrics(request_interval or self.request_interval)
+
+    def remove_cavity(self, cavity_name):
+        """Stop tracking a cavity and drop its histograms"""
+        with self._lock:
+            self._cavities.pop(cavity_name, None)
+
+    def add_gauge(self, name, func):
+        """Register a gauge.
+            Args:
+                name (str): Name of the gauge, e.g., update_queue
+                func (callable): Returns the gauge's current value.  Called from whichever thread takes a snapshot.
+            Returns (None): Returns nothing
+        """
+        with self._lock:
+            self._gauges[name] = func
+
+    def mark(self, cavity_name, stage, timestamp=None):
+        """Record that a cavity reached a stage of its cycle.
+            Args:
+                cavity_name (str): The cavity
+                stage (str): One of STAGES
+                timestamp (float): time.time() the stage was reached.  None means now.
+            Returns (None): Returns nothing
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        i = STAGES.index(stage)
+        with self._lock:
+            cav = self._cavities.get(cavity_name)
+            if cav is None:
+                cav = _CavityMetrics(self.request_interval)
+                self._cavities[cavity_name] = cav
+            times = cav.times
+            if i == 0:
+                if times[0] is not None:
+                    cav.histograms[CYCLE].record(timestamp - times[0])
+                for j in range(1, len(times)):
+                    times[j] = None
+            elif times[i - 1] is not None:
+                cav.histograms[stage].record(timestamp - times[i - 1])
+            times[i] = timestamp
+            if stage == "exported":
+                cav.updates += 1
+            if i == 0 or stage == "exported":
+                self._progress += 1
+
+    def snapshot(self, reset=False):
+        """Summarize everything recorded since the metrics were created or last reset, and sample the gauges.
+            Args:
+                reset (bool): Clear the histograms and update counts after reading them
+            Returns (dict): time, elapsed, gauges, stages (machine-wide latency summaries by stage, plus cycle),
+              update_rate and expected_rate (updates/s over all cavities), progress (requests made and results
+              exported since the metrics were created, never reset) and cavities (per cavity updates, update_rate,
+              rate_ratio (achieved over expected) and stages)
+        """
+        with self._lock:
+            gauges = dict(self._gauges)
+        gauge_values = {}
+        for name, func in gauges.items():
+            try:
+                gauge_values[name] = func()
+            except Exception:
+                logger.exception("Error reading gauge %s", name)
+                gauge_values[name] = None
+
+        # Only copy the raw counts under the lock, mark() waits on it.  A reset hands over the histograms themselves.
+        now = time.time()
+        raw = []
+        with self._lock:
+            elapsed = now - self._start
+            for cavity_name, cav in self._cavities.items():
+                if reset:
+                    histograms = cav.histograms
+                    cav.histograms = {name: LatencyHistogram() for name in histograms}
+                else:
+                    histograms = {name: h.copy() for name, h in cav.histograms.items()}
+                raw.append((cavity_name, cav.updates, cav.request_interval, histograms))
+                if reset:
+                    cav.updates = 0
+            if reset:
+                self._start = now
+            progress = self._progress
+
+        totals = {name: LatencyHistogram() for name in STAGES[1:] + (CYCLE,)}
+        cavities = {}
+        updates = 0
+        expected = 0.0
+        for cavity_name, cav_updates, request_interval, histograms in raw:
+            rate = cav_updates / elapsed if elapsed > 0 else 0.0
+            cavities[cavity_name] = {
+                "updates": cav_updates,
+                "update_rate": rate,
+                "rate_ratio": rate * request_interval,
+                "stages": {name: h.summary() for name, h in histograms.items()},
+            }
+            for name, h in histograms.items():
+                totals[name].merge(h)
+            updates += cav_updates
+            expected += 1.0 / request_interval
+
+        return {
+            "time": now,
+            "elapsed": elapsed,
+            "gauges": gauge_values,
+            "stages": {name: h.summary() for name, h in totals.items()},
+            "update_rate": updates / elapsed if elapsed > 0 else 0.0,
+            "expected_rate": expected,
+            "progress": progress,
+            "cavities": cavities,
+        }
+
+    def write_snapshot(self, path):
+        """Write a snapshot as JSON, replacing the file atomically so readers never see a partial one.
+            Args:
+                path (str): The file to write
+            Returns (None): Returns nothing
+        """
+        directory = os.path.dirname(path) or "."
+        fd, tmp = tempfile.mkstemp(dir=directory, prefix=".metrics")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(self.snapshot(), f)
+            os.replace(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+    def run_snapshots(self, path, interval, event):
+        """Callable meant to be run in own thread.  Writes a snapshot file every interval seconds until the event is
+        set, and once more after."""
+        while True:
+            stopping = event.wait(interval)
+            try:
+                self.write_snapshot(path)
+            except OSError:
+                logger.exception("Error writing metrics snapshot to %s", path)
+            if stopping:
+                break
+
+
+def _label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"')
+
+
+def render_text(snapshot):
+    """Format a snapshot in the Prometheus text exposition format.
+        Args:
+            snapshot (dict): As returned by PipelineMetrics.snapshot
+        Returns (str): The text
+    """
+    lines = []
+
+    def summary(metric, labels, s):
+        for q in QUANTILES:
+            lines.append('{}{{{}quantile="{:g}"}} {!r}'.format(metric, labels, q, s["p{:g}".format(q * 100)]))
+        lines.append("{}_count{{{}}} {}".format(metric, labels.rstrip(","), s["count"]))
+        lines.append("{}_sum{{{}}} {!r}".format(metric, labels.rstrip(","),
+                                                 s["mean"] * s["count"] if s["count"] else 0.0))
+
+    lines.append("# TYPE qlcalc_stage_latency_seconds summary")
+    for stage, s in snapshot["stages"].items():
+        summary("qlcalc_stage_latency_seconds", 'stage="{}",'.format(stage), s)
+    lines.append("# TYPE qlcalc_gauge gauge")
+    for name, value in snapshot["gauges"].items():
+        if value is not None:
+            lines.append('qlcalc_gauge{{name="{}"}} {}'.format(_label(name), value))
+    lines.append("# TYPE qlcalc_update_rate gauge")
+    lines.append("qlcalc_update_rate {!r}".format(snapshot["update_rate"]))
+    lines.append("qlcalc_expected_update_rate {!r}".format(snapshot["expected_rate"]))
+    lines.append("# TYPE qlcalc_cavity_update_rate gauge")
+    for cavity_name, cav in snapshot["cavities"].items():
+        label = _label(cavity_name)
+        lines.append('qlcalc_cavity_update_rate{{cavity="{}"}} {!r}'.format(label, cav["update_rate"]))
+        lines.append('qlcalc_cavity_rate_ratio{{cavity="{}"}} {!r}'.format(label, cav["rate_ratio"]))
+    lines.append("# TYPE qlcalc_cavity_stage_latency_seconds summary")
+    for cavity_name, cav in snapshot["cavities"].items():
+        for stage, s in cav["stages"].items():
+            summary("qlcalc_cavity_stage_latency_seconds",
+                    'cavity="{}",stage="{}",'.format(_label(cavity_name), stage), s)
+    return "\n".join(lines) + "\n"
+
+
+class MetricsServer:
+    """A local HTTP endpoint serving metric snapshots.  GET /metrics returns text (see render_text) and
+    GET /metrics.json returns the snapshot as JSON."""
+
+    def __init__(self, metrics, host="127.0.0.1", port=0):
+        """Bind the server.  Port 0 picks a free port (see port).  Nothing is served until start is called."""
+        handler = self._make_handler(metrics)
+        self.httpd = http.server.HTTPServer((host, port), handler)  #: HTTPServer: the underlying server
+        self.port = self.httpd.server_address[1]  #: int: the port being listened on
+        self._thread = None
+
+    @staticmethod
+    def _make_handler(metrics):
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path == "/metrics":
+                    body = render_text(metrics.snapshot()).encode("utf-8")
+                    content_type = "text/plain; version=0.0.4"
+                elif self.path == "/metrics.json":
+                    body = json.dumps(metrics.snapshot()).encode("utf-8")
+                    content_type = "application/json"
+                else:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logger.debug("metrics request from %s: " + format, self.client_address[0], *args)
+
+        return Handler
+
+    def start(self):
+        """Serve requests from a daemon thread"""
+        self._thread = threading.Thread(target=self.httpd.serve_forever, name="metrics-server", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop serving and close the socket"""
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        if self._thread is not None:
+            self._thread.join()
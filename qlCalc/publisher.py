@@ -0,0 +1,244 @@
+import logging
+import math
+import threading
+import time
+import epics
+
+import qlCalc.utils
+
+logger = logging.getLogger(__name__)
+
+# Cryocavity result attribute to the suffix of the PV it is published to.  The full PV name is the publisher's prefix,
+# the cavity's EPICS name and this suffix, e.g., adamc:R1Q1QLFLQ.
+RESULT_PVS = (
+    ("attenuation", "ATTNLQ"),
+    ("P_fc", "PFCLQ"),
+    ("P_rc", "PRCLQ"),
+    ("Q_lf", "QLFLQ"),
+    ("Q_lr", "QLRLQ"),
+    ("Q_lf_mean", "QLFMEANLQ"),
+    ("Q_lf_std", "QLFSTDLQ"),
+    ("Q_lr_mean", "QLRMEANLQ"),
+    ("Q_lr_std", "QLRSTDLQ"),
+    ("Q_lf_unc", "QLFUNCLQ"),
+    ("Q_lf_lo", "QLFLOLQ"),
+    ("Q_lf_hi", "QLFHILQ"),
+    ("Q_lr_unc", "QLRUNCLQ"),
+    ("Q_lr_lo", "QLRLOLQ"),
+    ("Q_lr_hi", "QLRHILQ"),
+    ("Q_fit", "QFITLQ"),
+    ("attenuation_fit", "ATTNFITLQ"),
+    ("err_msg", "ERRLQ"),
+    ("data_sync_start", "SYNCSTARTLQ"),
+    ("data_sync_end", "SYNCENDLQ"),
+    ("heartbeat", "HBLQ"),
+)
+
+
+def _same(a, b):
+    """Compare published values, treating NaN as equal to NaN so invalid results are not republished every cycle"""
+    if isinstance(a, float) and isinstance(b, float) and math.isnan(a) and math.isnan(b):
+        return True
+    return a == b
+
+
+class ResultPublisher:
+    """Buffers computed cavity results and writes them to EPICS in batches from its own thread.
+
+    Processing threads hand results over with submit, which only copies them into a buffer keyed by PV name and never
+    touches the network.  A newer value for a PV replaces an unpublished older one.  The publisher thread flushes the
+    buffer when it holds flush_size values or flush_interval seconds after the first unflushed value, whichever is
+    first.  A flush issues non-blocking puts for every value that differs from the last one published to that PV and
+    sends them to the network together.  Values for PVs that are not connected yet, or whose put failed, are retried by
+    the next flush, which is at most flush_interval later.  They do not count towards flush_size.
+    """
+
+    def __init__(self, event, pv_prefix="", flush_size=500, flush_interval=0.1, pv_factory=epics.PV):
+        """Construct a publisher.  Nothing is written until run is started.
+            Args:
+                event (threading.Event): Event used to signal application shutdown
+                pv_prefix (str): Prefix prepended to every result PV name
+                flush_size (int): Number of buffered values that triggers an immediate flush
+                flush_interval (float): Longest time in seconds a submitted value waits before a flush
+                pv_factory (callable): Creates a PV object from a PV name
+        """
+        self.event = event  #: threading.Event: shutdown signal
+        self.pv_prefix = pv_prefix  #: str: prefix prepended to every result PV name
+        self.flush_size = flush_size  #: int: buffered values that trigger an immediate flush
+        self.flush_interval = flush_interval  #: float: longest time in seconds a value waits before a flush
+        self.pv_factory = pv_factory  #: callable: creates a PV object from a PV name
+
+        self._cond = threading.Condition()
+        self._buffer = {}  # PV name to (value, submit time) waiting to be published
+        self._retry = {}  # PV name to (value, submit time) that a flush could not publish
+        self._first_submit = None  # Submit time of the oldest buffered value, or when retries are next due
+        self._pvs = {}  # Cavity name to list of (attribute, PV) pairs
+        self._last_published = {}  # PV name to last value successfully handed to CA
+
+        self._stats_start = time.time()
+        self._published = 0
+        self._unchanged = 0
+        self._flushes = 0
+        self._latency_total = 0.0
+        self._latency_max = 0.0
+
+    def register(self, cav):
+        """Create (and start connecting) the result PVs of a cavity.
+            Args:
+                cav (Cryocavity): The cavity.  Its epics_name determines the PV names.
+            Returns (None): Returns nothing
+        """
+        base = self.pv_prefix + cav.epics_name
+        pvs = [(attr, self.pv_factory(base + suffix)) for attr, suffix in RESULT_PVS]
+        with self._cond:
+            self._pvs[cav.cavity_name] = pvs
+
+    def unregister(self, cavity_name):
+        """Drop a cavity's result PVs and any of its unpublished values, disconnecting the PVs."""
+        with self._cond:
+            pvs = self._pvs.pop(cavity_name, [])
+            for attr, pv in pvs:
+                self._buffer.pop(pv.pvname, None)
+                self._retry.pop(pv.pvname, None)
+                self._last_published.pop(pv.pvname, None)
+        for attr, pv in pvs:
+            pv.disconnect()
+
+    def submit(self, cav, attrs=None):
+        """Buffer the current results of a cavity for publishing.  Does no network I/O.
+            Args:
+                cav (Cryocavity): The cavity whose results should be published.  It must have been registered.
+                attrs (tuple(str)): Publish only these result attributes (see RESULT_PVS).  None publishes all.
+            Returns (None): Returns nothing
+        """
+        now = time.time()
+        with self._cond:
+            pvs = self._pvs.get(cav.cavity_name)
+            if pvs is None:
+                logger.warning("Results submitted for unregistered cavity - %s", cav.cavity_name)
+                return
+            for attr, pv in pvs:
+                if attrs is not None and attr not in attrs:
+                    continue
+                value = getattr(cav, attr)
+                if attr == "err_msg":
+                    value = "; ".join(value)
+                elif value is None:
+                    continue
+                self._buffer[pv.pvname] = (value, now)
+            if self._first_submit is None:
+                self._first_submit = now
+                self._cond.notify()
+            elif len(self._buffer) >= self.flush_size:
+                self._cond.notify()
+
+    def flush(self):
+        """Publish everything currently buffered.  Called by the publisher thread, but may be called directly.
+            Returns (int): The number of values published
+        """
+        now = time.time()
+        to_put = []
+        values = []
+        retry = {}
+        unchanged = 0
+        latency_total = 0.0
+        latency_max = 0.0
+        with self._cond:
+            buffer = self._retry
+            buffer.update(self._buffer)  # Newer values replace retries
+            self._buffer = {}
+            self._retry = {}
+            self._first_submit = None
+            pvs = {pv.pvname: pv for cav_pvs in self._pvs.values() for attr, pv in cav_pvs}
+            for pvname, (value, submitted) in buffer.items():
+                pv = pvs.get(pvname)
+                if pv is None:
+                    continue
+                if not pv.connected:
+                    retry[pvname] = (value, submitted)
+                    continue
+                if pvname in self._last_published and _same(self._last_published[pvname], value):
+                    unchanged += 1
+                    continue
+                to_put.append(pv)
+                values.append(value)
+
+        published = 0
+        if to_put:
+            try:
+                qlCalc.utils.put_many(to_put, values)
+            except Exception:
+                logger.exception("Error publishing %d results", len(to_put))
+                for pv in to_put:
+                    retry[pv.pvname] = buffer[pv.pvname]
+            else:
+                published = len(to_put)
+                for pv in to_put:
+                    latency = now - buffer[pv.pvname][1]
+                    latency_total += latency
+                    if latency > latency_max:
+                        latency_max = latency
+
+        with self._cond:
+            if published:
+                for pv, value in zip(to_put, values):
+                    self._last_published[pv.pvname] = value
+            # Keep unpublished values unless something newer arrived meanwhile.  Their retry is due a flush_interval
+            # from now, not from when they were submitted, so that an unreachable PV cannot keep the thread flushing.
+            for pvname, entry in retry.items():
+                if pvname not in self._buffer:
+                    self._retry[pvname] = entry
+            if self._retry and self._first_submit is None:
+                self._first_submit = now
+            self._flushes += 1
+            self._published += published
+            self._unchanged += unchanged
+            self._latency_total += latency_total
+            if latency_max > self._latency_max:
+                self._latency_max = latency_max
+        return published
+
+    def run(self):
+        """Callable meant to be run in own thread.  Flushes on the size or time trigger until shutdown, then flushes
+        whatever is left."""
+        while not self.event.is_set():
+            with self._cond:
+                if self._first_submit is None:
+                    wait = self.flush_interval
+                else:
+                    wait = self._first_submit + self.flush_interval - time.time()
+                if len(self._buffer) < self.flush_size and wait > 0:
+                    self._cond.wait(wait)
+                due = self._first_submit is not None and (
+                    len(self._buffer) >= self.flush_size or time.time() >= self._first_submit + self.flush_interval)
+            if due:
+                self.flush()
+
+        self.flush()
+        logger.debug("result publisher has exited")
+
+    def get_stats(self, reset=False):
+        """Report publishing statistics since the publisher was created or the stats were last reset.
+            Args:
+                reset (bool): Start a new measurement interval after reading the stats
+            Returns (dict): Keys are published (puts issued), unchanged (values skipped because they had not changed),
+              flushes, mean_latency and max_latency (s from submit to put) and backlog (values waiting to be published)
+        """
+        with self._cond:
+            stats = {
+                "published": self._published,
+                "unchanged": self._unchanged,
+                "flushes": self._flushes,
+                "mean_latency": self._latency_total / self._published if self._published else 0.0,
+                "max_latency": self._latency_max,
+                "backlog": len(self._buffer) + len(self._retry),
+                "elapsed": time.time() - self._stats_start,
+            }
+            if reset:
+                self._stats_start = time.time()
+                self._published = 0
+                self._unchanged = 0
+                self._flushes = 0
+                self._latency_total = 0.0
+                self._latency_max = 0.0
+        return stats
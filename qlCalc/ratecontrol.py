@@ -0,0 +1,212 @@
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+def zone_of(cavity_name):
+    """The zone (cryomodule) of a cavity, e.g., VL26 for VL26-7.  The cavities of a zone share an FCC IOC.
+        Args:
+            cavity_name (str): The CED name of the cavity
+        Returns (str): Everything before the last "-", or the whole name if there is none
+    """
+    return cavity_name.rsplit("-", 1)[0]
+
+
+class RateController:
+    """Adapts each cavity's request interval to how quickly its FCC IOC answers, and limits the number of requests
+    outstanding at any one IOC.
+
+    The GETDATA 1->2 turnaround of every completed request updates an exponentially weighted moving average per cavity.
+    The interval is then adjusted AIMD style.  A request slower than slow_turnaround (or one that timed out) multiplies
+    the interval by backoff_factor, up to max_interval, to take load off a slow or overloaded IOC.  Otherwise the
+    interval shrinks by recover_step per request, down to the floor, which is min_interval or the averaged turnaround
+    divided by max_utilization, whichever is larger.  The latter keeps one cavity from keeping its IOC busy more than
+    max_utilization of the time.
+
+    admit decides which due requests may be made now.  An IOC never has more than max_outstanding requests in flight,
+    counting forced triggers.  Requests over the limit are deferred by the caller and retried retry_delay seconds later.
+    """
+
+    def __init__(self, min_interval=0.5, max_interval=10.0, slow_turnaround=2.0, max_utilization=0.5,
+                 backoff_factor=2.0, recover_step=0.05, smoothing=0.2, max_outstanding=4, retry_delay=0.05,
+                 ioc_of=zone_of):
+        """Construct a controller.
+            Args:
+                min_interval (float): Floor in seconds of any cavity's request interval
+                max_interval (float): Ceiling in seconds of any cavity's request interval
+                slow_turnaround (float): Turnaround in seconds above which a request counts as slow
+                max_utilization (float): Largest fraction of the time a cavity's requests may keep its IOC busy
+                backoff_factor (float): Interval multiplier for a slow or timed out request
+                recover_step (float): Seconds the interval shrinks by for each request that is not slow
+                smoothing (float): Weight of the newest turnaround in the moving average, in (0, 1]
+                max_outstanding (int): Requests allowed in flight per IOC, below the eight cavities of a zone so that
+                  it can bind.  None for no limit.
+                retry_delay (float): Seconds after which a deferred request should be retried
+                ioc_of (callable): Maps a cavity name to the name of its IOC
+        """
+        if not 0 < min_interval <= max_interval:
+            raise ValueError("Need 0 < min_interval <= max_interval, got {} and {}".format(min_interval, max_interval))
+        if not 0 < smoothing <= 1:
+            raise ValueError("smoothing must be in (0, 1], got {}".format(smoothing))
+        if max_outstanding is not None and max_outstanding < 1:
+            raise ValueError("max_outstanding must be at least 1, got {}".format(max_outstanding))
+        self.min_interval = min_interval  #: float: floor of any request interval in seconds
+        self.max_interval = max_interval  #: float: ceiling of any request interval in seconds
+        self.slow_turnaround = slow_turnaround  #: float: turnaround in seconds above which a request is slow
+        self.max_utilization = max_utilization  #: float: largest fraction of time a cavity may keep its IOC busy
+        self.backoff_factor = backoff_factor  #: float: interval multiplier for a slow or timed out request
+        self.recover_step = recover_step  #: float: seconds the interval shrinks by per request that is not slow
+        self.smoothing = smoothing  #: float: weight of the newest turnaround in the moving average
+        self.max_outstanding = max_outstanding  #: int: requests allowed in flight per IOC
+        self.retry_delay = retry_delay  #: float: seconds after which a deferred request should be retried
+        self.ioc_of = ioc_of  #: callable: maps a cavity name to the name of its IOC
+
+        self._lock = threading.Lock()
+        self._turnaround = {}  # Cavity name to moving average turnaround
+        self._interval = {}  # Cavity name to current request interval
+        self._outstanding = {}  # IOC name to set of cavity names with a request in flight
+        self._ioc = {}  # Cavity name to IOC name, memoized
+        self._backoffs = 0
+        self._deferred = 0
+
+    def _ioc_name(self, cavity_name):
+        ioc = self._ioc.get(cavity_name)
+        if ioc is None:
+            ioc = self.ioc_of(cavity_name)
+            self._ioc[cavity_name] = ioc
+        return ioc
+
+    def interval(self, cavity_name, default=1.0):
+        """Returns (float): The cavity's current request interval, or default if nothing is known about it yet"""
+        with self._lock:
+            return self._interval.get(cavity_name, default)
+
+    def admit(self, items):
+        """Split due requests into those that may be made now and those that would exceed their IOC's limit.  The
+        admitted ones count as outstanding from now on.
+            Args:
+                items (list): CavityTasks or Cryocavities (anything with a cavity_name), in priority order
+            Returns (tuple(list, list)): The admitted and the deferred items, each in their original order
+        """
+        if self.max_outstanding is None:
+            return list(items), []
+        admitted = []
+        deferred = []
+        with self._lock:
+            for item in items:
+                name = item.cavity_name
+                outstanding = self._outstanding.setdefault(self._ioc_name(name), set())
+                if name in outstanding or len(outstanding) < self.max_outstanding:
+                    outstanding.add(name)
+                    admitted.append(item)
+                else:
+                    deferred.append(item)
+            self._deferred += len(deferred)
+        return admitted, deferred
+
+    def requested(self, cavity_name):
+        """Record that a request was made for a cavity, whether or not it went through admit"""
+        with self._lock:
+            self._outstanding.setdefault(self._ioc_name(cavity_name), set()).add(cavity_name)
+
+    def completed(self, cavity_name, turnaround, current_interval=1.0):
+        """Record a completed request and compute the cavity's next request interval.
+            Args:
+                cavity_name (str): The cavity whose data was posted
+                turnaround (float): Seconds from the request to the data being posted
+                current_interval (float): The cavity's interval, used the first time the cavity is seen
+            Returns (float): The cavity's new request interval
+        """
+        with self._lock:
+            self._outstanding.get(self._ioc_name(cavity_name), set()).discard(cavity_name)
+            average = self._turnaround.get(cavity_name)
+            if average is None:
+                average = turnaround
+            else:
+                average += self.smoothing * (turnaround - average)
+            self._turnaround[cavity_name] = average
+
+            interval = self._interval.get(cavity_name, current_interval)
+            if turnaround > self.slow_turnaround:
+                interval = self._backoff(cavity_name, interval)
+            else:
+                interval = max(interval - self.recover_step, self.min_interval, average / self.max_utilization)
+            interval = min(interval, self.max_interval)
+            self._interval[cavity_name] = interval
+            return interval
+
+    def timed_out(self, cavity_name, current_interval=1.0):
+        """Record that a cavity's request timed out.  It no longer counts as outstanding and its interval backs off.
+            Args:
+                cavity_name (str): The cavity whose request timed out
+                current_interval (float): The cavity's interval, used the first time the cavity is seen
+            Returns (float): The cavity's new request interval
+        """
+        with self._lock:
+            self._outstanding.get(self._ioc_name(cavity_name), set()).discard(cavity_name)
+            interval = min(self._backoff(cavity_name, self._interval.get(cavity_name, current_interval)),
+                           self.max_interval)
+            self._interval[cavity_name] = interval
+            return interval
+
+    def _backoff(self, cavity_name, interval):
+        self._backoffs += 1
+        logger.debug("Backing off request interval from %.3f s - %s", interval, cavity_name)
+        return interval * self.backoff_factor
+
+    def turnaround(self, cavity_name):
+        """Returns (float): The cavity's moving average turnaround in seconds, or None if none was completed yet"""
+        with self._lock:
+            return self._turnaround.get(cavity_name)
+
+    def restore(self, cavity_name, interval, turnaround=None):
+        """Resume a cavity's state, e.g., from a checkpoint written before a restart.
+            Args:
+                cavity_name (str): The cavity
+                interval (float): Its request interval, limited to [min_interval, max_interval]
+                turnaround (float): Its moving average turnaround.  None leaves it unknown.
+            Returns (None): Returns nothing
+        """
+        with self._lock:
+            self._interval[cavity_name] = min(max(interval, self.min_interval), self.max_interval)
+            if turnaround is not None:
+                self._turnaround[cavity_name] = turnaround
+            else:
+                self._turnaround.pop(cavity_name, None)
+
+    def discard(self, cavity_name):
+        """Forget a cavity altogether, e.g., because it was removed"""
+        with self._lock:
+            self._outstanding.get(self._ioc_name(cavity_name), set()).discard(cavity_name)
+            self._turnaround.pop(cavity_name, None)
+            self._interval.pop(cavity_name, None)
+            self._ioc.pop(cavity_name, None)
+
+    def get_stats(self, reset=False):
+        """Report the state of the controller.
+            Args:
+                reset (bool): Zero the backoff and deferral counters after reading them
+            Returns (dict): Keys are cavities, mean_interval, min_interval and max_interval (s, over the cavities),
+              mean_turnaround (s), outstanding (requests in flight over all IOCs), max_ioc_outstanding (the most in
+              flight at any one IOC), backoffs and deferred (requests held back by the IOC limit)
+        """
+        with self._lock:
+            intervals = list(self._interval.values())
+            turnarounds = list(self._turnaround.values())
+            in_flight = [len(names) for names in self._outstanding.values()]
+            stats = {
+                "cavities": len(intervals),
+                "mean_interval": sum(intervals) / len(intervals) if intervals else 0.0,
+                "min_interval": min(intervals) if intervals else 0.0,
+                "max_interval": max(intervals) if intervals else 0.0,
+                "mean_turnaround": sum(turnarounds) / len(turnarounds) if turnarounds else 0.0,
+                "outstanding": sum(in_flight),
+                "max_ioc_outstanding": max(in_flight) if in_flight else 0,
+                "backoffs": self._backoffs,
+                "deferred": self._deferred,
+            }
+            if reset:
+                self._backoffs = 0
+                self._deferred = 0
+        return stats
@@ -0,0 +1,271 @@
+import collections
+import csv
+import logging
+import os
+import threading
+import time
+
+from qlCalc.cryocavity import Cryocavity
+from qlCalc.metadata import CavityMetadata, static_metadata
+from qlCalc.scheduler import staggered_start_times
+
+logger = logging.getLogger(__name__)
+
+#: How the running cavities differ from the desired set.  Each field is a list of cavity names.
+CavitySetDiff = collections.namedtuple("CavitySetDiff", ("added", "removed", "changed"))
+
+# Cryocavity attributes holding the machine-wide objects a CavityReloader attaches to each cavity it adds
+SHARED_ATTRS = ("metrics", "history", "fit", "rate_controller", "memo", "publisher", "results_table", "uncertainty",
+                "watchdog")
+
+
+def read_cavity_list(path):
+    """Read the desired set of cavities from a file.
+
+    The file is either a plain list with one CED name per line, or a CSV file with a cavity_name column, such as the
+    metadata file.  Blank lines and lines starting with # are skipped.
+        Args:
+            path (str): The file
+        Returns (list(str)): CED names in file order, without duplicates.  Raises ValueError if there are none.
+    """
+    with open(path, newline="") as f:
+        lines = [line for line in f if line.strip() and not line.lstrip().startswith("#")]
+    if lines and "," in lines[0]:
+        rows = csv.DictReader(lines)
+        if "cavity_name" not in (rows.fieldnames or ()):
+            raise ValueError("{} has no cavity_name column".format(path))
+        names = [row["cavity_name"].strip() for row in rows]
+    else:
+        names = [line.strip() for line in lines]
+    names = list(collections.OrderedDict.fromkeys(name for name in names if name))
+    if not names:
+        # More likely a file caught half written than a wish to stop every cavity
+        raise ValueError("{} lists no cavities".format(path))
+    return names
+
+
+def file_stamp(path):
+    """Returns (tuple): The inode, size and modification time of a file, which change whenever it is rewritten or
+      replaced.  None if it cannot be read."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_ino, st.st_size, st.st_mtime_ns
+
+
+def metadata_of(cav):
+    """Returns (CavityMetadata): The metadata a cavity currently runs with"""
+    return CavityMetadata(cav.cavity_name, cav.epics_name, cav.cavity_type, cav.length, cav.RQ)
+
+
+def diff_cavities(cav_dict, metadata):
+    """Compare the running cavities with the desired set.
+        Args:
+            cav_dict (dict): Cavity name to the running Cryocavity
+            metadata (dict): Cavity name to CavityMetadata of every desired cavity
+        Returns (CavitySetDiff): The cavities to add, the ones to remove and the running ones whose cavity type, length
+          or R/Q changed.  A cavity whose EPICS name changed is removed and added again, since its PVs change.
+    """
+    added = [name for name in metadata if name not in cav_dict]
+    removed = [name for name in cav_dict if name not in metadata]
+    changed = []
+    for name, cav in cav_dict.items():
+        md = metadata.get(name)
+        if md is None or md == metadata_of(cav):
+            continue
+        if md.epics_name != cav.epics_name:
+            removed.append(name)
+            added.append(name)
+        else:
+            changed.append(name)
+    return CavitySetDiff(added, removed, changed)
+
+
+class CavityReloader:
+    """Brings the set of running cavities in line with a cavity list, without restarting the application.
+
+    A reload diffs the desired cavities (and their freshly loaded metadata) against cav_dict.  Removed cavities are
+    taken out of cav_dict first, so nothing requests them any more, then drained together - their in-flight processing
+    and outstanding data requests are allowed to finish, up to one shared drain_timeout - and retired (see
+    Cryocavity.retire).
+    Changed metadata (cavity type, length and R/Q) is applied to the running cavity in place.  Added cavities are
+    created and connected, attached to the machine-wide objects below and only then put in cav_dict, with their
+    initial requests spread over the request interval.  The cavities that did not change keep their schedule,
+    results and history throughout.
+
+    The shared objects, results_out and the runtime hooks (start and drain) are given to the constructor, so the
+    reloader is built once the runtime it feeds exists.  Any of them may be None.
+    """
+
+    def __init__(self, cav_dict, create_cavities, load_metadata, path=None, cavity_names=None, drain_timeout=10.0,
+                 stamp=None, results_out="stdout", metrics=None, history=None, fit=None, rate_controller=None,
+                 memo=None, publisher=None, results_table=None, uncertainty=None, watchdog=None, start=None,
+                 drain=None):
+        """Construct a reloader.  Nothing is reloaded until asked.
+            Args:
+                cav_dict (dict): Cavity name to running Cryocavity.  Changed in place.
+                create_cavities (callable): Creates and connects cavities, given a list of names and a dict of name to
+                  CavityMetadata, like Cryocavity.create_cryocavities.  Returns (cav_dict, failed).
+                load_metadata (callable): Returns a dict of cavity name to CavityMetadata, given a list of names
+                path (str): The cavity list file (see read_cavity_list).  None keeps cavity_names.
+                cavity_names (iterable(str)): The desired cavities until the file says otherwise.  None for those in
+                  cav_dict.
+                drain_timeout (float): Longest time in seconds to wait for the removed cavities to go idle
+                stamp (tuple): The file_stamp of path from before cavity_names were read from it, so that a change
+                  made since is not missed.  None stamps the file now.
+                results_out (str): results_out of added cavities
+                metrics, history, fit, rate_controller, memo, publisher, results_table, uncertainty, watchdog: The
+                  machine-wide objects attached to added cavities (see SHARED_ATTRS)
+                start (callable): Runs added cavities, given a list of them and a dict of name to time.time() of their
+                  initial trigger.  None triggers them at once.
+                drain (callable): Stops the runtime from running a removed cavity and waits for its in-flight
+                  processing, given its name and a timeout.  Returns whether it finished in time.  None if taking it
+                  out of cav_dict is enough.
+        """
+        self.cav_dict = cav_dict  #: dict: cavity name to running Cryocavity
+        self.create_cavities = create_cavities  #: callable: creates and connects cavities
+        self.load_metadata = load_metadata  #: callable: loads metadata for cavity names
+        self.path = path  #: str: the cavity list file.  None if there is none.
+        self.cavity_names = list(cav_dict if cavity_names is None else cavity_names)  #: list(str): desired cavities
+        self.drain_timeout = drain_timeout  #: float: longest wait in seconds for removed cavities to go idle
+        self.results_out = results_out  #: str: results_out of added cavities
+        self.metrics = metrics  #: PipelineMetrics: attached to added cavities
+        self.history = history  #: ResultHistory: attached to added cavities
+        self.fit = fit  #: WindowedFit: attached to added cavities
+        self.rate_controller = rate_controller  #: RateController: attached to added cavities
+        self.memo = memo  #: InputMemo: attached to added cavities
+        self.publisher = publisher  #: ResultPublisher: attached to added cavities
+        self.results_table = results_table  #: ResultTable: attached to added cavities
+        self.uncertainty = uncertainty  #: UncertaintyEstimator: attached to added cavities
+        self.watchdog = watchdog  #: RequestWatchdog: attached to added cavities
+        self.start = start  #: callable: runs added cavities.  None triggers them at once.
+        self.drain = drain  #: callable: waits for a removed cavity to go idle.  None if nothing to wait for.
+
+        self._requested = threading.Event()
+        self._lock = threading.Lock()  # One reload at a time
+        self._stamp = stamp if stamp is not None else self._file_stamp()
+
+    def _file_stamp(self):
+        return file_stamp(self.path) if self.path is not None else None
+
+    def request(self):
+        """Ask the run thread to reload now, e.g., from a signal handler.
+            Returns (None): Returns nothing
+        """
+        self._requested.set()
+
+    def desired(self):
+        """Read the cavity list file, if any, and look up the metadata of every desired cavity.
+
+        Running cavities that the metadata source has nothing for keep their current metadata.  New cavities without
+        metadata fall back to the static name mapper, and are logged and left out if it does not know them either.
+            Returns (dict): Cavity name to CavityMetadata, in cavity list order
+        """
+        if self.path is not None:
+            self.cavity_names = read_cavity_list(self.path)
+        metadata = self.load_metadata(self.cavity_names)
+        desired = collections.OrderedDict()
+        for name in self.cavity_names:
+            md = metadata.get(name)
+            if md is None and name in self.cav_dict:
+                md = metadata_of(self.cav_dict[name])
+            elif md is None:
+                try:
+                    md = static_metadata(name)
+                except KeyError:
+                    logger.error("No metadata for cavity, not adding it - %s", name)
+                    continue
+            desired[name] = md
+        return desired
+
+    def reload(self):
+        """Add, remove and update cavities so that the running set matches the desired one.
+            Returns (CavitySetDiff): What was changed
+        """
+        with self._lock:
+            start = time.time()
+            desired = self.desired()
+            diff = diff_cavities(self.cav_dict, desired)
+            if diff.removed:
+                self._remove(diff.removed)
+            for name in diff.changed:
+                self.cav_dict[name].apply_metadata(desired[name])
+                logger.info("Updated cavity metadata to %s - %s", desired[name], name)
+            added = self._add({name: desired[name] for name in diff.added}) if diff.added else []
+            logger.info("Reloaded cavities in %.3f s: %d added (%d failed), %d removed, %d updated, %d running",
+                        time.time() - start, len(added), len(diff.added) - len(added), len(diff.removed),
+                        len(diff.changed), len(self.cav_dict))
+            return diff
+
+    def _remove(self, names):
+        deadline = time.time() + self.drain_timeout
+        removed = [self.cav_dict.pop(name) for name in names]
+        if self.drain is not None:
+            # All at once, so that a whole dead zone costs one drain_timeout rather than one per cavity
+            threads = [threading.Thread(target=self._drain, args=(cav.cavity_name, deadline)) for cav in removed]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        # Let outstanding requests complete, so that their IOCs do not count them as in flight forever
+        while any(cav.awaiting_data for cav in removed) and time.time() < deadline:
+            time.sleep(0.05)
+        for cav in removed:
+            cav.retire()
+            logger.info("Removed cavity - %s", cav.cavity_name)
+
+    def _drain(self, name, deadline):
+        try:
+            if not self.drain(name, max(0.0, deadline - time.time())):
+                logger.warning("Cavity still processing after %.1f s, removing it anyway - %s", self.drain_timeout,
+                               name)
+        except Exception:
+            logger.exception("Error draining cavity, removing it anyway - %s", name)
+
+    def _add(self, metadata):
+        created, failed = self.create_cavities(list(metadata), metadata)
+        for name, cav in created.items():
+            cav.results_out = self.results_out
+            for attr in SHARED_ATTRS:
+                setattr(cav, attr, getattr(self, attr))
+            if self.metrics is not None:
+                self.metrics.add_cavity(name, cav.request_interval)
+            for shared in (self.history, self.fit, self.results_table):
+                if shared is not None:
+                    shared.add_cavity(name)
+            if self.publisher is not None:
+                self.publisher.register(cav)
+        # Only now can the rest of the application see them
+        self.cav_dict.update(created)
+        for name in created:
+            logger.info("Added cavity - %s", name)
+        cavities = list(created.values())
+        if not cavities:
+            return cavities
+        if self.start is None:
+            Cryocavity.trigger_data_collection_batch(cavities)
+        else:
+            self.start(cavities, staggered_start_times(created, time.time()))
+        return cavities
+
+    def run(self, interval, event):
+        """Callable meant to be run in own thread.  Reloads whenever the cavity list file changes (checked every
+        interval seconds) or a reload is requested, until the event is set.  Call request after setting the event to
+        end the thread without waiting for the next check."""
+        while True:
+            requested = self._requested.wait(interval)
+            self._requested.clear()
+            if event.is_set():
+                break
+            stamp = self._file_stamp()
+            if not requested and stamp == self._stamp:
+                continue
+            self._stamp = stamp
+            if requested:
+                logger.info("Reloading cavities on request")
+            try:
+                self.reload()
+            except Exception:
+                logger.exception("Error reloading cavities, keeping the current ones")
+        logger.debug("cavity reloader has exited")
@@ -0,0 +1,230 @@
+"""Offline replay of archived synchronized cavity data through the loaded Q calculation.
+
+Archived data is held in a columnar archive: a directory with one NumPy .npy file per column, all of the same length
+with one row per synchronized sample.
+
+    cavities.txt    CED names of the cavities, one per line.  Row i of cavity.npy refers to line i.
+    timestamp.npy   float64 time of each sample
+    cavity.npy      int32 index of each sample's cavity into cavities.txt
+    GMESLQ.npy, CRFPLQ.npy, CRRPLQ.npy, DETALQ.npy, ITOTLQ.npy
+                    float64 synchronized inputs, in the units of the EPICS PVs
+
+Columns are memory-mapped and processed in fixed-size chunks, so an archive of any size is replayed in bounded
+memory.  The results are written the same way, one memory-mapped column per result field, alongside copies of the
+timestamp and cavity columns.
+
+Usage:
+    python -m qlCalc.replay convert samples.csv archive/
+    python -m qlCalc.replay run archive/ results/ [--metadata-file config/cavities.csv]
+"""
+import argparse
+import csv
+import logging
+import os
+import sys
+import time
+import numpy as np
+from numpy.lib.format import open_memmap
+
+from qlCalc import batch
+from qlCalc.metadata import DEFAULT_LENGTH, DEFAULT_RQ, FileMetadataSource, MetadataSourceError
+
+logger = logging.getLogger(__name__)
+
+# Archived input columns, in the order of Cryocavity.read_inputs
+INPUT_COLUMNS = ("GMESLQ", "CRFPLQ", "CRRPLQ", "DETALQ", "ITOTLQ")
+
+# File that names the cavities referenced by the cavity column
+CAVITY_NAMES_FILE = "cavities.txt"
+
+# Default number of samples processed at a time
+DEFAULT_CHUNK_SIZE = 65536
+
+
+def _write_cavity_names(directory, cavity_names):
+    with open(os.path.join(directory, CAVITY_NAMES_FILE), "w") as f:
+        for name in cavity_names:
+            f.write(name + "\n")
+
+
+def csv_to_columnar(csv_path, out_dir, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Convert a CSV file of archived samples to a columnar archive, streaming it so the CSV is never held in memory.
+
+    The CSV needs a header row with the columns timestamp, cavity_name and each of INPUT_COLUMNS.
+        Args:
+            csv_path (str): The CSV file to convert
+            out_dir (str): Directory of the archive to create
+            chunk_size (int): Number of rows converted at a time
+        Returns (int): The number of samples written
+    """
+    # The first pass sizes the columns and collects the cavity names
+    names = {}
+    rows = 0
+    with open(csv_path, newline="") as f:
+        for row in csv.DictReader(f):
+            names.setdefault(row["cavity_name"].strip(), len(names))
+            rows += 1
+
+    os.makedirs(out_dir, exist_ok=True)
+    _write_cavity_names(out_dir, names)
+    timestamps = open_memmap(os.path.join(out_dir, "timestamp.npy"), mode="w+", dtype=np.float64, shape=(rows,))
+    cavities = open_memmap(os.path.join(out_dir, "cavity.npy"), mode="w+", dtype=np.int32, shape=(rows,))
+    inputs = [open_memmap(os.path.join(out_dir, col + ".npy"), mode="w+", dtype=np.float64, shape=(rows,))
+              for col in INPUT_COLUMNS]
+
+    def write(start, chunk):
+        stop = start + len(chunk)
+        timestamps[start:stop] = [r[0] for r in chunk]
+        cavities[start:stop] = [r[1] for r in chunk]
+        for i, column in enumerate(inputs):
+            column[start:stop] = [r[2 + i] for r in chunk]
+        return stop
+
+    start = 0
+    chunk = []
+    with open(csv_path, newline="") as f:
+        for row in csv.DictReader(f):
+            chunk.append([float(row["timestamp"]), names[row["cavity_name"].strip()]] +
+                         [float(row[col]) for col in INPUT_COLUMNS])
+            if len(chunk) == chunk_size:
+                start = write(start, chunk)
+                chunk = []
+    if chunk:
+        write(start, chunk)
+
+    for column in [timestamps, cavities] + inputs:
+        column.flush()
+    return rows
+
+
+class ColumnarArchive:
+    """Read-only, memory-mapped view of a columnar archive"""
+
+    def __init__(self, path):
+        """Open an archive.  Nothing is read until columns are accessed.
+            Args:
+                path (str): Directory of the archive
+        """
+        self.path = path  #: str: directory of the archive
+        with open(os.path.join(path, CAVITY_NAMES_FILE)) as f:
+            self.cavity_names = [line.strip() for line in f if line.strip()]  #: list(str): names in index order
+        self.timestamp = self._load("timestamp")  #: ndarray: sample times
+        self.cavity = self._load("cavity")  #: ndarray: cavity index of each sample
+        self.inputs = {col: self._load(col) for col in INPUT_COLUMNS}  #: dict: input column name to ndarray
+
+        lengths = {len(self.timestamp), len(self.cavity)} | {len(c) for c in self.inputs.values()}
+        if len(lengths) != 1:
+            raise ValueError("Columns of archive {} have different lengths".format(path))
+
+    def _load(self, column):
+        return np.load(os.path.join(self.path, column + ".npy"), mmap_mode="r")
+
+    def __len__(self):
+        return len(self.timestamp)
+
+    def chunks(self, chunk_size=DEFAULT_CHUNK_SIZE):
+        """Iterate over the archive in fixed-size slices.
+            Args:
+                chunk_size (int): Number of samples per chunk.  The last chunk may be shorter.
+            Returns (generator): Yields (start, stop) row bounds
+        """
+        for start in range(0, len(self), chunk_size):
+            yield start, min(start + chunk_size, len(self))
+
+
+def load_cavity_parameters(cavity_names, metadata_file=None):
+    """Look up the active length and R/Q of each cavity.
+        Args:
+            cavity_names (list(str)): CED names of the cavities
+            metadata_file (str): CSV file read by FileMetadataSource.  Cavities not in it, or all cavities if None,
+              use the built in C100 values.
+        Returns (tuple(ndarray, ndarray)): Lengths in m and R/Q in Ohms, in cavity_names order
+    """
+    metadata = {}
+    if metadata_file is not None:
+        try:
+            metadata = FileMetadataSource(metadata_file).fetch(cavity_names)
+        except MetadataSourceError as e:
+            logger.warning("Using default cavity parameters: %s", e)
+    length = [metadata[name].length if name in metadata else DEFAULT_LENGTH for name in cavity_names]
+    RQ = [metadata[name].RQ if name in metadata else DEFAULT_RQ for name in cavity_names]
+    return np.array(length, dtype=np.float64), np.array(RQ, dtype=np.float64)
+
+
+def replay(archive, out_dir, length, RQ, chunk_size=DEFAULT_CHUNK_SIZE, exact=False, dtype=np.float32):
+    """Run every sample of an archive through the loaded Q calculation and write the results as a columnar archive.
+
+    Inputs are converted from PV units to base SI exactly as Cryocavity.update_formula_data does, then a whole chunk
+    is calculated in one call to qlCalc.batch.calculate.
+        Args:
+            archive (ColumnarArchive): The archived inputs
+            out_dir (str): Directory to write the results to
+            length (ndarray): Active length in m of each cavity, indexed like archive.cavity_names
+            RQ (ndarray): R/Q in Ohms of each cavity, indexed like archive.cavity_names
+            chunk_size (int): Number of samples calculated at a time
+            exact (bool): Match the live scalar calculation bit for bit (slower).  See qlCalc.batch.calculate.
+            dtype (numpy.dtype): Type of the floating point result columns
+        Returns (int): The number of samples replayed
+    """
+    n = len(archive)
+    os.makedirs(out_dir, exist_ok=True)
+    _write_cavity_names(out_dir, archive.cavity_names)
+
+    def column(name, col_dtype):
+        return open_memmap(os.path.join(out_dir, name + ".npy"), mode="w+", dtype=col_dtype, shape=(n,))
+
+    out_timestamp = column("timestamp", np.float64)
+    out_cavity = column("cavity", np.int32)
+    results = {field: column(field, np.int8 if field == "attenuation_factor_flag" else dtype)
+               for field in batch.RESULT_FIELDS}
+
+    for start, stop in archive.chunks(chunk_size):
+        idx = archive.cavity[start:stop]
+        GMES, CRFP, CRRP, DETA, ITOT = (archive.inputs[col][start:stop] for col in INPUT_COLUMNS)
+        chunk = batch.calculate(GMES * length[idx] * 1000000, CRFP * 1000, CRRP * 1000, np.radians(DETA),
+                                ITOT / 1000000, RQ[idx], exact=exact)
+        out_timestamp[start:stop] = archive.timestamp[start:stop]
+        out_cavity[start:stop] = idx
+        for field in batch.RESULT_FIELDS:
+            results[field][start:stop] = chunk[field]
+
+    for col in [out_timestamp, out_cavity] + list(results.values()):
+        col.flush()
+    return n
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Replay archived cavity data through the loaded Q calculation")
+    subparsers = parser.add_subparsers(dest="command")
+
+    convert = subparsers.add_parser("convert", help="Convert a CSV of archived samples to a columnar archive")
+    convert.add_argument("csv_file")
+    convert.add_argument("archive_dir")
+
+    run = subparsers.add_parser("run", help="Calculate loaded Q for every sample of a columnar archive")
+    run.add_argument("archive_dir")
+    run.add_argument("out_dir")
+    run.add_argument("--metadata-file", help="CSV of cavity metadata (defaults to C100 values)")
+    run.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE)
+    run.add_argument("--exact", action="store_true", help="Match the live calculation bit for bit (slower)")
+    run.add_argument("--float64", action="store_true", help="Write float64 rather than float32 results")
+
+    args = parser.parse_args(argv)
+    start = time.time()
+    if args.command == "convert":
+        n = csv_to_columnar(args.csv_file, args.archive_dir)
+    elif args.command == "run":
+        archive = ColumnarArchive(args.archive_dir)
+        length, RQ = load_cavity_parameters(archive.cavity_names, args.metadata_file)
+        n = replay(archive, args.out_dir, length, RQ, chunk_size=args.chunk_size, exact=args.exact,
+                   dtype=np.float64 if args.float64 else np.float32)
+    else:
+        parser.print_help()
+        return 2
+    elapsed = time.time() - start
+    print("{} samples in {:.2f} s ({:.0f} samples/s)".format(n, elapsed, n / elapsed if elapsed > 0 else 0))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,309 @@
+"""A fixed-layout table of every cavity's latest results in a memory-mapped file, for local consumers.
+
+    python -m qlCalc.resulttable /dev/shm/qlCalc-results
+"""
+import argparse
+import logging
+import math
+import mmap
+import os
+import tempfile
+import threading
+import time
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Identifies a result table file and the version of its layout.  Readers refuse anything else.
+TABLE_MAGIC = b"QLCALCRT"
+TABLE_VERSION = 1
+
+# Values of the status column
+STATUS_EMPTY = 0  #: int: no results written yet
+STATUS_OK = 1  #: int: results calculated without any error message
+STATUS_WARNING = 2  #: int: results calculated, but with error messages, e.g., a clamped attenuation factor
+STATUS_INVALID = 3  #: int: results replaced with NaN, e.g., because the data request timed out
+
+# Cryocavity result attributes in the table, in column order after seq and status
+TABLE_FIELDS = ("Q_lf", "Q_lr", "attenuation", "P_fc", "P_rc", "calc_timestamp", "heartbeat")
+
+HEADER_DTYPE = np.dtype([("magic", "S8"), ("version", "<u4"), ("capacity", "<u4"), ("row_size", "<u4"),
+                         ("name_size", "<u4"), ("pid", "<u4"), ("created", "<f8")])
+HEADER_SIZE = 64
+NAME_DTYPE = np.dtype("S32")
+ROW_DTYPE = np.dtype([("seq", "<u8"), ("status", "<i4"), ("pad", "<i4")] + [(f, "<f8") for f in TABLE_FIELDS])
+
+
+def _layout(capacity):
+    """Returns (tuple(int, int, int)): Offsets of the names and the rows, and the file size, for a capacity"""
+    names = HEADER_SIZE
+    rows = names + capacity * NAME_DTYPE.itemsize
+    rows += -rows % 64  # Rows start on a cache line
+    return names, rows, rows + capacity * ROW_DTYPE.itemsize
+
+
+def status_of(cav):
+    """Returns (int): The table status of a cavity's current results"""
+    if cav.Q_lf is None and cav.Q_lr is None:
+        return STATUS_EMPTY
+    if not any(isinstance(q, float) and math.isfinite(q) for q in (cav.Q_lf, cav.Q_lr)):
+        return STATUS_INVALID
+    return STATUS_WARNING if cav.err_msg else STATUS_OK
+
+
+class ResultTable:
+    """Writes every cavity's latest results into a memory-mapped file that other local processes can read.
+
+    The file holds a header, a fixed-width name per row and one fixed-size row per cavity (see ROW_DTYPE), so a reader
+    can map it and use the rows as a NumPy structured array with no copying and no network traffic.  Each row is a
+    seqlock: its seq counter is odd while the row is being written and is incremented again once the write is done.
+    A reader that sees the same even seq before and after copying a row has a consistent copy (see
+    ResultTableReader).
+
+    The file is built under a temporary name and renamed into place, so readers never see it half initialized.  Put
+    it on a memory-backed file system such as /dev/shm so that it is never written to disk.
+    """
+
+    def __init__(self, path, cavity_names, capacity=None):
+        """Create (or replace) the table file.
+            Args:
+                path (str): The table file
+                cavity_names (iterable(str)): CED names of the cavities, one row each in the given order
+                capacity (int): Number of rows, at least the number of cavities.  None for exactly one per cavity.
+        """
+        cavity_names = list(cavity_names)
+        if capacity is None:
+            capacity = len(cavity_names)
+        if capacity < len(cavity_names):
+            raise ValueError("capacity {} is less than the {} cavities".format(capacity, len(cavity_names)))
+        self.path = path  #: str: the table file
+        self.capacity = capacity  #: int: number of rows
+        self.index = {}  #: dict: cavity name to row number
+        self._lock = threading.Lock()  # One writer per row at a time, whichever thread exports the cavity
+        self._mmap = None
+        tmp = self._create(capacity)
+        self._free = list(range(capacity - 1, -1, -1))  # Unused rows, the lowest last
+        for name in cavity_names:
+            self._assign(name)
+        os.replace(tmp, path)
+
+    def _create(self, capacity):
+        """Map a new, empty table file under a temporary name.  Returns (str): the temporary name"""
+        names_offset, rows_offset, size = _layout(capacity)
+        directory = os.path.dirname(self.path) or "."
+        fd, tmp = tempfile.mkstemp(dir=directory, prefix=".resulttable")
+        try:
+            os.ftruncate(fd, max(size, 1))
+            self._mmap = mmap.mmap(fd, max(size, 1))
+        finally:
+            os.close(fd)
+        header = np.frombuffer(self._mmap, dtype=HEADER_DTYPE, count=1)
+        header[0] = (TABLE_MAGIC, TABLE_VERSION, capacity, ROW_DTYPE.itemsize, NAME_DTYPE.itemsize, os.getpid(),
+                     time.time())
+        self.capacity = capacity
+        self.names = np.frombuffer(self._mmap, dtype=NAME_DTYPE, count=capacity, offset=names_offset)  #: row names
+        self.rows = np.frombuffer(self._mmap, dtype=ROW_DTYPE, count=capacity, offset=rows_offset)  #: the rows
+        return tmp
+
+    def _assign(self, cavity_name):
+        encoded = cavity_name.encode()
+        if len(encoded) > NAME_DTYPE.itemsize:
+            raise ValueError("Cavity name longer than {} bytes - {}".format(NAME_DTYPE.itemsize, cavity_name))
+        row = self._free.pop()
+        self.names[row] = encoded
+        self.index[cavity_name] = row
+
+    def add_cavity(self, cavity_name):
+        """Give a cavity an empty row.  Does nothing if it already has one.
+
+        A table without a free row is copied into a new file of twice the capacity, which replaces the old one.
+        Readers of the old file keep seeing its last values until they reopen the table (see ResultTableReader.stale).
+            Args:
+                cavity_name (str): CED name of the cavity
+            Returns (None): Returns nothing
+        """
+        with self._lock:
+            if cavity_name in self.index:
+                return
+            if not self._free:
+                self._grow(max(1, 2 * self.capacity))
+            self._assign(cavity_name)
+
+    def remove_cavity(self, cavity_name):
+        """Clear a cavity's row (STATUS_EMPTY, no name) so that it can be reused.  Does nothing for a cavity without a
+        row."""
+        with self._lock:
+            i = self.index.pop(cavity_name, None)
+            if i is None:
+                return
+            # Clear the name first, so a reader that still finds the name also finds the row's last values
+            self.names[i] = b""
+            row = self.rows[i]
+            seq = int(row["seq"])
+            row["seq"] = seq + 1
+            row["status"] = STATUS_EMPTY
+            for field in TABLE_FIELDS:
+                row[field] = math.nan
+            row["seq"] = seq + 2
+            self._free.append(i)
+
+    def _grow(self, capacity):
+        old_mmap, names, rows = self._mmap, self.names, self.rows
+        tmp = self._create(capacity)
+        n = len(names)
+        self.names[:n] = names
+        self.rows[:n] = rows
+        self._free = list(range(capacity - 1, n - 1, -1))
+        os.replace(tmp, self.path)
+        del names, rows
+        try:
+            old_mmap.close()
+        except BufferError:
+            pass  # Someone still holds an array of the old table.  The mapping goes away with it.
+        logger.info("Result table %s grown to %d rows", self.path, capacity)
+
+    def write(self, cavity_name, status, values):
+        """Replace a cavity's row.
+            Args:
+                cavity_name (str): The cavity
+                status (int): One of the STATUS_* values
+                values (sequence(float)): One value per TABLE_FIELDS, in order.  None is stored as NaN.
+            Returns (None): Returns nothing
+        """
+        with self._lock:
+            row = self.rows[self.index[cavity_name]]
+            seq = int(row["seq"])
+            row["seq"] = seq + 1
+            row["status"] = status
+            for field, value in zip(TABLE_FIELDS, values):
+                row[field] = math.nan if value is None else value
+            row["seq"] = seq + 2
+
+    def write_cavity(self, cav):
+        """Replace a cavity's row with its current results.  Cavities without a row are ignored.
+            Args:
+                cav (Cryocavity): The cavity
+            Returns (None): Returns nothing
+        """
+        if cav.cavity_name in self.index:
+            self.write(cav.cavity_name, status_of(cav), [getattr(cav, field) for field in TABLE_FIELDS])
+
+    def close(self):
+        """Unmap the table.  The file stays, with the last results, until the next table replaces it."""
+        self.names = self.rows = None
+        self._mmap.close()
+
+
+class ResultTableReader:
+    """Maps a result table read-only.
+
+    rows is the table itself, a NumPy structured array over the shared memory with no copy.  Its values may change at
+    any time, so a consumer that needs a row's fields to belong together should read it with read or snapshot, which
+    copy rows under their seqlock.
+
+    Cavities added to or removed from a running qlCalc take or free rows, so index is only a hint.  read checks the
+    row's name and refreshes index when it no longer matches.  A table that ran out of rows, or whose writer was
+    restarted, is replaced by a new file - stale tells when to open the table again.
+    """
+
+    def __init__(self, path):
+        """Map a table file written by a ResultTable.
+            Args:
+                path (str): The table file
+        """
+        self.path = path  #: str: the table file
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._inode = os.fstat(f.fileno()).st_ino
+        if len(self._mmap) < HEADER_SIZE:
+            raise ValueError("{} is too short to be a result table".format(path))
+        header = np.frombuffer(self._mmap, dtype=HEADER_DTYPE, count=1).copy()[0]
+        if header["magic"] != TABLE_MAGIC or header["version"] != TABLE_VERSION:
+            raise ValueError("{} is not a version {} result table".format(path, TABLE_VERSION))
+        if header["row_size"] != ROW_DTYPE.itemsize or header["name_size"] != NAME_DTYPE.itemsize:
+            raise ValueError("{} has an unexpected row layout".format(path))
+        self.capacity = int(header["capacity"])  #: int: number of rows
+        self.pid = int(header["pid"])  #: int: process id of the writer
+        self.created = float(header["created"])  #: float: when the writer created the table
+        names_offset, rows_offset, size = _layout(self.capacity)
+        if len(self._mmap) < size:
+            raise ValueError("{} is shorter than its header says".format(path))
+        self.rows = np.frombuffer(self._mmap, dtype=ROW_DTYPE, count=self.capacity, offset=rows_offset)  #: the rows
+        self.names = np.frombuffer(self._mmap, dtype=NAME_DTYPE, count=self.capacity, offset=names_offset)  #: names
+        self.index = {}  #: dict: cavity name to row number, as of the last refresh
+        self.refresh()
+
+    def refresh(self):
+        """Re-read the row names into index, e.g., after cavities were added or removed.
+            Returns (dict): The updated index
+        """
+        self.index = {name.decode(): i for i, name in enumerate(self.names.tolist()) if name}
+        return self.index
+
+    def stale(self):
+        """Returns (bool): Whether the table file was replaced (or removed) since it was opened, so that this reader
+          no longer sees new results"""
+        try:
+            return os.stat(self.path).st_ino != self._inode
+        except FileNotFoundError:
+            return True
+
+    def read(self, cavity_name, retries=1000):
+        """Copy one cavity's row consistently.
+            Args:
+                cavity_name (str): The cavity
+                retries (int): Attempts before giving up on a row that keeps changing
+            Returns (dict): seq, status and every TABLE_FIELDS value
+        """
+        encoded = cavity_name.encode()
+        for _ in range(retries):
+            i = self.index.get(cavity_name)
+            if i is None or self.names[i] != encoded:
+                i = self.refresh()[cavity_name]
+            before = int(self.rows["seq"][i])
+            if before % 2 == 0:
+                row = self.rows[i].copy()
+                if int(self.rows["seq"][i]) == before and self.names[i] == encoded:
+                    return {field: row[field].item() for field in ("seq", "status") + TABLE_FIELDS}
+            time.sleep(0)  # Let a writer in this process finish the row
+        raise RuntimeError("Row kept changing while being read - {}".format(cavity_name))
+
+    def snapshot(self, retries=1000):
+        """Copy the whole table, every row consistent in itself.
+            Args:
+                retries (int): Attempts at re-reading rows that changed while being copied
+            Returns (ndarray): A copy of rows (see ROW_DTYPE)
+        """
+        copy = self.rows.copy()
+        for _ in range(retries):
+            torn = (copy["seq"] % 2 == 1) | (self.rows["seq"] != copy["seq"])
+            if not torn.any():
+                return copy
+            time.sleep(0)
+            copy[torn] = self.rows[torn]
+        raise RuntimeError("Rows kept changing while the table was being read")
+
+    def close(self):
+        """Unmap the table.  Arrays taken from rows must not be used afterwards."""
+        self.rows = self.names = None
+        self._mmap.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Print the results table of a running qlCalc")
+    parser.add_argument("path", help="The table file, i.e., results_table_file of qlCalc.main")
+    args = parser.parse_args(argv)
+
+    reader = ResultTableReader(args.path)
+    rows = reader.snapshot()
+    print("{:<12} {:>6} {:>12} {:>12} {:>8} {:>26}".format("cavity", "status", "Q_lf", "Q_lr", "atten", "calculated"))
+    for name, i in sorted(reader.index.items()):
+        row = rows[i]
+        ts = row["calc_timestamp"]
+        when = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(ts)) if math.isfinite(ts) else "-"
+        print("{:<12} {:>6} {:>12.4g} {:>12.4g} {:>8.4f} {:>26}".format(name, int(row["status"]), row["Q_lf"],
+                                                                         row["Q_lr"], row["attenuation"], when))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,178 @@
+import heapq
+import itertools
+import logging
+import math
+import random
+import threading
+
+from qlCalc.ratecontrol import zone_of
+
+logger = logging.getLogger(__name__)
+
+
+class RequestScheduler:
+    """A binary heap of CavityTasks ordered by request time that releases due requests in coalesced time slots.
+
+    Time is divided into slots of slot_width seconds.  A slot is released once it has completely elapsed, and every
+    request that fell in it is returned together so the caller can issue them as a single batch.  Requests are never
+    made early and are at most slot_width (plus wakeup delay) late.  A slot_width of 0 releases each request as soon as
+    it is due.  add and pop are O(log n).
+
+    Lateness (release time minus requested time) is tracked for every released request.  Jitter is reported as the
+    standard deviation of lateness.
+    """
+
+    def __init__(self, slot_width=0.05):
+        """Construct an empty scheduler.
+            Args:
+                slot_width (float): Width in seconds of the time slots in which due requests are coalesced
+        """
+        if slot_width < 0:
+            raise ValueError("slot_width must be non-negative, got {}".format(slot_width))
+        self.slot_width = slot_width  #: float: Width in seconds of the coalescing time slots
+        self._heap = []
+        self._lock = threading.Lock()  # Lets other threads add tasks and read stats while the scheduler runs
+        self._counter = itertools.count()  # Tie breaker so that tasks themselves are never compared
+        self._reset_stats()
+
+    def __len__(self):
+        return len(self._heap)
+
+    def add(self, task):
+        """Schedule a CavityTask for its request_timestamp.
+            Args:
+                task (CavityTask): The task to schedule
+            Returns (None): Returns nothing
+        """
+        with self._lock:
+            heapq.heappush(self._heap, (task.request_timestamp, next(self._counter), task))
+
+    def discard(self, cavity_name):
+        """Drop every task scheduled for a cavity, e.g., one that was removed and may be added again under its name.
+            Args:
+                cavity_name (str): The cavity
+            Returns (int): The number of tasks dropped
+        """
+        with self._lock:
+            kept = [entry for entry in self._heap if entry[2].cavity_name != cavity_name]
+            dropped = len(self._heap) - len(kept)
+            if dropped:
+                heapq.heapify(kept)
+                self._heap = kept
+        return dropped
+
+    def peek(self):
+        """Returns (CavityTask): The task with the earliest request time, or None if the scheduler is empty"""
+        with self._lock:
+            return self._heap[0][2] if self._heap else None
+
+    def slot_end(self, timestamp):
+        """Returns (float): The time at which the slot containing timestamp is released"""
+        if self.slot_width == 0:
+            return timestamp
+        return (math.floor(timestamp / self.slot_width) + 1) * self.slot_width
+
+    def next_release_time(self):
+        """Returns (float): The time at which the next batch of requests becomes due, or None if empty"""
+        with self._lock:
+            if not self._heap:
+                return None
+            return self.slot_end(self._heap[0][0])
+
+    def pop_due(self, now):
+        """Remove and return every task whose slot has been released by the given time.
+            Args:
+                now (float): The current time.time()
+            Returns (list(CavityTask)): The due tasks, earliest first.  Empty if nothing is due.
+        """
+        due = []
+        with self._lock:
+            heap = self._heap
+            while heap and self.slot_end(heap[0][0]) <= now:
+                ts, _, task = heapq.heappop(heap)
+                due.append(task)
+                lateness = now - ts
+                self._count += 1
+                self._lateness_sum += lateness
+                self._lateness_sumsq += lateness * lateness
+                if lateness > self._lateness_max:
+                    self._lateness_max = lateness
+            if due:
+                self._batches += 1
+        return due
+
+    def reset_stats(self):
+        """Start a new measurement interval for the lateness and jitter statistics"""
+        with self._lock:
+            self._reset_stats()
+
+    def _reset_stats(self):
+        self._count = 0
+        self._batches = 0
+        self._lateness_sum = 0.0
+        self._lateness_sumsq = 0.0
+        self._lateness_max = 0.0
+
+    def get_stats(self, reset=False):
+        """Report scheduling lateness and jitter since the scheduler was created or its stats were last reset.
+            Args:
+                reset (bool): Start a new measurement interval after reading the stats
+            Returns (dict): Keys are requests, batches, mean_batch_size, mean_lateness (s), max_lateness (s),
+              jitter (s) and scheduled (number of tasks waiting)
+        """
+        with self._lock:
+            n = self._count
+            mean = self._lateness_sum / n if n else 0.0
+            var = self._lateness_sumsq / n - mean * mean if n else 0.0
+            stats = {
+                "requests": n,
+                "batches": self._batches,
+                "mean_batch_size": n / self._batches if self._batches else 0.0,
+                "mean_lateness": mean,
+                "max_lateness": self._lateness_max,
+                "jitter": math.sqrt(var) if var > 0 else 0.0,
+                "scheduled": len(self._heap),
+            }
+            if reset:
+                self._reset_stats()
+        return stats
+
+
+def staggered_start_times(cav_dict, now, saved=None, rng=None, ioc_of=zone_of):
+    """Spread the initial data requests of many cavities over their request intervals, so that a (re)start does not
+    send every IOC a request for all of its cavities at the same moment.
+
+    Each IOC's cavities are spread evenly over the cavity's request_interval, each at a random point of its own share
+    of it, so that the load on every IOC, and the machine as a whole, is level from the first request.  Cavities
+    restored from a checkpoint keep the order of their previous request schedule.  The others follow, in name order.
+
+        Args:
+            cav_dict (dict): Cavity name to Cryocavity, with its request_interval already restored if checkpointed
+            now (float): The time.time() the first request may be made
+            saved (dict): Cavity name to saved state, as returned by Checkpoint.restore.  None if nothing was restored.
+            rng (random.Random): Source of the jitter.  None creates an unseeded one.
+            ioc_of (callable): Maps a cavity name to the name of its IOC
+        Returns (dict): Cavity name to the time.time() of its initial request
+    """
+    if rng is None:
+        rng = random.Random()
+    if saved is None:
+        saved = {}
+
+    def order(name):
+        entry = saved.get(name) or {}
+        last = entry.get("last_request")
+        interval = entry.get("request_interval")
+        if last is None or not interval:
+            return 1, 0.0, name
+        return 0, (last % interval) / interval, name
+
+    iocs = {}
+    for name in cav_dict:
+        iocs.setdefault(ioc_of(name), []).append(name)
+    times = {}
+    for names in iocs.values():
+        names.sort(key=order)
+        for j, name in enumerate(names):
+            times[name] = now + (j + rng.random()) / len(names) * cav_dict[name].request_interval
+    return times
@@ -0,0 +1,332 @@
+import heapq
+import itertools
+import logging
+import math
+import random
+import threading
+import time
+import numpy as np
+
+from qlCalc.acquisition import INPUT_PVS
+
+logger = logging.getLogger(__name__)
+
+# Suffixes of the PVs the FCC IOC serves for each cavity (see Cryocavity.PV_SUFFIXES)
+CAVITY_PV_SUFFIXES = ("GETDATA", "GMESLQ", "CRFPLQ", "CRRPLQ", "DETALQ", "ITOTLQ", "STARTLQ", "ENDLQ")
+
+
+class SimulatedPV:
+    """An in-process stand-in for an epics.PV, served by a SimulatedIOC.
+
+    It supports the subset of the epics.PV interface that qlCalc uses.  It is connected as soon as it is created.  Puts
+    change the value immediately, and monitor callbacks are run later from the IOC's thread, much like callbacks from
+    the CA library's thread.
+    """
+
+    def __init__(self, ioc, pvname, value=0):
+        self.ioc = ioc  #: SimulatedIOC: the IOC serving this PV
+        self.pvname = pvname  #: str: the PV name
+        self.value = value  #: the current value
+        self.timestamp = time.time()  #: float: time of the last update
+        self.connected = True  #: bool: always True until disconnect is called
+        self.callbacks = {}  #: dict: callback index to callback
+        self._next_index = itertools.count(1)
+
+    def get(self, **kw):
+        return self.value
+
+    def put(self, value, wait=False, **kw):
+        self.value = value
+        self.timestamp = time.time()
+        self.ioc.on_put(self, value)
+
+    def add_callback(self, callback, **kw):
+        index = next(self._next_index)
+        self.callbacks[index] = callback
+        return index
+
+    def remove_callback(self, index):
+        self.callbacks.pop(index, None)
+
+    def clear_callbacks(self):
+        self.callbacks = {}
+
+    def disconnect(self):
+        self.connected = False
+        self.callbacks = {}
+
+    def _post(self, value, timestamp):
+        """Update the value and run the monitor callbacks.  Only called from the IOC thread."""
+        self.value = value
+        self.timestamp = timestamp
+        for callback in list(self.callbacks.values()):
+            try:
+                callback(pvname=self.pvname, value=value, char_value=str(value), timestamp=timestamp)
+            except Exception:
+                logger.exception("Exception in monitor callback of %s", self.pvname)
+
+
+class _SimulatedCavity:
+    """The FCC records of one simulated cavity and the operating point its *LQ values are generated from"""
+
+    def __init__(self, name, rng, RQ, length):
+        self.name = name
+        self.pvs = {}
+        self.pending = None  # Sequence number of the outstanding data request, if any
+        self.requested = None  # time of the last GETDATA=1 put
+        self.posted = None  # time of the last GETDATA=2 post not yet followed by a published result
+
+        self.RQ = RQ
+        self.length = length
+        self.gradient = rng.uniform(8, 19)  # MV/m
+        self.Q_l = rng.uniform(1.5e7, 3.5e7)
+        self.detune = rng.uniform(-10, 10)  # degrees
+        self.current = rng.uniform(100, 200)  # uA
+        self.attenuation_factor = rng.uniform(0.85, 0.99)
+
+    def sample(self, rng, noise=1.0):
+        """Generate a physically consistent set of *LQ values around the cavity's operating point.
+
+        Forward and reflected power at the cavity follow from the loaded Q, voltage, beam current and detuning.  The
+        measured powers include the attenuation of the lines, so the calculation recovers Q_l within the noise.
+            Args:
+                rng (random.Random): Source of the noise
+                noise (float): Scale of the noise.  0 gives the operating point itself.
+            Returns (dict): Input PV suffix to value, in the units of the FCC PVs
+        """
+        gradient = self.gradient * (1 + rng.gauss(0, 1e-3 * noise))
+        detune = self.detune + rng.gauss(0, 0.5 * noise)
+        current = max(1.0, self.current + rng.gauss(0, noise))
+        Q_l = self.Q_l * (1 + rng.gauss(0, 1e-3 * noise))
+
+        V = gradient * self.length * 1e6
+        IV = current * 1e-6 * V
+        x = self.RQ * (current * 1e-6) ** 2 * Q_l
+        tan2 = math.tan(math.radians(detune)) ** 2
+        P_fc = ((x + IV) ** 2 + IV ** 2 * tan2) / (4 * x)
+        P_rc = ((x - IV) ** 2 + IV ** 2 * tan2) / (4 * x)
+        return {"GMESLQ": gradient, "CRFPLQ": P_fc / self.attenuation_factor / 1000,
+                "CRRPLQ": P_rc * self.attenuation_factor / 1000, "DETALQ": detune, "ITOTLQ": current}
+
+
+class SimulatedIOC:
+    """A local stand-in for the FCC IOCs, serving the PVs of any number of simulated cavities.
+
+    Use pv_factory wherever qlCalc takes one (e.g., Cryocavity.create_cryocavities and ResultPublisher).  PVs named
+    prefix + <EPICS name> + one of CAVITY_PV_SUFFIXES belong to a simulated cavity.  Any other name is a plain soft PV.
+
+    Putting 1 to a cavity's GETDATA requests data.  After the response latency (normally distributed with the given
+    mean and jitter) the IOC posts new *LQ values and then sets GETDATA to 2, unless the request is dropped, in which
+    case it never answers.  Putting 0 cancels an outstanding request.  Everything the IOC does, including running
+    monitor callbacks, happens on one thread ordered by a heap of due times, so thousands of cavities cost a single
+    thread.
+
+    The IOC also measures the application it serves.  The cycle time is the time between successive data requests for
+    a cavity.  The processing latency is the time from a cavity's data being posted to its first result put to
+    result_prefix + <EPICS name> + result_suffix.
+    """
+
+    def __init__(self, prefix="", latency=0.1, jitter=0.02, drop_rate=0.0, seed=None, RQ=868.9, length=0.7,
+                 result_prefix=None, result_suffix="QLFLQ", noise=1.0):
+        """Construct an IOC.  Call start before use.
+            Args:
+                prefix (str): Prefix of the cavity PV names
+                latency (float): Mean seconds from a data request to the response
+                jitter (float): Standard deviation in seconds of the response latency
+                drop_rate (float): Fraction of data requests that are never answered
+                seed (int): Seed of the random generator, for reproducible runs
+                RQ (float): R/Q in Ohms used to generate *LQ values.  Should match the cavities' metadata.
+                length (float): Active length in m used to generate *LQ values
+                result_prefix (str): Prefix of the result PVs watched for the processing latency.  None uses prefix.
+                result_suffix (str): Suffix of the result PV watched for the processing latency
+                noise (float): Scale of the noise on the generated *LQ values.  0 posts each cavity's operating point.
+        """
+        self.prefix = prefix  #: str: prefix of the cavity PV names
+        self.latency = latency  #: float: mean response latency in seconds
+        self.jitter = jitter  #: float: standard deviation of the response latency in seconds
+        self.drop_rate = drop_rate  #: float: fraction of data requests never answered
+        self.RQ = RQ  #: float: R/Q in Ohms used to generate *LQ values
+        self.length = length  #: float: active length in m used to generate *LQ values
+        self.result_prefix = prefix if result_prefix is None else result_prefix  #: str: prefix of result PVs
+        self.result_suffix = result_suffix  #: str: suffix of the result PV that marks a cavity's results published
+        self.noise = noise  #: float: scale of the noise on the generated *LQ values
+
+        self._rng = random.Random(seed)
+        self._cond = threading.Condition()
+        self._heap = []  # (due time, sequence number, action, args)
+        self._seq = itertools.count()
+        self._running = False
+        self._thread = None
+        self._pvs = {}  # PV name to SimulatedPV
+        self._cavities = {}  # EPICS name to _SimulatedCavity
+        self._result_pvs = {}  # Result PV name to _SimulatedCavity
+
+        self._stats_start = time.time()
+        self._requests = 0
+        self._responses = 0
+        self._dropped = 0
+        self._cycles = []
+        self._processing = []
+
+    def pv_factory(self, pvname):
+        """Create (or return the existing) PV of the given name.  Matches the epics.PV(pvname) signature."""
+        with self._cond:
+            pv = self._pvs.get(pvname)
+            if pv is not None:
+                return pv
+            pv = SimulatedPV(self, pvname)
+            self._pvs[pvname] = pv
+            if pvname.startswith(self.prefix):
+                for suffix in CAVITY_PV_SUFFIXES:
+                    if pvname.endswith(suffix):
+                        cav = self._cavity(pvname[len(self.prefix):len(pvname) - len(suffix)])
+                        cav.pvs[suffix] = pv
+                        break
+            if pvname.startswith(self.result_prefix) and pvname.endswith(self.result_suffix):
+                self._result_pvs[pvname] = self._cavity(
+                    pvname[len(self.result_prefix):len(pvname) - len(self.result_suffix)])
+            return pv
+
+    def _cavity(self, epics_name):
+        cav = self._cavities.get(epics_name)
+        if cav is None:
+            cav = _SimulatedCavity(epics_name, self._rng, self.RQ, self.length)
+            self._cavities[epics_name] = cav
+        return cav
+
+    def start(self):
+        """Start the IOC thread"""
+        with self._cond:
+            self._running = True
+        self._thread = threading.Thread(target=self._run, name="SimulatedIOC", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop the IOC thread.  Outstanding requests are never answered."""
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _schedule(self, due, action, *args):
+        entry = (due, next(self._seq), action, args)
+        with self._cond:
+            heapq.heappush(self._heap, entry)
+            if self._heap[0] is entry:
+                self._cond.notify()
+
+    def on_put(self, pv, value):
+        """Called by SimulatedPV.put from the putting thread.  Hands the put over to the IOC thread."""
+        self._schedule(time.time(), self._handle_put, pv, value)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._running and (not self._heap or self._heap[0][0] > time.time()):
+                    wait = self._heap[0][0] - time.time() if self._heap else None
+                    self._cond.wait(wait)
+                if not self._running:
+                    return
+                due, seq, action, args = heapq.heappop(self._heap)
+            action(*args)
+
+    def _handle_put(self, pv, value):
+        now = time.time()
+        cav = self._result_pvs.get(pv.pvname)
+        if cav is not None:
+            if cav.posted is not None:
+                with self._cond:
+                    self._processing.append(now - cav.posted)
+                cav.posted = None
+        elif pv.pvname.endswith("GETDATA") and pv.pvname.startswith(self.prefix):
+            cav = self._cavities[pv.pvname[len(self.prefix):-len("GETDATA")]]
+            if value == 1:
+                self._request(cav, now)
+            elif value == 0:
+                cav.pending = None
+        pv._post(value, now)
+
+    def _request(self, cav, now):
+        dropped = self._rng.random() < self.drop_rate
+        with self._cond:
+            self._requests += 1
+            if cav.requested is not None:
+                self._cycles.append(now - cav.requested)
+            if dropped:
+                self._dropped += 1
+        cav.requested = now
+        if dropped:
+            cav.pending = None
+            return
+        cav.pending = next(self._seq)
+        delay = max(0.0, self._rng.gauss(self.latency, self.jitter))
+        self._schedule(now + delay, self._respond, cav, cav.pending)
+
+    def _respond(self, cav, request):
+        if cav.pending != request:
+            return  # Cancelled or superseded
+        cav.pending = None
+        now = time.time()
+        values = cav.sample(self._rng, self.noise)
+        pvs = cav.pvs
+        if "STARTLQ" in pvs:
+            pvs["STARTLQ"]._post(now, now)
+        for suffix in INPUT_PVS:
+            if suffix in pvs:
+                pvs[suffix]._post(values[suffix], now)
+        if "ENDLQ" in pvs:
+            pvs["ENDLQ"]._post(now, now)
+        with self._cond:
+            self._responses += 1
+        cav.posted = time.time()
+        if "GETDATA" in pvs:
+            pvs["GETDATA"]._post(2, cav.posted)
+
+    def true_loaded_q(self, epics_name):
+        """Returns (float): The loaded Q the simulated cavity's values are generated around"""
+        return self._cavities[epics_name].Q_l
+
+    def get_stats(self, reset=False):
+        """Report the IOC's counters and the application's measured cycle and processing times.
+            Args:
+                reset (bool): Start a new measurement interval after reading the stats
+            Returns (dict): requests, responses and dropped counts, elapsed seconds, cycle_rate (requests/s), and
+              cycle_time and processing_latency dicts of count, mean and the 50th, 90th, 99th percentiles and max
+        """
+        with self._cond:
+            elapsed = time.time() - self._stats_start
+            stats = {
+                "requests": self._requests,
+                "responses": self._responses,
+                "dropped": self._dropped,
+                "elapsed": elapsed,
+                "cycle_rate": self._requests / elapsed if elapsed > 0 else 0.0,
+                "cycle_time": _distribution(self._cycles),
+                "processing_latency": _distribution(self._processing),
+            }
+            if reset:
+                self._stats_start = time.time()
+                self._requests = 0
+                self._responses = 0
+                self._dropped = 0
+                self._cycles = []
+                self._processing = []
+        return stats
+
+
+def _distribution(samples):
+    if not samples:
+        return {"count": 0, "mean": math.nan, "p50": math.nan, "p90": math.nan, "p99": math.nan, "max": math.nan}
+    a = np.asarray(samples)
+    p50, p90, p99 = np.percentile(a, (50, 90, 99))
+    return {"count": len(a), "mean": float(a.mean()), "p50": float(p50), "p90": float(p90), "p99": float(p99),
+            "max": float(a.max())}
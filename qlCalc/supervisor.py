@@ -0,0 +1,461 @@
+"""Run the cavities of a whole machine in several processes, each running the usual qlCalc pipeline for its shard.
+
+    python -m qlCalc.supervisor --workers 8 --shard-by zone
+"""
+import argparse
+import collections
+import json
+import logging
+import multiprocessing
+import os
+import signal
+import threading
+import time
+import zlib
+
+from qlCalc.ratecontrol import zone_of
+
+logger = logging.getLogger(__name__)
+
+# Ways of splitting the cavities into shards
+SHARD_BY_ZONE = "zone"  #: Whole zones, so every cavity of an FCC IOC is in the same process
+SHARD_BY_LINAC = "linac"  #: Whole linacs (e.g., 1L, 2L) where possible, split by zone when there are more workers
+SHARD_BY_HASH = "hash"  #: A stable hash of the cavity name, ignoring the machine's layout
+SHARD_MODES = (SHARD_BY_ZONE, SHARD_BY_LINAC, SHARD_BY_HASH)
+
+
+def linac_of(cavity_name):
+    """The linac of a cavity, e.g., 1L for 1L22-3.  The first two characters of its zone."""
+    return zone_of(cavity_name)[:2]
+
+
+def shard_cavities(cavity_names, num_shards, shard_by=SHARD_BY_ZONE):
+    """Split cavities into at most num_shards shards of similar size.
+
+    Zone and linac sharding keep groups together and assign the largest groups first to the currently smallest shard.
+    Linac sharding falls back to zones when there are fewer linacs than shards.  Shards that would be empty are left
+    out.
+        Args:
+            cavity_names (iterable(str)): CED names of the cavities
+            num_shards (int): Number of shards wanted
+            shard_by (str): One of SHARD_MODES
+        Returns (list(list(str))): The shards, each sorted by cavity name
+    """
+    if num_shards < 1:
+        raise ValueError("num_shards must be at least 1, got {}".format(num_shards))
+    if shard_by not in SHARD_MODES:
+        raise ValueError("Received unsupported shard_by '{}'".format(shard_by))
+    names = sorted(set(cavity_names))
+    shards = [[] for _ in range(num_shards)]
+    if shard_by == SHARD_BY_HASH:
+        for name in names:
+            shards[zlib.crc32(name.encode()) % num_shards].append(name)
+    else:
+        key = zone_of
+        if shard_by == SHARD_BY_LINAC and len({linac_of(name) for name in names}) >= num_shards:
+            key = linac_of
+        groups = collections.OrderedDict()
+        for name in names:
+            groups.setdefault(key(name), []).append(name)
+        for group in sorted(groups.values(), key=len, reverse=True):
+            min(shards, key=len).extend(group)
+    return [sorted(shard) for shard in shards if shard]
+
+
+def run_shard(shard_id, cavity_names, metadata, log_file, metrics_file, overrides=None, simulate=None):
+    """Entry point of a worker process.  Runs qlCalc.main.main for one shard until the process is terminated.
+        Args:
+            shard_id (int): The shard's number, used in log messages
+            cavity_names (list(str)): CED names of the shard's cavities
+            metadata (dict): Cavity name to CavityMetadata.  None loads it through the metadata cache.
+            log_file (str): The shard's log file
+            metrics_file (str): The shard's metrics snapshot file, which the supervisor reads
+            overrides (dict): Settings of qlCalc.main (module attribute name to value) to change first
+            simulate (dict): If given, serve the shard's PVs from an in-process SimulatedIOC constructed with these
+              keyword arguments, e.g., for testing
+    """
+    import qlCalc.main
+
+    qlCalc.main.log_file = log_file
+    qlCalc.main.metrics_snapshot_file = metrics_file
+    for name, value in (overrides or {}).items():
+        if not hasattr(qlCalc.main, name):
+            raise ValueError("qlCalc.main has no setting '{}'".format(name))
+        setattr(qlCalc.main, name, value)
+
+    if simulate is None:
+        qlCalc.main.main(cav_names=tuple(cavity_names), metadata=metadata)
+        return
+
+    from qlCalc.simioc import SimulatedIOC
+    ioc = SimulatedIOC(prefix="adamc:", result_prefix=qlCalc.main.results_prefix, **simulate)
+    ioc.start()
+    try:
+        qlCalc.main.main(cav_names=tuple(cavity_names), pv_factory=ioc.pv_factory, metadata=metadata)
+    finally:
+        ioc.stop()
+
+
+class ShardWorker:
+    """Bookkeeping for the process running one shard"""
+
+    def __init__(self, shard_id, cavity_names):
+        self.shard_id = shard_id  #: int: the shard's number
+        self.cavity_names = cavity_names  #: list(str): CED names of the shard's cavities
+        self.process = None  #: multiprocessing.Process: the current worker process.  None until started.
+        self.started = None  #: float: time.time() the current process was started
+        self.restarts = 0  #: int: number of times the shard's process was restarted
+        self.consecutive_failures = 0  #: int: failures since the shard last ran healthily for healthy_period
+        self.next_start = None  #: float: time.time() a failed shard will be restarted.  None if running.
+        self.progress = None  #: int: the latest progress count (see PipelineMetrics.snapshot) read from the shard
+        self.progressed = None  #: float: time.time() the progress count last changed, or the process started
+        self.last_exitcode = None  #: int: exit code of the last process to end
+
+
+class Supervisor:
+    """Splits the cavities across worker processes, watches them and restarts any that crash or hang.
+
+    Each worker runs the full qlCalc pipeline (qlCalc.main.main) for its shard with its own log file and metrics
+    snapshot file.  Workers are spawned, not forked, so that no Channel Access state is shared between processes.
+    The supervisor reads each shard's metrics snapshot to report health and throughput.  A worker that exits, or whose
+    pipeline has made no progress (no request made and no result exported, as counted in its snapshots) within
+    stale_after seconds, is (terminated and) restarted after a delay that doubles with each consecutive failure,
+    without touching the other shards.  Failures only stop counting as consecutive once the restarted worker has run
+    healthily for healthy_period seconds, so a worker that crashes soon after every start keeps backing off.  rebalance re-splits the cavities, e.g., with a different number of workers,
+    and restarts only the shards whose cavities changed.
+    """
+
+    def __init__(self, cavity_names, num_workers=None, shard_by=SHARD_BY_ZONE, metadata=None, run_dir=None,
+                 overrides=None, simulate=None, restart_delay=1.0, max_restart_delay=60.0, stale_after=60.0,
+                 stop_timeout=30.0, healthy_period=300.0):
+        """Construct a supervisor.  No process is started until start is called.
+            Args:
+                cavity_names (iterable(str)): CED names of all the cavities to run
+                num_workers (int): Number of worker processes.  None uses one per CPU.
+                shard_by (str): How to split the cavities.  One of SHARD_MODES
+                metadata (dict): Cavity name to CavityMetadata, handed to every worker.  None has each worker load
+                  its own through the metadata cache.
+                run_dir (str): Directory of the shards' log and metrics files.  None uses qlCalc.main's log directory.
+                overrides (dict): Settings of qlCalc.main changed in every worker (see run_shard)
+                simulate (dict): Have each worker serve its PVs from a SimulatedIOC (see run_shard)
+                restart_delay (float): Seconds before a failed worker is first restarted
+                max_restart_delay (float): Upper bound in seconds on the doubled restart delay
+                stale_after (float): Seconds without pipeline progress after which a worker counts as hung.  None,
+                  or overrides setting metrics_snapshot_file to None, never restarts a live worker.
+                stop_timeout (float): Seconds a worker gets to shut down gracefully before it is killed
+                healthy_period (float): Seconds a (re)started worker must run healthily before its restart delay
+                  starts over from restart_delay
+        """
+        if num_workers is None:
+            num_workers = os.cpu_count() or 1
+        self.cavity_names = sorted(set(cavity_names))  #: list(str): all the cavities being run
+        self.num_workers = num_workers  #: int: number of shards wanted
+        self.shard_by = shard_by  #: str: how the cavities are split.  One of SHARD_MODES
+        self.metadata = metadata  #: dict: cavity name to CavityMetadata, or None
+        if run_dir is None:
+            import qlCalc.main
+            run_dir = os.path.dirname(qlCalc.main.log_file)
+        self.run_dir = run_dir  #: str: directory of the shards' log and metrics files
+        self.overrides = dict(overrides or {})  #: dict: qlCalc.main settings changed in every worker
+        self.simulate = simulate  #: dict: SimulatedIOC keyword arguments, or None for real IOCs
+        self.restart_delay = restart_delay  #: float: seconds before a failed worker is first restarted
+        self.max_restart_delay = max_restart_delay  #: float: upper bound on the restart delay in seconds
+        self.stale_after = stale_after  #: float: seconds without progress after which a worker is hung
+        self.stop_timeout = stop_timeout  #: float: seconds a worker gets to shut down before it is killed
+        self.healthy_period = healthy_period  #: float: seconds of healthy running that reset the restart delay
+        self.workers = []  #: list(ShardWorker): one per shard
+
+        self._context = multiprocessing.get_context("spawn")
+        self._lock = threading.RLock()
+        self._running = False
+
+    def log_file(self, shard_id):
+        """Returns (str): The log file of a shard"""
+        return os.path.join(self.run_dir, "qlCalc-shard{}.log".format(shard_id))
+
+    def metrics_file(self, shard_id):
+        """Returns (str): The metrics snapshot file of a shard"""
+        return os.path.join(self.run_dir, "metrics-shard{}.json".format(shard_id))
+
+    def checkpoint_file(self, shard_id):
+        """Returns (str): The checkpoint file of a shard, unless overrides set one"""
+        return os.path.join(self.run_dir, "checkpoint-shard{}.json".format(shard_id))
+
+    def start(self):
+        """Split the cavities and start a worker process per shard"""
+        with self._lock:
+            self._running = True
+            shards = shard_cavities(self.cavity_names, self.num_workers, self.shard_by)
+            self.workers = [ShardWorker(i, shard) for i, shard in enumerate(shards)]
+            for worker in self.workers:
+                self._start_worker(worker)
+            logger.info("Started %d shard workers for %d cavities (by %s)", len(self.workers), len(self.cavity_names),
+                        self.shard_by)
+
+    def _start_worker(self, worker):
+        import qlCalc.main
+
+        metadata = None
+        if self.metadata is not None:
+            metadata = {name: self.metadata[name] for name in worker.cavity_names if name in self.metadata}
+        metrics_file = self.metrics_file(worker.shard_id)
+        try:
+            os.remove(metrics_file)
+        except FileNotFoundError:
+            pass
+        # Shards must not overwrite each other's checkpoint or result table
+        overrides = dict(self.overrides)
+        overrides.setdefault("checkpoint_file", self.checkpoint_file(worker.shard_id))
+        table = overrides.get("results_table_file", qlCalc.main.results_table_file)
+        if table is not None:
+            overrides["results_table_file"] = "{}-shard{}".format(table, worker.shard_id)
+        # The supervisor decides which cavities each shard runs (see rebalance), so shards do not watch the list
+        overrides["cavities_file"] = None
+        worker.process = self._context.Process(
+            target=run_shard, name="qlCalc-shard{}".format(worker.shard_id),
+            args=(worker.shard_id, worker.cavity_names, metadata, self.log_file(worker.shard_id), metrics_file,
+                  overrides, self.simulate))
+        worker.process.start()
+        worker.started = time.time()
+        worker.next_start = None
+        worker.progress = None
+        worker.progressed = worker.started
+        logger.info("Started shard %d (pid %d) with %d cavities", worker.shard_id, worker.process.pid,
+                    len(worker.cavity_names))
+
+    def _stop_worker(self, worker):
+        process = worker.process
+        if process is None:
+            return
+        if process.is_alive():
+            process.terminate()
+            process.join(self.stop_timeout)
+            if process.is_alive():
+                logger.error("Shard %d (pid %d) did not stop within %.1f s, killing it", worker.shard_id, process.pid,
+                             self.stop_timeout)
+                os.kill(process.pid, signal.SIGKILL)
+                process.join()
+        worker.last_exitcode = process.exitcode
+
+    def stop(self):
+        """Ask every worker to shut down gracefully, killing any that take longer than stop_timeout"""
+        with self._lock:
+            self._running = False
+            for worker in self.workers:
+                if worker.process is not None and worker.process.is_alive():
+                    worker.process.terminate()
+            for worker in self.workers:
+                self._stop_worker(worker)
+            logger.info("Stopped %d shard workers", len(self.workers))
+
+    def read_snapshot(self, shard_id):
+        """Returns (dict): The shard's latest metrics snapshot (see PipelineMetrics.snapshot), or None if there is
+        none yet or it cannot be read"""
+        try:
+            with open(self.metrics_file(shard_id)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _is_stale(self, worker, snapshot, now):
+        # The snapshot time is no sign of life, since the metrics thread writes snapshots even if the pipeline is stuck
+        if self.stale_after is None or self.overrides.get("metrics_snapshot_file", "") is None:
+            return False
+        progress = snapshot.get("progress") if snapshot is not None else None
+        if progress is not None and progress != (worker.progress or 0):
+            worker.progressed = now
+        if progress is not None:
+            worker.progress = progress
+        return now - worker.progressed > self.stale_after
+
+    def poll(self, now=None):
+        """Restart workers that have exited or hung and whose restart delay has passed.  Called periodically by run.
+            Args:
+                now (float): The current time.time().  None means now.
+            Returns (list(int)): The shards restarted
+        """
+        if now is None:
+            now = time.time()
+        restarted = []
+        with self._lock:
+            if not self._running:
+                return restarted
+            for worker in self.workers:
+                if worker.next_start is None:
+                    alive = worker.process.is_alive()
+                    snapshot = self.read_snapshot(worker.shard_id) if alive else None
+                    if alive and not self._is_stale(worker, snapshot, now):
+                        if snapshot is not None and now - worker.started >= self.healthy_period:
+                            worker.consecutive_failures = 0
+                        continue
+                    if alive:
+                        logger.error("Shard %d (pid %d) has made no progress for %.1f s, restarting it",
+                                     worker.shard_id, worker.process.pid, self.stale_after)
+                        self._stop_worker(worker)
+                    else:
+                        worker.last_exitcode = worker.process.exitcode
+                        logger.error("Shard %d (pid %d) exited with code %s", worker.shard_id, worker.process.pid,
+                                     worker.last_exitcode)
+                    delay = min(self.restart_delay * 2 ** worker.consecutive_failures, self.max_restart_delay)
+                    worker.consecutive_failures += 1
+                    worker.next_start = now + delay
+                    logger.info("Restarting shard %d in %.1f s", worker.shard_id, delay)
+                if worker.next_start is not None and now >= worker.next_start:
+                    worker.restarts += 1
+                    self._start_worker(worker)
+                    restarted.append(worker.shard_id)
+        return restarted
+
+    def rebalance(self, num_workers=None, shard_by=None, cavity_names=None):
+        """Re-split the cavities and restart the shards whose cavities changed.  Unchanged shards keep running.
+            Args:
+                num_workers (int): New number of workers.  None keeps the current number.
+                shard_by (str): New way of splitting.  None keeps the current one.
+                cavity_names (iterable(str)): New set of cavities.  None keeps the current set.
+            Returns (list(int)): The shards (re)started
+        """
+        with self._lock:
+            if num_workers is not None:
+                self.num_workers = num_workers
+            if shard_by is not None:
+                self.shard_by = shard_by
+            if cavity_names is not None:
+                self.cavity_names = sorted(set(cavity_names))
+            shards = shard_cavities(self.cavity_names, self.num_workers, self.shard_by)
+
+            # Keep the workers whose shards survive unchanged, whatever their position
+            current = {tuple(w.cavity_names): w for w in self.workers}
+            kept = {}
+            for shard in shards:
+                worker = current.pop(tuple(shard), None)
+                if worker is not None:
+                    kept[tuple(shard)] = worker
+            for worker in current.values():
+                self._stop_worker(worker)
+
+            used_ids = {w.shard_id for w in kept.values()}
+            free_ids = (i for i in range(len(shards) + len(self.workers)) if i not in used_ids)
+            workers = []
+            started = []
+            for shard in shards:
+                worker = kept.get(tuple(shard))
+                if worker is None:
+                    worker = ShardWorker(next(free_ids), shard)
+                    if self._running:
+                        self._start_worker(worker)
+                    started.append(worker.shard_id)
+                workers.append(worker)
+            self.workers = workers
+            logger.info("Rebalanced %d cavities into %d shards (by %s), %d restarted", len(self.cavity_names),
+                        len(workers), self.shard_by, len(started))
+        return started
+
+    def get_health(self):
+        """Report the health and throughput of every shard.
+            Returns (list(dict)): One dict per shard with keys shard, pid, alive, healthy (alive, not waiting for a
+              restart and reporting), cavities, restarts, exitcode (of the last process to end), update_rate and
+              expected_rate (updates/s from the latest snapshot, None without one) and snapshot_age (s, or None)
+        """
+        now = time.time()
+        health = []
+        with self._lock:
+            for worker in self.workers:
+                process = worker.process
+                alive = process is not None and process.is_alive()
+                snapshot = self.read_snapshot(worker.shard_id) if alive else None
+                health.append({
+                    "shard": worker.shard_id,
+                    "pid": process.pid if process is not None else None,
+                    "alive": alive,
+                    "healthy": alive and worker.next_start is None and snapshot is not None and not self._is_stale(
+                        worker, snapshot, now),
+                    "cavities": len(worker.cavity_names),
+                    "restarts": worker.restarts,
+                    "exitcode": worker.last_exitcode,
+                    "update_rate": snapshot.get("update_rate") if snapshot is not None else None,
+                    "expected_rate": snapshot.get("expected_rate") if snapshot is not None else None,
+                    "snapshot_age": now - snapshot["time"] if snapshot is not None and "time" in snapshot else None,
+                })
+        return health
+
+    def run(self, event, poll_interval=1.0, stats_interval=60.0):
+        """Start the workers and supervise them until the event is set, then stop them.
+            Args:
+                event (threading.Event): Event used to signal shutdown
+                poll_interval (float): Seconds between checks on the workers
+                stats_interval (float): Seconds between logging the shards' health
+            Returns (None): Returns nothing
+        """
+        self.start()
+        next_stats = time.time() + stats_interval
+        try:
+            while not event.wait(poll_interval):
+                self.poll()
+                if time.time() >= next_stats:
+                    next_stats += stats_interval
+                    log_health(self.get_health())
+        finally:
+            self.stop()
+
+
+def log_health(health):
+    """Log the health of every shard and the machine-wide update rate"""
+    total = 0.0
+    for shard in health:
+        total += shard["update_rate"] or 0.0
+        logger.info("Shard %d: pid %s, %d cavities, %s, %s updates/s, %d restarts", shard["shard"], shard["pid"],
+                    shard["cavities"], "healthy" if shard["healthy"] else "UNHEALTHY",
+                    "-" if shard["update_rate"] is None else "{:.1f}".format(shard["update_rate"]), shard["restarts"])
+    logger.info("%d shards, %.1f updates/s in total", len(health), total)
+
+
+def main(argv=None):
+    import qlCalc.main
+    from qlCalc.logconfig import setup_logging
+    from qlCalc.metadata import MetadataCache, FileMetadataSource, CEDMetadataSource
+
+    parser = argparse.ArgumentParser(description="Run qlCalc for the whole machine in several worker processes")
+    parser.add_argument("--workers", type=int, default=None, help="Number of worker processes (default: one per CPU)")
+    parser.add_argument("--shard-by", choices=SHARD_MODES, default=SHARD_BY_ZONE)
+    parser.add_argument("--cavities", nargs="+", default=None,
+                        help="CED names of the cavities to run (default: every cavity of the metadata source)")
+    parser.add_argument("--poll-interval", type=float, default=1.0)
+    args = parser.parse_args(argv)
+
+    log_pipeline = setup_logging(os.path.join(os.path.dirname(qlCalc.main.log_file), "qlCalc-supervisor.log"),
+                                 level=qlCalc.main.log_level)
+
+    # Look the metadata up once, rather than once per worker.  Listing every cavity already fetches all of it.
+    source = CEDMetadataSource() if qlCalc.main.metadata_source == "ced" else FileMetadataSource(
+        qlCalc.main.metadata_file)
+    cache = MetadataCache(qlCalc.main.metadata_cache_file, ttl=qlCalc.main.metadata_ttl)
+    names = args.cavities
+    if names is None:
+        metadata = source.fetch()
+        cache.store(metadata.values())
+        names = sorted(metadata)
+    else:
+        metadata = cache.load(names, source=source)
+
+    event = threading.Event()
+    received = []
+
+    def handler(signum, frame):
+        # Only record the signal.  Logging here can deadlock, see qlCalc.main.sig_handler.
+        received.append(signum)
+        event.set()
+
+    for sig in (signal.SIGHUP, signal.SIGINT, signal.SIGQUIT, signal.SIGTERM):
+        signal.signal(sig, handler)
+
+    supervisor = Supervisor(names, num_workers=args.workers, shard_by=args.shard_by, metadata=metadata,
+                            stale_after=max(60.0, 3 * qlCalc.main.metrics_snapshot_interval))
+    supervisor.run(event, poll_interval=args.poll_interval, stats_interval=qlCalc.main.stats_interval)
+    if received:
+        logger.info("received signal '%s' - stopped shard workers.", received[0])
+    if log_pipeline is not None:
+        log_pipeline.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,236 @@
+import logging
+import math
+import threading
+import time
+import numpy as np
+
+from qlCalc import batch
+from qlCalc.acquisition import INPUT_PVS
+
+logger = logging.getLogger(__name__)
+
+# Default measurement uncertainty (one standard deviation) of each raw input as (absolute in the PV's units, relative
+# fraction of the value).  The two add: sigma = absolute + relative * |value|.
+DEFAULT_UNCERTAINTIES = {
+    "GMESLQ": (0.0, 0.02),  # MV/m
+    "CRFPLQ": (0.0, 0.05),  # kW
+    "CRRPLQ": (0.0, 0.05),  # kW
+    "DETALQ": (1.0, 0.0),  # degrees
+    "ITOTLQ": (0.0, 0.01),  # uA
+}
+
+# Cryocavity attributes holding the uncertainty estimates, in the order they are published
+UNCERTAINTY_FIELDS = ("Q_lf_unc", "Q_lf_lo", "Q_lf_hi", "Q_lr_unc", "Q_lr_lo", "Q_lr_hi")
+
+
+def _quantiles(samples, probs):
+    """Quantiles along the last axis, ignoring NaN, by linear interpolation between order statistics.  Rows without
+    any finite value give NaN.  np.nanpercentile falls back to a Python loop over rows when NaN is present."""
+    ordered = np.sort(samples, axis=-1)  # NaN sorts last
+    count = np.sum(np.isfinite(ordered), axis=-1)
+    last = np.maximum(count - 1, 0)[..., None]
+    out = []
+    for p in probs:
+        pos = p * last
+        lo = np.floor(pos).astype(np.int64)
+        hi = np.minimum(lo + 1, last)
+        frac = pos - lo
+        a = np.take_along_axis(ordered, lo, axis=-1)
+        b = np.take_along_axis(ordered, hi, axis=-1)
+        q = (a + (b - a) * frac)[..., 0]
+        q[count == 0] = np.nan
+        out.append(q)
+    return out
+
+
+def monte_carlo(V_c, P_f, P_r, detune_angle, I_tot, RQ, sigma, draws=2000, confidence=0.9, rng=None,
+                max_elements=1 << 20):
+    """Propagate input uncertainties through the loaded Q chain by Monte Carlo, for many cavities at once.
+
+    Every cavity's inputs are drawn draws times from independent normal distributions and the draws of as many cavities
+    as fit in max_elements go through batch.calculate together as one (cavities, draws) array.  Draws for which the
+    chain is undefined (NaN or inf) are left out of the statistics, and the fraction left in is reported.
+
+        Args:
+            V_c, P_f, P_r, detune_angle, I_tot, RQ (array_like): One value per cavity, in base SI units as for
+              batch.calculate.  RQ is not varied.
+            sigma (tuple(array_like)): Standard deviations of V_c, P_f, P_r, detune_angle and I_tot, same units
+            draws (int): Monte Carlo draws per cavity
+            confidence (float): Coverage of the reported central interval, e.g., 0.9 for the 5th to 95th percentile
+            rng (np.random.RandomState): Source of the draws.  None creates an unseeded one.
+            max_elements (int): Largest number of draws evaluated in one pass, bounding memory use
+        Returns (dict): Arrays with one value per cavity - UNCERTAINTY_FIELDS (standard deviation, lower and upper
+          interval bounds of Q_lf and Q_lr) and valid_fraction (fraction of draws with finite Q_lf and Q_lr)
+    """
+    if draws < 2:
+        raise ValueError("draws must be at least 2, got {}".format(draws))
+    if not 0 < confidence < 1:
+        raise ValueError("confidence must be in (0, 1), got {}".format(confidence))
+    if rng is None:
+        rng = np.random.RandomState()
+    values = np.broadcast_arrays(*(np.atleast_1d(np.asarray(x, dtype=np.float64))
+                                   for x in (V_c, P_f, P_r, detune_angle, I_tot, RQ)))
+    means = values[:5]
+    RQ = values[5]
+    n = RQ.shape[0]
+    sigma = [np.broadcast_to(np.asarray(s, dtype=np.float64), (n,)) for s in sigma]
+    probs = ((1 - confidence) / 2, (1 + confidence) / 2)
+
+    out = {field: np.full(n, np.nan) for field in UNCERTAINTY_FIELDS}
+    out["valid_fraction"] = np.zeros(n)
+    rows = max(1, max_elements // draws)
+    for start in range(0, n, rows):
+        rs = slice(start, min(start + rows, n))
+        m = rs.stop - rs.start
+        sampled = [mu[rs, None] + s[rs, None] * rng.standard_normal((m, draws)) for mu, s in zip(means, sigma)]
+        results = batch.calculate(*sampled, RQ[rs, None], exact=False)
+        Q_lf = results["Q_lf"]
+        Q_lr = results["Q_lr"]
+        valid = np.isfinite(Q_lf) & np.isfinite(Q_lr)
+        out["valid_fraction"][rs] = valid.mean(axis=1)
+        for name, Q in (("Q_lf", Q_lf), ("Q_lr", Q_lr)):
+            Q = np.where(valid, Q, np.nan)
+            k = valid.sum(axis=1)
+            with np.errstate(invalid="ignore", divide="ignore"):
+                mean = np.where(valid, Q, 0.0).sum(axis=1) / k
+                dev = np.where(valid, Q - mean[:, None], 0.0)
+                out[name + "_unc"][rs] = np.sqrt((dev * dev).sum(axis=1) / (k - 1))
+            out[name + "_unc"][rs][k < 2] = np.nan
+            lo, hi = _quantiles(Q, probs)
+            out[name + "_lo"][rs] = lo
+            out[name + "_hi"][rs] = hi
+    return out
+
+
+class UncertaintyEstimator:
+    """Estimates the uncertainty of every cavity's loaded Q by Monte Carlo in one machine-wide pass per interval.
+
+    Processing threads hand over a cavity's formula inputs with submit after each calculation, which only copies them.
+    The estimator thread runs one monte_carlo pass over every cavity submitted since the last pass, sets each cavity's
+    UNCERTAINTY_FIELDS attributes and hands them to the cavity's publisher.  Only a cavity's latest inputs are used,
+    so the work per pass is bounded by the number of cavities whatever their update rate.
+    """
+
+    def __init__(self, event, uncertainties=None, draws=2000, confidence=0.9, interval=1.0, seed=None):
+        """Construct an estimator.  Nothing is estimated until run is started.
+            Args:
+                event (threading.Event): Event used to signal application shutdown
+                uncertainties (dict): Input PV suffix (see acquisition.INPUT_PVS) to (absolute, relative) standard
+                  deviation, as in DEFAULT_UNCERTAINTIES.  Inputs left out use the defaults.
+                draws (int): Monte Carlo draws per cavity
+                confidence (float): Coverage of the published interval
+                interval (float): Seconds between passes
+                seed (int): Seed of the random draws.  None for an unpredictable seed.
+        """
+        merged = dict(DEFAULT_UNCERTAINTIES)
+        if uncertainties is not None:
+            unknown = set(uncertainties) - set(INPUT_PVS)
+            if unknown:
+                raise ValueError("Uncertainties given for unknown inputs {}".format(sorted(unknown)))
+            merged.update(uncertainties)
+        self.event = event  #: threading.Event: shutdown signal
+        self.uncertainties = merged  #: dict: input PV suffix to (absolute, relative) standard deviation
+        self.draws = draws  #: int: Monte Carlo draws per cavity
+        self.confidence = confidence  #: float: coverage of the published interval
+        self.interval = interval  #: float: seconds between passes
+        self.rng = np.random.RandomState(seed)  #: np.random.RandomState: source of the draws
+
+        self._cond = threading.Condition()
+        self._pending = {}  # Cavity name to (Cryocavity, formula inputs) waiting for the next pass
+        self._passes = 0
+        self._estimated = 0
+        self._time_total = 0.0
+        self._time_max = 0.0
+        self._stats_start = time.time()
+
+    def submit(self, cav):
+        """Queue a cavity's current formula inputs (as set by update_formula_data) for the next pass"""
+        inputs = (cav.V_c, cav.P_f, cav.P_r, cav.detune_angle, cav.I_tot, cav.length, cav.RQ)
+        with self._cond:
+            self._pending[cav.cavity_name] = (cav, inputs)
+
+    def discard(self, cavity_name):
+        """Drop a cavity's queued inputs, e.g., because its results were replaced with NaN"""
+        with self._cond:
+            self._pending.pop(cavity_name, None)
+
+    def sigmas(self, V_c, P_f, P_r, detune_angle, I_tot, length):
+        """Convert the configured uncertainties to standard deviations of the SI formula inputs.
+            Args:
+                V_c, P_f, P_r, detune_angle, I_tot (ndarray): Formula inputs in base SI units
+                length (ndarray): Active length of each cavity in m, which relates GMESLQ to V_c
+            Returns (tuple(ndarray)): Standard deviations of V_c, P_f, P_r, detune_angle and I_tot
+        """
+        scales = (length * 1e6, 1e3, 1e3, math.pi / 180, 1e-6)
+        values = (V_c, P_f, P_r, detune_angle, I_tot)
+        return tuple(self.uncertainties[name][0] * scale + self.uncertainties[name][1] * np.abs(value)
+                     for name, scale, value in zip(INPUT_PVS, scales, values))
+
+    def estimate(self):
+        """Run one pass over every cavity submitted since the last pass.  Called by the estimator thread, but may be
+        called directly.
+            Returns (int): The number of cavities estimated
+        """
+        with self._cond:
+            pending = self._pending
+            self._pending = {}
+        if not pending:
+            return 0
+
+        start = time.time()
+        cavities = [cav for cav, inputs in pending.values()]
+        columns = np.array([inputs for cav, inputs in pending.values()], dtype=np.float64).T
+        V_c, P_f, P_r, detune_angle, I_tot, length, RQ = columns
+        results = monte_carlo(V_c, P_f, P_r, detune_angle, I_tot, RQ,
+                              self.sigmas(V_c, P_f, P_r, detune_angle, I_tot, length), draws=self.draws,
+                              confidence=self.confidence, rng=self.rng)
+        for i, cav in enumerate(cavities):
+            for field in UNCERTAINTY_FIELDS:
+                setattr(cav, field, float(results[field][i]))
+            if cav.results_out == "epics" and cav.publisher is not None:
+                cav.publisher.submit(cav, attrs=UNCERTAINTY_FIELDS)
+        elapsed = time.time() - start
+
+        with self._cond:
+            self._passes += 1
+            self._estimated += len(cavities)
+            self._time_total += elapsed
+            if elapsed > self._time_max:
+                self._time_max = elapsed
+        if elapsed > self.interval:
+            logger.warning("Uncertainty pass over %d cavities took %.3f s, longer than its %.3f s interval",
+                           len(cavities), elapsed, self.interval)
+        return len(cavities)
+
+    def run(self):
+        """Callable meant to be run in own thread.  Runs a pass every interval seconds until shutdown."""
+        while not self.event.wait(self.interval):
+            try:
+                self.estimate()
+            except Exception:
+                logger.exception("Error estimating loaded Q uncertainties")
+        logger.debug("uncertainty estimator has exited")
+
+    def get_stats(self, reset=False):
+        """Report estimation throughput since the estimator was created or the stats were last reset.
+            Args:
+                reset (bool): Start a new measurement interval after reading the stats
+            Returns (dict): Keys are passes, estimated (cavities), mean_pass_time and max_pass_time (s), pending and
+              elapsed (s)
+        """
+        with self._cond:
+            stats = {
+                "passes": self._passes,
+                "estimated": self._estimated,
+                "mean_pass_time": self._time_total / self._passes if self._passes else 0.0,
+                "max_pass_time": self._time_max,
+                "pending": len(self._pending),
+                "elapsed": time.time() - self._stats_start,
+            }
+            if reset:
+                self._passes = 0
+                self._estimated = 0
+                self._time_total = 0.0
+                self._time_max = 0.0
+                self._stats_start = time.time()
+        return stats
@@ -1,3 +1,7 @@
+import time
+import epics
+
+
 def get_epics_cavity_name(ced_name):
     # TODO: pull this info from the CED and don't bother with a static mapper function
     mapper = {
@@ -12,3 +16,58 @@ def get_epics_cavity_name(ced_name):
     }
 
     return mapper[ced_name]
+
+
+def put_many(pvs, values):
+    """Issue non-blocking puts to several PVs back to back and flush them to the network together.
+
+    PV.put polls (and so flushes) after every put.  Numbers put to connected scalar Channel Access PVs are instead
+    queued with ca_array_put and flushed once at the end.  Anything else, e.g., strings or simulated PVs, goes through
+    the PV's own put.
+        Args:
+            pvs (list(PV)): The PVs to write
+            values (list): The value to write to each PV
+        Returns (None): Returns nothing
+    """
+    queued = False
+    for pv, value in zip(pvs, values):
+        if _queue_put(pv, value):
+            queued = True
+        else:
+            pv.put(value, wait=False)
+    if queued:
+        epics.ca.flush_io()
+
+
+def _queue_put(pv, value):
+    """Queue a put to a connected scalar PV without flushing it.  Returns (bool): False if PV.put has to do it."""
+    if not isinstance(pv, epics.PV) or not isinstance(value, (int, float)) or not pv.connected:
+        return False
+    if pv.context != epics.ca.current_context() or epics.ca.element_count(pv.chid) != 1:
+        return False
+    ftype = epics.ca.field_type(pv.chid)
+    if ftype == epics.dbr.STRING:
+        return False
+    data = (1 * epics.dbr.Map[ftype])()
+    try:
+        data[0] = value
+    except TypeError:
+        return False  # E.g., a float for an integer field.  PV.put converts it.
+    epics.ca.PySEVCHK("put", epics.ca.libca.ca_array_put(ftype, 1, pv.chid, data))
+    return True
+
+
+def wait_for_connections(pvs, timeout):
+    """Wait for many PVs to connect concurrently, giving up on all of them at one overall deadline.
+
+        Args:
+            pvs (list(PV)): The PVs to wait on.  Their connections must already have been started.
+            timeout (float): Overall time in seconds to wait
+        Returns (bool): True if every PV connected before the deadline
+    """
+    deadline = time.time() + timeout
+    waiting = [pv for pv in pvs if not pv.connected]
+    while waiting and time.time() < deadline:
+        epics.ca.poll(evt=0.01, iot=0.001)  # Unlike pend_event, starts CA if no PV has yet
+        waiting = [pv for pv in waiting if not pv.connected]
+    return not waiting
@@ -0,0 +1,159 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class RequestWatchdog:
+    """Detects GETDATA requests that never complete, re-triggers them and publishes NaN results in their place.
+
+    Outstanding requests are kept in a heap ordered by deadline, so the watchdog thread only ever looks at the request
+    that expires next and sleeps until then.  A new earlier deadline wakes it, which bounds detection latency to the
+    thread wakeup time instead of a polling period.  Completed or superseded requests are dropped lazily when they
+    reach the top of the heap.
+
+    Each consecutive timeout of a cavity doubles (by backoff_factor) the time allowed for its next request, up to
+    max_timeout, so a dead IOC is still poked periodically without being hammered.  A completed request resets the
+    backoff.
+    """
+
+    def __init__(self, cav_dict, event, timeout=5.0, backoff_factor=2.0, max_timeout=60.0):
+        """Construct a watchdog.  Nothing is watched until requests are armed, and nothing expires until run.
+            Args:
+                cav_dict (dict): A dictionary of cavity names to Cryocavity objects
+                event (threading.Event): Event used to signal application shutdown
+                timeout (float): Seconds a request may stay outstanding before it is considered stale
+                backoff_factor (float): Multiplier applied to the timeout for each consecutive timeout of a cavity
+                max_timeout (float): Upper bound in seconds on the backed off timeout
+        """
+        self.cav_dict = cav_dict  #: dict: cavity names to Cryocavity objects
+        self.event = event  #: threading.Event: shutdown signal
+        self.timeout = timeout  #: float: base request timeout in seconds
+        self.backoff_factor = backoff_factor  #: float: timeout multiplier per consecutive timeout
+        self.max_timeout = max_timeout  #: float: upper bound on the backed off timeout in seconds
+        self.timeout_counts = {}  #: dict: cavity name to total number of timed out requests
+        self.consecutive_timeouts = {}  #: dict: cavity name to number of timeouts since its last completed request
+
+        self._cond = threading.Condition()
+        self._heap = []  # (deadline, generation, cavity_name)
+        self._generation = itertools.count()
+        self._outstanding = {}  # cavity name to generation of its live heap entry
+
+    def timeout_for(self, cavity_name):
+        """Returns (float): The time in seconds the cavity's next request may take, including any backoff"""
+        n = self.consecutive_timeouts.get(cavity_name, 0)
+        return min(self.timeout * self.backoff_factor ** n, self.max_timeout)
+
+    def arm(self, cavity_name, request_timestamp):
+        """Start watching a request that was just made.  Supersedes any request already outstanding for the cavity.
+            Args:
+                cavity_name (str): The cavity the request was made for
+                request_timestamp (float): The time.time() at which the request was made
+            Returns (None): Returns nothing
+        """
+        with self._cond:
+            deadline = request_timestamp + self.timeout_for(cavity_name)
+            gen = next(self._generation)
+            self._outstanding[cavity_name] = gen
+            heapq.heappush(self._heap, (deadline, gen, cavity_name))
+            if self._heap[0][1] == gen:
+                # New earliest deadline.  Make sure the watchdog thread is not sleeping past it.
+                self._cond.notify()
+
+    def complete(self, cavity_name):
+        """Stop watching the cavity's outstanding request because its data was posted.
+            Args:
+                cavity_name (str): The cavity whose request completed
+            Returns (None): Returns nothing
+        """
+        with self._cond:
+            self._outstanding.pop(cavity_name, None)
+            self.consecutive_timeouts[cavity_name] = 0
+
+    def discard(self, cavity_name):
+        """Stop watching a cavity altogether, e.g., because it was removed.  Its counters are kept."""
+        with self._cond:
+            self._outstanding.pop(cavity_name, None)
+
+    def pop_expired(self, now):
+        """Remove and return the cavities whose outstanding request expired by the given time.
+            Args:
+                now (float): The current time.time()
+            Returns (list(str)): Names of the cavities that timed out
+        """
+        expired = []
+        with self._cond:
+            heap = self._heap
+            while heap and heap[0][0] <= now:
+                deadline, gen, cavity_name = heapq.heappop(heap)
+                if self._outstanding.get(cavity_name) != gen:
+                    # Completed or superseded by a newer request
+                    continue
+                del self._outstanding[cavity_name]
+                self.timeout_counts[cavity_name] = self.timeout_counts.get(cavity_name, 0) + 1
+                self.consecutive_timeouts[cavity_name] = self.consecutive_timeouts.get(cavity_name, 0) + 1
+                expired.append(cavity_name)
+        return expired
+
+    def next_deadline(self):
+        """Returns (float): The earliest deadline in the heap (possibly a stale one), or None if it is empty"""
+        with self._cond:
+            return self._heap[0][0] if self._heap else None
+
+    def handle_timeout(self, cavity_name):
+        """Publish NaN results for a cavity whose request went stale and re-trigger its data collection.
+            Args:
+                cavity_name (str): The cavity that timed out
+            Returns (None): Returns nothing
+        """
+        cav = self.cav_dict.get(cavity_name)
+        if cav is None:
+            return
+        logger.warning("Data request timed out (%d consecutive, %d total), re-triggering - %s",
+                       self.consecutive_timeouts.get(cavity_name, 0), self.timeout_counts.get(cavity_name, 0),
+                       cavity_name)
+        rate_controller = getattr(cav, "rate_controller", None)
+        if rate_controller is not None:
+            cav.request_interval = rate_controller.timed_out(cavity_name, cav.request_interval)
+        try:
+            cav.publish_invalid_results("Data request timed out")
+        except Exception:
+            logger.exception("Error publishing invalid results - %s", cavity_name)
+        if not self.event.is_set():
+            try:
+                cav.trigger_data_collection()
+            except Exception:
+                logger.exception("Error re-triggering data collection - %s", cavity_name)
+
+    def run(self, max_sleep=1.0):
+        """Callable meant to be run in own thread.  Handles expired requests until shutdown is signaled.
+            Args:
+                max_sleep (float): Longest time in seconds to sleep before checking for shutdown
+        """
+        while not self.event.is_set():
+            for cavity_name in self.pop_expired(time.time()):
+                self.handle_timeout(cavity_name)
+            with self._cond:
+                wait = max_sleep
+                if self._heap:
+                    wait = min(max(self._heap[0][0] - time.time(), 0), max_sleep)
+                if wait > 0:
+                    self._cond.wait(wait)
+
+        logger.debug("request watchdog has exited")
+
+    def get_stats(self):
+        """Report outstanding requests and timeout counters.
+            Returns (dict): Keys are outstanding (number of requests being watched), timeouts (total across all
+              cavities) and timed_out_cavities (dict of cavity name to timeout count for cavities with any timeouts)
+        """
+        with self._cond:
+            counts = {name: n for name, n in self.timeout_counts.items() if n}
+            return {
+                "outstanding": len(self._outstanding),
+                "timeouts": sum(counts.values()),
+                "timed_out_cavities": counts,
+            }
@@ -0,0 +1,182 @@
+import collections
+import logging
+import queue
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class ProcessingPool:
+    """A pool of threads that process the CavityTasks posted to the update queue.
+
+    Any worker may pick up any task, so one slow IOC only ties up the worker handling that cavity instead of stalling
+    every other cavity.  At most one task per cavity is in flight at a time.  A task that arrives while its cavity is
+    already being processed is parked, and the worker handling that cavity runs it next, which preserves per-cavity
+    ordering.  Processed tasks are handed on to the request queue.  Tasks of cavities no longer in cav_dict (i.e.,
+    removed while running) are dropped, which ends their request cycle.
+    """
+
+    def __init__(self, cav_dict, update_queue, req_queue, event, num_workers=4, poll_interval=0.5):
+        """Construct a pool.  No threads run until start is called.
+            Args:
+                cav_dict (dict): A dictionary of cavity names to Cryocavity objects
+                update_queue (queue.Queue): The queue from which CavityTasks will be read
+                req_queue (queue.Queue): The queue to which CavityTasks will be written after processing their data
+                event (threading.Event): Event used to signal application shutdown
+                num_workers (int): Number of worker threads
+                poll_interval (float): How long in seconds a worker blocks on the update queue before checking for
+                  shutdown
+        """
+        if num_workers < 1:
+            raise ValueError("num_workers must be at least 1, got {}".format(num_workers))
+        self.cav_dict = cav_dict  #: dict: cavity names to Cryocavity objects
+        self.update_queue = update_queue  #: queue.Queue: source of CavityTasks with new data to process
+        self.req_queue = req_queue  #: queue.Queue: destination for processed CavityTasks
+        self.event = event  #: threading.Event: shutdown signal
+        self.num_workers = num_workers  #: int: number of worker threads
+        self.poll_interval = poll_interval  #: float: update queue timeout in seconds
+        self.threads = []  #: list(threading.Thread): the worker threads
+
+        # Guards in_flight and pending.  Notified whenever a cavity stops being in flight.
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._in_flight = set()  # Names of cavities a worker is currently processing
+        self._pending = {}  # Cavity name to deque of tasks that arrived while that cavity was in flight
+
+        # Guards the statistics below
+        self._stats_lock = threading.Lock()
+        self._stats_start = time.time()
+        self._processed = 0
+        self._failed = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+    def start(self):
+        """Start the worker threads.
+            Returns (None): Returns nothing
+        """
+        for i in range(self.num_workers):
+            t = threading.Thread(target=self.run_worker, name="process-worker-{}".format(i))
+            t.start()
+            self.threads.append(t)
+
+    def join(self):
+        """Wait for every worker to exit.  Workers exit once shutdown is signaled and the update queue is drained.
+            Returns (None): Returns nothing
+        """
+        for t in self.threads:
+            t.join()
+
+    def run_worker(self):
+        """Callable run by each worker thread.  Claims tasks from the update queue and processes them."""
+        while not self.event.is_set() or not self.update_queue.empty():
+            try:
+                task = self.update_queue.get(timeout=self.poll_interval)
+            except queue.Empty:
+                continue
+
+            cavity_name = task.cavity_name
+            with self._lock:
+                if cavity_name in self._in_flight:
+                    # Another worker owns this cavity.  It will run this task once it finishes the current one.
+                    self._pending.setdefault(cavity_name, collections.deque()).append(task)
+                    continue
+                self._in_flight.add(cavity_name)
+
+            while task is not None:
+                self.process_task(task)
+                with self._lock:
+                    backlog = self._pending.get(cavity_name)
+                    if backlog:
+                        task = backlog.popleft()
+                        if not backlog:
+                            del self._pending[cavity_name]
+                    else:
+                        self._in_flight.discard(cavity_name)
+                        self._idle.notify_all()
+                        task = None
+
+        logger.debug("process worker %s has exited", threading.current_thread().name)
+
+    def drain(self, cavity_name, timeout=None):
+        """Wait for a cavity's processing to finish, e.g., after removing it from cav_dict.
+            Args:
+                cavity_name (str): The cavity
+                timeout (float): Longest time in seconds to wait.  None waits as long as it takes.
+            Returns (bool): True if nothing of the cavity's is in flight any more
+        """
+        with self._idle:
+            return self._idle.wait_for(lambda: cavity_name not in self._in_flight, timeout)
+
+    def process_task(self, task):
+        """Process the new data for one CavityTask and pass the task on to the request queue.
+            Args:
+                task (CavityTask): The task to process
+            Returns (None): Returns nothing
+        """
+        cavity_name = task.cavity_name
+        cav = self.cav_dict.get(cavity_name)
+        if cav is None:
+            logger.debug("Dropping task of removed cavity - %s", cavity_name)
+            return
+        metrics = getattr(cav, "metrics", None)
+        now = time.time()
+        wait = now - task.enqueue_timestamp
+        logger.debug("process worker received cavity '%s' after %f s in queue", cavity_name, wait)
+        if metrics is not None:
+            metrics.mark(cavity_name, "dequeued", now)
+        failed = False
+        try:
+            cav.process_new_data()
+        except Exception:
+            # Keep the worker and the cavity's request cycle alive.  A bad sample should only cost one result.
+            logger.exception("Error processing new data - %s", cavity_name)
+            failed = True
+
+        with self._stats_lock:
+            self._processed += 1
+            self._failed += failed
+            self._wait_total += wait
+            if wait > self._wait_max:
+                self._wait_max = wait
+
+        if self.cav_dict.get(cavity_name) is not cav:
+            # Removed while being processed, and possibly added again since, with a request cycle of its own
+            logger.debug("Dropping task of cavity removed while processing - %s", cavity_name)
+            return
+        logger.debug("process worker writing '%s' to request_queue", cavity_name)
+        self.req_queue.put(task)
+        if metrics is not None:
+            metrics.mark(cavity_name, "rescheduled")
+
+    def get_stats(self, reset=False):
+        """Report throughput and queue wait time since the pool was created or the stats were last reset.
+            Args:
+                reset (bool): Start a new measurement interval after reading the stats
+            Returns (dict): Keys are processed, failed, elapsed (s), throughput (tasks/s), mean_queue_wait (s),
+              max_queue_wait (s), in_flight and pending (number of parked tasks)
+        """
+        now = time.time()
+        with self._lock:
+            in_flight = len(self._in_flight)
+            pending = sum(len(d) for d in self._pending.values())
+        with self._stats_lock:
+            elapsed = now - self._stats_start
+            stats = {
+                "processed": self._processed,
+                "failed": self._failed,
+                "elapsed": elapsed,
+                "throughput": self._processed / elapsed if elapsed > 0 else 0.0,
+                "mean_queue_wait": self._wait_total / self._processed if self._processed else 0.0,
+                "max_queue_wait": self._wait_max,
+                "in_flight": in_flight,
+                "pending": pending,
+            }
+            if reset:
+                self._stats_start = now
+                self._processed = 0
+                self._failed = 0
+                self._wait_total = 0.0
+                self._wait_max = 0.0
+        return stats
@@ -0,0 +1,66 @@
+"""Stand-ins for EPICS PVs and a Cryocavity factory shared by the tests"""
+import threading
+from qlCalc.cryocavity import Cryocavity
+
+# Input PV values of a typical C100 cavity, in PV units
+INPUT_VALUES = {"GMESLQ": 17.794, "CRFPLQ": 3.396, "CRRPLQ": 0.805, "DETALQ": 0.67, "ITOTLQ": 201.8}
+
+
+class FakePV:
+    """In-memory stand-in for an epics.PV.  Counts gets, records puts and runs monitor callbacks on post."""
+
+    def __init__(self, pvname, value=None, connected=True):
+        self.pvname = pvname
+        self.value = value
+        self.connected = connected
+        self.disconnected = False
+        self.gets = 0
+        self.puts = []
+        self.callbacks = {}
+
+    def get(self, **kw):
+        self.gets += 1
+        return self.value
+
+    def put(self, value, wait=False, **kw):
+        self.value = value
+        self.puts.append(value)
+
+    def add_callback(self, callback, **kw):
+        index = len(self.callbacks) + 1
+        self.callbacks[index] = callback
+        return index
+
+    def remove_callback(self, index):
+        self.callbacks.pop(index, None)
+
+    def post(self, value, timestamp=None):
+        """Set the value and run the callbacks the way a monitor update would"""
+        self.value = value
+        for cb in list(self.callbacks.values()):
+            cb(pvname=self.pvname, value=value, timestamp=timestamp)
+
+    def disconnect(self):
+        self.connected = False
+        self.disconnected = True
+
+
+def make_pvs(epics_name="R1Q1", suffixes=Cryocavity.PV_SUFFIXES, **values):
+    """Returns (dict): A FakePV for each of a cavity's PV suffixes, holding the value given for it or None"""
+    return {suffix: FakePV(epics_name + suffix, values.get(suffix)) for suffix in suffixes}
+
+
+def make_cavity(name="c1", pvs=None, **kwargs):
+    """Build a C100 Cryocavity for tests.
+        Args:
+            name (str): The cavity name
+            pvs (dict): PVs by suffix, e.g., from make_pvs.  Any PV not given is None.
+            kwargs: Any other Cryocavity argument, overriding the defaults used here
+        Returns (Cryocavity): The new cavity
+    """
+    args = {suffix: None for suffix in Cryocavity.PV_SUFFIXES}
+    args.update(cavity_name=name, cavity_type="c100", length=0.7, RQ=868.9, update_queue=None, request_interval=1,
+                shutdown_event=threading.Event())
+    args.update(pvs or {})
+    args.update(kwargs)
+    return Cryocavity(**args)
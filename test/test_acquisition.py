@@ -0,0 +1,108 @@
+import unittest
+from unittest import TestCase
+from qlCalc.acquisition import InputSnapshot, INPUT_PVS, SNAPSHOT_PVS, INPUT_MODE_MONITOR
+from test.helpers import INPUT_VALUES, make_cavity, make_pvs
+import math
+
+
+def make_acquiring_cavity(input_mode):
+    pvs = make_pvs(suffixes=SNAPSHOT_PVS)
+    return make_cavity("my_cav", pvs=pvs, input_mode=input_mode), pvs
+
+
+def post_sample(pvs, start=100.0, sample=100.5, end=101.0):
+    pvs["STARTLQ"].post(start, start)
+    for name in INPUT_PVS:
+        pvs[name].post(INPUT_VALUES[name], sample)
+    pvs["ENDLQ"].post(end, end)
+
+
+class TestInputSnapshot(TestCase):
+
+    def test_monitor_mode_reads_without_gets(self):
+        cav, pvs = make_acquiring_cavity(INPUT_MODE_MONITOR)
+        post_sample(pvs)
+        cav.update_formula_data()
+        self.assertAlmostEqual(17.794 * 0.7 * 1000000, cav.V_c)
+        self.assertAlmostEqual(math.radians(0.67), cav.detune_angle)
+        self.assertAlmostEqual(201.8 / 1000000, cav.I_tot)
+        self.assertEqual(0, sum(pv.gets for pv in pvs.values()))
+        self.assertEqual([], cav.err_msg)
+
+    def test_unbracketed_sample_is_flagged(self):
+        cav, pvs = make_acquiring_cavity(INPUT_MODE_MONITOR)
+        post_sample(pvs, start=100.0, sample=99.0, end=101.0)
+        cav.update_formula_data()
+        self.assertEqual(1, len(cav.err_msg))
+
+    def test_window_comes_from_posted_values(self):
+        cav, pvs = make_acquiring_cavity(INPUT_MODE_MONITOR)
+        post_sample(pvs, start=100.0, sample=100.5, end=101.0)
+        # The window PVs' own updates arriving late does not widen the window
+        pvs["ENDLQ"].post(101.0, 105.0)
+        pvs["GMESLQ"].post(17.794, 103.0)
+        cav.update_formula_data()
+        self.assertEqual(1, len(cav.err_msg))
+
+    def test_sample_older_than_request_is_flagged(self):
+        cav, pvs = make_acquiring_cavity(INPUT_MODE_MONITOR)
+        post_sample(pvs, start=100.0, sample=100.5, end=101.0)
+        cav.last_request_timestamp = 100.5
+        cav.update_formula_data()
+        self.assertEqual(["Synchronized inputs predate the last request"], cav.err_msg)
+        self.assertAlmostEqual(17.794 * 0.7 * 1000000, cav.V_c)
+        cav.err_msg.clear()
+        # Within the default tolerance of a tenth of the request interval
+        post_sample(pvs, start=100.45, sample=100.5, end=101.0)
+        cav.update_formula_data()
+        self.assertEqual([], cav.err_msg)
+
+    def test_non_numeric_window_is_flagged(self):
+        cav, pvs = make_acquiring_cavity(INPUT_MODE_MONITOR)
+        post_sample(pvs, start="100.0", sample=100.5, end=101.0)
+        cav.update_formula_data()
+        self.assertEqual([], cav.err_msg)
+        post_sample(pvs, start="2024-01-01 00:00:00", sample=100.5, end=101.0)
+        cav.update_formula_data()
+        self.assertEqual(1, len(cav.err_msg))
+
+    def test_missing_value_raises(self):
+        cav, pvs = make_acquiring_cavity(INPUT_MODE_MONITOR)
+        with self.assertRaises(ValueError):
+            cav.update_formula_data()
+
+    def test_get_mode_uses_pv_get(self):
+        cav, pvs = make_acquiring_cavity("get")
+        post_sample(pvs)
+        cav.update_formula_data()
+        self.assertEqual(5, sum(pv.gets for pv in pvs.values()))
+        self.assertIsNone(cav.snapshot)
+
+    def test_is_bracketed(self):
+        snap = InputSnapshot()
+        self.assertFalse(snap.is_bracketed())
+        for name in SNAPSHOT_PVS:
+            snap.update(name, 0, 5.0)
+        snap.update("STARTLQ", 4.0, 9.0)
+        snap.update("ENDLQ", 6.0, 9.0)
+        self.assertTrue(snap.is_bracketed())
+        snap.update("GMESLQ", 0, 6.5)
+        self.assertFalse(snap.is_bracketed())
+        self.assertTrue(snap.is_bracketed(tolerance=1.0))
+
+    def test_is_newer(self):
+        snap = InputSnapshot()
+        self.assertFalse(snap.is_newer(3.0))
+        snap.update("STARTLQ", 4.0, 9.0)
+        self.assertTrue(snap.is_newer(3.0))
+        self.assertFalse(snap.is_newer(4.5))
+        self.assertTrue(snap.is_newer(4.5, tolerance=1.0))
+
+    def test_unsubscribe(self):
+        cav, pvs = make_acquiring_cavity(INPUT_MODE_MONITOR)
+        cav.snapshot.unsubscribe()
+        self.assertEqual(0, sum(len(pv.callbacks) for pv in pvs.values()))
+
+
+if __name__ == '__main__':
+    unittest.main()
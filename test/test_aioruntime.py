@@ -0,0 +1,131 @@
+import unittest
+from unittest import TestCase
+from qlCalc.aioruntime import AsyncRuntime
+from qlCalc.acquisition import INPUT_MODE_MONITOR
+from qlCalc.cryocavity import Cryocavity, CavityTask
+from qlCalc.metadata import CavityMetadata
+from qlCalc.ratecontrol import RateController
+from qlCalc.simioc import SimulatedIOC
+import threading
+import time
+
+
+def sim_metadata(n):
+    return {"SIM-{}".format(i): CavityMetadata("SIM-{}".format(i), "S{:04d}".format(i), "c100", 0.7, 868.9)
+            for i in range(n)}
+
+
+class TestAsyncRuntime(TestCase):
+
+    def setUp(self):
+        self.ioc = SimulatedIOC(prefix="sim:", latency=0.01, jitter=0.002, seed=21)
+        self.ioc.start()
+        self.event = threading.Event()
+
+    def tearDown(self):
+        self.event.set()
+        self.ioc.stop()
+
+    def run_runtime(self, n, duration, stagger=None, **kwargs):
+        rt = AsyncRuntime(self.event, num_workers=2, slot_width=0.01, **kwargs)
+        cav_dict, failed = Cryocavity.create_cryocavities(
+            sim_metadata(n).keys(), update_queue=rt.update_queue, shutdown_event=self.event, epics_prefix="sim:",
+            input_mode=INPUT_MODE_MONITOR, pv_factory=self.ioc.pv_factory, metadata=sim_metadata(n))
+        self.assertEqual({}, failed)
+        for cav in cav_dict.values():
+            cav.results_out = "stdout"
+            cav.print_results = lambda: None
+            cav.request_interval = 0.1
+            cav.rate_controller = rt.rate_controller
+            rt.add_cavity(cav)
+        start_times = None
+        if stagger is not None:
+            now = time.time()
+            start_times = {name: now + i * stagger / n for i, name in enumerate(sorted(cav_dict))}
+        timer = threading.Timer(duration, rt.stop)
+        timer.start()
+        try:
+            rt.run(install_signal_handlers=False, start_times=start_times)
+        finally:
+            timer.cancel()
+        return rt, cav_dict
+
+    def test_cycles_every_cavity(self):
+        rt, cav_dict = self.run_runtime(20, 0.6)
+        stats = rt.get_stats()
+        self.assertTrue(self.event.is_set())
+        self.assertEqual(0, stats["failed"])
+        self.assertEqual(0, stats["timeouts"])
+        # The initial trigger plus at least three scheduled requests a tenth of a second apart
+        self.assertGreaterEqual(stats["processed"], 20 * 4)
+        self.assertLess(stats["batches"], stats["requests"])
+        for cav in cav_dict.values():
+            true_q = self.ioc.true_loaded_q(cav.epics_name)
+            self.assertAlmostEqual(1.0, cav.Q_lf / true_q, delta=0.05)
+        # Every timer was cancelled and every task finished
+        self.assertEqual((0, 0, 0), (stats["timers"], stats["in_flight"], stats["pending"]))
+        self.assertTrue(rt.loop.is_closed())
+
+    def test_initial_triggers_are_staggered(self):
+        # Triggers spread over two seconds, stopped after half a second
+        rt, cav_dict = self.run_runtime(20, 0.5, stagger=2.0)
+        stats = rt.get_stats()
+        triggered = [cav for cav in cav_dict.values() if cav.last_request_timestamp is not None]
+        self.assertTrue(4 <= len(triggered) <= 6)
+        self.assertEqual(0, stats["timeouts"])
+        self.assertEqual(0, stats["timers"])
+
+    def test_requests_are_limited_per_ioc(self):
+        # Every simulated cavity is in zone SIM, so they share one IOC
+        rc = RateController(min_interval=0.1, recover_step=0, max_outstanding=2, retry_delay=0.01)
+        rt, cav_dict = self.run_runtime(6, 0.6, rate_controller=rc)
+        stats = rt.get_stats()
+        self.assertGreaterEqual(stats["processed"], 6 * 3)
+        self.assertGreater(rc.get_stats()["deferred"], 0)
+
+    def test_timed_out_requests_are_retriggered_with_backoff(self):
+        self.ioc.drop_rate = 1.0
+        rt, cav_dict = self.run_runtime(3, 0.5, request_timeout=0.1, backoff_factor=2.0, max_timeout=1.0)
+        stats = rt.get_stats()
+        self.assertEqual(0, stats["processed"])
+        # Timeouts at 0.1, 0.3 s (0.1 + 0.2) for each cavity; the next would be at 0.7 s
+        self.assertEqual(6, stats["timeouts"])
+        self.assertAlmostEqual(0.4, rt.timeout_for("SIM-0"))
+        for cav in cav_dict.values():
+            self.assertIn("Data request timed out", cav.err_msg)
+
+    def test_stop_is_fast(self):
+        rt = AsyncRuntime(self.event, request_timeout=30)
+        start = time.time()
+        threading.Timer(0.05, rt.stop).start()
+        rt.run(install_signal_handlers=False)
+        self.assertLess(time.time() - start, 1.0)
+        self.assertTrue(self.event.is_set())
+        # The loop is closed, so late data ready notifications are dropped
+        rt.update_queue.put(CavityTask("SIM-0", time.time()))
+
+    def test_stuck_work_does_not_hold_up_shutdown(self):
+        rt = AsyncRuntime(self.event, num_workers=1, shutdown_timeout=0.2)
+        cav_dict, failed = Cryocavity.create_cryocavities(
+            ["SIM-0"], update_queue=rt.update_queue, shutdown_event=self.event, epics_prefix="sim:",
+            input_mode=INPUT_MODE_MONITOR, pv_factory=self.ioc.pv_factory, metadata=sim_metadata(1))
+        release = threading.Event()
+        cav = cav_dict["SIM-0"]
+        cav.process_new_data = lambda: release.wait(10)  # Like a CA get that never returns
+        rt.add_cavity(cav)
+        threading.Timer(0.3, rt.stop).start()
+        start = time.time()
+        try:
+            with self.assertLogs("qlCalc.aioruntime", "WARNING"):
+                rt.run(install_signal_handlers=False)
+            self.assertLess(time.time() - start, 2.0)
+        finally:
+            release.set()
+
+    def test_rejects_no_workers(self):
+        with self.assertRaises(ValueError):
+            AsyncRuntime(num_workers=0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,107 @@
+import unittest
+from unittest import TestCase
+from qlCalc.batch import CavityBatch, calculate, AF_OK, AF_LOWERED, AF_RAISED
+from test.helpers import make_cavity
+import math
+import random
+import numpy as np
+
+
+class TestCavityBatch(TestCase):
+
+    def setUp(self):
+        # 408 cavities is the linac-wide target.  Mix in cavities that clamp the attenuation factor in both directions.
+        rng = random.Random(408)
+        self.cavities = []
+        for i in range(408):
+            cav = make_cavity("cav{}".format(i), length=rng.choice((0.5, 0.7)), RQ=rng.choice((482.5, 868.9)))
+            V_c = rng.uniform(5, 20) * cav.length * 1000000
+            P_f = rng.uniform(1, 6) * 1000
+            P_r = rng.uniform(0.1, 1.5) * 1000
+            if i % 50 == 1:
+                P_r = 5 * P_f
+            if i % 50 == 2:
+                P_f = -P_f
+                P_r = 0
+            cav.update_formula_data(V_c=V_c, P_f=P_f, P_r=P_r, detune_angle=math.radians(rng.uniform(-20, 20)),
+                                    I_tot=rng.uniform(1, 200) / 1000000)
+            if i % 50 == 0:
+                # The reference cavity from test_cryocavity, which does not clamp
+                cav.length = 0.7
+                cav.RQ = 868.9
+                cav.update_formula_data(V_c=(17.794 * 0.7 * 1000000), P_f=(3.396 * 1000), P_r=(0.805 * 1000),
+                                        detune_angle=math.radians(0.67), I_tot=(201.8 / 1000000))
+            self.cavities.append(cav)
+
+    def test_results_match_scalar_path_exactly(self):
+        batch = CavityBatch.from_cavities(self.cavities)
+        batch.load_inputs(self.cavities)
+        batch.run_calculations()
+
+        compared = 0
+        for i, cav in enumerate(self.cavities):
+            try:
+                cav.run_calculations()
+            except ValueError:
+                # Scalar path raises on a math domain error, batch reports NaN for only that cavity
+                self.assertTrue(math.isnan(batch.Q_lf[i]) or math.isnan(batch.Q_lr[i]) or
+                                math.isnan(batch.attenuation[i]))
+                continue
+            compared += 1
+            self.assertEqual(cav.attenuation_factor, batch.attenuation_factor[i])
+            self.assertEqual(cav.attenuation, batch.attenuation[i])
+            self.assertEqual(cav.P_fc, batch.P_fc[i])
+            self.assertEqual(cav.P_rc, batch.P_rc[i])
+            self.assertEqual(cav.Q_lf, batch.Q_lf[i])
+            self.assertEqual(cav.Q_lr, batch.Q_lr[i])
+        self.assertGreater(compared, 300)
+
+    def test_clamping_flags(self):
+        batch = CavityBatch.from_cavities(self.cavities)
+        batch.load_inputs(self.cavities)
+        batch.run_calculations()
+        self.assertEqual(AF_LOWERED, batch.attenuation_factor_flag[1])
+        self.assertEqual(1, batch.attenuation_factor[1])
+        self.assertGreater(batch.unclamped_attenuation_factor[1], 1)
+        self.assertEqual(AF_RAISED, batch.attenuation_factor_flag[2])
+        self.assertEqual(0, batch.attenuation_factor[2])
+        self.assertEqual(AF_OK, batch.attenuation_factor_flag[0])
+
+    def test_apply_results_records_clamping(self):
+        batch = CavityBatch.from_cavities(self.cavities[:3])
+        batch.load_inputs(self.cavities)
+        batch.run_calculations()
+        with self.assertLogs("qlCalc.batch", "WARNING") as logs:
+            batch.apply_results(self.cavities)
+        self.assertEqual(batch.calc_timestamp, self.cavities[0].calc_timestamp)
+        self.assertIsNotNone(self.cavities[0].calc_timestamp)
+        self.assertEqual([], self.cavities[0].err_msg)
+        # The unclamped factor is logged in full, not truncated to an integer
+        self.assertIn(str(float(batch.unclamped_attenuation_factor[1])), logs.output[0])
+        self.assertEqual(1, self.cavities[1].attenuation_factor)
+        self.assertTrue(self.cavities[1].err_msg[0].startswith("Attenuation factor lowered from "))
+        self.assertTrue(self.cavities[2].err_msg[0].startswith("Attenuation factor raised from "))
+        self.assertEqual(float(batch.Q_lf[0]), self.cavities[0].Q_lf)
+
+    def test_fast_mode_is_close(self):
+        V_c = np.array([c.V_c for c in self.cavities])
+        P_f = np.array([c.P_f for c in self.cavities])
+        P_r = np.array([c.P_r for c in self.cavities])
+        psi = np.array([c.detune_angle for c in self.cavities])
+        I_tot = np.array([c.I_tot for c in self.cavities])
+        RQ = np.array([c.RQ for c in self.cavities])
+        exact = calculate(V_c, P_f, P_r, psi, I_tot, RQ, exact=True)
+        fast = calculate(V_c, P_f, P_r, psi, I_tot, RQ, exact=False)
+        np.testing.assert_allclose(exact["Q_lf"], fast["Q_lf"], rtol=1e-9)
+        np.testing.assert_array_equal(exact["attenuation_factor_flag"], fast["attenuation_factor_flag"])
+
+    def test_reference_cavity(self):
+        # Same reference values as test_cryocavity
+        res = calculate(17.794 * 0.7 * 1000000, 3.396 * 1000, 0.805 * 1000, math.radians(0.67), 201.8 / 1000000,
+                        868.9)
+        self.assertAlmostEqual(0.981636983, float(res["attenuation_factor"]), 6)
+        self.assertAlmostEqual(23937066.5884476000000, float(res["Q_lf"]), 6)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,50 @@
+import unittest
+from unittest import TestCase
+from bench.harness import Benchmark, compare, summarize, write_results
+from bench.run_benchmarks import build_benchmarks, run_benchmarks
+import json
+import os
+import shutil
+import tempfile
+
+
+class TestBenchmarks(TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_summarize(self):
+        stats = summarize([4.0, 1.0, 3.0, 2.0])
+        self.assertEqual((4, 1.0, 2.5, 2.5, 4.0), (stats["n"], stats["min"], stats["median"], stats["mean"],
+                                                   stats["max"]))
+        self.assertEqual(0.4, stats["ops_per_sec"])
+
+    def test_warmup_setup_and_samples(self):
+        calls = []
+        b = Benchmark("case", lambda: calls.append("run") or [0.5], warmup=2, repeat=3,
+                      setup=lambda: calls.append("setup"), teardown=lambda: calls.append("teardown"))
+        result = b.run()
+        self.assertEqual(["setup", "run"] * 5 + ["teardown"], calls)
+        self.assertEqual(3, result["n"])
+        self.assertEqual(0.5, result["median"])
+
+    def test_all_cases_run_and_compare(self):
+        results = run_benchmarks(build_benchmarks(sizes=(10,), warmup=0, repeat=1))
+        names = [r["name"] for r in results]
+        self.assertEqual(len(names), len(set(names)))
+        self.assertIn("request_new_data[10]", names)
+
+        path = os.path.join(self.dir, "results.json")
+        write_results(path, results)
+        with open(path) as f:
+            self.assertEqual(names, [r["name"] for r in json.load(f)["results"]])
+        comparison = compare(path, results)
+        self.assertEqual(len(results), len(comparison))
+        self.assertFalse(any(regressed for *_, regressed in comparison))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+import unittest
+from unittest import TestCase
+from qlCalc.checkpoint import Checkpoint, CHECKPOINT_VERSION
+from qlCalc.ratecontrol import RateController
+from test.helpers import make_cavity
+import json
+import math
+import os
+import tempfile
+import threading
+
+
+class TestCheckpoint(TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, "state", "checkpoint.json")
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_write_and_restore(self):
+        cav = make_cavity("1L22-1")
+        cav.request_interval = 2.5
+        cav.last_request_timestamp = 1000.25
+        cav.Q_lf = 2.39e7
+        cav.Q_lr = math.nan
+        cav.calc_timestamp = 1000.5
+        rc = RateController(max_interval=4.0)
+        cav.request_interval = rc.completed("1L22-1", 3.0, cav.request_interval)
+        Checkpoint(self.path, {"1L22-1": cav, "1L22-2": make_cavity("1L22-2")}, rate_controller=rc).write()
+        self.assertEqual(["checkpoint.json"], os.listdir(os.path.dirname(self.path)))
+
+        # The restarted process knows 1L22-1 and a new cavity.  1L22-2 is gone.
+        restored = make_cavity("1L22-1")
+        new = make_cavity("1L22-3")
+        new_rc = RateController(max_interval=4.0)
+        saved = Checkpoint(self.path, {"1L22-1": restored, "1L22-3": new}, rate_controller=new_rc).restore()
+        self.assertEqual(["1L22-1"], list(saved))
+        self.assertEqual(1000.25, saved["1L22-1"]["last_request"])
+        self.assertEqual((4.0, 4.0), (restored.request_interval, new_rc.interval("1L22-1")))
+        self.assertEqual(3.0, new_rc.turnaround("1L22-1"))
+        self.assertEqual((2.39e7, 1000.5), (restored.Q_lf, restored.calc_timestamp))
+        self.assertTrue(math.isnan(restored.Q_lr))
+        self.assertIsNone(new.Q_lf)
+
+    def test_unusable_files_are_ignored(self):
+        cav_dict = {"1L22-1": make_cavity("1L22-1")}
+        checkpoint = Checkpoint(self.path, cav_dict)
+        self.assertEqual({}, checkpoint.restore())
+
+        checkpoint.write()
+        self.assertEqual(["1L22-1"], list(checkpoint.read(max_age=60)))
+        self.assertEqual({}, checkpoint.read(max_age=-1))
+
+        with open(self.path, "w") as f:
+            f.write('{"version": ')
+        self.assertEqual({}, checkpoint.read())
+        with open(self.path, "w") as f:
+            json.dump({"version": CHECKPOINT_VERSION + 1, "cavities": {"1L22-1": {}}}, f)
+        self.assertEqual({}, checkpoint.read())
+
+    def test_run_writes_at_exit(self):
+        event = threading.Event()
+        event.set()
+        Checkpoint(self.path, {"1L22-1": make_cavity("1L22-1")}).run(60, event)
+        with open(self.path) as f:
+            self.assertEqual(["1L22-1"], list(json.load(f)["cavities"]))
+
+
+if __name__ == '__main__':
+    unittest.main()
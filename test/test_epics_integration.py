@@ -1,9 +1,127 @@
 import unittest
 from unittest import TestCase
+from qlCalc.acquisition import INPUT_MODE_MONITOR
 from qlCalc.cryocavity import Cryocavity
+from qlCalc.metadata import CavityMetadata
+from qlCalc.resulttable import ResultTableReader, STATUS_OK
+from qlCalc.simioc import SimulatedIOC
+import qlCalc.main
+import json
+import os
+import queue
+import tempfile
+import threading
+import time
 
 
+def sim_metadata(n):
+    return {"SIM-{}".format(i): CavityMetadata("SIM-{}".format(i), "S{:04d}".format(i), "c100", 0.7, 868.9)
+            for i in range(n)}
 
-class TestCryocavity(TestCase):
 
-    pass
+class TestSimulatedIOC(TestCase):
+
+    def setUp(self):
+        self.ioc = SimulatedIOC(prefix="sim:", latency=0.01, jitter=0.002, seed=12)
+        self.ioc.start()
+        self.update_queue = queue.Queue()
+
+    def tearDown(self):
+        self.ioc.stop()
+
+    def create(self, n, input_mode=INPUT_MODE_MONITOR):
+        cav_dict, failed = Cryocavity.create_cryocavities(
+            sim_metadata(n).keys(), update_queue=self.update_queue, shutdown_event=threading.Event(),
+            epics_prefix="sim:", input_mode=input_mode, pv_factory=self.ioc.pv_factory, metadata=sim_metadata(n))
+        self.assertEqual({}, failed)
+        for cav in cav_dict.values():
+            cav.results_out = "stdout"
+            cav.print_results = lambda: None
+        return cav_dict
+
+    def test_handshake_posts_consistent_data(self):
+        cav_dict = self.create(3)
+        Cryocavity.trigger_data_collection_batch(list(cav_dict.values()))
+        for _ in range(3):
+            task = self.update_queue.get(timeout=2)
+            cav = cav_dict[task.cavity_name]
+            self.assertEqual(2, cav.GETDATA.get())
+            cav.process_new_data()
+            true_q = self.ioc.true_loaded_q(cav.epics_name)
+            self.assertAlmostEqual(1.0, cav.Q_lf / true_q, delta=0.05)
+            self.assertAlmostEqual(1.0, cav.Q_lr / true_q, delta=0.05)
+            self.assertEqual([], cav.err_msg)
+
+        stats = self.ioc.get_stats()
+        self.assertEqual((3, 3, 0), (stats["requests"], stats["responses"], stats["dropped"]))
+
+    def test_dropped_and_cancelled_requests_are_not_answered(self):
+        cav_dict = self.create(2)
+        self.ioc.drop_rate = 1.0
+        cav_dict["SIM-0"].request_new_data()
+        time.sleep(0.05)
+        self.ioc.drop_rate = 0.0
+        cav_dict["SIM-1"].request_new_data()
+        cav_dict["SIM-1"].GETDATA.put(0)
+        time.sleep(0.1)
+        self.assertTrue(self.update_queue.empty())
+        self.assertEqual(1, self.ioc.get_stats()["dropped"])
+
+    def test_full_pipeline(self):
+        self.run_full_pipeline("threads")
+
+    def test_full_pipeline_asyncio(self):
+        self.run_full_pipeline("asyncio")
+
+    def run_full_pipeline(self, runtime):
+        n = 50
+        metadata = sim_metadata(n)
+        ioc = SimulatedIOC(prefix="adamc:", latency=0.02, jitter=0.005, seed=13)
+        ioc.start()
+        qlCalc.main.shutdown_event.clear()
+        timer = threading.Timer(2.5, qlCalc.main.shutdown_event.set)
+        timer.start()
+        saved_runtime = qlCalc.main.runtime
+        saved_checkpoint = qlCalc.main.checkpoint_file
+        saved_results_out = qlCalc.main.results_out
+        qlCalc.main.runtime = runtime
+        qlCalc.main.results_out = "epics"  # The simulated IOC serves the result PVs
+        tmp = tempfile.TemporaryDirectory()
+        qlCalc.main.checkpoint_file = os.path.join(tmp.name, "checkpoint.json")
+        qlCalc.main.results_table_file = os.path.join(tmp.name, "results")
+        saved_metrics_file = qlCalc.main.metrics_snapshot_file
+        qlCalc.main.metrics_snapshot_file = os.path.join(tmp.name, "metrics.json")
+        try:
+            qlCalc.main.main(cav_names=tuple(metadata), pv_factory=ioc.pv_factory, metadata=metadata)
+            with open(qlCalc.main.checkpoint_file) as f:
+                checkpoint = json.load(f)
+            reader = ResultTableReader(qlCalc.main.results_table_file)
+            table = reader.snapshot()
+            reader.close()
+        finally:
+            qlCalc.main.runtime = saved_runtime
+            qlCalc.main.checkpoint_file = saved_checkpoint
+            qlCalc.main.results_out = saved_results_out
+            qlCalc.main.results_table_file = None
+            qlCalc.main.metrics_snapshot_file = saved_metrics_file
+            tmp.cleanup()
+            timer.cancel()
+            qlCalc.main.shutdown_event.clear()
+            ioc.stop()
+
+        stats = ioc.get_stats()
+        # Every cavity completes its initial trigger and at least one scheduled request a second later
+        self.assertGreaterEqual(stats["requests"], 2 * n)
+        self.assertGreaterEqual(stats["processing_latency"]["count"], n)
+        self.assertGreater(stats["cycle_time"]["p50"], 0.9)
+        self.assertEqual(0, stats["dropped"])
+        # The final state of every cavity was checkpointed at exit
+        self.assertEqual(set(metadata), set(checkpoint["cavities"]))
+        self.assertTrue(all(entry["results"]["Q_lf"] > 0 for entry in checkpoint["cavities"].values()))
+        # And the latest results of every cavity are in the shared table
+        self.assertEqual([STATUS_OK] * n, list(table["status"]))
+        self.assertTrue(all(table["Q_lf"] > 0))
+
+
+if __name__ == '__main__':
+    unittest.main()
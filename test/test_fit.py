@@ -0,0 +1,99 @@
+import unittest
+from unittest import TestCase
+from qlCalc import batch
+from qlCalc.fit import WindowedFit, sample_terms
+from test.helpers import make_cavity
+import math
+import numpy as np
+
+# Formula inputs (SI) of a typical C100 cavity with beam
+INPUTS = (17.794 * 0.7e6, 3396.0, 805.0, math.radians(0.67), 201.8e-6)
+RQ = 868.9
+
+
+def model_powers(V_c, detune_angle, I_tot, Q_L, attenuation_factor):
+    """Uncorrected forward and reflected power of a cavity with the given loaded Q, as the IOC would measure them"""
+    x = RQ * Q_L
+    h = I_tot * V_c / 2
+    field = V_c ** 2 * (1 + math.tan(detune_angle) ** 2) / (4 * x) + I_tot ** 2 * x / 4
+    return (field + h) / attenuation_factor, (field - h) * attenuation_factor
+
+
+class TestWindowedFit(TestCase):
+
+    def test_single_sample_matches_scalar_chain(self):
+        fit = WindowedFit(["a"], window=5, min_samples=1)
+        fit.record("a", *INPUTS, RQ)
+        results = batch.calculate(*INPUTS, RQ)
+        stats = fit.get_stats("a")
+        self.assertEqual(1, stats["count"])
+        self.assertAlmostEqual(1.0, stats["Q_L"] / results["Q_lf"][()], places=12)
+        self.assertAlmostEqual(1.0, stats["Q_L"] / results["Q_lr"][()], places=12)
+        self.assertAlmostEqual(results["attenuation"][()], stats["attenuation"], places=12)
+
+    def test_fit_is_stable_at_low_current(self):
+        rng = np.random.RandomState(8)
+        for I_tot in (200e-6, 1e-6, 0.0):
+            fit = WindowedFit(["a"], window=30)
+            for i in range(100):
+                detune_angle = math.radians(rng.normal(0, 5))
+                P_f, P_r = model_powers(12e6, detune_angle, I_tot, 2.0e7, 0.83)
+                fit.record("a", 12e6, P_f * (1 + rng.normal(0, 0.01)), P_r * (1 + rng.normal(0, 0.01)),
+                           detune_angle, I_tot, RQ)
+            stats = fit.get_stats("a")
+            self.assertEqual(30, stats["count"])
+            self.assertAlmostEqual(1.0, stats["Q_L"] / 2.0e7, delta=0.01)
+            self.assertAlmostEqual(1.0, stats["attenuation_factor"] / 0.83, delta=0.01)
+        # The single-shot values have nothing to offer without beam
+        self.assertTrue(math.isnan(batch.calculate(12e6, P_f, P_r, detune_angle, 0.0, RQ)["Q_lf"][()]))
+
+    def test_incremental_sums_match_window(self):
+        rng = np.random.RandomState(9)
+        window = 7
+        fit = WindowedFit(["a", "b"], window=window, min_samples=1)
+        seen = []
+        for i in range(40):
+            sample = (rng.uniform(11e6, 13e6), rng.uniform(3e3, 4e3), rng.uniform(500, 1000),
+                      math.radians(rng.normal(0, 5)), rng.uniform(0, 200e-6))
+            if i % 11 == 4:
+                sample = (math.nan,) + sample[1:]
+            seen.append(sample)
+            fit.record("a", *sample, RQ)
+            terms, valid = sample_terms(*np.array(seen[-window:]).T)
+            np.testing.assert_allclose(terms.sum(axis=0), fit.sums[0], rtol=1e-12)
+            self.assertEqual(valid.sum(), fit.get_stats("a")["count"])
+        self.assertEqual(0, fit.get_stats("b")["count"])
+
+    def test_many_cavities_at_once(self):
+        rng = np.random.RandomState(10)
+        names = ["c{}".format(i) for i in range(20)]
+        fit = WindowedFit(names, window=10, min_samples=3)
+        for i in range(12):
+            inputs = (rng.uniform(11e6, 13e6, 20), rng.uniform(3e3, 4e3, 20), rng.uniform(500, 1000, 20),
+                      np.radians(rng.normal(0, 5, 20)), rng.uniform(100e-6, 200e-6, 20))
+            # The last cavity gets only two samples
+            fit.record_many(names[:-1] if i > 1 else names, *(x[:19] if i > 1 else x for x in inputs), RQ)
+        results = fit.solve()
+        self.assertEqual([10] * 19 + [2], list(results["count"]))
+        self.assertTrue(math.isnan(results["Q_L"][-1]))
+        for i, name in enumerate(names[:-1]):
+            self.assertEqual(results["Q_L"][i], fit.get_stats(name)["Q_L"])
+
+    def test_record_cavity_sets_fit(self):
+        cav = make_cavity("my_cav", RQ=RQ)
+        fit = WindowedFit(["my_cav"], window=4, min_samples=2)
+        cav.update_formula_data(*INPUTS)
+        fit.record_cavity(cav)
+        self.assertTrue(math.isnan(cav.Q_fit))
+        cav.run_calculations()
+        fit.record_cavity(cav)
+        self.assertAlmostEqual(1.0, cav.Q_fit / cav.Q_lf, places=12)
+        self.assertAlmostEqual(cav.attenuation, cav.attenuation_fit, places=12)
+
+    def test_rejects_bad_window(self):
+        with self.assertRaises(ValueError):
+            WindowedFit(["a"], window=0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+import unittest
+from unittest import TestCase
+from qlCalc.history import ResultHistory
+from test.helpers import make_cavity
+import math
+import random
+import statistics
+
+
+class TestResultHistory(TestCase):
+
+    def test_rolling_stats_match_direct_computation(self):
+        rng = random.Random(9)
+        window = 7
+        history = ResultHistory(["a", "b"], window=window, fields=("Q_lf",))
+        seen = []
+        for i in range(100):
+            x = rng.gauss(2.4e7, 1e6)
+            if i % 13 == 5:
+                x = math.nan
+            seen.append(x)
+            history.record("a", [x], float(i))
+
+            current = [v for v in seen[-window:] if not math.isnan(v)]
+            stats = history.get_stats("a")["Q_lf"]
+            self.assertEqual(len(current), stats["count"])
+            self.assertAlmostEqual(statistics.mean(current), stats["mean"], delta=1e-3)
+            if len(current) > 1:
+                self.assertAlmostEqual(statistics.stdev(current), stats["std"], delta=1e-3)
+            self.assertEqual(min(current), stats["min"])
+            self.assertEqual(max(current), stats["max"])
+
+        # Other rows are untouched
+        self.assertEqual(0, history.get_stats("b")["Q_lf"]["count"])
+
+    def test_all_invalid_window(self):
+        history = ResultHistory(["a"], window=2, fields=("Q_lf",))
+        history.record("a", [1.0], 0)
+        history.record("a", [math.nan], 1)
+        history.record("a", [None], 2)
+        stats = history.get_stats("a")["Q_lf"]
+        self.assertEqual(0, stats["count"])
+        self.assertTrue(math.isnan(stats["mean"]))
+        self.assertTrue(math.isnan(stats["min"]))
+
+    def test_window_is_chronological(self):
+        history = ResultHistory(["a"], window=3, fields=("Q_lf", "Q_lr"))
+        for i in range(5):
+            history.record("a", [i, 10 * i], 100.0 + i)
+        ts, values = history.get_window("a")
+        self.assertEqual([102.0, 103.0, 104.0], list(ts))
+        self.assertEqual([2.0, 3.0, 4.0], list(values[0]))
+        self.assertEqual([20.0, 30.0, 40.0], list(values[1]))
+
+    def test_cavities_added_and_removed(self):
+        history = ResultHistory(["a", "b"], window=3, fields=("Q_lf",))
+        history.record("a", [1.0], 0)
+        history.record("b", [2.0], 0)
+        history.remove_cavity("a")
+        self.assertNotIn("a", history.index)
+        # The free row is reused, empty, before the arrays grow
+        history.add_cavity("c")
+        self.assertEqual({"b": 1, "c": 0}, history.index)
+        self.assertEqual(0, history.get_stats("c")["Q_lf"]["count"])
+        history.add_cavity("d")
+        self.assertEqual(4, len(history.cavity_names))
+        history.record("d", [4.0], 1)
+        self.assertEqual(4.0, history.get_stats("d")["Q_lf"]["mean"])
+        self.assertEqual(2.0, history.get_stats("b")["Q_lf"]["mean"])
+        self.assertEqual((4, 1, 3), history.values.shape)
+
+    def test_record_cavity_sets_smoothed_values(self):
+        cav = make_cavity("my_cav")
+        history = ResultHistory(["my_cav"], window=4)
+        for q in (1.0, 2.0, 3.0):
+            cav.Q_lf = q
+            cav.Q_lr = 2 * q
+            history.record_cavity(cav)
+        self.assertEqual(2.0, cav.Q_lf_mean)
+        self.assertEqual(4.0, cav.Q_lr_mean)
+        self.assertEqual(1.0, cav.Q_lf_std)
+
+
+if __name__ == '__main__':
+    unittest.main()
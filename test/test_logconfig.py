@@ -0,0 +1,158 @@
+import unittest
+from unittest import TestCase
+from qlCalc.aioruntime import AsyncRuntime
+from qlCalc.cryocavity import ErrorRecord
+from qlCalc.logconfig import AsyncLogging, DuplicateFilter, DroppingQueueHandler, RateLimitFilter
+from test.helpers import make_cavity
+import qlCalc.main
+import logging
+import os
+import queue
+import shutil
+import signal
+import tempfile
+import threading
+
+
+def make_record(msg, *args, name="qlCalc.test", level=logging.WARNING):
+    return logging.LogRecord(name, level, __file__, 1, msg, args, None)
+
+
+class TestLogFilters(TestCase):
+
+    def test_rate_limit_shares_budget_per_template(self):
+        f = RateLimitFilter(rate=0.0, burst=2)
+        passed = [f.filter(make_record("Timed out - %s", "c{}".format(i))) for i in range(5)]
+        self.assertEqual([True, True, False, False, False], passed)
+        self.assertTrue(f.filter(make_record("Another message")))
+
+        f.rate = 1e6
+        record = make_record("Timed out - %s", "c9")
+        self.assertTrue(f.filter(record))
+        self.assertEqual("Timed out - c9 [3 similar messages suppressed]", record.getMessage())
+
+    def test_duplicates_are_suppressed_within_window(self):
+        f = DuplicateFilter(window=3600)
+        self.assertTrue(f.filter(make_record("clamped - %s", "c1")))
+        self.assertFalse(f.filter(make_record("clamped - %s", "c1")))
+        self.assertTrue(f.filter(make_record("clamped - %s", "c2")))
+
+        f.window = 0
+        record = make_record("clamped - %s", "c1")
+        self.assertTrue(f.filter(record))
+        self.assertEqual("clamped - c1 [repeated 1 times]", record.getMessage())
+
+    def test_full_queue_drops_without_blocking(self):
+        handler = DroppingQueueHandler(queue.Queue(maxsize=1))
+        handler.handle(make_record("first"))
+        handler.handle(make_record("second"))
+        self.assertEqual(1, handler.dropped)
+        handler.queue.get_nowait()
+        handler.handle(make_record("third"))
+        self.assertEqual("third [1 log records dropped]", handler.queue.get_nowait().getMessage())
+        self.assertEqual(0, handler.dropped)
+
+
+class TestSignalHandler(TestCase):
+
+    def tearDown(self):
+        qlCalc.main.shutdown_event.clear()
+        qlCalc.main.shutdown_signal = None
+
+    def test_handler_does_not_log(self):
+        # The handler runs on the main thread, which may be in the middle of enqueueing a record
+        handler = DroppingQueueHandler(queue.Queue())
+        log = logging.getLogger("qlCalc.main")
+        log.addHandler(handler)
+        level = log.level
+        log.setLevel(logging.INFO)
+        try:
+            with handler._lock:
+                thread = threading.Thread(target=qlCalc.main.sig_handler, args=(signal.SIGTERM, None))
+                thread.start()
+                thread.join(5)
+                self.assertFalse(thread.is_alive())
+        finally:
+            log.removeHandler(handler)
+            log.setLevel(level)
+        self.assertTrue(qlCalc.main.shutdown_event.is_set())
+        self.assertEqual(signal.SIGTERM, qlCalc.main.shutdown_signal)
+        self.assertTrue(handler.queue.empty())
+
+    def test_async_runtime_keeps_handler(self):
+        # A signal received while the asyncio runtime runs goes through sig_handler too
+        previous = signal.signal(signal.SIGTERM, qlCalc.main.sig_handler)
+        timer = threading.Timer(0.2, os.kill, args=(os.getpid(), signal.SIGTERM))
+        try:
+            timer.start()
+            qlCalc.main.run_async_runtime(AsyncRuntime(qlCalc.main.shutdown_event), {}, lambda: None)
+            self.assertIs(qlCalc.main.sig_handler, signal.getsignal(signal.SIGTERM))
+        finally:
+            timer.cancel()
+            signal.signal(signal.SIGTERM, previous)
+        self.assertEqual(signal.SIGTERM, qlCalc.main.shutdown_signal)
+
+
+class TestAsyncLogging(TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.root_level = logging.getLogger().level
+
+    def tearDown(self):
+        logging.getLogger().setLevel(self.root_level)
+        shutil.rmtree(self.dir)
+
+    def test_records_are_written_by_listener(self):
+        path = os.path.join(self.dir, "test.log")
+        handler = logging.FileHandler(path)
+        pipeline = AsyncLogging([handler], level=logging.INFO, rate=None, dedup_window=None)
+        pipeline.start()
+        log = logging.getLogger("qlCalc.test_async")
+        try:
+            log.debug("not written")
+            for i in range(3):
+                log.info("written %d", i)
+        finally:
+            pipeline.stop()
+        self.assertNotIn(pipeline.handler, logging.getLogger().handlers)
+        with open(path) as f:
+            self.assertEqual(["written 0", "written 1", "written 2"], f.read().split("\n")[:3])
+
+
+class TestErrorRecord(TestCase):
+
+    def test_bounded_and_deduplicated(self):
+        errors = ErrorRecord(maxlen=2)
+        errors.append("a")
+        errors.append("a")
+        self.assertEqual(["a"], errors)
+        errors.extend(["b", "c", "d"])
+        self.assertEqual(["a", "b", "2 more errors"], errors)
+        self.assertEqual("a; b; 2 more errors", "; ".join(errors))
+        errors.clear()
+        errors.append("e")
+        self.assertEqual(["e"], errors)
+
+    def test_extend_carries_dropped_count(self):
+        errors = ErrorRecord(maxlen=2)
+        errors.extend(["a", "b", "c"])
+        copy = errors.copy()
+        self.assertEqual(["a", "b", "1 more errors"], copy)
+        errors.clear()
+        errors.extend(copy)
+        self.assertEqual(["a", "b", "1 more errors"], errors)
+        errors.append("d")
+        self.assertEqual(["a", "b", "2 more errors"], errors)
+        self.assertEqual(["a", "b"], errors.messages())
+
+    def test_cleared_each_cycle(self):
+        cav = make_cavity("my_cav")
+        cav.print_results = lambda: None
+        cav.publish_invalid_results("Data request timed out")
+        cav.publish_invalid_results("Data request timed out again")
+        self.assertEqual(["Data request timed out again"], cav.err_msg)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+import unittest
+from unittest import TestCase
+from qlCalc.acquisition import INPUT_PVS
+from qlCalc.fit import WindowedFit
+from qlCalc.history import ResultHistory
+from qlCalc.memo import InputMemo
+from test.helpers import INPUT_VALUES, make_cavity, make_pvs
+import math
+
+INPUTS = [INPUT_VALUES[name] for name in INPUT_PVS]
+
+
+def make_memo_cavity():
+    pvs = make_pvs(GETDATA=2, **INPUT_VALUES)
+    cav = make_cavity(pvs=pvs)
+    cav.exports = []
+    cav.export_results = lambda out=None: cav.exports.append("results")
+    cav.export_heartbeat = lambda: cav.exports.append("heartbeat")
+    return cav, pvs
+
+
+class TestInputMemo(TestCase):
+
+    def test_deadbands(self):
+        memo = InputMemo(deadbands={"GMESLQ": 0.01, "ITOTLQ": 1.0})
+        self.assertFalse(memo.check("c1", INPUTS, now=0))
+        self.assertTrue(memo.check("c1", INPUTS, now=1))
+        self.assertTrue(memo.check("c1", [17.8, 3.396, 0.805, 0.67, 202.5], now=2))
+        # Any change of an input without a deadband is a change
+        self.assertFalse(memo.check("c1", [17.794, 3.397, 0.805, 0.67, 201.8], now=3))
+        self.assertEqual((2, 2), (memo.get_stats()["hits"], memo.get_stats()["misses"]))
+
+    def test_drift_is_measured_from_the_reference(self):
+        memo = InputMemo(deadbands={"GMESLQ": 0.01})
+        memo.check("c1", INPUTS, now=0)
+        self.assertTrue(memo.check("c1", [17.800] + INPUTS[1:], now=1))
+        self.assertFalse(memo.check("c1", [17.806] + INPUTS[1:], now=2))
+
+    def test_max_age_nan_and_invalidate(self):
+        memo = InputMemo(max_age=10)
+        memo.check("c1", INPUTS, now=0)
+        self.assertTrue(memo.check("c1", INPUTS, now=9))
+        self.assertFalse(memo.check("c1", INPUTS, now=10))
+        memo.invalidate("c1")
+        self.assertFalse(memo.check("c1", INPUTS, now=11))
+        nan = [math.nan] + INPUTS[1:]
+        memo.check("c1", nan, now=12)
+        self.assertFalse(memo.check("c1", nan, now=13))
+        stats = memo.get_stats(reset=True)
+        self.assertAlmostEqual(1 / 6, stats["hit_rate"])
+        self.assertEqual(0, memo.get_stats()["hits"])
+
+    def test_rejects_bad_deadbands(self):
+        with self.assertRaises(ValueError):
+            InputMemo(deadbands={"FOO": 1.0})
+        with self.assertRaises(ValueError):
+            InputMemo(deadbands={"GMESLQ": -1.0})
+
+    def test_process_new_data_skips_unchanged_inputs(self):
+        cav, pvs = make_memo_cavity()
+        cav.memo = InputMemo(deadbands={"DETALQ": 0.1})
+        cav.history = ResultHistory(["c1"], window=4)
+        cav.fit = WindowedFit(["c1"], window=4)
+        cav.process_new_data()
+        Q_lf = cav.Q_lf
+        calc_timestamp = cav.calc_timestamp
+        pvs["DETALQ"].value = 0.7
+        cav.process_new_data()
+        self.assertEqual(["results", "heartbeat"], cav.exports)
+        self.assertEqual(calc_timestamp, cav.calc_timestamp)
+        self.assertGreaterEqual(cav.heartbeat, calc_timestamp)
+        self.assertEqual(Q_lf, cav.Q_lf)
+        # The repeated sample still counts in the windows
+        self.assertEqual(2, cav.history.get_stats("c1")["Q_lf"]["count"])
+        self.assertEqual(cav.heartbeat, cav.history.get_window("c1")[0][-1])
+        self.assertEqual(2, cav.fit.get_stats("c1")["count"])
+        # The fit gets the inputs just read, not those the results came from
+        self.assertEqual(math.radians(0.7), cav.detune_angle)
+
+        pvs["DETALQ"].value = 5.0
+        cav.process_new_data()
+        self.assertEqual(["results", "heartbeat", "results"], cav.exports)
+        self.assertNotEqual(Q_lf, cav.Q_lf)
+
+        # Invalid results are always followed by a recalculation
+        cav.publish_invalid_results("Data request timed out")
+        cav.process_new_data()
+        self.assertFalse(math.isnan(cav.Q_lf))
+        self.assertEqual([], cav.err_msg)
+
+
+if __name__ == '__main__':
+    unittest.main()
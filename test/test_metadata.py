@@ -0,0 +1,97 @@
+import unittest
+from unittest import TestCase
+from qlCalc.metadata import CavityMetadata, FileMetadataSource, MetadataCache, MetadataSourceError, static_metadata
+from test.helpers import make_cavity
+import os
+import shutil
+import tempfile
+import time
+
+
+class CountingSource:
+    """A metadata source that counts how often it is queried and can be made unavailable"""
+
+    def __init__(self, metadata):
+        self.metadata = metadata
+        self.fetches = []
+        self.available = True
+
+    def fetch(self, cavity_names=None):
+        if not self.available:
+            raise MetadataSourceError("CED unavailable")
+        self.fetches.append(list(cavity_names))
+        return {name: md for name, md in self.metadata.items() if name in cavity_names}
+
+
+class TestMetadata(TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.cache = MetadataCache(os.path.join(self.dir, "cache", "metadata.sqlite"), ttl=3600)
+        self.source = CountingSource({
+            "1L22-1": CavityMetadata("1L22-1", "R1M1", "c100", 0.7, 868.9),
+            "1L13-1": CavityMetadata("1L13-1", "R1D1", "c75", 0.5, 482.5),
+        })
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_file_source(self):
+        path = os.path.join(self.dir, "cavities.csv")
+        with open(path, "w") as f:
+            f.write("cavity_name,epics_name,cavity_type,length,RQ\n1L13-1,R1D1,c75,0.5,482.5\n1L22-1,R1M1,,,\n")
+        md = FileMetadataSource(path).fetch(["1L22-1", "1L13-1"])
+        self.assertEqual(CavityMetadata("1L13-1", "R1D1", "c75", 0.5, 482.5), md["1L13-1"])
+        self.assertEqual(CavityMetadata("1L22-1", "R1M1", "c100", 0.7, 868.9), md["1L22-1"])
+        with self.assertRaises(MetadataSourceError):
+            FileMetadataSource(os.path.join(self.dir, "missing.csv")).fetch()
+
+    def test_file_source_skips_malformed_rows(self):
+        path = os.path.join(self.dir, "cavities.csv")
+        with open(path, "w") as f:
+            f.write("cavity_name,epics_name,cavity_type,length,RQ\n1L13-1,R1D1,c75,0.5,482.5\n"
+                    "1L22-1,R1M1,c100,0.7,n/a\n")
+        with self.assertLogs("qlCalc.metadata", "WARNING"):
+            md = FileMetadataSource(path).fetch()
+        self.assertEqual(["1L13-1"], list(md))
+
+    def test_cache_only_fetches_missing_entries(self):
+        self.cache.load(["1L22-1"], source=self.source)
+        md = self.cache.load(["1L22-1", "1L13-1"], source=self.source)
+        self.assertEqual([["1L22-1"], ["1L13-1"]], self.source.fetches)
+        self.assertEqual("R1D1", md["1L13-1"].epics_name)
+
+        # A new cache object on the same file does not go to the source at all
+        md = MetadataCache(self.cache.path).load(["1L22-1", "1L13-1"], source=self.source)
+        self.assertEqual(2, len(self.source.fetches))
+        self.assertEqual(0.5, md["1L13-1"].length)
+
+    def test_stale_entries_refresh_and_survive_outage(self):
+        self.cache.store([CavityMetadata("1L22-1", "OLD", "c100", 0.7, 868.9)], fetched_at=time.time() - 7200)
+        self.source.available = False
+        md = self.cache.load(["1L22-1"], source=self.source)
+        self.assertEqual("OLD", md["1L22-1"].epics_name)
+
+        self.source.available = True
+        md = self.cache.load(["1L22-1"], source=self.source)
+        self.assertEqual("R1M1", md["1L22-1"].epics_name)
+        self.assertEqual("R1M1", self.cache.read()["1L22-1"][0].epics_name)
+
+    def test_forced_refresh(self):
+        self.cache.load(["1L22-1"], source=self.source)
+        self.cache.load(["1L22-1"], source=self.source, refresh=True)
+        self.assertEqual(2, len(self.source.fetches))
+
+    def test_static_metadata(self):
+        self.assertEqual(CavityMetadata("VL26-3", "RVQ3", "c100", 0.7, 868.9), static_metadata("VL26-3"))
+
+    def test_apply_metadata(self):
+        cav = make_cavity("1L13-1")
+        cav.apply_metadata(self.source.metadata["1L13-1"])
+        self.assertEqual(("R1D1", "c75", 0.5, 482.5), (cav.epics_name, cav.cavity_type, cav.length, cav.RQ))
+        with self.assertRaises(ValueError):
+            cav.apply_metadata(self.source.metadata["1L22-1"])
+
+
+if __name__ == '__main__':
+    unittest.main()
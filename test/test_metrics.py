@@ -0,0 +1,135 @@
+import unittest
+from unittest import TestCase
+from qlCalc.metrics import LatencyHistogram, MetricsServer, PipelineMetrics, STAGES, render_text
+import json
+import math
+import os
+import queue
+import shutil
+import tempfile
+import threading
+import urllib.request
+
+
+class TestLatencyHistogram(TestCase):
+
+    def test_quantiles_within_bucket_resolution(self):
+        h = LatencyHistogram()
+        values = [i * 1e-4 for i in range(1, 1001)]
+        for v in values:
+            h.record(v)
+        self.assertEqual(1000, h.count)
+        self.assertAlmostEqual(sum(values) / 1000, h.summary()["mean"])
+        for q in (0.5, 0.9, 0.99):
+            exact = values[int(q * 1000) - 1]
+            self.assertLess(abs(h.quantile(q) / exact - 1), 0.2)
+        self.assertEqual(values[-1], h.quantile(1.0))
+
+    def test_empty_and_out_of_range(self):
+        h = LatencyHistogram()
+        self.assertTrue(math.isnan(h.quantile(0.5)))
+        h.record(0.0)
+        h.record(1e9)
+        self.assertEqual(0.0, h.quantile(0.0))
+        self.assertEqual(1e9, h.quantile(1.0))
+
+    def test_merge(self):
+        a = LatencyHistogram()
+        b = LatencyHistogram()
+        a.record(0.1)
+        b.record(0.3)
+        a.merge(b)
+        self.assertEqual((2, 0.1, 0.3), (a.count, a.min, a.max))
+
+    def test_copy(self):
+        a = LatencyHistogram()
+        a.record(0.1)
+        b = a.copy()
+        a.record(0.3)
+        self.assertEqual((1, 0.1, 0.1), (b.count, b.min, b.max))
+        self.assertEqual(1, sum(b.counts))
+
+
+class TestPipelineMetrics(TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def run_cycle(self, metrics, name, start, steps=(0.1, 0.01, 0.002, 0.001, 0.003, 0.0005)):
+        t = start
+        metrics.mark(name, "requested", t)
+        for stage, step in zip(STAGES[1:], steps):
+            t += step
+            metrics.mark(name, stage, t)
+
+    def test_stage_latencies_and_rates(self):
+        metrics = PipelineMetrics(request_interval=1.0)
+        metrics.add_cavity("c1")
+        metrics.add_cavity("c2", request_interval=2.0)
+        for i in range(3):
+            self.run_cycle(metrics, "c1", 100.0 + i)
+        self.run_cycle(metrics, "c2", 100.0)
+
+        q = queue.Queue()
+        q.put(1)
+        metrics.add_gauge("update_queue", q.qsize)
+        snap = metrics.snapshot()
+        self.assertEqual({"update_queue": 1}, snap["gauges"])
+        self.assertEqual(4, snap["stages"]["posted"]["count"])
+        self.assertAlmostEqual(0.1, snap["stages"]["posted"]["mean"])
+        self.assertEqual(2, snap["stages"]["cycle"]["count"])
+        self.assertAlmostEqual(1.0, snap["stages"]["cycle"]["p50"])
+        self.assertEqual(3, snap["cavities"]["c1"]["updates"])
+        self.assertEqual(1.5, snap["expected_rate"])
+        self.assertAlmostEqual(0.003, snap["cavities"]["c1"]["stages"]["exported"]["max"])
+
+        # A stage reached without its predecessor (e.g., after a timed out request) is not timed
+        metrics.mark("c2", "requested", 200.0)
+        metrics.mark("c2", "dequeued", 200.5)
+        self.assertEqual(1, metrics.snapshot()["cavities"]["c2"]["stages"]["dequeued"]["count"])
+
+        # Progress counts requests and exports, and survives resets
+        progress = metrics.snapshot()["progress"]
+        metrics.mark("c2", "exported", 201.0)
+        self.assertEqual(progress + 1, metrics.snapshot()["progress"])
+        text = render_text(metrics.snapshot(reset=True))
+        self.assertIn('qlcalc_stage_latency_seconds_count{stage="posted"} 4', text)
+        self.assertIn('qlcalc_gauge{name="update_queue"} 1', text)
+        self.assertEqual(0, metrics.snapshot()["stages"]["posted"]["count"])
+        self.assertEqual(progress + 1, metrics.snapshot()["progress"])
+
+    def test_snapshot_file_and_http(self):
+        metrics = PipelineMetrics()
+        self.run_cycle(metrics, "c1", 100.0)
+        path = os.path.join(self.dir, "metrics.json")
+        metrics.write_snapshot(path)
+        with open(path) as f:
+            self.assertEqual(1, json.load(f)["cavities"]["c1"]["updates"])
+        self.assertEqual(["metrics.json"], os.listdir(self.dir))
+
+        # The final snapshot at shutdown is written, and a failure to write it is only logged
+        event = threading.Event()
+        event.set()
+        os.remove(path)
+        metrics.run_snapshots(path, 60, event)
+        self.assertTrue(os.path.exists(path))
+        with self.assertLogs("qlCalc.metrics", "ERROR"):
+            metrics.run_snapshots(os.path.join(self.dir, "missing", "metrics.json"), 60, event)
+
+        server = MetricsServer(metrics)
+        server.start()
+        try:
+            url = "http://127.0.0.1:{}".format(server.port)
+            with urllib.request.urlopen(url + "/metrics", timeout=5) as r:
+                self.assertIn("qlcalc_update_rate", r.read().decode())
+            with urllib.request.urlopen(url + "/metrics.json", timeout=5) as r:
+                self.assertIn("c1", json.loads(r.read().decode())["cavities"])
+        finally:
+            server.stop()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,155 @@
+import unittest
+from unittest import TestCase
+from qlCalc.publisher import ResultPublisher, RESULT_PVS
+from test.helpers import FakePV, make_cavity
+import math
+import threading
+import time
+
+
+def make_published_cavity(name="c1", epics_name="R1Q1"):
+    cav = make_cavity(name)
+    cav.epics_name = epics_name
+    cav.attenuation = 0.08
+    cav.P_fc = 3333.6
+    cav.P_rc = 820.1
+    cav.Q_lf = 2.39e7
+    cav.Q_lr = 2.39e7
+    cav.Q_lf_mean = cav.Q_lr_mean = 2.39e7
+    cav.Q_lf_std = cav.Q_lr_std = 1.0e5
+    cav.Q_lf_unc = cav.Q_lr_unc = 4.0e5
+    cav.Q_lf_lo = cav.Q_lr_lo = 2.3e7
+    cav.Q_lf_hi = cav.Q_lr_hi = 2.5e7
+    cav.Q_fit = 2.4e7
+    cav.attenuation_fit = 0.08
+    cav.data_sync_start = "now"
+    cav.data_sync_end = "a little later"
+    cav.heartbeat = 1.7e9
+    return cav
+
+
+class TestResultPublisher(TestCase):
+
+    def setUp(self):
+        self.pvs = {}
+
+        def factory(pvname):
+            self.pvs[pvname] = FakePV(pvname)
+            return self.pvs[pvname]
+
+        self.publisher = ResultPublisher(threading.Event(), pv_prefix="test:", pv_factory=factory)
+
+    def test_submit_is_buffered_until_flush(self):
+        cav = make_published_cavity()
+        self.publisher.register(cav)
+        self.assertEqual(len(RESULT_PVS), len(self.pvs))
+        self.publisher.submit(cav)
+        self.assertEqual([], self.pvs["test:R1Q1QLFLQ"].puts)
+        self.assertEqual(len(RESULT_PVS), self.publisher.get_stats()["backlog"])
+        self.assertEqual(len(RESULT_PVS), self.publisher.flush())
+        self.assertEqual([2.39e7], self.pvs["test:R1Q1QLFLQ"].puts)
+        self.assertEqual([""], self.pvs["test:R1Q1ERRLQ"].puts)
+
+    def test_unchanged_values_are_skipped(self):
+        cav = make_published_cavity()
+        self.publisher.register(cav)
+        self.publisher.submit(cav)
+        self.publisher.flush()
+        cav.Q_lf = 2.4e7
+        self.publisher.submit(cav)
+        self.assertEqual(1, self.publisher.flush())
+        self.assertEqual([2.39e7, 2.4e7], self.pvs["test:R1Q1QLFLQ"].puts)
+        self.assertEqual(len(RESULT_PVS) - 1, self.publisher.get_stats()["unchanged"])
+
+    def test_submit_selected_attributes(self):
+        cav = make_published_cavity()
+        self.publisher.register(cav)
+        self.publisher.submit(cav, attrs=("heartbeat",))
+        self.assertEqual(1, self.publisher.flush())
+        self.assertEqual([1.7e9], self.pvs["test:R1Q1HBLQ"].puts)
+        self.assertEqual([], self.pvs["test:R1Q1QLFLQ"].puts)
+
+    def test_nan_is_published_once(self):
+        cav = make_published_cavity()
+        self.publisher.register(cav)
+        cav.Q_lr = math.nan
+        self.publisher.submit(cav)
+        self.publisher.flush()
+        self.publisher.submit(cav)
+        self.publisher.flush()
+        self.assertEqual(1, len(self.pvs["test:R1Q1QLRLQ"].puts))
+
+    def test_disconnected_pv_stays_buffered(self):
+        cav = make_published_cavity()
+        self.publisher.register(cav)
+        self.pvs["test:R1Q1QLFLQ"].connected = False
+        self.publisher.submit(cav)
+        self.publisher.flush()
+        self.assertEqual(1, self.publisher.get_stats()["backlog"])
+        self.pvs["test:R1Q1QLFLQ"].connected = True
+        self.assertEqual(1, self.publisher.flush())
+        self.assertEqual(0, self.publisher.get_stats()["backlog"])
+
+    def test_disconnected_pv_is_retried_on_interval(self):
+        cav = make_published_cavity()
+        self.publisher.register(cav)
+        self.pvs["test:R1Q1QLFLQ"].connected = False
+        self.publisher.flush_interval = 0.05
+        thread = threading.Thread(target=self.publisher.run)
+        thread.start()
+        try:
+            self.publisher.submit(cav)
+            time.sleep(0.5)
+        finally:
+            self.publisher.event.set()
+            thread.join()
+        # About one retry per interval, not a flush loop
+        self.assertLess(self.publisher.get_stats()["flushes"], 20)
+        self.assertEqual(1, self.publisher.get_stats()["backlog"])
+
+    def test_failed_put_is_retried(self):
+        cav = make_published_cavity()
+        self.publisher.register(cav)
+        pv = self.pvs["test:R1Q1QLFLQ"]
+
+        def fail(value, wait=False):
+            raise RuntimeError("CA error")
+        pv.put = fail
+        self.publisher.submit(cav)
+        with self.assertLogs("qlCalc.publisher", "ERROR"):
+            self.assertEqual(0, self.publisher.flush())
+        self.assertEqual(len(RESULT_PVS), self.publisher.get_stats()["backlog"])
+        del pv.put
+        self.assertEqual(len(RESULT_PVS), self.publisher.flush())
+        self.assertEqual([2.39e7], pv.puts)
+
+    def test_thread_flushes_on_interval_and_shutdown(self):
+        cav = make_published_cavity()
+        self.publisher.register(cav)
+        self.publisher.flush_interval = 0.05
+        thread = threading.Thread(target=self.publisher.run)
+        thread.start()
+        try:
+            self.publisher.submit(cav)
+            time.sleep(0.3)
+            self.assertEqual([2.39e7], self.pvs["test:R1Q1QLFLQ"].puts)
+            cav.Q_lf = 1.0
+            self.publisher.submit(cav)
+        finally:
+            self.publisher.event.set()
+            thread.join()
+        self.assertEqual([2.39e7, 1.0], self.pvs["test:R1Q1QLFLQ"].puts)
+
+    def test_export_results_to_epics(self):
+        cav = make_published_cavity()
+        cav.results_out = "epics"
+        with self.assertRaises(ValueError):
+            cav.export_results()
+        cav.publisher = self.publisher
+        self.publisher.register(cav)
+        cav.export_results()
+        self.assertEqual(len(RESULT_PVS), self.publisher.get_stats()["backlog"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,95 @@
+import unittest
+from unittest import TestCase
+from qlCalc.cryocavity import CavityTask
+from qlCalc.ratecontrol import RateController, zone_of
+from qlCalc.scheduler import RequestScheduler
+import qlCalc.main
+import queue
+import threading
+
+
+class TestRateController(TestCase):
+
+    def test_zone_of(self):
+        self.assertEqual("VL26", zone_of("VL26-7"))
+        self.assertEqual("2L22", zone_of("2L22-1"))
+        self.assertEqual("R1Q1", zone_of("R1Q1"))
+
+    def test_responsive_cavity_tightens_to_floor(self):
+        rc = RateController(min_interval=0.5, recover_step=0.1, max_utilization=0.5)
+        interval = 1.0
+        for _ in range(20):
+            interval = rc.completed("VL26-1", 0.05, interval)
+        self.assertAlmostEqual(0.5, interval)
+        # A turnaround of 0.4 s may only keep the IOC busy half the time
+        for _ in range(50):
+            interval = rc.completed("VL26-2", 0.4, interval)
+        self.assertAlmostEqual(0.8, interval, places=3)
+
+    def test_slow_and_timed_out_requests_back_off(self):
+        rc = RateController(slow_turnaround=1.0, backoff_factor=2.0, max_interval=5.0)
+        self.assertEqual(2.0, rc.completed("VL26-1", 1.5, 1.0))
+        self.assertEqual(4.0, rc.timed_out("VL26-1"))
+        self.assertEqual(5.0, rc.timed_out("VL26-1"))
+        self.assertEqual(5.0, rc.interval("VL26-1"))
+        self.assertEqual(3, rc.get_stats()["backoffs"])
+
+    def test_admit_limits_outstanding_per_ioc(self):
+        rc = RateController(max_outstanding=2)
+        tasks = [CavityTask(name, 0) for name in ("VL26-1", "VL26-2", "VL26-3", "VL25-1")]
+        admitted, deferred = rc.admit(tasks)
+        self.assertEqual(["VL26-1", "VL26-2", "VL25-1"], [t.cavity_name for t in admitted])
+        self.assertEqual(["VL26-3"], [t.cavity_name for t in deferred])
+
+        # A cavity already in flight is re-admitted, a completion frees a slot
+        self.assertEqual(([tasks[0]], [tasks[2]]), rc.admit([tasks[0], tasks[2]]))
+        rc.completed("VL26-1", 0.1)
+        self.assertEqual(([tasks[2]], []), rc.admit([tasks[2]]))
+
+        # Forced triggers count against the limit even though they were never admitted
+        rc.timed_out("VL25-1")
+        rc.requested("VL25-2")
+        rc.requested("VL25-3")
+        self.assertEqual(([], [tasks[3]]), rc.admit([tasks[3]]))
+        stats = rc.get_stats()
+        self.assertEqual((4, 2, 3), (stats["outstanding"], stats["max_ioc_outstanding"], stats["deferred"]))
+
+    def test_default_limit_defers_within_a_zone(self):
+        # The configured limit must hold back some of a zone's eight cavities, which share an IOC
+        rc = RateController(max_outstanding=qlCalc.main.ioc_max_outstanding)
+        tasks = [CavityTask("VL26-{}".format(i), 0) for i in range(1, 9)]
+        admitted, deferred = rc.admit(tasks)
+        self.assertEqual(tasks[:qlCalc.main.ioc_max_outstanding], admitted)
+        self.assertEqual(tasks[qlCalc.main.ioc_max_outstanding:], deferred)
+        self.assertEqual(RateController().max_outstanding, qlCalc.main.ioc_max_outstanding)
+
+    def test_deferred_requests_dropped_at_shutdown(self):
+        rc = RateController()
+        for i in range(1, rc.max_outstanding + 1):
+            rc.requested("VL26-{}".format(i))
+        scheduler = RequestScheduler(slot_width=0.01)
+        scheduler.add(CavityTask("VL26-8", 0))
+        event = threading.Event()
+        event.set()
+        thread = threading.Thread(target=qlCalc.main.request_new_data, args=({}, queue.Queue(), event, scheduler, rc))
+        thread.start()
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(0, len(scheduler))
+
+    def test_no_limit(self):
+        rc = RateController(max_outstanding=None)
+        tasks = [CavityTask("VL26-{}".format(i), 0) for i in range(20)]
+        self.assertEqual((tasks, []), rc.admit(tasks))
+
+    def test_rejects_bad_settings(self):
+        with self.assertRaises(ValueError):
+            RateController(min_interval=2.0, max_interval=1.0)
+        with self.assertRaises(ValueError):
+            RateController(smoothing=0)
+        with self.assertRaises(ValueError):
+            RateController(max_outstanding=0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,269 @@
+import unittest
+from unittest import TestCase
+from qlCalc.acquisition import INPUT_MODE_MONITOR
+from qlCalc.cryocavity import Cryocavity
+from qlCalc.history import ResultHistory
+from qlCalc.metadata import CavityMetadata
+from qlCalc.metrics import PipelineMetrics
+from qlCalc.publisher import ResultPublisher
+from qlCalc.reload import CavityReloader, diff_cavities, file_stamp, read_cavity_list
+from qlCalc.resulttable import ResultTable, ResultTableReader, STATUS_OK
+from qlCalc.simioc import SimulatedIOC
+import qlCalc.main
+import json
+import os
+import queue
+import tempfile
+import threading
+import time
+
+
+def sim_metadata(names, RQ=868.9):
+    return {name: CavityMetadata(name, "S{:04d}".format(int(name.split("-")[1])), "c100", 0.7, RQ) for name in names}
+
+
+def write_file(path, text):
+    # Replace the file like an editor would, so it is never seen half written
+    with open(path + ".tmp", "w") as f:
+        f.write(text)
+    os.replace(path + ".tmp", path)
+
+
+class TestReadCavityList(TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, "cavities")
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_plain_and_csv_lists(self):
+        write_file(self.path, "# Injector\n1L22-1\n\n1L22-2\n1L22-1\n")
+        self.assertEqual(["1L22-1", "1L22-2"], read_cavity_list(self.path))
+        write_file(self.path, "cavity_name,epics_name,RQ\nVL26-1,RVQ1,868.9\nVL26-2,RVQ2,868.9\n")
+        self.assertEqual(["VL26-1", "VL26-2"], read_cavity_list(self.path))
+
+    def test_rejects_empty_and_unknown_lists(self):
+        write_file(self.path, "# Nothing yet\n")
+        with self.assertRaises(ValueError):
+            read_cavity_list(self.path)
+        write_file(self.path, "name,epics_name\nVL26-1,RVQ1\n")
+        with self.assertRaises(ValueError):
+            read_cavity_list(self.path)
+
+
+class TestCavityReloader(TestCase):
+
+    def setUp(self):
+        self.ioc = SimulatedIOC(prefix="sim:", latency=0.01, jitter=0.002, seed=31)
+        self.ioc.start()
+        self.event = threading.Event()
+        self.update_queue = queue.Queue()
+        self.dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.event.set()
+        self.ioc.stop()
+        self.dir.cleanup()
+
+    def create_cavities(self, names, metadata):
+        return Cryocavity.create_cryocavities(names, update_queue=self.update_queue, shutdown_event=self.event,
+                                              epics_prefix="sim:", input_mode=INPUT_MODE_MONITOR,
+                                              pv_factory=self.ioc.pv_factory, metadata=metadata)
+
+    def test_diff(self):
+        cav_dict, failed = self.create_cavities(["SIM-0", "SIM-1", "SIM-2"], sim_metadata(["SIM-0", "SIM-1", "SIM-2"]))
+        desired = sim_metadata(["SIM-1", "SIM-2", "SIM-3"])
+        desired["SIM-1"] = desired["SIM-1"]._replace(RQ=1000.0)
+        desired["SIM-2"] = desired["SIM-2"]._replace(epics_name="S0099")
+        diff = diff_cavities(cav_dict, desired)
+        self.assertEqual((["SIM-3", "SIM-2"], ["SIM-0", "SIM-2"], ["SIM-1"]), diff)
+
+    def test_reload_adds_removes_and_updates(self):
+        names = ["SIM-0", "SIM-1", "SIM-2"]
+        metadata = sim_metadata(names)
+        cav_dict, failed = self.create_cavities(names, metadata)
+        history = ResultHistory(names, window=4)
+        metrics = PipelineMetrics()
+        publisher = ResultPublisher(self.event, pv_prefix="res:", pv_factory=self.ioc.pv_factory)
+        table = ResultTable(os.path.join(self.dir.name, "results"), names)
+        for cav in cav_dict.values():
+            cav.history = history
+            cav.metrics = metrics
+            cav.publisher = publisher
+            cav.results_table = table
+            metrics.add_cavity(cav.cavity_name)
+            publisher.register(cav)
+
+        path = os.path.join(self.dir.name, "cavities")
+        write_file(path, "SIM-1\nSIM-2\nSIM-3\n")
+        loaded = []
+        metadata["SIM-2"] = metadata["SIM-2"]._replace(RQ=1000.0)
+        metadata.update(sim_metadata(["SIM-3"]))
+
+        def load_metadata(cavity_names):
+            loaded.append(list(cavity_names))
+            return {name: metadata[name] for name in cavity_names}
+        started = []
+        reloader = CavityReloader(cav_dict, self.create_cavities, load_metadata, path=path, cavity_names=names,
+                                  drain_timeout=0.2, history=history, metrics=metrics, publisher=publisher,
+                                  results_table=table,
+                                  start=lambda cavities, start_times: started.append((cavities, start_times)))
+
+        removed = cav_dict["SIM-0"]
+        unchanged = cav_dict["SIM-1"]
+        updated = cav_dict["SIM-2"]
+        removed.awaiting_data = True  # Never answered, so drained for drain_timeout
+        t_start = time.time()
+        diff = reloader.reload()
+        self.assertGreaterEqual(time.time() - t_start, 0.2)
+        self.assertEqual((["SIM-3"], ["SIM-0"], ["SIM-2"]), diff)
+        self.assertEqual([["SIM-1", "SIM-2", "SIM-3"]], loaded)
+
+        self.assertEqual(["SIM-1", "SIM-2", "SIM-3"], sorted(cav_dict))
+        self.assertIs(unchanged, cav_dict["SIM-1"])
+        self.assertIs(updated, cav_dict["SIM-2"])
+        self.assertEqual(1000.0, updated.RQ)
+        self.assertFalse(removed.GETDATA.connected)
+        self.assertEqual({"SIM-1": 1, "SIM-2": 2, "SIM-3": 0}, history.index)
+        self.assertEqual({"SIM-1": 1, "SIM-2": 2, "SIM-3": 0}, table.index)
+        self.assertEqual(["SIM-1", "SIM-2", "SIM-3"], sorted(metrics.snapshot()["cavities"]))
+
+        added = cav_dict["SIM-3"]
+        self.assertIs(history, added.history)
+        self.assertIs(table, added.results_table)
+        self.assertEqual([([added], {"SIM-3": started[0][1]["SIM-3"]})], started)
+        added.update_formula_data(17.794 * 0.7e6, 3396.0, 805.0, 0.0117, 201.8e-6)
+        added.run_calculations()
+        added.heartbeat = added.calc_timestamp
+        history.record_cavity(added)
+        added.results_out = "epics"
+        added.export_results()
+        reader = ResultTableReader(table.path)
+        self.assertEqual(STATUS_OK, reader.read("SIM-3")["status"])
+        reader.close()
+        table.close()
+
+        # Nothing changed, nothing to do
+        self.assertEqual(([], [], []), reloader.reload())
+
+
+    def test_removed_cavities_are_drained_together(self):
+        names = ["SIM-0", "SIM-1", "SIM-2", "SIM-3"]
+        cav_dict, failed = self.create_cavities(names, sim_metadata(names))
+        path = os.path.join(self.dir.name, "cavities")
+        write_file(path, "SIM-3\n")
+        drained = []
+
+        def drain(name, timeout):
+            # Stuck processing, as on a dead IOC
+            drained.append(name)
+            time.sleep(timeout)
+            return False
+        reloader = CavityReloader(cav_dict, self.create_cavities, sim_metadata, path=path, drain_timeout=0.3,
+                                  drain=drain)
+        removed = [cav_dict[name] for name in names[:3]]
+        for cav in removed:
+            cav.awaiting_data = True
+        t_start = time.time()
+        with self.assertLogs("qlCalc.reload", "WARNING"):
+            reloader.reload()
+        self.assertLess(time.time() - t_start, 0.6)
+        self.assertEqual(names[:3], sorted(drained))
+        self.assertEqual(["SIM-3"], list(cav_dict))
+        self.assertFalse(any(cav.GETDATA.connected for cav in removed))
+
+    def test_change_before_the_reloader_starts_is_not_missed(self):
+        names = ["SIM-0", "SIM-1"]
+        path = os.path.join(self.dir.name, "cavities")
+        write_file(path, "SIM-0\nSIM-1\n")
+        stamp = file_stamp(path)
+        cav_dict, failed = self.create_cavities(read_cavity_list(path), sim_metadata(names))
+        write_file(path, "SIM-0\n")
+        reloader = CavityReloader(cav_dict, self.create_cavities, sim_metadata, path=path, stamp=stamp)
+        thread = threading.Thread(target=reloader.run, args=(0.05, self.event))
+        thread.start()
+        try:
+            deadline = time.time() + 5
+            while "SIM-1" in cav_dict and time.time() < deadline:
+                time.sleep(0.05)
+        finally:
+            self.event.set()
+            reloader.request()
+            thread.join()
+        self.assertEqual(["SIM-0"], list(cav_dict))
+
+
+class TestHotReload(TestCase):
+    """The running application follows changes to its cavity list file"""
+
+    def test_reload_threads(self):
+        self.run_reload("threads")
+
+    def test_reload_asyncio(self):
+        self.run_reload("asyncio")
+
+    def run_reload(self, runtime):
+        # Noise free, so that each cavity's single latest result can be checked against its true Q
+        ioc = SimulatedIOC(prefix="adamc:", latency=0.02, jitter=0.005, seed=32, noise=0)
+        ioc.start()
+        tmp = tempfile.TemporaryDirectory()
+        cavities_file = os.path.join(tmp.name, "cavities")
+        metadata_file = os.path.join(tmp.name, "metadata.csv")
+        csv_header = "cavity_name,epics_name,cavity_type,length,RQ\n"
+        csv_rows = ["SIM-{0},S{0:04d},c100,0.7,868.9\n".format(i) for i in range(5)]
+        write_file(metadata_file, csv_header + "".join(csv_rows))
+        write_file(cavities_file, "SIM-0\nSIM-1\nSIM-2\nSIM-3\n")
+
+        def change():
+            # SIM-0 goes, SIM-4 comes and SIM-1's R/Q doubles
+            csv_rows[1] = "SIM-1,S0001,c100,0.7,1737.8\n"
+            write_file(metadata_file, csv_header + "".join(csv_rows))
+            write_file(cavities_file, "SIM-1\nSIM-2\nSIM-3\nSIM-4\n")
+
+        settings = {"runtime": runtime, "cavities_file": cavities_file, "reload_interval": 0.1,
+                    "metadata_source": "file", "metadata_file": metadata_file,
+                    "metadata_cache_file": os.path.join(tmp.name, "metadata.sqlite"),
+                    "checkpoint_file": os.path.join(tmp.name, "checkpoint.json"),
+                    "metrics_snapshot_file": os.path.join(tmp.name, "metrics.json"),
+                    "results_table_file": os.path.join(tmp.name, "results")}
+        saved = {name: getattr(qlCalc.main, name) for name in settings}
+        for name, value in settings.items():
+            setattr(qlCalc.main, name, value)
+        qlCalc.main.shutdown_event.clear()
+        change_timer = threading.Timer(1.0, change)
+        stop_timer = threading.Timer(3.0, qlCalc.main.shutdown_event.set)
+        change_timer.start()
+        stop_timer.start()
+        try:
+            qlCalc.main.main(pv_factory=ioc.pv_factory)
+            with open(settings["checkpoint_file"]) as f:
+                checkpoint = json.load(f)
+            reader = ResultTableReader(settings["results_table_file"])
+            results = {name: reader.read(name) for name in reader.index}
+            reader.close()
+        finally:
+            for name, value in saved.items():
+                setattr(qlCalc.main, name, value)
+            change_timer.cancel()
+            stop_timer.cancel()
+            qlCalc.main.shutdown_event.clear()
+            ioc.stop()
+            tmp.cleanup()
+
+        self.assertEqual({"SIM-1", "SIM-2", "SIM-3", "SIM-4"}, set(checkpoint["cavities"]))
+        self.assertEqual({"SIM-1", "SIM-2", "SIM-3", "SIM-4"}, set(results))
+        for name, row in results.items():
+            self.assertEqual(STATUS_OK, row["status"], name)
+        # The added cavity was calculated, and SIM-1's doubled R/Q halves its Q_lf
+        true_q = {name: ioc.true_loaded_q("S{:04d}".format(int(name[-1]))) for name in results}
+        self.assertAlmostEqual(1.0, results["SIM-4"]["Q_lf"] / true_q["SIM-4"], delta=0.05)
+        self.assertAlmostEqual(0.5, results["SIM-1"]["Q_lf"] / true_q["SIM-1"], delta=0.05)
+        self.assertAlmostEqual(1.0, results["SIM-2"]["Q_lf"] / true_q["SIM-2"], delta=0.05)
+        # The removed cavity's requests stopped
+        self.assertEqual(0, ioc.get_stats()["dropped"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,81 @@
+import unittest
+from unittest import TestCase
+from qlCalc.replay import ColumnarArchive, csv_to_columnar, load_cavity_parameters, main, replay
+from test.helpers import make_cavity
+import math
+import os
+import random
+import shutil
+import tempfile
+import numpy as np
+
+
+class TestReplay(TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.csv = os.path.join(self.dir, "samples.csv")
+        self.metadata = os.path.join(self.dir, "cavities.csv")
+        with open(self.metadata, "w") as f:
+            f.write("cavity_name,epics_name,cavity_type,length,RQ\n1L13-1,R1D1,c75,0.5,482.5\n")
+
+        rng = random.Random(10)
+        self.samples = []
+        with open(self.csv, "w") as f:
+            f.write("timestamp,cavity_name,GMESLQ,CRFPLQ,CRRPLQ,DETALQ,ITOTLQ\n")
+            for i in range(250):
+                row = (1.6e9 + i, "1L22-1" if i % 3 else "1L13-1", rng.uniform(15, 19), rng.uniform(3, 4),
+                       rng.uniform(0.5, 1), rng.uniform(-5, 5), rng.uniform(100, 200))
+                self.samples.append(row)
+                f.write(",".join(str(x) for x in row) + "\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def scalar_results(self, name, length, RQ, GMES, CRFP, CRRP, DETA, ITOT):
+        cav = make_cavity(name, length=length, RQ=RQ)
+        cav.update_formula_data(V_c=GMES * length * 1000000, P_f=CRFP * 1000, P_r=CRRP * 1000,
+                                detune_angle=math.radians(DETA), I_tot=ITOT / 1000000)
+        cav.run_calculations()
+        return cav
+
+    def test_convert_and_replay_match_scalar_calculation(self):
+        archive_dir = os.path.join(self.dir, "archive")
+        out_dir = os.path.join(self.dir, "results")
+        self.assertEqual(250, csv_to_columnar(self.csv, archive_dir, chunk_size=64))
+
+        archive = ColumnarArchive(archive_dir)
+        self.assertEqual(["1L13-1", "1L22-1"], archive.cavity_names)
+        self.assertEqual(250, len(archive))
+        self.assertEqual([(0, 100), (100, 200), (200, 250)], list(archive.chunks(100)))
+
+        length, RQ = load_cavity_parameters(archive.cavity_names, self.metadata)
+        self.assertEqual([0.5, 0.7], list(length))
+        self.assertEqual([482.5, 868.9], list(RQ))
+        replay(archive, out_dir, length, RQ, chunk_size=100, exact=True, dtype=np.float64)
+
+        Q_lf = np.load(os.path.join(out_dir, "Q_lf.npy"))
+        Q_lr = np.load(os.path.join(out_dir, "Q_lr.npy"))
+        ts = np.load(os.path.join(out_dir, "timestamp.npy"))
+        cavity = np.load(os.path.join(out_dir, "cavity.npy"))
+        for i, (t, name, GMES, CRFP, CRRP, DETA, ITOT) in enumerate(self.samples):
+            j = archive.cavity_names.index(name)
+            cav = self.scalar_results(name, length[j], RQ[j], GMES, CRFP, CRRP, DETA, ITOT)
+            self.assertEqual(t, ts[i])
+            self.assertEqual(j, cavity[i])
+            self.assertEqual(cav.Q_lf, Q_lf[i])
+            self.assertEqual(cav.Q_lr, Q_lr[i])
+
+    def test_command_line(self):
+        archive_dir = os.path.join(self.dir, "archive")
+        out_dir = os.path.join(self.dir, "results")
+        self.assertEqual(0, main(["convert", self.csv, archive_dir]))
+        self.assertEqual(0, main(["run", archive_dir, out_dir, "--chunk-size", "32"]))
+        Q_lf = np.load(os.path.join(out_dir, "Q_lf.npy"), mmap_mode="r")
+        self.assertEqual(np.float32, Q_lf.dtype)
+        self.assertEqual(250, len(Q_lf))
+        self.assertTrue(np.all(np.isfinite(Q_lf)))
+
+
+if __name__ == '__main__':
+    unittest.main()
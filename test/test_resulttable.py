@@ -0,0 +1,135 @@
+import unittest
+from unittest import TestCase
+from qlCalc.resulttable import ResultTable, ResultTableReader, STATUS_EMPTY, STATUS_OK, STATUS_WARNING, \
+    STATUS_INVALID, TABLE_FIELDS, main
+from test.helpers import make_cavity
+import contextlib
+import io
+import math
+import os
+import tempfile
+import threading
+
+
+def make_table_cavity(name):
+    cav = make_cavity(name)
+    cav.print_results = lambda: None
+    return cav
+
+
+class TestResultTable(TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, "results")
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_exported_results_are_shared(self):
+        table = ResultTable(self.path, ["1L22-1", "1L22-2"], capacity=4)
+        reader = ResultTableReader(self.path)
+        self.assertEqual({"1L22-1": 0, "1L22-2": 1}, reader.index)
+        self.assertEqual((4, os.getpid()), (reader.capacity, reader.pid))
+        self.assertEqual(STATUS_EMPTY, reader.read("1L22-1")["status"])
+
+        cav = make_table_cavity("1L22-1")
+        cav.results_table = table
+        cav.update_formula_data(17.794 * 0.7e6, 3396.0, 805.0, math.radians(0.67), 201.8e-6)
+        cav.run_calculations()
+        cav.heartbeat = cav.calc_timestamp
+        cav.export_results()
+        row = reader.read("1L22-1")
+        self.assertEqual((2, STATUS_OK), (row["seq"], row["status"]))
+        for field in TABLE_FIELDS:
+            self.assertEqual(getattr(cav, field), row[field])
+        # The reader's rows are the shared memory itself
+        self.assertEqual(cav.Q_lf, reader.rows["Q_lf"][0])
+
+        cav.err_msg.append("Attenuation factor lowered from 1.1 to 1")
+        cav.export_heartbeat()
+        self.assertEqual((4, STATUS_WARNING), (reader.read("1L22-1")["seq"], reader.read("1L22-1")["status"]))
+        cav.publish_invalid_results("Data request timed out")
+        self.assertEqual(STATUS_INVALID, reader.read("1L22-1")["status"])
+        self.assertTrue(math.isnan(reader.snapshot()["Q_lf"][0]))
+        table.close()
+        reader.close()
+
+    def test_reads_are_consistent_while_writing(self):
+        table = ResultTable(self.path, ["a", "b"])
+        reader = ResultTableReader(self.path)
+        stop = threading.Event()
+
+        def writer():
+            i = 0
+            while not stop.is_set():
+                i += 1
+                # Every field of a row holds the same value, so a torn read would show different ones
+                table.write("a", STATUS_OK, [float(i)] * len(TABLE_FIELDS))
+                table.write("b", STATUS_OK, [float(-i)] * len(TABLE_FIELDS))
+
+        thread = threading.Thread(target=writer)
+        thread.start()
+        try:
+            for _ in range(2000):
+                row = reader.read("a")
+                self.assertEqual(1, len({row[field] for field in TABLE_FIELDS}))
+                rows = reader.snapshot()
+                for i in range(2):
+                    self.assertEqual(1, len({rows[field][i] for field in TABLE_FIELDS}))
+                    self.assertEqual(0, rows["seq"][i] % 2)
+        finally:
+            stop.set()
+            thread.join()
+        table.close()
+        reader.close()
+
+    def test_cavities_added_and_removed(self):
+        table = ResultTable(self.path, ["a", "b"])
+        reader = ResultTableReader(self.path)
+        table.write("a", STATUS_OK, [1.0] * len(TABLE_FIELDS))
+        table.write("b", STATUS_OK, [2.0] * len(TABLE_FIELDS))
+        table.remove_cavity("a")
+        self.assertEqual(STATUS_EMPTY, reader.rows["status"][0])
+        self.assertEqual({"b": 1}, reader.refresh())
+        with self.assertRaises(KeyError):
+            reader.read("a")
+        # The free row is reused without replacing the file
+        table.add_cavity("c")
+        table.write("c", STATUS_OK, [3.0] * len(TABLE_FIELDS))
+        self.assertEqual(3.0, reader.read("c")["Q_lf"])
+        self.assertFalse(reader.stale())
+
+        # A full table is copied into a bigger file that replaces it
+        table.add_cavity("d")
+        self.assertEqual(4, table.capacity)
+        self.assertTrue(reader.stale())
+        reader.close()
+        reader = ResultTableReader(self.path)
+        self.assertEqual({"c": 0, "b": 1, "d": 2}, reader.index)
+        self.assertEqual((3.0, 2.0), (reader.read("c")["Q_lf"], reader.read("b")["Q_lf"]))
+        self.assertEqual(STATUS_EMPTY, reader.read("d")["status"])
+        table.close()
+        reader.close()
+
+    def test_rejects_other_files(self):
+        with open(self.path, "wb") as f:
+            f.write(b"x" * 128)
+        with self.assertRaises(ValueError):
+            ResultTableReader(self.path)
+        with self.assertRaises(ValueError):
+            ResultTable(self.path, ["a", "b"], capacity=1)
+
+    def test_command_line(self):
+        table = ResultTable(self.path, ["1L22-1"])
+        table.write("1L22-1", STATUS_OK, [2.39e7, 2.4e7, 0.08, 3333.6, 820.1, 1.7e9, 1.7e9])
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            main([self.path])
+        self.assertIn("1L22-1", out.getvalue())
+        self.assertIn("2.39e+07", out.getvalue())
+        table.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
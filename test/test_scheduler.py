@@ -0,0 +1,79 @@
+import unittest
+from unittest import TestCase
+from qlCalc.cryocavity import CavityTask
+from qlCalc.scheduler import RequestScheduler, staggered_start_times
+from types import SimpleNamespace
+import random
+
+
+class TestRequestScheduler(TestCase):
+
+    def test_pops_in_time_order(self):
+        s = RequestScheduler(slot_width=0)
+        for name, ts in (("c", 3.0), ("a", 1.0), ("b", 2.0), ("a2", 1.0)):
+            s.add(CavityTask(name, ts))
+        self.assertEqual("a", s.peek().cavity_name)
+        self.assertEqual(["a", "a2", "b"], [t.cavity_name for t in s.pop_due(2.5)])
+        self.assertEqual(1, len(s))
+
+    def test_coalesces_slots_and_is_never_early(self):
+        s = RequestScheduler(slot_width=0.5)
+        for i, ts in enumerate((10.01, 10.2, 10.49, 10.5, 10.7)):
+            s.add(CavityTask("c{}".format(i), ts))
+        self.assertAlmostEqual(10.5, s.next_release_time())
+        self.assertEqual([], s.pop_due(10.49))
+        self.assertEqual(["c0", "c1", "c2"], [t.cavity_name for t in s.pop_due(10.5)])
+        self.assertAlmostEqual(11.0, s.next_release_time())
+        self.assertEqual(2, len(s.pop_due(11.0)))
+        self.assertIsNone(s.next_release_time())
+
+    def test_discard(self):
+        s = RequestScheduler(slot_width=0)
+        for name, ts in (("a", 1.0), ("b", 2.0), ("a", 3.0), ("c", 4.0)):
+            s.add(CavityTask(name, ts))
+        self.assertEqual(2, s.discard("a"))
+        self.assertEqual(0, s.discard("a"))
+        self.assertEqual(["b", "c"], [t.cavity_name for t in s.pop_due(5.0)])
+
+    def test_stats(self):
+        s = RequestScheduler(slot_width=0)
+        s.add(CavityTask("a", 1.0))
+        s.add(CavityTask("b", 2.0))
+        s.pop_due(2.0)
+        stats = s.get_stats(reset=True)
+        self.assertEqual(2, stats["requests"])
+        self.assertEqual(1, stats["batches"])
+        self.assertAlmostEqual(0.5, stats["mean_lateness"])
+        self.assertAlmostEqual(1.0, stats["max_lateness"])
+        self.assertAlmostEqual(0.5, stats["jitter"])
+        self.assertEqual(0, s.get_stats()["requests"])
+
+    def test_negative_slot_width_rejected(self):
+        with self.assertRaises(ValueError):
+            RequestScheduler(slot_width=-1)
+
+
+class TestStaggeredStartTimes(TestCase):
+
+    def test_spread_evenly_per_ioc(self):
+        cav_dict = {"{}-{}".format(zone, i): SimpleNamespace(request_interval=1.0)
+                    for zone in ("1L22", "1L23", "2L04") for i in range(1, 9)}
+        times = staggered_start_times(cav_dict, 100.0, rng=random.Random(1))
+        self.assertEqual(set(cav_dict), set(times))
+        for zone in ("1L22", "1L23", "2L04"):
+            offsets = sorted(times[name] - 100.0 for name in cav_dict if name.startswith(zone))
+            # One cavity in each eighth of the interval
+            self.assertEqual(list(range(8)), [int(offset * 8) for offset in offsets])
+
+    def test_checkpointed_order_is_kept(self):
+        cav_dict = {"1L22-{}".format(i): SimpleNamespace(request_interval=2.0) for i in range(1, 5)}
+        saved = {"1L22-1": {"last_request": 51.5, "request_interval": 2.0},
+                 "1L22-3": {"last_request": 40.5, "request_interval": 2.0},
+                 "1L22-4": {"last_request": None, "request_interval": 2.0}}
+        times = staggered_start_times(cav_dict, 100.0, saved=saved, rng=random.Random(2))
+        self.assertEqual(["1L22-3", "1L22-1", "1L22-2", "1L22-4"], sorted(times, key=times.get))
+        self.assertTrue(all(100.0 <= t < 102.0 for t in times.values()))
+
+
+if __name__ == '__main__':
+    unittest.main()
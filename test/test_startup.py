@@ -0,0 +1,53 @@
+import unittest
+from unittest import TestCase
+from qlCalc.cryocavity import Cryocavity
+from test.helpers import FakePV, make_cavity
+import queue
+import threading
+
+
+class TestCreateCryocavities(TestCase):
+
+    def test_unconnected_cavities_are_left_out(self):
+        created = {}
+
+        def factory(pvname):
+            # Nothing for VL26-3 (RVQ3) connects
+            created[pvname] = FakePV(pvname, connected="RVQ3" not in pvname)
+            return created[pvname]
+
+        names = ("VL26-1", "VL26-2", "VL26-3")
+        cav_dict, failed = Cryocavity.create_cryocavities(names, update_queue=queue.Queue(),
+                                                          shutdown_event=threading.Event(), epics_prefix="test:",
+                                                          connection_timeout=0.05, pv_factory=factory)
+        self.assertEqual(["VL26-1", "VL26-2"], sorted(cav_dict))
+        self.assertEqual(["VL26-3"], list(failed))
+        self.assertIn("test:RVQ3GETDATA", failed["VL26-3"])
+        self.assertEqual(len(names) * len(Cryocavity.PV_SUFFIXES), len(created))
+        self.assertTrue(created["test:RVQ3GMESLQ"].disconnected)
+
+        cav = cav_dict["VL26-1"]
+        self.assertEqual("RVQ1", cav.epics_name)
+        self.assertIs(created["test:RVQ1GETDATA"], cav.GETDATA)
+        self.assertEqual([0], cav.GETDATA.puts)
+
+    def test_cavities_without_metadata_are_left_out(self):
+        names = ("VL26-1", "1L22-1")
+        with self.assertLogs("qlCalc.cryocavity", "ERROR"):
+            cav_dict, failed = Cryocavity.create_cryocavities(names, update_queue=queue.Queue(),
+                                                              shutdown_event=threading.Event(), connection_timeout=0.05,
+                                                              pv_factory=FakePV)
+        self.assertEqual(["VL26-1"], list(cav_dict))
+        self.assertEqual({"1L22-1": []}, failed)
+
+    def test_trigger_data_collection_batch(self):
+        cavs = [make_cavity("c{}".format(i), pvs=Cryocavity.create_pvs("c{}".format(i), pv_factory=FakePV))
+                for i in range(3)]
+        Cryocavity.trigger_data_collection_batch(cavs)
+        for cav in cavs:
+            self.assertEqual([0, 1], cav.GETDATA.puts)
+            self.assertIsNotNone(cav.last_request_timestamp)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,141 @@
+import unittest
+from unittest import TestCase
+from qlCalc.metadata import CavityMetadata
+from qlCalc.supervisor import Supervisor, ShardWorker, shard_cavities, linac_of, SHARD_BY_HASH, SHARD_BY_LINAC, \
+    SHARD_BY_ZONE
+from types import SimpleNamespace
+import json
+import os
+import signal
+import tempfile
+import time
+
+MACHINE = ["{}L{:02d}-{}".format(linac, zone, cav) for linac in (1, 2) for zone in range(2, 6) for cav in range(1, 9)]
+
+
+def wait_for(predicate, timeout=30.0):
+    end = time.time() + timeout
+    while time.time() < end:
+        if predicate():
+            return True
+        time.sleep(0.1)
+    return False
+
+
+class TestShardCavities(TestCase):
+
+    def test_zone(self):
+        shards = shard_cavities(MACHINE, 3, SHARD_BY_ZONE)
+        self.assertEqual([24, 24, 16], [len(s) for s in shards])
+        self.assertEqual(sorted(MACHINE), sorted(name for shard in shards for name in shard))
+        for shard in shards:
+            self.assertEqual(0, len(shard) % 8)
+
+    def test_linac(self):
+        self.assertEqual("1L", linac_of("1L22-3"))
+        shards = shard_cavities(MACHINE, 2, SHARD_BY_LINAC)
+        self.assertEqual([{"1L"}, {"2L"}], [{linac_of(name) for name in shard} for shard in shards])
+        # More workers than linacs splits by zone
+        self.assertEqual(4, len(shard_cavities(MACHINE, 4, SHARD_BY_LINAC)))
+
+    def test_hash_is_stable(self):
+        shards = shard_cavities(MACHINE, 5, SHARD_BY_HASH)
+        self.assertEqual(shards, shard_cavities(reversed(MACHINE), 5, SHARD_BY_HASH))
+        self.assertEqual(len(MACHINE), sum(len(s) for s in shards))
+
+    def test_empty_shards_are_left_out(self):
+        self.assertEqual(2, len(shard_cavities(MACHINE[:16], 4, SHARD_BY_ZONE)))
+
+    def test_rejects_bad_arguments(self):
+        with self.assertRaises(ValueError):
+            shard_cavities(MACHINE, 0)
+        with self.assertRaises(ValueError):
+            shard_cavities(MACHINE, 2, "cryomodule")
+
+
+class TestSupervisor(TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        names = ["1L02-1", "1L02-2", "1L03-1", "1L03-2"]
+        metadata = {name: CavityMetadata(name, "S{}".format(i), "c100", 0.7, 868.9) for i, name in enumerate(names)}
+        self.supervisor = Supervisor(names, num_workers=2, metadata=metadata, run_dir=self.dir.name,
+                                     overrides={"metrics_snapshot_interval": 0.2, "log_level": 40},
+                                     simulate={"latency": 0.01, "jitter": 0.002}, restart_delay=0.1, stale_after=20,
+                                     stop_timeout=10)
+
+    def tearDown(self):
+        self.supervisor.stop()
+        self.dir.cleanup()
+
+    def healthy(self):
+        health = self.supervisor.get_health()
+        return all(shard["healthy"] for shard in health)
+
+    def test_staleness_follows_progress(self):
+        sup = self.supervisor
+        worker = ShardWorker(0, ["1L02-1"])
+        worker.started = worker.progressed = 100.0
+        # Fresh snapshots of a stuck pipeline are no sign of life
+        self.assertFalse(sup._is_stale(worker, None, 110.0))
+        self.assertFalse(sup._is_stale(worker, {"time": 115.0, "progress": 0}, 115.0))
+        self.assertTrue(sup._is_stale(worker, {"time": 125.0, "progress": 0}, 125.0))
+        self.assertFalse(sup._is_stale(worker, {"time": 130.0, "progress": 8}, 130.0))
+        self.assertFalse(sup._is_stale(worker, {"time": 149.0, "progress": 8}, 149.0))
+        self.assertTrue(sup._is_stale(worker, {"time": 151.0, "progress": 8}, 151.0))
+        # Without snapshots there is nothing to judge by
+        sup.overrides["metrics_snapshot_file"] = None
+        self.assertFalse(sup._is_stale(worker, None, 1000.0))
+
+    def test_failures_reset_after_healthy_period(self):
+        sup = self.supervisor
+        sup.healthy_period = 10
+        worker = ShardWorker(0, ["1L02-1"])
+        worker.process = SimpleNamespace(pid=1, is_alive=lambda: True)
+        worker.started = worker.progressed = 100.0
+        worker.consecutive_failures = 3
+        sup.workers = [worker]
+        sup._running = True
+        try:
+            for now, progress, failures in ((101.0, 1, 3), (109.0, 2, 3), (111.0, 3, 0)):
+                with open(sup.metrics_file(0), "w") as f:
+                    json.dump({"time": now, "progress": progress}, f)
+                self.assertEqual([], sup.poll(now))
+                self.assertEqual(failures, worker.consecutive_failures)
+        finally:
+            sup._running = False
+            sup.workers = []
+
+    def test_restart_and_rebalance(self):
+        sup = self.supervisor
+        sup.start()
+        self.assertEqual([["1L02-1", "1L02-2"], ["1L03-1", "1L03-2"]], [w.cavity_names for w in sup.workers])
+        self.assertTrue(wait_for(self.healthy))
+        self.assertTrue(wait_for(lambda: all(s["update_rate"] for s in sup.get_health())))
+
+        # A crashed shard is restarted, the other keeps running
+        pids = [w.process.pid for w in sup.workers]
+        os.kill(pids[0], signal.SIGKILL)
+        self.assertTrue(wait_for(lambda: not sup.workers[0].process.is_alive(), 5))
+        self.assertEqual([], sup.poll())
+        self.assertTrue(wait_for(lambda: sup.poll() == [0], 5))
+        health = sup.get_health()
+        self.assertEqual((1, -signal.SIGKILL), (health[0]["restarts"], health[0]["exitcode"]))
+        self.assertNotEqual(pids[0], health[0]["pid"])
+        self.assertEqual(pids[1], health[1]["pid"])
+        self.assertTrue(wait_for(self.healthy))
+
+        # Rebalancing onto one worker replaces both shards
+        self.assertEqual([0], sup.rebalance(num_workers=1))
+        self.assertEqual(1, len(sup.workers))
+        self.assertEqual(4, sup.get_health()[0]["cavities"])
+        self.assertTrue(wait_for(self.healthy))
+        # Nothing changes, nothing restarts
+        self.assertEqual([], sup.rebalance())
+
+        sup.stop()
+        self.assertEqual(0, sup.workers[0].last_exitcode)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,117 @@
+import unittest
+from unittest import TestCase
+from qlCalc import batch
+from qlCalc.uncertainty import monte_carlo, UncertaintyEstimator, UNCERTAINTY_FIELDS
+from test.helpers import make_cavity
+import math
+import threading
+import time
+import numpy as np
+
+# Formula inputs (SI) of a typical C100 cavity with beam
+INPUTS = (17.794 * 0.7e6, 3396.0, 805.0, math.radians(0.67), 201.8e-6)
+RQ = 868.9
+
+
+class TestMonteCarlo(TestCase):
+
+    def test_no_uncertainty_gives_point_value(self):
+        out = monte_carlo(*INPUTS, RQ, sigma=(0, 0, 0, 0, 0), draws=10, rng=np.random.RandomState(1))
+        Q_lf = batch.calculate(*INPUTS, RQ, exact=False)["Q_lf"]
+        self.assertAlmostEqual(0.0, out["Q_lf_unc"][0] / Q_lf, places=12)
+        self.assertAlmostEqual(1.0, out["Q_lf_lo"][0] / Q_lf, places=12)
+        self.assertAlmostEqual(1.0, out["Q_lf_hi"][0] / Q_lf, places=12)
+        self.assertEqual(1.0, out["valid_fraction"][0])
+
+    def test_small_uncertainty_matches_linear_propagation(self):
+        # One cavity, only forward power uncertain.  Compare with the finite difference derivative.
+        sigma = 0.001 * INPUTS[1]
+        out = monte_carlo(*INPUTS, RQ, sigma=(0, sigma, 0, 0, 0), draws=20000, rng=np.random.RandomState(2))
+        h = 1e-3 * INPUTS[1]
+        up = batch.calculate(INPUTS[0], INPUTS[1] + h, *INPUTS[2:], RQ, exact=False)["Q_lf"]
+        down = batch.calculate(INPUTS[0], INPUTS[1] - h, *INPUTS[2:], RQ, exact=False)["Q_lf"]
+        linear = abs(up - down) / (2 * h) * sigma
+        self.assertAlmostEqual(1.0, out["Q_lf_unc"][0] / linear, delta=0.02)
+        # A 90% interval of a normal distribution spans 3.29 standard deviations
+        self.assertAlmostEqual(3.29, (out["Q_lf_hi"][0] - out["Q_lf_lo"][0]) / out["Q_lf_unc"][0], delta=0.1)
+
+    def test_many_cavities_in_chunks(self):
+        n = 50
+        rng = np.random.RandomState(3)
+        inputs = (rng.uniform(15, 19, n) * 0.7e6, rng.uniform(3e3, 4e3, n), rng.uniform(500, 1000, n),
+                  np.radians(rng.uniform(-5, 5, n)), rng.uniform(100e-6, 200e-6, n))
+        sigma = tuple(0.01 * np.abs(x) for x in inputs)
+        whole = monte_carlo(*inputs, RQ, sigma=sigma, draws=2000, rng=np.random.RandomState(4))
+        chunked = monte_carlo(*inputs, RQ, sigma=sigma, draws=2000, rng=np.random.RandomState(4), max_elements=5000)
+        for field in UNCERTAINTY_FIELDS:
+            self.assertEqual((n,), whole[field].shape)
+            # Different draws, same distributions
+            np.testing.assert_allclose(whole[field], chunked[field], rtol=0.15)
+        self.assertTrue(np.all(whole["Q_lf_lo"] < whole["Q_lf_hi"]))
+
+    def test_undefined_draws_are_left_out(self):
+        # Without beam the chain divides by zero for every draw
+        out = monte_carlo(INPUTS[0], INPUTS[1], INPUTS[2], INPUTS[3], [INPUTS[4], 0.0], RQ,
+                          sigma=(0, 0, 0, 0, 0), draws=10, rng=np.random.RandomState(5))
+        self.assertEqual([1.0, 0.0], list(out["valid_fraction"]))
+        for field in UNCERTAINTY_FIELDS:
+            self.assertTrue(math.isnan(out[field][1]))
+
+    def test_rejects_bad_arguments(self):
+        with self.assertRaises(ValueError):
+            monte_carlo(*INPUTS, RQ, sigma=(0, 0, 0, 0, 0), draws=1)
+        with self.assertRaises(ValueError):
+            monte_carlo(*INPUTS, RQ, sigma=(0, 0, 0, 0, 0), confidence=1.0)
+
+
+class TestUncertaintyEstimator(TestCase):
+
+    def make_cavity(self, name):
+        cav = make_cavity(name, RQ=RQ)
+        cav.update_formula_data(*INPUTS)
+        cav.run_calculations()
+        return cav
+
+    def test_estimate_sets_and_publishes(self):
+        published = []
+
+        class Publisher:
+            def submit(self, cav, attrs=None):
+                published.append((cav.cavity_name, attrs))
+
+        estimator = UncertaintyEstimator(threading.Event(), draws=1000, seed=6)
+        cavities = [self.make_cavity("c{}".format(i)) for i in range(3)]
+        for cav in cavities:
+            cav.uncertainty = estimator
+            cav.results_out = "epics"
+            cav.publisher = Publisher()
+            estimator.submit(cav)
+        estimator.submit(cavities[0])
+        self.assertEqual(3, estimator.estimate())
+        self.assertEqual(0, estimator.estimate())
+        self.assertEqual([("c0", UNCERTAINTY_FIELDS), ("c1", UNCERTAINTY_FIELDS), ("c2", UNCERTAINTY_FIELDS)],
+                         sorted(published))
+        for cav in cavities:
+            self.assertTrue(cav.Q_lf_lo < cav.Q_lf < cav.Q_lf_hi)
+            self.assertTrue(cav.Q_lr_lo < cav.Q_lr < cav.Q_lr_hi)
+            self.assertGreater(cav.Q_lf_unc, 0)
+
+        # Invalid results drop any queued inputs and invalidate the estimate
+        estimator.submit(cavities[1])
+        cavities[1].publish_invalid_results("Data request timed out")
+        self.assertEqual(0, estimator.estimate())
+        self.assertTrue(math.isnan(cavities[1].Q_lf_unc))
+        stats = estimator.get_stats()
+        self.assertEqual((1, 3), (stats["passes"], stats["estimated"]))
+
+    def test_machine_pass_fits_in_update_cycle(self):
+        estimator = UncertaintyEstimator(threading.Event(), draws=2000, seed=7)
+        for i in range(400):
+            estimator.submit(self.make_cavity("c{}".format(i)))
+        start = time.time()
+        estimator.estimate()
+        self.assertLess(time.time() - start, 1.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
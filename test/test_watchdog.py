@@ -0,0 +1,90 @@
+import unittest
+from unittest import TestCase
+from qlCalc.watchdog import RequestWatchdog
+from test.helpers import FakePV, make_cavity
+import math
+import threading
+import time
+
+
+def make_watched_cavity(name):
+    cav = make_cavity(name, pvs={"GETDATA": FakePV("R1Q1GETDATA")})
+    cav.exported = 0
+
+    def export_results(out="stdout"):
+        cav.exported += 1
+    cav.export_results = export_results
+    return cav
+
+
+class TestRequestWatchdog(TestCase):
+
+    def test_completed_requests_do_not_expire(self):
+        wd = RequestWatchdog({}, threading.Event(), timeout=5)
+        wd.arm("a", 100.0)
+        wd.arm("b", 101.0)
+        wd.complete("a")
+        self.assertEqual([], wd.pop_expired(104.9))
+        self.assertEqual(["b"], wd.pop_expired(106.0))
+        self.assertEqual({"b": 1}, wd.get_stats()["timed_out_cavities"])
+
+    def test_new_request_supersedes_old(self):
+        wd = RequestWatchdog({}, threading.Event(), timeout=5)
+        wd.arm("a", 100.0)
+        wd.arm("a", 103.0)
+        self.assertEqual([], wd.pop_expired(106.0))
+        self.assertEqual(["a"], wd.pop_expired(108.0))
+
+    def test_backoff(self):
+        wd = RequestWatchdog({}, threading.Event(), timeout=5, backoff_factor=2, max_timeout=12)
+        self.assertEqual(5, wd.timeout_for("a"))
+        wd.arm("a", 0.0)
+        wd.pop_expired(5.0)
+        self.assertEqual(10, wd.timeout_for("a"))
+        wd.arm("a", 5.0)
+        wd.pop_expired(15.0)
+        self.assertEqual(12, wd.timeout_for("a"))
+        wd.complete("a")
+        self.assertEqual(5, wd.timeout_for("a"))
+        self.assertEqual(2, wd.timeout_counts["a"])
+
+    def test_timeout_publishes_nan_and_retriggers(self):
+        event = threading.Event()
+        cav = make_watched_cavity("c1")
+        wd = RequestWatchdog({"c1": cav}, event, timeout=0.05, max_timeout=0.05)
+        cav.watchdog = wd
+        thread = threading.Thread(target=wd.run, kwargs={"max_sleep": 0.5})
+        thread.start()
+        try:
+            cav.request_new_data()
+            time.sleep(0.3)
+        finally:
+            event.set()
+            thread.join()
+        self.assertGreaterEqual(wd.timeout_counts["c1"], 2)
+        self.assertTrue(math.isnan(cav.Q_lf))
+        self.assertGreaterEqual(cav.exported, 2)
+        # Initial request plus at least one 0 -> 1 re-trigger
+        self.assertEqual([1, 0, 1], cav.GETDATA.puts[:3])
+
+    def test_data_posted_completes_request(self):
+        cav = make_watched_cavity("c1")
+        wd = RequestWatchdog({"c1": cav}, threading.Event(), timeout=5)
+        cav.watchdog = wd
+
+        class Queue:
+            def put(self, task):
+                pass
+
+            def qsize(self):
+                return 0
+
+        cav.update_queue = Queue()
+        cav.request_new_data()
+        self.assertEqual(1, wd.get_stats()["outstanding"])
+        cav.on_GETDATA_change(pvname="R1Q1GETDATA", value=2)
+        self.assertEqual(0, wd.get_stats()["outstanding"])
+
+
+if __name__ == '__main__':
+    unittest.main()
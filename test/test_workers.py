@@ -0,0 +1,107 @@
+import unittest
+from unittest import TestCase
+from qlCalc.cryocavity import CavityTask
+from qlCalc.workers import ProcessingPool
+import queue
+import threading
+import time
+
+
+class RecordingCavity:
+    """Stand-in for a Cryocavity that records when its data was processed"""
+
+    def __init__(self, name, log, delay=0.0):
+        self.cavity_name = name
+        self.log = log
+        self.delay = delay
+        self.active = 0
+        self.max_active = 0
+        self.lock = threading.Lock()
+
+    def process_new_data(self):
+        with self.lock:
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        time.sleep(self.delay)
+        self.log.append((self.cavity_name, time.time()))
+        with self.lock:
+            self.active -= 1
+
+
+class TestProcessingPool(TestCase):
+
+    def run_pool(self, cav_dict, tasks, num_workers=4):
+        update_queue = queue.Queue()
+        req_queue = queue.Queue()
+        event = threading.Event()
+        pool = ProcessingPool(cav_dict, update_queue, req_queue, event, num_workers=num_workers, poll_interval=0.05)
+        for task in tasks:
+            update_queue.put(task)
+        pool.start()
+        event.set()
+        pool.join()
+        return pool, req_queue
+
+    def test_one_task_per_cavity_in_order(self):
+        log = []
+        cav = RecordingCavity("c1", log, delay=0.01)
+        tasks = [CavityTask("c1", i) for i in range(10)]
+        pool, req_queue = self.run_pool({"c1": cav}, tasks)
+        self.assertEqual(1, cav.max_active)
+        out = [req_queue.get_nowait().request_timestamp for _ in range(10)]
+        self.assertEqual(list(range(10)), out)
+
+    def test_slow_cavity_does_not_block_others(self):
+        log = []
+        cav_dict = {"slow": RecordingCavity("slow", log, delay=0.5)}
+        for i in range(20):
+            cav_dict["c{}".format(i)] = RecordingCavity("c{}".format(i), log)
+        tasks = [CavityTask(name, 0) for name in cav_dict]
+        pool, req_queue = self.run_pool(cav_dict, tasks)
+        # Everything else finished before the slow cavity did
+        self.assertEqual("slow", log[-1][0])
+        self.assertEqual(21, req_queue.qsize())
+
+        stats = pool.get_stats()
+        self.assertEqual(21, stats["processed"])
+        self.assertEqual(0, stats["in_flight"])
+        self.assertGreater(stats["throughput"], 0)
+
+    def test_failure_keeps_cycle_alive(self):
+        class Broken:
+            def process_new_data(self):
+                raise ValueError("math domain error")
+
+        pool, req_queue = self.run_pool({"bad": Broken()}, [CavityTask("bad", 0)], num_workers=1)
+        self.assertEqual(1, pool.get_stats()["failed"])
+        self.assertEqual("bad", req_queue.get_nowait().cavity_name)
+
+    def test_removed_cavity_is_drained_and_dropped(self):
+        log = []
+        cav_dict = {"c1": RecordingCavity("c1", log, delay=0.2)}
+        update_queue = queue.Queue()
+        req_queue = queue.Queue()
+        event = threading.Event()
+        pool = ProcessingPool(cav_dict, update_queue, req_queue, event, num_workers=2, poll_interval=0.05)
+        pool.start()
+        update_queue.put(CavityTask("c1", 0))
+        time.sleep(0.05)
+        # Removed while being processed.  Neither the task being processed nor the next one is rescheduled.
+        del cav_dict["c1"]
+        update_queue.put(CavityTask("c1", 1))
+        self.assertFalse(pool.drain("c1", timeout=0.01))
+        self.assertTrue(pool.drain("c1", timeout=1))
+        event.set()
+        pool.join()
+        self.assertEqual(1, len(log))
+        self.assertEqual(0, req_queue.qsize())
+
+    def test_stats_reset(self):
+        log = []
+        pool, _ = self.run_pool({"c1": RecordingCavity("c1", log)}, [CavityTask("c1", 0)])
+        self.assertEqual(1, pool.get_stats(reset=True)["processed"])
+        self.assertEqual(0, pool.get_stats()["processed"])
+
+
+if __name__ == '__main__':
+    unittest.main()